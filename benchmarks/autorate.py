@@ -0,0 +1,290 @@
+"""Autorate benchmark: throughput and queueing delay on a link of varying capacity.
+
+Builds client, ISP and server network namespaces joined by veth pairs, so it
+needs root but leaves the host's interfaces alone:
+
+    sudo python benchmarks/autorate.py --capacities 20 8 30 > autorate.json
+
+The ISP forwards between the client (WAN0) and the server through a
+bottleneck with a deep buffer, the way a modem or an LTE link does. Its
+capacity steps through ``--capacities`` (Mbit/s), one phase each. The
+bottleneck is netem (rate plus ``--delay`` ms) where the kernel has it, and
+otherwise tbf with a 200ms buffer and no added delay; the output says which.
+
+Bulk TCP flows saturate one direction while WAN0 is either limited to a fixed
+rate (the link's nominal capacity, as a static limit would be) or driven by
+autorate. For every phase the report has the throughput as a fraction of
+the capacity and percentiles of the queueing delay seen by pings.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from netthrottle.autorate import AutoRate, LatencyProbe, RateBounds  # noqa: E402
+from netthrottle.backends import get_backend  # noqa: E402
+from netthrottle.core import ThrottleCore  # noqa: E402
+from netthrottle.policy import FIFO, QUEUES  # noqa: E402
+from netthrottle.sampler import percentile  # noqa: E402
+
+IFACE = 'wan0'
+CLIENT = '10.77.1.2'
+SERVER = '10.77.2.2'
+PORT = 5202
+TBF_BUFFER_MS = 200
+
+# Sink: accept connections and discard what they deliver
+SINK = """
+import socket, sys, threading
+listener = socket.create_server((sys.argv[1], int(sys.argv[2])))
+def drain(conn):
+    with conn:
+        while conn.recv(65536):
+            pass
+while True:
+    threading.Thread(target=drain, args=(listener.accept()[0],), daemon=True).start()
+"""
+
+# Sender: argv[3] parallel flows to the sink for argv[4] seconds
+SENDER = """
+import socket, sys, threading, time
+deadline = time.monotonic() + float(sys.argv[4])
+def send():
+    sock = socket.create_connection((sys.argv[1], int(sys.argv[2])))
+    payload = b'x' * 65536
+    while time.monotonic() < deadline:
+        sock.sendall(payload)
+    sock.close()
+flows = [threading.Thread(target=send) for _ in range(int(sys.argv[3]))]
+for flow in flows:
+    flow.start()
+for flow in flows:
+    flow.join()
+"""
+
+
+def sh(*args):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def has_qdisc(kind):
+    """Whether the kernel can instantiate qdisc ``kind`` (tried on lo in a scratch ns)"""
+    name = f'ntbench-probe-{os.getpid()}'
+    sh('ip', 'netns', 'add', name)
+    try:
+        args = ['ip', 'netns', 'exec', name, 'tc', 'qdisc', 'add', 'dev', 'lo', 'root', kind]
+        return subprocess.run(args, capture_output=True).returncode == 0
+    finally:
+        sh('ip', 'netns', 'del', name)
+
+
+def in_netns(ns):
+    """Command prefix running in netns ``ns``, or in ours for None"""
+    return ['ip', 'netns', 'exec', ns] if ns else []
+
+
+def enter_namespaces(name, isp, server):
+    """Create netns ``name`` (joined), ``isp`` and ``server``, routed client-isp-server"""
+    for ns in (name, isp, server):
+        sh('ip', 'netns', 'add', ns)
+    with open(f'/run/netns/{name}') as f:
+        os.setns(f.fileno(), os.CLONE_NEWNET)
+    # The Sampler reads /sys/class/net, which shows the namespace sysfs was
+    # mounted in: remount it privately, as "ip netns exec" does
+    os.unshare(os.CLONE_NEWNS)
+    sh('mount', '--make-rprivate', '/')
+    sh('mount', '-t', 'sysfs', 'sysfs', '/sys')
+    sh('ip', 'link', 'add', IFACE, 'type', 'veth', 'peer', 'name', 'isp0', 'netns', isp)
+    sh('ip', '-n', isp, 'link', 'add', 'core0', 'type', 'veth', 'peer', 'name', 'srv0',
+       'netns', server)
+    for ns, dev, address in ((name, IFACE, f'{CLIENT}/24'), (isp, 'isp0', '10.77.1.1/24'),
+                             (isp, 'core0', '10.77.2.1/24'), (server, 'srv0', f'{SERVER}/24')):
+        sh('ip', '-n', ns, 'link', 'set', 'lo', 'up')
+        sh('ip', '-n', ns, 'addr', 'add', address, 'dev', dev)
+        sh('ip', '-n', ns, 'link', 'set', dev, 'up')
+    sh('ip', 'route', 'add', 'default', 'via', '10.77.1.1')
+    sh('ip', '-n', server, 'route', 'add', 'default', 'via', '10.77.2.1')
+    sh('ip', 'netns', 'exec', isp, 'sysctl', '-qw', 'net.ipv4.ip_forward=1')
+
+
+def bottleneck(isp, dev, capacity_mbit, emulator, delay_ms, change=False):
+    """Install (or change) the ISP's bottleneck on ``dev``"""
+    verb = 'change' if change else 'add'
+    if emulator == 'netem':
+        # A deep buffer: a few hundred ms at the capacity
+        limit = max(100, capacity_mbit * 1000 * TBF_BUFFER_MS // (8 * 1500))
+        options = ['netem', 'rate', f'{capacity_mbit}mbit', 'delay', f'{delay_ms}ms',
+                   'limit', str(limit)]
+    else:
+        options = ['tbf', 'rate', f'{capacity_mbit}mbit', 'burst', '32kb',
+                   'latency', f'{TBF_BUFFER_MS}ms']
+    sh('ip', 'netns', 'exec', isp, 'tc', 'qdisc', verb, 'dev', dev, 'root', *options)
+
+
+def phase_summary(capacity, samples):
+    """Throughput and delay of one phase, ignoring its first quarter (the transition)"""
+    samples = samples[len(samples) // 4:]
+    load = sorted(sample['load'] for sample in samples)
+    delays = sorted(sample['delay'] for sample in samples if sample['delay'] is not None)
+    # What remains once the time spent in our own queue is taken out: the
+    # standing queue at the bottleneck, which the shaper is there to prevent
+    path = sorted(max(0.0, sample['delay'] - sample['own_queue'])
+                  for sample in samples if sample['delay'] is not None)
+    throughput = sum(load) / len(load) / 1000 if load else 0
+    return {
+        'capacity_mbit': capacity,
+        'throughput_mbit': round(throughput, 2),
+        'utilisation': round(throughput / capacity, 3),
+        'delay_p50_ms': round(percentile(delays, 50), 2) if delays else None,
+        'delay_p95_ms': round(percentile(delays, 95), 2) if delays else None,
+        'bottleneck_delay_p50_ms': round(percentile(path, 50), 2) if path else None,
+        'bottleneck_delay_p95_ms': round(percentile(path, 95), 2) if path else None,
+        'lost_probes': len(samples) - len(delays),
+        'final_rate_mbit': samples[-1]['rate'] / 1000 if samples and samples[-1]['rate'] else None,
+    }
+
+
+def bench(core, mode, args, isp, server, base_rtt):
+    """One run over every capacity phase, with a static limit or autorate"""
+    direction = args.direction
+    bounds = RateBounds(*args.range) if args.range else RateBounds.for_capacity(
+        max(args.capacities) * 1000)
+    sink, source, target = ((server, None, SERVER) if direction == 'download'
+                            else (None, server, CLIENT))
+    # Download limits shape what WAN0 sends (through the ISP's core0), upload
+    # limits what it receives (through isp0)
+    link = 'core0' if direction == 'download' else 'isp0'
+    key = 'download_kbps' if direction == 'download' else 'upload_kbps'
+    bottleneck(isp, link, args.capacities[0], args.emulator, args.delay, change=True)
+    core.clear_limits(IFACE)
+
+    samples = []
+    current = {'phase': 0}
+
+    def record(step):
+        load = step['load_kbps'][direction]
+        delay = None if step['rtt_ms'] is None else step['rtt_ms'] - base_rtt
+        samples.append({'phase': current['phase'], 'load': load, 'delay': delay,
+                        'rate': step['rate_kbps'].get(direction),
+                        'own_queue': step.get('own_queue_ms')})
+
+    stop = threading.Event()
+    # A static limit is an autorate range that cannot move: same measurements
+    if mode == 'static':
+        bounds = RateBounds(bounds.maximum, bounds.maximum, bounds.maximum)
+    core.set_limits(IFACE, **{key: bounds.base}, queue=args.queue)
+    controller = AutoRate(core, IFACE, target_ms=args.target, interval=args.interval,
+                          reflectors=[SERVER], **{direction: bounds})
+    worker = threading.Thread(target=controller.run, args=(stop, record))
+    duration = args.phase * len(args.capacities)
+    listener = subprocess.Popen([*in_netns(sink), sys.executable, '-c', SINK, target, str(PORT)])
+    try:
+        time.sleep(0.5)
+        sender = subprocess.Popen([*in_netns(source), sys.executable, '-c', SENDER, target,
+                                   str(PORT), str(args.flows), str(duration)])
+        worker.start()
+        for phase, capacity in enumerate(args.capacities):
+            if phase:
+                bottleneck(isp, link, capacity, args.emulator, args.delay, change=True)
+            current['phase'] = phase
+            time.sleep(args.phase)
+        stop.set()
+        worker.join()
+        sender.wait()
+    finally:
+        listener.kill()
+        listener.wait()
+        controller.close()
+        core.clear_limits(IFACE)
+    result = {
+        'mode': mode,
+        'direction': direction,
+        'range_mbit': [bounds.minimum / 1000, bounds.base / 1000, bounds.maximum / 1000],
+        'phases': [phase_summary(capacity, [s for s in samples if s['phase'] == phase])
+                   for phase, capacity in enumerate(args.capacities)],
+    }
+    if args.trace:
+        result['trace'] = samples
+    return result
+
+
+def idle_rtt(count=20):
+    """Lowest RTT to the server with no load, in ms"""
+    probe = LatencyProbe([SERVER], IFACE)
+    try:
+        rtts = [rtt for rtt in (probe.rtt() for _ in range(count)) if rtt is not None]
+    finally:
+        probe.close()
+    if not rtts:
+        raise RuntimeError("The server does not answer pings")
+    return min(rtts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure autorate on a link of varying capacity")
+    parser.add_argument('--capacities', type=int, nargs='+', default=[20, 8, 30],
+                        help="bottleneck capacity of each phase in Mbit/s")
+    parser.add_argument('--phase', type=float, default=15.0, help="seconds per phase")
+    parser.add_argument('--direction', choices=('download', 'upload'), default='download',
+                        help="which limit of WAN0 is under test")
+    parser.add_argument('--range', type=int, nargs=3, metavar=('MIN', 'BASE', 'MAX'),
+                        help="autorate range in kbit/s (default from the largest capacity)")
+    parser.add_argument('--modes', nargs='+', default=['static', 'autorate'],
+                        choices=('static', 'autorate'))
+    parser.add_argument('--target', type=float, default=15.0, help="autorate delay target in ms")
+    parser.add_argument('--interval', type=float, default=0.5)
+    parser.add_argument('--flows', type=int, default=4, help="parallel TCP flows")
+    parser.add_argument('--delay', type=int, default=20, help="netem one-way delay in ms")
+    parser.add_argument('--queue', choices=QUEUES,
+                        help="queue behind the limit (default fq_codel where available)")
+    parser.add_argument('--backend', default='netlink')
+    parser.add_argument('--trace', action='store_true', help="include every tick's sample")
+    args = parser.parse_args(argv)
+
+    if os.geteuid() != 0:
+        print("This benchmark needs root (it creates network namespaces)", file=sys.stderr)
+        return 1
+
+    args.emulator = 'netem' if has_qdisc('netem') else 'tbf'
+    args.queue = args.queue or ('fq_codel' if has_qdisc('fq_codel') else FIFO)
+    namespace = f'ntbench-autorate-{os.getpid()}'
+    isp, server = f'{namespace}-isp', f'{namespace}-srv'
+    enter_namespaces(namespace, isp, server)
+    core = ThrottleCore(backend=get_backend(args.backend), journal=False)
+    try:
+        for link in ('core0', 'isp0'):
+            bottleneck(isp, link, max(args.capacities), args.emulator, args.delay)
+        base_rtt = idle_rtt()
+        results = {
+            'benchmark': 'autorate',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'backend': args.backend,
+            'emulator': args.emulator,
+            'added_delay_ms': args.delay if args.emulator == 'netem' else 0,
+            'base_rtt_ms': round(base_rtt, 3),
+            'phase_seconds': args.phase,
+            'target_ms': args.target,
+            'queue': args.queue,
+            'runs': [bench(core, mode, args, isp, server, base_rtt) for mode in args.modes],
+        }
+    finally:
+        core.close()
+        for name in (namespace, isp, server):
+            subprocess.run(['ip', 'netns', 'del', name], capture_output=True)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""Upload limiting benchmark: accuracy and CPU cost of each ingress mode.
+
+Runs between two private network namespaces joined by a veth pair, so it
+needs root but leaves the host's interfaces alone:
+
+    sudo python benchmarks/ingress.py --rates 10 100 1000 > ingress.json
+
+A TCP sender in the peer namespace pushes data into the benchmark interface
+over IPv4 and IPv6 while its upload limit is enforced by each ingress mode
+(and by nothing, as a baseline). For every run it reports the goodput as a
+fraction of the limit and the CPU time the whole host spent per Gbit
+received, including the time in softirq context where the shaping happens.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from netthrottle.backends import get_backend  # noqa: E402
+from netthrottle.core import ThrottleCore  # noqa: E402
+from netthrottle.policy import INGRESS_MODES  # noqa: E402
+
+IFACE = 'bench0'
+PEER = 'bench1'
+ADDRESSES = {
+    'ipv4': (socket.AF_INET, '192.0.2.1', '192.0.2.2', 24),
+    'ipv6': (socket.AF_INET6, 'fd00:be::1', 'fd00:be::2', 64),
+}
+PORT = 5201
+CHUNK = 64 * 1024
+
+# Runs in the peer namespace: send to argv[1] until argv[2] seconds have passed
+SENDER = """
+import socket, sys, time
+sock = socket.create_connection((sys.argv[1], int(sys.argv[2])))
+payload = b'x' * int(sys.argv[4])
+deadline = time.monotonic() + float(sys.argv[3])
+while time.monotonic() < deadline:
+    sock.sendall(payload)
+sock.close()
+"""
+
+
+def sh(*args):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def enter_namespaces(name, peer):
+    """Create netns ``name`` (joined) and ``peer``, linked by IFACE and PEER"""
+    sh('ip', 'netns', 'add', name)
+    sh('ip', 'netns', 'add', peer)
+    with open(f'/run/netns/{name}') as f:
+        os.setns(f.fileno(), os.CLONE_NEWNET)
+    sh('ip', 'link', 'add', IFACE, 'type', 'veth', 'peer', 'name', PEER, 'netns', peer)
+    sh('ip', 'link', 'set', 'lo', 'up')
+    sh('ip', 'link', 'set', IFACE, 'up')
+    sh('ip', '-n', peer, 'link', 'set', PEER, 'up')
+    for _, local, remote, prefix in ADDRESSES.values():
+        sh('ip', 'addr', 'add', f'{local}/{prefix}', 'dev', IFACE, 'nodad')
+        sh('ip', '-n', peer, 'addr', 'add', f'{remote}/{prefix}', 'dev', PEER, 'nodad')
+
+
+def cpu_times():
+    """(busy, softirq) seconds summed over all CPUs, from /proc/stat"""
+    with open('/proc/stat') as f:
+        fields = [int(value) for value in f.readline().split()[1:]]
+    ticks = os.sysconf('SC_CLK_TCK')
+    idle = fields[3] + fields[4]
+    return (sum(fields[:8]) - idle) / ticks, fields[6] / ticks
+
+
+def receive(listener, counters):
+    """Count what one connection delivers, timing it from accept() to EOF"""
+    conn, _ = listener.accept()
+    counters['cpu'], counters['started'] = cpu_times(), time.perf_counter()
+    received = 0
+    with conn:
+        while True:
+            data = conn.recv(CHUNK)
+            if not data:
+                break
+            received += len(data)
+    busy, softirq = cpu_times()
+    counters.update(bytes=received, seconds=time.perf_counter() - counters['started'],
+                    busy=busy - counters['cpu'][0], softirq=softirq - counters['cpu'][1])
+
+
+def transfer(family, peer, duration):
+    """{'bytes', 'seconds', 'busy', 'softirq'} of one TCP upload (CPU in seconds)"""
+    af, local, _, _ = ADDRESSES[family]
+    listener = socket.socket(af, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((local, PORT))
+    listener.listen(1)
+    counters = {}
+    receiver = threading.Thread(target=receive, args=(listener, counters))
+    receiver.start()
+    try:
+        subprocess.run(['ip', 'netns', 'exec', peer, sys.executable, '-c', SENDER, local,
+                        str(PORT), str(duration), str(CHUNK)], check=True)
+        receiver.join()
+    finally:
+        listener.close()
+    return counters
+
+
+def bench_mode(core, mode, rate_mbit, family, peer, duration):
+    result = {'mode': mode, 'rate_mbit': rate_mbit, 'family': family}
+    try:
+        if mode == 'none':
+            core.clear_limits(IFACE)
+        else:
+            core.set_limits(IFACE, upload_kbps=rate_mbit * 1000, ingress_mode=mode)
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    counters = transfer(family, peer, duration)
+    gbit = counters['bytes'] * 8 / 1e9
+    goodput = gbit * 1000 / counters['seconds']
+    result.update({
+        'goodput_mbit': round(goodput, 2),
+        'accuracy': None if mode == 'none' else round(goodput / rate_mbit, 3),
+        'cpu_s_per_gbit': round(counters['busy'] / gbit, 3) if gbit else None,
+        'softirq_s_per_gbit': round(counters['softirq'] / gbit, 3) if gbit else None,
+    })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure upload limiting accuracy and CPU cost")
+    parser.add_argument('--rates', type=int, nargs='+', default=[10, 100, 1000],
+                        help="upload limits in Mbit/s")
+    parser.add_argument('--modes', nargs='+', default=['none', *INGRESS_MODES])
+    parser.add_argument('--families', nargs='+', default=list(ADDRESSES), choices=list(ADDRESSES))
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per transfer")
+    parser.add_argument('--backend', default='netlink')
+    args = parser.parse_args(argv)
+
+    if os.geteuid() != 0:
+        print("This benchmark needs root (it creates network namespaces)", file=sys.stderr)
+        return 1
+
+    namespace = f'ntbench-ingress-{os.getpid()}'
+    peer = f'{namespace}-peer'
+    enter_namespaces(namespace, peer)
+    core = ThrottleCore(backend=get_backend(args.backend), journal=False)
+    try:
+        results = {
+            'benchmark': 'ingress',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'backend': args.backend,
+            'duration': args.duration,
+            'runs': [bench_mode(core, mode, rate, family, peer, args.duration)
+                     for rate in args.rates for mode in args.modes for family in args.families],
+        }
+        core.clear_limits(IFACE)
+    finally:
+        core.close()
+        for name in (namespace, peer):
+            subprocess.run(['ip', 'netns', 'del', name], capture_output=True)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Proxy benchmark: throughput, rate accuracy and CPU cost of the throttling proxy.
+
+Runs over loopback, so it needs no privileges:
+
+    python benchmarks/proxy.py --rates 0 100 1000 5000 > proxy.json
+
+A sender process pushes data through a SOCKS5 connection to a sink process,
+with the proxy running on a thread of this one. The proxy relays either with
+os.splice (the default on Linux) or by copying through Python. For every
+rate (Mbit/s, 0 for unlimited) and relay mode the report has the goodput,
+its accuracy against the limit, and the CPU time of the proxy's thread per
+Gbit relayed, kernel time included.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from netthrottle.proxy import SPLICE, ProxyLimits, ThrottleProxy  # noqa: E402
+
+# Runs in a child: count what arrives on an ephemeral port, print the port,
+# then "bytes seconds" for the window starting argv[1] seconds after the first byte
+SINK = """
+import socket, sys, time
+warmup = float(sys.argv[1])
+listener = socket.create_server(('127.0.0.1', 0))
+print(listener.getsockname()[1], flush=True)
+conn, _ = listener.accept()
+buffer = bytearray(1 << 20)
+received = start_bytes = 0
+start = None
+first = time.monotonic()
+while True:
+    n = conn.recv_into(buffer, len(buffer), socket.MSG_TRUNC)
+    if not n:
+        break
+    received += n
+    if start is None and time.monotonic() - first >= warmup:
+        start, start_bytes = time.monotonic(), received
+end = time.monotonic()
+print(received - start_bytes, end - start if start else 0.0, flush=True)
+"""
+
+# Runs in a child: SOCKS5 CONNECT through argv[1] to argv[2] and send for argv[3] seconds
+SENDER = """
+import os, socket, struct, sys, time
+proxy_port, port, duration = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+sock = socket.create_connection(('127.0.0.1', proxy_port))
+sock.sendall(b'\\x05\\x01\\x00')
+assert sock.recv(2) == b'\\x05\\x00'
+sock.sendall(b'\\x05\\x01\\x00\\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', port))
+assert sock.recv(10)[1] == 0
+fd = os.memfd_create('sender')
+os.ftruncate(fd, 4 << 20)
+deadline = time.monotonic() + duration
+while time.monotonic() < deadline:
+    os.sendfile(sock.fileno(), fd, 0, 4 << 20)
+sock.close()
+"""
+
+
+def thread_cpu(thread):
+    """CPU seconds used so far by ``thread``, kernel time included"""
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+
+def run(rate_mbit, splice, duration, warmup):
+    limits = ProxyLimits(download_kbps=rate_mbit * 1000 or None,
+                         upload_kbps=rate_mbit * 1000 or None)
+    proxy = ThrottleProxy(limits, '127.0.0.1', 0, splice=splice)
+    proxy.start()
+    sink = subprocess.Popen([sys.executable, '-c', SINK, str(warmup)], stdout=subprocess.PIPE,
+                            text=True)
+    try:
+        port = int(sink.stdout.readline())
+        cpu = thread_cpu(proxy.thread)
+        subprocess.run([sys.executable, '-c', SENDER, str(proxy.listening[0][1]), str(port),
+                        str(duration + warmup)], check=True)
+        cpu = thread_cpu(proxy.thread) - cpu
+        received, seconds = sink.stdout.readline().split()
+    finally:
+        sink.wait()
+        proxy.stop()
+    gbit = int(received) * 8 / 1e9
+    goodput = gbit * 1000 / float(seconds) if float(seconds) else 0.0
+    return {
+        'relay': 'splice' if splice else 'copy',
+        'rate_mbit': rate_mbit or None,
+        'goodput_mbit': round(goodput, 1),
+        'accuracy': round(goodput / rate_mbit, 4) if rate_mbit else None,
+        # Over the whole transfer, warm-up included
+        'proxy_cpu_s_per_gbit': round(cpu / (proxy.bytes['upload'] * 8 / 1e9), 4)
+        if proxy.bytes['upload'] else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the throttling proxy")
+    parser.add_argument('--rates', type=int, nargs='+', default=[0, 100, 1000, 5000],
+                        help="limits in Mbit/s, 0 for none")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds measured per run")
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--relays', nargs='+', choices=('splice', 'copy'),
+                        default=['splice', 'copy'] if SPLICE else ['copy'])
+    args = parser.parse_args(argv)
+
+    results = {
+        'benchmark': 'proxy',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'duration': args.duration,
+        'runs': [run(rate, relay == 'splice', args.duration, args.warmup)
+                 for rate in args.rates for relay in args.relays],
+    }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
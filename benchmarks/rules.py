@@ -0,0 +1,212 @@
+"""Rule engine benchmark: apply time and per-packet classification cost.
+
+Runs in a private network namespace on a veth pair, so it needs root but
+leaves the host's interfaces alone:
+
+    sudo python benchmarks/rules.py --rules 100 1000 10000 > rules.json
+
+For every rule count and backend it reports the time to install the rules on
+a bare interface, to re-plan them when nothing changed and to change one
+rule. The per-packet cost is the CPU time of sending UDP datagrams through
+the egress qdisc to a destination that matches a host rule and to one that
+matches nothing, next to the same number of u32 filters in a linear chain.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from netthrottle.backends import get_backend  # noqa: E402
+from netthrottle.core import ThrottleCore  # noqa: E402
+from netthrottle.policy import Rule  # noqa: E402
+from netthrottle.reconcile import Step  # noqa: E402
+from netthrottle.tc import u32_handle  # noqa: E402
+
+IFACE = 'bench0'
+GATEWAY = '192.0.2.2'
+RULE_KBPS = 1000000
+# Hosts come from 10.0.0.0/10 and subnets from 10.64.0.0/10; this matches neither
+UNMATCHED = '10.200.0.1'
+# Source and destination port of probe packets; port rules never use it
+PROBE_PORT = 9
+LINEAR_NODES_PER_TABLE = 4000
+
+
+def sh(*args):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def enter_namespace(name):
+    """Create netns ``name`` with a veth pair routing 10.0.0.0/8 out of IFACE, and join it"""
+    sh('ip', 'netns', 'add', name)
+    with open(f'/run/netns/{name}') as f:
+        os.setns(f.fileno(), os.CLONE_NEWNET)
+    sh('ip', 'link', 'add', IFACE, 'type', 'veth', 'peer', 'name', 'bench1')
+    for dev in ('lo', IFACE, 'bench1'):
+        sh('ip', 'link', 'set', dev, 'up')
+    sh('ip', 'addr', 'add', '192.0.2.1/24', 'dev', IFACE)
+    sh('ip', 'neigh', 'replace', GATEWAY, 'lladdr', '02:00:00:00:00:02', 'dev', IFACE,
+       'nud', 'permanent')
+    sh('ip', 'route', 'add', '10.0.0.0/8', 'via', GATEWAY)
+
+
+def make_rules(count, seed=0):
+    """70% hosts, 20% subnets, 10% ports, all at RULE_KBPS"""
+    rng = random.Random(seed)
+    hosts = rng.sample(range(1, 1 << 22), count * 7 // 10)
+    subnets = set()
+    while len(subnets) < count * 2 // 10:
+        prefix = rng.choice((16, 20, 24, 28))
+        address = (10 << 24) | (1 << 22) | rng.getrandbits(22)
+        subnets.add((address >> (32 - prefix) << (32 - prefix), prefix))
+    ports = rng.sample(range(1024, 65536), count - len(hosts) - len(subnets))
+    rules = [Rule(socket.inet_ntoa(((10 << 24) | host).to_bytes(4, 'big')), RULE_KBPS)
+             for host in hosts]
+    rules += [Rule(f"{socket.inet_ntoa(address.to_bytes(4, 'big'))}/{prefix}", RULE_KBPS)
+              for address, prefix in sorted(subnets)]
+    rules += [Rule(f"port:{port}", RULE_KBPS) for port in ports]
+    return rules
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def packet_cost(destination, packets):
+    """CPU nanoseconds per UDP datagram sent to ``destination`` through IFACE"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', PROBE_PORT))
+    payload = b'x' * 64
+    address = (destination, PROBE_PORT)
+    try:
+        for _ in range(packets // 10):
+            sock.sendto(payload, address)
+        started = time.process_time()
+        for _ in range(packets):
+            sock.sendto(payload, address)
+        return round((time.process_time() - started) * 1e9 / packets)
+    finally:
+        sock.close()
+
+
+def install_linear(backend, destinations):
+    """One exact-match u32 node per destination, tried one after another"""
+    steps = [Step('qdisc', 'add_htb_qdisc', IFACE, '1:', 'root', 0x30),
+             Step('class', 'add_htb_class', IFACE, '1:1', '1:', 10000000),
+             Step('class', 'add_htb_class', IFACE, '1:30', '1:1', 10000000)]
+    # A u32 bucket holds at most 4095 nodes: chain several single-bucket tables
+    for start in range(0, len(destinations), LINEAR_NODES_PER_TABLE):
+        htid = 0x10 + start // LINEAR_NODES_PER_TABLE
+        steps.append(Step('table', 'add_u32_table', IFACE, '1:', 10, htid, 1))
+        for node, destination in enumerate(destinations[start:start + LINEAR_NODES_PER_TABLE], 1):
+            address = int.from_bytes(socket.inet_aton(destination), 'big')
+            steps.append(Step('node', 'add_u32_node', IFACE, '1:', 10, u32_handle(htid, 0, node),
+                              [(address, 0xFFFFFFFF, 16)], '1:30'))
+        steps.append(Step('link', 'add_u32_node', IFACE, '1:', 10,
+                          u32_handle(0x800, 0, 1 + start // LINEAR_NODES_PER_TABLE),
+                          [(0, 0, 0)], None, htid))
+    backend.run(steps)
+
+
+def bench_backend(name, counts, packets):
+    core = ThrottleCore(backend=get_backend(name), journal=False)
+    results = []
+    try:
+        for count in counts:
+            rules = make_rules(count)
+            core.clear_limits(IFACE)
+            apply_ms, (_, steps) = timed(core.set_rules, IFACE, rules, replace=True)
+            replan_ms, (_, noop) = timed(core.set_rules, IFACE, [], dry_run=True)
+            changed = Rule(rules[0].match, RULE_KBPS // 2)
+            change_ms, (_, change) = timed(core.set_rules, IFACE, [changed])
+            result = {
+                'backend': name,
+                'rules': count,
+                'apply_ms': round(apply_ms, 1),
+                'apply_steps': len(steps),
+                'replan_ms': round(replan_ms, 1),
+                'replan_steps': len(noop),
+                'change_one_ms': round(change_ms, 1),
+                'change_one_steps': len(change),
+            }
+            if packets:
+                result['packet_ns'] = {
+                    'host_match': packet_cost(rules[len(rules) * 7 // 10 - 1].match, packets),
+                    'no_match': packet_cost(UNMATCHED, packets),
+                }
+            results.append(result)
+        core.clear_limits(IFACE)
+    finally:
+        core.close()
+    return results
+
+
+def bench_linear(counts, packets):
+    backend = get_backend('netlink')
+    results = []
+    try:
+        for count in counts:
+            destinations = [rule.match for rule in make_rules(count)[:count * 7 // 10]]
+            backend.delete_qdisc(IFACE)
+            install_ms, _ = timed(install_linear, backend, destinations)
+            results.append({
+                'rules': len(destinations),
+                'install_ms': round(install_ms, 1),
+                'packet_ns': {
+                    'last_match': packet_cost(destinations[-1], packets),
+                    'no_match': packet_cost(UNMATCHED, packets),
+                },
+            })
+        backend.delete_qdisc(IFACE)
+    finally:
+        backend.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure rule apply time and per-packet cost")
+    parser.add_argument('--rules', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--backends', nargs='+', default=['netlink', 'shell'])
+    parser.add_argument('--packets', type=int, default=20000,
+                        help="datagrams per per-packet measurement (0 skips it)")
+    args = parser.parse_args(argv)
+
+    if os.geteuid() != 0:
+        print("This benchmark needs root (it creates a network namespace)", file=sys.stderr)
+        return 1
+
+    namespace = f'ntbench-rules-{os.getpid()}'
+    enter_namespace(namespace)
+    try:
+        results = {
+            'benchmark': 'rules',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'packets': args.packets,
+        }
+        if args.packets:
+            results['baseline_packet_ns'] = packet_cost(UNMATCHED, args.packets)
+        results['hashed'] = [result for backend in args.backends
+                             for result in bench_backend(backend, args.rules, args.packets)]
+        if args.packets:
+            results['linear'] = bench_linear(args.rules, args.packets)
+    finally:
+        subprocess.run(['ip', 'netns', 'del', namespace], capture_output=True)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
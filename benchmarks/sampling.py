@@ -0,0 +1,144 @@
+"""Monitoring loop benchmark: CPU per sample and timing jitter.
+
+Runs the loop the GUI monitor and the daemon use (a Sampler polled from
+``ticks``) for ``--duration`` seconds per interface count:
+
+    sudo python benchmarks/sampling.py --interfaces 1 10 100 > sampling.json
+
+With root the interfaces are veth pairs in a private network namespace.
+Without root the host's own interfaces are sampled, as many as there are.
+For every count the report has the CPU time per poll, the CPU share of the
+whole loop, and how late each tick woke up (percentiles, and ticks missed
+entirely). ``--busy-threads`` adds Python threads spinning in the background,
+the way a busy GUI competes for the GIL.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from netthrottle.sampler import SYSFS_NET, Sampler, percentile, ticks  # noqa: E402
+
+
+def sh(*args):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def enter_namespace(name, count):
+    """Create netns ``name`` with ``count`` veth interfaces, join it, return their names"""
+    sh('ip', 'netns', 'add', name)
+    with open(f'/run/netns/{name}') as f:
+        os.setns(f.fileno(), os.CLONE_NEWNET)
+    # sysfs shows the namespace it was mounted in: remount it in a private mount namespace
+    os.unshare(os.CLONE_NEWNS)
+    sh('mount', '--make-rprivate', '/')
+    sh('mount', '-t', 'sysfs', 'sysfs', '/sys')
+    names = []
+    for pair in range((count + 1) // 2):
+        sh('ip', 'link', 'add', f'bench{pair}a', 'type', 'veth', 'peer', 'name', f'bench{pair}b')
+        names += [f'bench{pair}a', f'bench{pair}b']
+    return names[:count]
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def bench(names, interval, duration):
+    sampler = Sampler(names, interval)
+    polls = []
+    late = []
+    missed = 0
+    stop = threading.Event()
+    step = int(interval * 1e9)
+    try:
+        sampler.poll()
+        # CPU of this thread only, so busy threads do not count
+        started_cpu = time.thread_time()
+        started = last = time.monotonic_ns()
+        timer = threading.Timer(duration, stop.set)
+        timer.start()
+        for _ in ticks(interval, stop):
+            woke = time.monotonic_ns()
+            late.append(((woke - started) % step) / 1e6)
+            missed += max(0, round((woke - last) / step) - 1)
+            last = woke
+            before = time.thread_time_ns()
+            sampler.poll()
+            polls.append((time.thread_time_ns() - before) / 1000)
+        elapsed = (time.monotonic_ns() - started) / 1e9
+        cpu = time.thread_time() - started_cpu
+    finally:
+        sampler.close()
+    polls.sort()
+    late.sort()
+    return {
+        'interfaces': len(names),
+        'ticks': len(polls),
+        'missed_ticks': missed,
+        'poll_cpu_us': {
+            'median': round(percentile(polls, 50), 1),
+            'p95': round(percentile(polls, 95), 1),
+            'per_interface': round(percentile(polls, 50) / len(names), 2),
+        },
+        'loop_cpu_percent': round(cpu / elapsed * 100, 2),
+        'late_ms': {
+            'median': round(percentile(late, 50), 3),
+            'p95': round(percentile(late, 95), 3),
+            'p99': round(percentile(late, 99), 3),
+            'max': round(late[-1], 3),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the monitoring loop's CPU and jitter")
+    parser.add_argument('--interfaces', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per interface count")
+    parser.add_argument('--busy-threads', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = {
+        'benchmark': 'sampling',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'interval': args.interval,
+        'busy_threads': args.busy_threads,
+    }
+    namespace = None
+    if os.geteuid() == 0 and platform.system().lower() == 'linux':
+        namespace = f'ntbench-sampling-{os.getpid()}'
+        available = enter_namespace(namespace, max(args.interfaces))
+        results['interfaces'] = 'veth in a private namespace'
+    else:
+        available = sorted(os.listdir(SYSFS_NET)) if os.path.isdir(SYSFS_NET) else []
+        results['interfaces'] = 'host'
+
+    stop = threading.Event()
+    for _ in range(args.busy_threads):
+        threading.Thread(target=spin, args=(stop,), daemon=True).start()
+    try:
+        results['runs'] = [bench(available[:count], args.interval, args.duration)
+                           for count in sorted(set(min(c, len(available)) for c in args.interfaces))
+                           if count]
+    finally:
+        stop.set()
+        if namespace:
+            subprocess.run(['ip', 'netns', 'del', namespace], capture_output=True)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
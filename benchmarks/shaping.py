@@ -0,0 +1,132 @@
+"""Shaping benchmark: time to apply, change and remove a limit through each backend.
+
+With root, the netlink and shell backends shape a veth pair in a private
+network namespace, so the host's interfaces are left alone. The simulated
+backend keeps tc state in memory: it runs without privileges and measures
+NetThrottle's own planning cost with no kernel work at all.
+
+    sudo python benchmarks/shaping.py --runs 20 > shaping.json
+    python benchmarks/shaping.py --backends simulated > shaping.json
+
+Every run times, through ThrottleCore as the GUI and daemon use it:
+
+- apply: download and upload limits on a bare interface, IFB included
+- noop: the same limits again, which should plan nothing
+- change: new rates, changed in place
+- remove: clearing both limits, IFB included
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from netthrottle.backends import SimulatedBackend, get_backend  # noqa: E402
+from netthrottle.core import ThrottleCore  # noqa: E402
+from netthrottle.policy import FIFO, QUEUES  # noqa: E402
+from netthrottle.sampler import percentile  # noqa: E402
+
+IFACE = 'bench0'
+PRIVILEGED = ('netlink', 'shell')
+OPERATIONS = ('apply', 'noop', 'change', 'remove')
+
+
+def sh(*args):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def enter_namespace(name):
+    """Create netns ``name`` with a veth pair IFACE/bench1, and join it"""
+    sh('ip', 'netns', 'add', name)
+    with open(f'/run/netns/{name}') as f:
+        os.setns(f.fileno(), os.CLONE_NEWNET)
+    sh('ip', 'link', 'add', IFACE, 'type', 'veth', 'peer', 'name', 'bench1')
+    for dev in ('lo', IFACE, 'bench1'):
+        sh('ip', 'link', 'set', dev, 'up')
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    _, steps = function(*args, **kwargs)
+    return (time.perf_counter() - started) * 1000, len(steps)
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'median_ms': round(percentile(ordered, 50), 3),
+        'p95_ms': round(percentile(ordered, 95), 3),
+        'min_ms': round(ordered[0], 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+
+
+def bench_backend(name, runs, queue):
+    backend = SimulatedBackend([IFACE]) if name == 'simulated' else get_backend(name)
+    core = ThrottleCore(backend=backend, journal=False)
+    times = {operation: [] for operation in OPERATIONS}
+    steps = {}
+    try:
+        core.clear_limits(IFACE)
+        for run in range(runs):
+            # Vary the rates so no run repeats the previous one's state
+            down, up = 10000 + run * 100, 2000 + run * 10
+            for operation, call in (
+                    ('apply', lambda: core.set_limits(IFACE, down, up, queue)),
+                    ('noop', lambda: core.set_limits(IFACE, down, up, queue)),
+                    ('change', lambda: core.set_limits(IFACE, down * 2, up * 2, queue)),
+                    ('remove', lambda: core.clear_limits(IFACE))):
+                elapsed, count = timed(call)
+                times[operation].append(elapsed)
+                steps[operation] = count
+    finally:
+        core.close()
+    return {operation: dict(summarize(times[operation]), steps=steps[operation])
+            for operation in OPERATIONS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure apply, change and remove times")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--backends', nargs='+', default=['netlink', 'shell', 'simulated'],
+                        choices=['netlink', 'shell', 'simulated'])
+    parser.add_argument('--queue', choices=QUEUES, default=FIFO)
+    args = parser.parse_args(argv)
+
+    results = {
+        'benchmark': 'shaping',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'queue': args.queue,
+        'backends': {},
+    }
+    privileged = [name for name in args.backends if name in PRIVILEGED]
+    if privileged and os.geteuid() != 0:
+        results['skipped'] = {name: "needs root (it creates a network namespace)"
+                              for name in privileged}
+        privileged = []
+
+    if 'simulated' in args.backends:
+        results['backends']['simulated'] = bench_backend('simulated', args.runs, args.queue)
+    if privileged:
+        namespace = f'ntbench-shaping-{os.getpid()}'
+        enter_namespace(namespace)
+        try:
+            for name in privileged:
+                results['backends'][name] = bench_backend(name, args.runs, args.queue)
+        finally:
+            subprocess.run(['ip', 'netns', 'del', namespace], capture_output=True)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Startup benchmark: import time and time to first frame.
+
+Each run starts a fresh interpreter so the numbers include everything a user
+waits for. Results are printed as JSON so runs can be compared over time:
+
+    python benchmarks/startup.py --runs 10 > startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the child interpreter; prints milliseconds since it started
+FIRST_FRAME = """
+import time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.NetworkSpeedController()
+built = time.perf_counter()
+
+def first_frame():
+    app.root.update_idletasks()
+    drawn = time.perf_counter()
+    print(f"{(imported - start) * 1000:.3f} {(built - start) * 1000:.3f} {(drawn - start) * 1000:.3f}")
+    app.core.close()
+    app.root.destroy()
+
+app.root.after(0, first_frame)
+app.root.mainloop()
+"""
+
+
+def run_child(code):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True,
+                            text=True, check=True)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def import_profile():
+    """Cumulative import time per top-level module from -X importtime, in ms"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((depth, name.strip(), int(parts[1]) / 1000))
+
+    # Children are listed before their parent: walk back from "main"
+    modules = {}
+    end = max(i for i, row in enumerate(rows) if row[:2] == (0, 'main'))
+    modules['main'] = rows[end][2]
+    for depth, name, cumulative in reversed(rows[:end]):
+        if depth == 0:
+            break
+        if depth == 1:
+            modules[name] = cumulative
+    return modules
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'median_ms': round(statistics.median(samples), 3),
+        'min_ms': round(min(samples), 3),
+        'max_ms': round(max(samples), 3),
+    }
+
+
+def has_display():
+    return platform.system().lower() != 'linux' or bool(
+        os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure NetThrottle cold start")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = {
+        'benchmark': 'startup',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'interpreter_ms': summarize([run_child('pass')[0] for _ in range(args.runs)]),
+        'import_main_ms': summarize([run_child('import main')[0] for _ in range(args.runs)]),
+        'import_profile_ms': import_profile(),
+    }
+
+    if has_display():
+        imported, built, drawn = [], [], []
+        for _ in range(args.runs):
+            _, result = run_child(FIRST_FRAME)
+            values = [float(v) for v in result.stdout.split()[-3:]]
+            imported.append(values[0])
+            built.append(values[1])
+            drawn.append(values[2])
+        results['first_frame'] = {
+            'imported_ms': summarize(imported),
+            'window_built_ms': summarize(built),
+            'first_frame_ms': summarize(drawn),
+        }
+    else:
+        results['first_frame'] = {'skipped': "no display (set DISPLAY, e.g. under xvfb-run)"}
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Run the benchmarks together and compare the results with an earlier run.
+
+Every benchmark runs in its own interpreter with quick settings, and the
+results are merged into one JSON document tagged with the version measured:
+
+    sudo python benchmarks/suite.py > after.json
+    sudo python benchmarks/suite.py --compare before.json
+
+``--compare`` prints the change of every number both runs have, keyed by its
+dotted path (``shaping.backends.netlink.apply.median_ms``), on stderr.
+Benchmarks needing root or a display record what they skipped instead.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.join(ROOT, 'benchmarks')
+
+# Quick settings for every benchmark; pass --full for their own defaults
+BENCHMARKS = {
+    'shaping': ['--runs', '10'],
+    'sampling': ['--interfaces', '1', '10', '100', '--duration', '2'],
+    'ui': ['--duration', '1'],
+    'startup': ['--runs', '3'],
+    'proxy': ['--rates', '0', '100', '--duration', '2'],
+}
+# Keys describing a run rather than measuring it
+METADATA = {'benchmark', 'python', 'platform'}
+
+
+def git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(name, full):
+    args = [] if full else BENCHMARKS[name]
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(HERE, f'{name}.py'), *args],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {'error': (result.stderr.strip().splitlines() or ['failed'])[-1]}
+    data = json.loads(result.stdout)
+    for key in METADATA:
+        data.pop(key, None)
+    data['wall_s'] = round(time.perf_counter() - started, 2)
+    return data
+
+
+def run_key(item, index):
+    """Runs of the same benchmark are told apart by their parameters, when they have them"""
+    if not isinstance(item, dict):
+        return str(index)
+    if 'relay' in item:
+        return f"{item['relay']}-{item['rate_mbit'] or 0}"
+    return str(item.get('interfaces', item.get('threads', index)))
+
+
+def flatten(data, prefix=''):
+    """Numeric leaves of ``data`` as {dotted.path: value}; list items keyed by index"""
+    items = {}
+    if isinstance(data, dict):
+        children = data.items()
+    elif isinstance(data, list):
+        children = ((run_key(item, index), item) for index, item in enumerate(data))
+    else:
+        if isinstance(data, (int, float)) and not isinstance(data, bool):
+            items[prefix] = data
+        return items
+    for key, value in children:
+        items.update(flatten(value, f'{prefix}.{key}' if prefix else str(key)))
+    return items
+
+
+def compare(base, current):
+    """Lines of "path: before -> after (+x%)" for the benchmarks both runs have"""
+    shared = base.get('results', {}).keys() & current.get('results', {}).keys()
+    before = flatten({name: base['results'][name] for name in shared})
+    after = flatten({name: current['results'][name] for name in shared})
+    lines = [f"Comparing {base.get('version') or '?'} -> {current.get('version') or '?'}"]
+    for path in sorted(before.keys() & after.keys()):
+        old, new = before[path], after[path]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        lines.append(f"  {path}: {old} -> {new} ({change})")
+    for path in sorted(before.keys() - after.keys()):
+        lines.append(f"  {path}: only in the base run")
+    for path in sorted(after.keys() - before.keys()):
+        lines.append(f"  {path}: only in this run")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run NetThrottle's benchmarks")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--full', action='store_true', help="use each benchmark's own defaults")
+    parser.add_argument('--compare', metavar='BASE.json', help="compare with an earlier run")
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+
+    current = {
+        'version': git('describe', '--always', '--dirty'),
+        'commit': git('rev-parse', 'HEAD'),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'kernel': platform.release(),
+        'root': hasattr(os, 'geteuid') and os.geteuid() == 0,
+        'results': {},
+    }
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"Running {name}...", file=sys.stderr)
+        current['results'][name] = run_benchmark(name, args.full)
+
+    json.dump(current, sys.stdout, indent=2)
+    print()
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print('\n'.join(compare(base, current)), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
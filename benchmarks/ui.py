@@ -0,0 +1,188 @@
+"""UI benchmark: the cost of a log flood to the threads logging and to the Tk loop.
+
+Worker threads call ``log_status`` as fast as they can for ``--duration``
+seconds, the way a storm of errors or rule updates would:
+
+    python benchmarks/ui.py --threads 1 4 > ui.json
+
+The queue part needs no display. Producers log through the real
+``log_status`` into an UpdateQueue, drained every frame by this thread with
+a handler that only joins the lines, so it measures what logging costs the
+workers, the drain per frame and how many lines the bounded batch dropped.
+
+With a display the same flood goes to the real window, and the report adds
+the drain time with the Text widget's insert/trim/scroll, and how late a
+10 ms timer on the Tk loop fires meanwhile (the input lag a user would feel).
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main as gui  # noqa: E402
+from netthrottle.sampler import percentile  # noqa: E402
+from netthrottle.uiqueue import FRAME_MS, UpdateQueue  # noqa: E402
+
+PROBE_MS = 10
+MESSAGES = ("Error: cannot apply limit to eth0", "Current speeds: 1.2 MB/s down, 300 KB/s up",
+            "Warning: interface wlan0 went down", "Download limit set to 5 Mbps")
+
+
+class StubRoot:
+    """Just enough of Tk for an UpdateQueue drained by hand"""
+
+    def after(self, ms, callback):
+        return 'after#0'
+
+    def after_cancel(self, job):
+        pass
+
+
+def has_display():
+    return platform.system().lower() != 'linux' or bool(
+        os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def distribution(samples, digits=3):
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    return {
+        'count': len(ordered),
+        'median': round(percentile(ordered, 50), digits),
+        'p95': round(percentile(ordered, 95), digits),
+        'max': round(ordered[-1], digits),
+    }
+
+
+def flood(log, threads, stop):
+    """Start ``threads`` producers calling ``log``; returns their per-call times in µs"""
+    timings = [[] for _ in range(threads)]
+
+    def produce(times):
+        count = 0
+        while not stop.is_set():
+            before = time.perf_counter_ns()
+            log(f"{MESSAGES[count % len(MESSAGES)]} #{count}")
+            times.append((time.perf_counter_ns() - before) / 1000)
+            count += 1
+
+    workers = [threading.Thread(target=produce, args=(times,), daemon=True) for times in timings]
+    for worker in workers:
+        worker.start()
+    return workers, timings
+
+
+def bench_queue(threads, duration):
+    """Flood an UpdateQueue drained every frame by this thread"""
+    updates = UpdateQueue(StubRoot())
+    app = type('App', (), {'updates': updates})()
+    written = [0]
+
+    def write(lines):
+        ''.join(lines)
+        written[0] += len(lines)
+
+    updates.register_batch('log', write)
+    stop = threading.Event()
+    drains = []
+    workers, timings = flood(lambda message: gui.NetworkSpeedController.log_status(app, message),
+                             threads, stop)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        time.sleep(FRAME_MS / 1000)
+        before = time.perf_counter()
+        updates.drain()
+        drains.append((time.perf_counter() - before) * 1000)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    updates.drain()
+    posted = sum(len(times) for times in timings)
+    return {
+        'threads': threads,
+        'lines_posted': posted,
+        'lines_written': written[0],
+        'lines_dropped': posted - written[0],
+        'log_call_us': distribution([t for times in timings for t in times], 2),
+        'drain_ms': distribution(drains),
+    }
+
+
+def bench_window(threads, duration):
+    """Flood the real window and watch the Tk loop's responsiveness"""
+    app = gui.NetworkSpeedController()
+    drains, late = [], []
+    drain = app.updates.drain
+
+    def timed_drain():
+        before = time.perf_counter()
+        drain()
+        drains.append((time.perf_counter() - before) * 1000)
+
+    app.updates.drain = timed_drain
+    stop = threading.Event()
+    state = {}
+
+    def probe(scheduled):
+        late.append(max(0.0, (time.perf_counter() - scheduled) * 1000 - PROBE_MS))
+        if stop.is_set():
+            return
+        app.root.after(PROBE_MS, probe, time.perf_counter())
+
+    def begin():
+        state['workers'], state['timings'] = flood(app.log_status, threads, stop)
+        app.root.after(PROBE_MS, probe, time.perf_counter())
+        app.root.after(int(duration * 1000), finish)
+
+    def finish():
+        stop.set()
+        for worker in state['workers']:
+            worker.join()
+        app.updates.stop()
+        app.core.close()
+        app.root.destroy()
+
+    # Let startup settle before flooding
+    app.root.after(500, begin)
+    app.root.mainloop()
+    return {
+        'threads': threads,
+        'lines_posted': sum(len(times) for times in state['timings']),
+        'log_call_us': distribution([t for times in state['timings'] for t in times], 2),
+        'drain_ms': distribution(drains),
+        'timer_late_ms': distribution(late),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure UI update cost under a log flood")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds per thread count")
+    args = parser.parse_args(argv)
+
+    results = {
+        'benchmark': 'ui',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'frame_ms': FRAME_MS,
+        'queue': [bench_queue(threads, args.duration) for threads in args.threads],
+    }
+    if has_display():
+        results['window'] = [bench_window(threads, args.duration) for threads in args.threads]
+    else:
+        results['window'] = {'skipped': "no display (set DISPLAY, e.g. under xvfb-run)"}
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
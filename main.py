@@ -1,24 +1,51 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, font
-import subprocess
+from tkinter import ttk
 import threading
 import time
-import re
-import psutil
-import json
 import os
 import platform
 import sys
 
+from netthrottle.chart import ThroughputChart
+from netthrottle.core import ThrottleCore, convert_to_kbps, format_speed
+from netthrottle.executor import ShapingExecutor
+from netthrottle.units import format_bytes, format_limit, format_queue, format_tc_entry
+from netthrottle.uiqueue import UpdateQueue
+
+# The live chart is fed ten times a second; stat cards show a smoothed
+# value refreshed once a second
+MONITOR_INTERVAL = 0.1
+CARD_UPDATE_EVERY = 10
+# Status log lines kept; older lines are trimmed in bulk once the slack is used
+MAX_LOG_LINES = 200
+LOG_TRIM_SLACK = 100
+# Rows in the busiest-interfaces table
+TOP_LINKS = 8
+# Queue choices shown in the sidebar, mapped to policy queues
+QUEUE_CHOICES = {
+    "FIFO (kernel default)": 'fifo',
+    "fq_codel (low latency)": 'fq_codel',
+    "cake (low latency)": 'cake',
+    "cake shaper (no HTB)": 'cake-shaper',
+}
+# How the upload limit is enforced, mapped to policy ingress modes
+INGRESS_CHOICES = {
+    "Shape via IFB (queues, rules)": 'ifb',
+    "Police (lower CPU, drops excess)": 'police',
+}
+
 class NetworkSpeedController:
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("NetThrottle - Network Speed Controller")
         
+        # Shaping, monitoring and settings live in the GUI-independent core
+        self.core = ThrottleCore()
+        
         # Detect operating system for cross-platform compatibility
-        self.os_type = platform.system().lower()
-        self.is_windows = self.os_type == 'windows'
-        self.is_linux = self.os_type == 'linux'
+        self.os_type = self.core.os_type
+        self.is_windows = self.core.is_windows
+        self.is_linux = self.core.is_linux
         
         # Cross-platform window maximization
         self.maximize_window()
@@ -31,12 +58,38 @@ class NetworkSpeedController:
         # Variables
         self.current_download_limit = tk.StringVar(value="No limit")
         self.current_upload_limit = tk.StringVar(value="No limit")
-        self.is_monitoring = False
-        self.monitoring_thread = None
-        
-        # Get network interfaces
-        self.interfaces = self.get_network_interfaces()
-        self.selected_interface = tk.StringVar(value=self.interfaces[0] if self.interfaces else "")
+        self.queue_choice = tk.StringVar(value=next(iter(QUEUE_CHOICES)))
+        self.ingress_choice = tk.StringVar(value=next(iter(INGRESS_CHOICES)))
+        self.download_queue = tk.StringVar(value="Not shaped")
+        self.upload_queue = tk.StringVar(value="Not shaped")
+        self.autorate_enabled = tk.BooleanVar(value=False)
+        self.autorate_status = tk.StringVar(value="Off")
+        self.autorate_interface = None
+        # Counters of the previous refresh, so the next one can show rates
+        self.tc_stats = None
+        # "[ADDRESS:]PORT" to serve OpenMetrics on, from the settings file only
+        self.metrics_address = None
+        
+        # Network interfaces are enumerated in the background after the first frame
+        self.interfaces = []
+        self.selected_interface = tk.StringVar(value="")
+        self.apply_all = tk.BooleanVar(value=False)
+        self.speed_samples = 0
+        self.chart_interface = None
+        self.log_lines = 0
+        
+        # All updates from worker threads reach Tk through this queue
+        self.updates = UpdateQueue(self.root)
+        self.updates.register_batch('log', self.write_log)
+        self.updates.register_batch('speed', self.update_speed_display)
+        # tc runs on background workers, one interface at a time; their
+        # progress comes back through the update queue
+        self.shaping = ShapingExecutor(self.core, self.on_shaping_event)
+        self.shaping_done = None
+        self.shaping_errors = []
+        self.shaping_warnings = []
+        self.top_sort = 'total'
+        self.top_rows = []
         
         # Modern colors - Clean light theme
         self.colors = {
@@ -54,7 +107,7 @@ class NetworkSpeedController:
         }
         
         self.setup_ui()
-        self.load_settings()
+        self.updates.start()
         
     def maximize_window(self):
         """Cross-platform window maximization"""
@@ -74,26 +127,89 @@ class NetworkSpeedController:
             self.root.geometry("1200x800")
             print(f"Warning: Could not maximize window: {e}")
     
-    def check_platform_support(self):
+    def start_startup_probe(self):
+        """Enumerate interfaces and look for tc off the Tk thread"""
+        threading.Thread(target=self.startup_probe, daemon=True).start()
+
+    def startup_probe(self):
+        """Slow startup work: interface discovery, the tc lookup and backend selection"""
+        interfaces = None
+        if self.is_linux:
+            try:
+                # Follows interfaces coming and going, and restores their limits
+                interfaces = self.core.start_link_watch(self.on_link_event).interfaces()
+            except Exception as e:
+                print(f"Warning: Not following interface changes: {e}")
+        if interfaces is None:
+            interfaces = self.core.get_network_interfaces()
+        has_tc = True
+        backend_name = None
+        journaled = {}
+        if self.is_linux:
+            import shutil
+            has_tc = shutil.which('tc') is not None
+            try:
+                backend_name = self.core.backend.name if self.core.backend else None
+                # Limits restored at boot (or still in force) from the state journal
+                journaled = self.core.journal.load()
+            except Exception:
+                pass
+        self.updates.post(self.on_startup_probe, interfaces, has_tc, backend_name, journaled)
+
+    def on_startup_probe(self, interfaces, has_tc, backend_name, journaled=None):
+        """Apply the background probe results on the Tk thread"""
+        self.interfaces = interfaces
+        self.interface_combo.configure(values=interfaces)
+        if not self.selected_interface.get() and interfaces:
+            self.selected_interface.set(interfaces[0])
+        self.load_settings()
+        policy = (journaled or {}).get(self.selected_interface.get())
+        if policy:
+            self.show_limit('download', format_limit(policy.download_kbps))
+            self.show_limit('upload', format_limit(policy.upload_kbps))
+        if backend_name:
+            self.log_status(f"🔧 Traffic control backend: {backend_name}")
+        if self.metrics_address:
+            self.start_metrics()
+        self.root.after(1000, self.check_platform_support, has_tc)  # Let the UI settle first
+
+    def on_link_event(self, event):
+        """Called from the link watcher when an interface appears, goes or changes"""
+        self.updates.post_latest('links', self.update_interfaces, event['interfaces'])
+        interface = event['interface']
+        if event['event'] == 'failed':
+            self.log_status(f"Error: interface watch failed, retrying in {event['retry']:g}s: "
+                            f"{event['error']}")
+            return
+        if event['event'] in ('added', 'removed', 'renamed'):
+            self.log_status(f"Interface {interface} {event['event']}")
+        if event.get('restored'):
+            self.log_status(f"✅ Limits on {interface} restored")
+        elif event.get('error'):
+            self.log_status(f"Failed to restore limits on {interface}: {event['error']}")
+
+    def update_interfaces(self, interfaces):
+        """Offer the current interfaces; the selection is kept even while its device is gone"""
+        self.interfaces = interfaces
+        self.interface_combo.configure(values=interfaces)
+        if not self.selected_interface.get() and interfaces:
+            self.selected_interface.set(interfaces[0])
+
+    def check_platform_support(self, has_tc=True):
         """Check and display platform-specific feature support"""
         if self.is_windows:
             self.show_modern_notification(
                 "Platform Info", 
-                "Running on Windows. Bandwidth limiting is not supported on this platform.", 
+                "Running on Windows. Limits apply to applications using the SOCKS5 proxy "
+                "NetThrottle starts on 127.0.0.1:1080.", 
+                "warning"
+            )
+        elif self.is_linux and not has_tc:
+            self.show_modern_notification(
+                "Missing Dependency", 
+                "Traffic Control (tc) not found. Install with: sudo apt install iproute2", 
                 "warning"
             )
-        elif self.is_linux:
-            # Check if tc is available
-            try:
-                result = subprocess.run("which tc", shell=True, capture_output=True, text=True)
-                if result.returncode != 0:
-                    self.show_modern_notification(
-                        "Missing Dependency", 
-                        "Traffic Control (tc) not found. Install with: sudo apt install iproute2", 
-                        "warning"
-                    )
-            except:
-                pass
 
     def setup_modern_theme(self):
         """Setup clean modern light theme for ttk widgets"""
@@ -189,34 +305,6 @@ class NetworkSpeedController:
                  background=[('active', '#b91c1c'),
                            ('pressed', '#991b1b')])
         
-    def get_network_interfaces(self):
-        """Get available network interfaces (cross-platform)"""
-        try:
-            interfaces = []
-            for interface, addrs in psutil.net_if_addrs().items():
-                # Skip loopback interfaces
-                if interface.lower() in ['lo', 'loopback']:
-                    continue
-                    
-                # Check if interface has an IP address
-                if any(addr.family == 2 for addr in addrs):  # AF_INET = 2
-                    interfaces.append(interface)
-            
-            # Return found interfaces or platform-specific defaults
-            if interfaces:
-                return interfaces
-            elif self.is_windows:
-                return ['Wi-Fi', 'Ethernet', 'Local Area Connection']
-            else:
-                return ['eth0', 'wlan0', 'enp0s3']
-                
-        except Exception:
-            # Fallback defaults based on platform
-            if self.is_windows:
-                return ['Wi-Fi', 'Ethernet', 'Local Area Connection']
-            else:
-                return ['eth0', 'wlan0', 'enp0s3']
-    
     def setup_ui(self):
         """Setup clean, modern user interface"""
         # Configure root for proper resizing
@@ -255,8 +343,8 @@ class NetworkSpeedController:
         # Start monitoring
         self.start_monitoring()
         
-        # Check platform support and show warnings if needed
-        self.root.after(1000, self.check_platform_support)  # Delay to let UI load first
+        # Interfaces, tc and backend are probed once the first frame is up
+        self.root.after_idle(self.start_startup_probe)
     
     def setup_sidebar(self, parent):
         """Setup the left sidebar with controls"""
@@ -279,14 +367,17 @@ class NetworkSpeedController:
         ttk.Label(interface_section, text="Network Interface", 
                  style='Subtitle.TLabel').pack(anchor=tk.W, pady=(0, 10))
         
-        interface_combo = ttk.Combobox(interface_section, textvariable=self.selected_interface, 
-                                     values=self.interfaces, state="readonly", 
-                                     style='Modern.TCombobox', font=('Inter', 11))
-        interface_combo.pack(fill=tk.X, pady=(0, 5))
+        self.interface_combo = ttk.Combobox(interface_section, textvariable=self.selected_interface, 
+                                          values=self.interfaces, state="readonly", 
+                                          style='Modern.TCombobox', font=('Inter', 11))
+        self.interface_combo.pack(fill=tk.X, pady=(0, 5))
         
         ttk.Label(interface_section, text="Select your active network interface", 
                  style='Info.TLabel').pack(anchor=tk.W)
         
+        ttk.Checkbutton(interface_section, text="Apply limits to all interfaces", 
+                       variable=self.apply_all).pack(anchor=tk.W, pady=(5, 0))
+        
         # Download Control
         download_section = tk.Frame(parent, bg='#ffffff')
         download_section.pack(fill=tk.X, padx=30, pady=(0, 30))
@@ -320,6 +411,9 @@ class NetworkSpeedController:
         ttk.Label(download_status_frame, textvariable=self.current_download_limit, 
                  style='Modern.TLabel').pack(side=tk.LEFT, pady=8)
         
+        ttk.Label(download_section, textvariable=self.download_queue, 
+                 style='Info.TLabel').pack(anchor=tk.W, padx=10)
+        
         # Upload Control
         upload_section = tk.Frame(parent, bg='#ffffff')
         upload_section.pack(fill=tk.X, padx=30, pady=(0, 30))
@@ -340,6 +434,10 @@ class NetworkSpeedController:
         self.upload_unit.set("mbps")
         self.upload_unit.pack(side=tk.RIGHT)
         
+        ttk.Combobox(upload_section, textvariable=self.ingress_choice, values=list(INGRESS_CHOICES), 
+                    state="readonly", style='Modern.TCombobox', 
+                    font=('Inter', 11)).pack(fill=tk.X, pady=(0, 10))
+        
         ttk.Button(upload_section, text="Set Upload Limit", 
                   command=self.set_upload_limit, 
                   style='Primary.TButton').pack(fill=tk.X, pady=(0, 10))
@@ -353,6 +451,39 @@ class NetworkSpeedController:
         ttk.Label(upload_status_frame, textvariable=self.current_upload_limit, 
                  style='Modern.TLabel').pack(side=tk.LEFT, pady=8)
         
+        ttk.Label(upload_section, textvariable=self.upload_queue, 
+                 style='Info.TLabel').pack(anchor=tk.W, padx=10)
+        
+        # Queue discipline used behind the limits
+        queue_section = tk.Frame(parent, bg='#ffffff')
+        queue_section.pack(fill=tk.X, padx=30, pady=(0, 30))
+        
+        ttk.Label(queue_section, text="Queue", 
+                 style='Subtitle.TLabel').pack(anchor=tk.W, pady=(0, 10))
+        
+        ttk.Combobox(queue_section, textvariable=self.queue_choice, values=list(QUEUE_CHOICES), 
+                    state="readonly", style='Modern.TCombobox', 
+                    font=('Inter', 11)).pack(fill=tk.X, pady=(0, 5))
+        
+        ttk.Label(queue_section, text="fq_codel/cake keep SSH and calls responsive under a limit", 
+                 style='Info.TLabel').pack(anchor=tk.W)
+        
+        # Closed-loop limits that follow the link's capacity
+        autorate_section = tk.Frame(parent, bg='#ffffff')
+        autorate_section.pack(fill=tk.X, padx=30, pady=(0, 30))
+        
+        ttk.Label(autorate_section, text="Auto Rate", 
+                 style='Subtitle.TLabel').pack(anchor=tk.W, pady=(0, 10))
+        
+        ttk.Checkbutton(autorate_section, text="Adapt limits to the link's capacity", 
+                       variable=self.autorate_enabled, 
+                       command=self.toggle_autorate).pack(anchor=tk.W, pady=(0, 5))
+        
+        ttk.Label(autorate_section, text="The limits entered above are the link's maximum speeds", 
+                 style='Info.TLabel').pack(anchor=tk.W)
+        ttk.Label(autorate_section, textvariable=self.autorate_status, 
+                 style='Info.TLabel').pack(anchor=tk.W, padx=10)
+        
         # Action Buttons
         actions_section = tk.Frame(parent, bg='#ffffff')
         actions_section.pack(fill=tk.X, padx=30, pady=(0, 40))
@@ -396,6 +527,14 @@ class NetworkSpeedController:
                   command=self.refresh_status, 
                   style='Primary.TButton').pack(side=tk.RIGHT)
         
+        # Live throughput chart
+        self.chart = ThroughputChart(monitor_frame, column_seconds=MONITOR_INTERVAL,
+                                     bg='#f8fafc', grid_color=self.colors['border'],
+                                     text_color=self.colors['text_secondary'])
+        self.chart.add_series('download', self.colors['success'], "Download")
+        self.chart.add_series('upload', self.colors['accent'], "Upload")
+        self.chart.canvas.pack(fill=tk.X, padx=30, pady=(0, 15))
+        
         # Monitor content
         monitor_content = tk.Frame(monitor_frame, bg='#ffffff')
         monitor_content.pack(fill=tk.BOTH, expand=True, padx=30, pady=(0, 20))
@@ -416,19 +555,66 @@ class NetworkSpeedController:
         self.status_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         status_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
+        if self.is_linux:
+            self.setup_top_links(parent)
+        
         # Welcome messages
         self.log_status("🚀 Network Speed Controller initialized successfully!")
         self.log_status(f"�️  Running on {platform.system()} ({platform.machine()})")
         
         if self.is_windows:
-            self.log_status("💡 Windows detected - Network monitoring available")
-            self.log_status("⚠️  Bandwidth limiting not supported on Windows")
+            self.log_status("💡 Windows detected - Network monitoring and proxy limiting available")
+            self.log_status("⚠️  Limits apply to applications using the SOCKS5 proxy "
+                            "NetThrottle starts on 127.0.0.1:1080")
         elif self.is_linux:
             self.log_status("💡 Linux detected - Full bandwidth control available")
             self.log_status("⚠️  Root privileges required for traffic control")
         
         self.log_status("⌨️  Shortcuts: Ctrl+R=Refresh, Ctrl+S=Save, Ctrl+Q=Quit")
     
+    def setup_top_links(self, parent):
+        """Setup the busiest-interfaces table (all links, one netlink dump per tick)"""
+        top_frame = tk.Frame(parent, bg='#ffffff', relief='flat')
+        top_frame.grid(row=2, column=0, sticky="ew", padx=30, pady=(0, 30))
+        
+        ttk.Label(top_frame, text="Busiest Interfaces", 
+                 style='Subtitle.TLabel').pack(anchor=tk.W, padx=30, pady=(20, 10))
+        
+        columns = ('interface', 'rx', 'tx', 'total')
+        self.top_tree = ttk.Treeview(top_frame, columns=columns, show='headings', height=TOP_LINKS)
+        headings = {'interface': "Interface", 'rx': "Download", 'tx': "Upload", 'total': "Total"}
+        for column in columns:
+            self.top_tree.heading(column, text=headings[column],
+                                  command=lambda key=column: self.sort_top_links(key))
+            self.top_tree.column(column, anchor=tk.W if column == 'interface' else tk.E)
+        self.top_tree.pack(fill=tk.X, padx=30, pady=(0, 20))
+    
+    def sort_top_links(self, key):
+        """Sort the busiest-interfaces table by a column"""
+        self.top_sort = key
+        self.update_top_links(self.top_rows)
+    
+    def on_top_sample(self, rows):
+        """Called from the monitoring thread with the busiest links"""
+        self.updates.post_latest('top', self.update_top_links, rows)
+    
+    def update_top_links(self, rows):
+        """Redraw the busiest-interfaces table"""
+        self.top_rows = rows
+        if self.top_sort == 'interface':
+            rows = sorted(rows, key=lambda row: row['interface'])
+        elif self.top_sort in ('rx', 'tx'):
+            rows = sorted(rows, key=lambda row: row[f'{self.top_sort}_bytes_per_sec'], reverse=True)
+        else:
+            rows = sorted(rows, key=lambda row: row['rx_bytes_per_sec'] + row['tx_bytes_per_sec'],
+                          reverse=True)
+        self.top_tree.delete(*self.top_tree.get_children())
+        for row in rows:
+            rx = row['rx_bytes_per_sec'] / 1024
+            tx = row['tx_bytes_per_sec'] / 1024
+            self.top_tree.insert('', tk.END, values=(row['interface'], format_speed(rx),
+                                                     format_speed(tx), format_speed(rx + tx)))
+    
     def create_stat_card(self, parent, title, icon, value, column):
         """Create a statistics card"""
         card = tk.Frame(parent, bg='#ffffff', relief='flat')
@@ -461,30 +647,29 @@ class NetworkSpeedController:
             self.upload_stat_label = value_label
     def convert_to_kbps(self, value, unit):
         """Convert speed value to kbps"""
-        try:
-            value = float(value)
-            if unit == "mbps":
-                return int(value * 1000)
-            return int(value)
-        except ValueError:
-            return None
+        return convert_to_kbps(value, unit)
     
+    def uses_proxy(self):
+        """Whether limits go through the local SOCKS5 proxy, where tc is not available"""
+        return not self.is_linux
+
+    def log_proxy(self):
+        host, port = self.core.proxy.listening[0]
+        self.log_status(f"Limits apply to applications using the SOCKS5 proxy on {host}:{port}")
+
+    def show_limit(self, direction, text):
+        """Show a limit in the sidebar and on its stat card"""
+        getattr(self, f'current_{direction}_limit').set(text)
+        if hasattr(self, f'{direction}_stat_label'):
+            getattr(self, f'{direction}_stat_label').config(text=text)
+
     def set_download_limit(self):
-        """Set download speed limit using tc (Linux only)"""
-        # Check platform support
-        if self.is_windows:
-            self.show_modern_notification(
-                "Not Supported", 
-                "Bandwidth limiting is not supported on Windows. This feature requires Linux with Traffic Control (tc).", 
-                "warning"
-            )
-            return
-            
+        """Set download speed limit using tc, or the proxy off Linux"""
         speed = self.download_entry.get().strip()
         unit = self.download_unit.get()
         interface = self.selected_interface.get()
         
-        if not speed or not interface:
+        if not speed or not (interface or self.uses_proxy()):
             self.show_error_notification("Please enter speed and select interface")
             return
         
@@ -494,49 +679,28 @@ class NetworkSpeedController:
             return
         
         try:
-            # Remove existing rules
-            subprocess.run(f"sudo tc qdisc del dev {interface} root", shell=True, 
-                         stderr=subprocess.DEVNULL)
-            
-            # Add new download limit using HTB
-            commands = [
-                f"sudo tc qdisc add dev {interface} root handle 1: htb default 30",
-                f"sudo tc class add dev {interface} parent 1: classid 1:1 htb rate {speed_kbps}kbit",
-                f"sudo tc class add dev {interface} parent 1:1 classid 1:10 htb rate {speed_kbps}kbit ceil {speed_kbps}kbit"
-            ]
-            
-            for cmd in commands:
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                if result.returncode != 0:
-                    raise Exception(f"Command failed: {cmd}\n{result.stderr}")
-            
-            self.current_download_limit.set(f"{speed} {unit}")
-            self.log_status(f"✅ Download limit set to {speed} {unit}")
-            self.show_modern_notification("Success!", f"Download limit set to {speed} {unit}", "success")
-            
-            # Update stat card
-            if hasattr(self, 'download_stat_label'):
-                self.download_stat_label.config(text=f"{speed} {unit}")
+            if self.uses_proxy():
+                self.core.set_proxy_limits(download_kbps=speed_kbps)
+                self.log_proxy()
+                self.show_limit('download', f"{speed} {unit}")
+                self.log_status(f"✅ Download limit set to {speed} {unit}")
+                self.show_modern_notification("Success!", f"Download limit set to {speed} {unit}", "success")
+            else:
+                # Change the HTB class in place (the tree is only built when missing);
+                # the sidebar follows once it is applied
+                self.shape_interfaces({'download_kbps': speed_kbps,
+                                       'queue': QUEUE_CHOICES[self.queue_choice.get()]})
             
         except Exception as e:
             self.show_error_notification(f"Failed to set download limit: {str(e)}")
     
     def set_upload_limit(self):
-        """Set upload speed limit using tc (Linux only)"""
-        # Check platform support
-        if self.is_windows:
-            self.show_modern_notification(
-                "Not Supported", 
-                "Bandwidth limiting is not supported on Windows. This feature requires Linux with Traffic Control (tc).", 
-                "warning"
-            )
-            return
-            
+        """Set upload speed limit using tc, or the proxy off Linux"""
         speed = self.upload_entry.get().strip()
         unit = self.upload_unit.get()
         interface = self.selected_interface.get()
         
-        if not speed or not interface:
+        if not speed or not (interface or self.uses_proxy()):
             self.show_error_notification("Please enter speed and select interface")
             return
         
@@ -546,126 +710,223 @@ class NetworkSpeedController:
             return
         
         try:
-            # Remove existing ingress rules
-            subprocess.run(f"sudo tc qdisc del dev {interface} ingress", shell=True, 
-                         stderr=subprocess.DEVNULL)
-            
-            # For upload limiting, we need to use ifb (Intermediate Functional Block)
-            # This is more complex and requires additional setup
-            self.setup_upload_limiting(interface, speed_kbps)
-            
-            self.current_upload_limit.set(f"{speed} {unit}")
-            self.log_status(f"✅ Upload limit set to {speed} {unit}")
-            self.show_modern_notification("Success!", f"Upload limit set to {speed} {unit}", "success")
-            
-            # Update stat card
-            if hasattr(self, 'upload_stat_label'):
-                self.upload_stat_label.config(text=f"{speed} {unit}")
+            if self.uses_proxy():
+                self.core.set_proxy_limits(upload_kbps=speed_kbps)
+                self.log_proxy()
+                self.show_limit('upload', f"{speed} {unit}")
+                self.log_status(f"✅ Upload limit set to {speed} {unit}")
+                self.show_modern_notification("Success!", f"Upload limit set to {speed} {unit}", "success")
+            else:
+                # For upload limiting, we need to use ifb (Intermediate Functional Block)
+                # This is more complex and requires additional setup
+                self.setup_upload_limiting(interface, speed_kbps)
             
         except Exception as e:
             self.show_error_notification(f"Failed to set upload limit: {str(e)}")
     
     def setup_upload_limiting(self, interface, speed_kbps):
-        """Setup upload limiting using ifb"""
+        """Setup upload limiting on ingress, shaped on an IFB or policed"""
         try:
-            # Load ifb module
-            subprocess.run("sudo modprobe ifb", shell=True)
-            
-            # Create ifb interface
-            subprocess.run("sudo ip link add ifb0 type ifb", shell=True, stderr=subprocess.DEVNULL)
-            subprocess.run("sudo ip link set dev ifb0 up", shell=True)
-            
-            # Redirect ingress traffic to ifb0
-            commands = [
-                f"sudo tc qdisc add dev {interface} ingress",
-                f"sudo tc filter add dev {interface} parent ffff: protocol ip u32 match u32 0 0 flowid 1:1 action mirred egress redirect dev ifb0",
-                f"sudo tc qdisc add dev ifb0 root handle 1: htb default 30",
-                f"sudo tc class add dev ifb0 parent 1: classid 1:1 htb rate {speed_kbps}kbit",
-                f"sudo tc class add dev ifb0 parent 1:1 classid 1:10 htb rate {speed_kbps}kbit ceil {speed_kbps}kbit"
-            ]
-            
-            for cmd in commands:
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                if result.returncode != 0 and "File exists" not in result.stderr:
-                    self.log_status(f"Warning: {cmd} - {result.stderr.strip()}")
+            # Either redirect all ingress traffic to the IFB and shape it there,
+            # or police it on the ingress qdisc without the extra hop
+            self.shape_interfaces({'upload_kbps': speed_kbps,
+                                   'queue': QUEUE_CHOICES[self.queue_choice.get()],
+                                   'ingress_mode': INGRESS_CHOICES[self.ingress_choice.get()]})
                     
         except Exception as e:
             raise Exception(f"Upload limiting setup failed: {str(e)}")
     
+    def shape_interfaces(self, settings):
+        """Queue set_limits() ``settings`` (None clears) for the selected interface,
+        or for every interface when "all interfaces" is ticked"""
+        interfaces = self.interfaces if self.apply_all.get() else [self.selected_interface.get()]
+        for interface in interfaces:
+            if settings is None:
+                self.shaping.clear_limits(interface)
+            else:
+                self.shaping.set_limits(interface, **settings)
+
+    def on_shaping_event(self, event):
+        """Called from the shaping workers as operations queue, run and finish"""
+        self.updates.post(self.update_shaping, event)
+
+    def update_shaping(self, event):
+        """Log shaping progress; update the sidebar and notify once the queue is idle"""
+        interface, state = event['interface'], event['state']
+        if event['kind'] == 'call':
+            # Status reads log for themselves
+            pass
+        elif state == 'running':
+            waiting = event['pending'] - 1
+            self.log_status(f"Applying limits on {interface}"
+                            + (f" ({waiting} more queued)" if waiting else ""))
+        elif state == 'done':
+            policy, _, warning = event['result']
+            if event['kind'] == 'clear':
+                message = "All speed limits removed"
+                directions = ('download', 'upload')
+            else:
+                directions = [d for d in ('download', 'upload') if f'{d}_kbps' in event['settings']]
+                message = ", ".join(
+                    f"{direction.capitalize()} limit set to "
+                    f"{format_limit(getattr(policy, f'{direction}_kbps'))}"
+                    for direction in directions) or "Queue changed"
+            if interface == self.selected_interface.get():
+                for direction in directions:
+                    self.show_limit(direction, format_limit(getattr(policy, f'{direction}_kbps')))
+            self.log_status(f"✅ {message} on {interface}")
+            self.shaping_done = message if not self.apply_all.get() else f"{message} on all interfaces"
+            if warning:
+                self.shaping_warnings.append(f"{interface}: {warning}")
+        elif state == 'failed':
+            self.shaping_errors.append(f"{interface}: {event['error']}")
+            self.log_status(f"Failed to apply limits on {interface}: {event['error']}")
+        
+        if state in ('done', 'failed') and event['pending'] == 0:
+            if self.shaping_errors:
+                self.show_error_notification(f"Failed to apply limits: {'; '.join(self.shaping_errors)}")
+            elif self.shaping_warnings:
+                self.show_warning_notification('; '.join(self.shaping_warnings))
+            elif self.shaping_done:
+                self.show_modern_notification("Success!", self.shaping_done, "success")
+            self.shaping_done = None
+            self.shaping_errors = []
+            self.shaping_warnings = []
+    
     def remove_all_limits(self):
-        """Remove all speed limits (Linux only)"""
-        # Check platform support
-        if self.is_windows:
-            self.show_modern_notification(
-                "Not Supported", 
-                "Bandwidth limiting is not supported on Windows. This feature requires Linux with Traffic Control (tc).", 
-                "warning"
-            )
-            return
-            
+        """Remove all speed limits"""
         interface = self.selected_interface.get()
-        if not interface:
+        if not interface and not self.uses_proxy():
             self.show_error_notification("Please select an interface")
             return
         
         try:
-            # Remove all tc rules
-            commands = [
-                f"sudo tc qdisc del dev {interface} root",
-                f"sudo tc qdisc del dev {interface} ingress",
-                "sudo ip link del ifb0"
-            ]
-            
-            for cmd in commands:
-                subprocess.run(cmd, shell=True, stderr=subprocess.DEVNULL)
-            
-            self.current_download_limit.set("No limit")
-            self.current_upload_limit.set("No limit")
-            self.log_status("✅ All speed limits removed")
-            self.show_modern_notification("Success!", "All speed limits removed", "success")
-            
-            # Update stat cards
-            if hasattr(self, 'download_stat_label'):
-                self.download_stat_label.config(text="No limit")
-            if hasattr(self, 'upload_stat_label'):
-                self.upload_stat_label.config(text="No limit")
+            if self.uses_proxy():
+                # Keep proxying, so applications pointed at it still connect
+                if self.core.proxy:
+                    self.core.set_proxy_limits(download_kbps=None, upload_kbps=None)
+                self.show_limit('download', "No limit")
+                self.show_limit('upload', "No limit")
+                self.log_status("✅ All speed limits removed")
+                self.show_modern_notification("Success!", "All speed limits removed", "success")
+            else:
+                # Remove all tc rules and the interface's own ifb device
+                self.shape_interfaces(None)
             
         except Exception as e:
             self.show_error_notification(f"Failed to remove limits: {str(e)}")
     
+    def toggle_autorate(self):
+        """Start or stop adapting the selected interface's limits (Linux only)"""
+        from netthrottle.autorate import RateBounds
+        
+        if self.autorate_interface:
+            self.core.stop_autorate(self.autorate_interface)
+            self.log_status(f"Auto rate stopped on {self.autorate_interface}")
+            self.autorate_interface = None
+            self.autorate_status.set("Off")
+        if not self.autorate_enabled.get():
+            return
+        
+        interface = self.selected_interface.get()
+        maxima = {}
+        for direction, entry, unit in (('download', self.download_entry, self.download_unit),
+                                       ('upload', self.upload_entry, self.upload_unit)):
+            if entry.get().strip():
+                maxima[direction] = self.convert_to_kbps(entry.get().strip(), unit.get())
+        if self.is_windows or not interface or not maxima or None in maxima.values():
+            self.autorate_enabled.set(False)
+            self.show_error_notification("Select an interface and enter the link's download "
+                                         "and/or upload speed")
+            return
+        
+        try:
+            bounds = {direction: RateBounds.for_capacity(kbps) for direction, kbps in maxima.items()}
+            self.core.start_autorate(interface, callback=self.on_autorate_step, **bounds)
+            self.autorate_interface = interface
+            self.log_status(f"Auto rate started on {interface}")
+        except Exception as e:
+            self.autorate_enabled.set(False)
+            self.show_error_notification(f"Failed to start auto rate: {str(e)}")
+    
+    def on_autorate_step(self, step):
+        """Called from the autorate thread after every control tick"""
+        self.updates.post_latest('autorate', self.update_autorate_display, step)
+    
+    def update_autorate_display(self, step):
+        """Show the rates autorate has set and the queueing delay it measures"""
+        if step['interface'] != self.autorate_interface:
+            return
+        if step['error']:
+            self.autorate_status.set(f"Error: {step['error']}")
+            return
+        rates = step['rate_kbps']
+        if 'download' in rates:
+            self.current_download_limit.set(format_limit(rates['download']))
+        if 'upload' in rates:
+            self.current_upload_limit.set(format_limit(rates['upload']))
+        delay = "no reply" if step['delay_ms'] is None else f"+{step['delay_ms']:.0f} ms"
+        self.autorate_status.set(f"Latency {delay}, " + ", ".join(
+            f"{direction} {format_limit(rate)}" for direction, rate in rates.items()))
+    
+    def log_tc_stats(self, interface):
+        """Log the qdiscs and classes shaping ``interface``, with rates since the last refresh"""
+        from netthrottle.tcstats import TcStats
+
+        if self.tc_stats is None:
+            self.tc_stats = TcStats(self.core)
+        stats = self.tc_stats.poll(interface)
+        for direction in ('download', 'upload'):
+            tree = stats[direction]
+            if tree is None:
+                self.log_status(f"{direction.capitalize()}: not shaped")
+                continue
+            link = tree['link']
+            line = f"{direction.capitalize()} on {tree['device']}"
+            if link:
+                line += f": rx {format_speed(link['rx'] / 1024)}, tx {format_speed(link['tx'] / 1024)}"
+            self.log_status(line)
+            for qdisc in tree['qdiscs']:
+                self.log_status(f"  {format_tc_entry('qdisc', qdisc['handle'], qdisc)}")
+            for cls in tree['classes']:
+                self.log_status(f"  {format_tc_entry('class', cls['classid'], cls)}")
+        if not stats['elapsed']:
+            self.log_status("Refresh again to see rates")
+
     def refresh_status(self):
         """Refresh the current status (cross-platform)"""
         interface = self.selected_interface.get()
         if not interface:
             return
-        
+        # Read behind any change still queued for the interface, off the Tk thread
+        self.shaping.call(interface, self.log_interface_status, interface)
+
+    def log_interface_status(self, interface):
+        """Log the shaping and counters of ``interface``; runs on a shaping worker"""
         try:
             # Platform-specific status checking
             if self.is_linux:
-                # Check current tc rules on Linux
-                result = subprocess.run(f"tc qdisc show dev {interface}", shell=True, 
-                                      capture_output=True, text=True)
-                
                 self.log_status("=== Current Traffic Control Rules ===")
-                if result.stdout.strip():
-                    self.log_status(result.stdout)
-                else:
-                    self.log_status("No traffic control rules found")
+                try:
+                    self.log_tc_stats(interface)
+                except Exception as e:
+                    self.log_status(f"Could not read traffic control statistics: {e}")
             elif self.is_windows:
                 # Windows status
                 self.log_status("=== Windows Platform Status ===")
-                self.log_status("Traffic control not supported on Windows")
-                self.log_status("Monitoring network statistics only")
+                if self.core.proxy and self.core.proxy.listening:
+                    self.log_proxy()
+                else:
+                    self.log_status("No limits set; the SOCKS5 proxy starts with the first one")
                 
             # Check network statistics (works on all platforms)
-            stats = psutil.net_io_counters(pernic=True)
-            if interface in stats:
-                stat = stats[interface]
+            stat = self.core.interface_counters(interface)
+            if stat:
                 self.log_status(f"\n=== Interface {interface} Statistics ===")
-                self.log_status(f"Bytes sent: {stat.bytes_sent:,}")
-                self.log_status(f"Bytes received: {stat.bytes_recv:,}")
-                self.log_status(f"Packets sent: {stat.packets_sent:,}")
-                self.log_status(f"Packets received: {stat.packets_recv:,}")
+                self.log_status(f"Bytes sent: {stat['bytes_sent']:,}")
+                self.log_status(f"Bytes received: {stat['bytes_recv']:,}")
+                self.log_status(f"Packets sent: {stat['packets_sent']:,}")
+                self.log_status(f"Packets received: {stat['packets_recv']:,}")
             else:
                 self.log_status(f"Interface {interface} not found in statistics")
                 
@@ -674,63 +935,86 @@ class NetworkSpeedController:
     
     def start_monitoring(self):
         """Start network monitoring"""
-        if not self.is_monitoring:
-            self.is_monitoring = True
-            self.monitoring_thread = threading.Thread(target=self.monitor_network, daemon=True)
-            self.monitoring_thread.start()
+        self.core.start_monitoring(self.selected_interface.get, self.on_speed_sample,
+                                   interval=MONITOR_INTERVAL)
+        if self.is_linux:
+            # Sorting by name still ranks the busiest links by total traffic
+            self.core.start_top_monitoring(
+                self.on_top_sample, lambda: 'total' if self.top_sort == 'interface' else self.top_sort,
+                count=TOP_LINKS)
+            self.core.start_queue_monitoring(self.selected_interface.get, self.on_queue_sample)
+            # Data caps are counted here unless a daemon already counts them
+            self.core.start_quota(self.on_quota_change)
     
-    def monitor_network(self):
-        """Monitor network activity"""
-        last_stats = None
-        
-        while self.is_monitoring:
-            try:
-                interface = self.selected_interface.get()
-                if interface:
-                    stats = psutil.net_io_counters(pernic=True)
-                    if interface in stats:
-                        current_stats = stats[interface]
-                        
-                        if last_stats:
-                            bytes_sent_diff = current_stats.bytes_sent - last_stats.bytes_sent
-                            bytes_recv_diff = current_stats.bytes_recv - last_stats.bytes_recv
-                            
-                            # Convert to KB/s
-                            upload_speed = bytes_sent_diff / 1024
-                            download_speed = bytes_recv_diff / 1024
-                            
-                            # Update status every 5 seconds
-                            if int(time.time()) % 5 == 0:
-                                self.root.after(0, self.update_speed_display, 
-                                               upload_speed, download_speed)
-                        
-                        last_stats = current_stats
-                
-                time.sleep(1)
-                
-            except Exception:
-                time.sleep(1)
-    
-    def update_speed_display(self, upload_speed, download_speed):
-        """Update speed display in status with modern formatting"""
-        # Format speeds with units
-        def format_speed(speed_kbs):
-            if speed_kbs > 1024:
-                return f"{speed_kbs/1024:.1f} MB/s"
-            else:
-                return f"{speed_kbs:.1f} KB/s"
-        
-        download_formatted = format_speed(download_speed)
-        upload_formatted = format_speed(upload_speed)
+    def start_metrics(self):
+        """Serve OpenMetrics on the address from the settings file"""
+        from netthrottle.metrics import parse_address
+
+        try:
+            address, port = parse_address(self.metrics_address)
+            self.core.start_metrics(address, port)
+            self.log_status(f"📈 Metrics on http://{address}:{port}/metrics")
+        except (OSError, ValueError) as e:
+            self.log_status(f"Error starting the metrics exporter: {e}")
+
+    def on_quota_change(self, change):
+        """Called from the quota thread when a data cap changes an interface's limits"""
+        interface = change['interface']
+        if change.get('error') and interface is None:
+            self.log_status(f"Error: {change['error']}")
+        elif change.get('error'):
+            self.log_status(f"Error applying the data cap tier on {interface}: {change['error']}")
+        elif change['to'] < 0:
+            self.log_status(f"Data cap period restarted on {interface}, limits restored")
+        else:
+            used = f"{format_bytes(change['used_bytes'])} of {format_bytes(change['limit_bytes'])}"
+            limits = [f"{direction} {format_limit(change[f'{direction}_kbps'])}"
+                      for direction in ('download', 'upload') if change[f'{direction}_kbps']]
+            self.log_status(f"Warning: {used} used on {interface}, "
+                            f"limits now {', '.join(limits) or 'unchanged'}")
+    
+    def on_queue_sample(self, interface, stats):
+        """Called from the monitoring thread with the backlog and drops of the shaping queues"""
+        self.updates.post_latest('queues', self.update_queue_display, interface, stats)
+    
+    def update_queue_display(self, interface, stats):
+        """Show the queue counters under the current limits"""
+        if interface != self.selected_interface.get():
+            return
+        self.download_queue.set(f"Queue: {format_queue(stats['download'])}")
+        self.upload_queue.set(f"Queue: {format_queue(stats['upload'])}")
+    
+    def on_speed_sample(self, upload_speed, download_speed):
+        """Called from the monitoring thread with the latest KB/s rates"""
+        self.updates.post_batch('speed', (upload_speed, download_speed, time.monotonic()))
+    
+    def update_speed_display(self, samples):
+        """Feed a frame's worth of samples to the live chart and refresh the stat cards"""
+        interface = self.selected_interface.get()
+        if interface != self.chart_interface:
+            self.chart_interface = interface
+            self.chart.clear()
+        for upload_speed, download_speed, timestamp in samples:
+            self.chart.add_sample('download', download_speed, timestamp)
+            self.chart.add_sample('upload', upload_speed, timestamp)
+        
+        # The cards only need the newest value, about once a second
+        previous = self.speed_samples
+        self.speed_samples += len(samples)
+        if self.speed_samples // CARD_UPDATE_EVERY == previous // CARD_UPDATE_EVERY:
+            return
+        stats = self.core.speed_stats(interface)
+        # Right after an interface switch the ring has no rate yet: keep the sample's
+        if stats and stats['rx']['ewma'] is not None:
+            download_speed = stats['rx']['ewma'] / 1024
+        if stats and stats['tx']['ewma'] is not None:
+            upload_speed = stats['tx']['ewma'] / 1024
         
         # Update stat cards
         if hasattr(self, 'download_stat_label') and download_speed > 0:
-            self.download_stat_label.config(text=download_formatted)
+            self.download_stat_label.config(text=format_speed(download_speed))
         if hasattr(self, 'upload_stat_label') and upload_speed > 0:
-            self.upload_stat_label.config(text=upload_formatted)
-        
-        status_msg = f"📊 Real-time → ↓ {download_formatted} | ↑ {upload_formatted}"
-        self.log_status(status_msg)
+            self.upload_stat_label.config(text=format_speed(upload_speed))
     
     def log_status(self, message):
         """Log message to status text widget with modern formatting"""
@@ -753,45 +1037,53 @@ class NetworkSpeedController:
             prefix = "ℹ️"
             color = "#ffffff"
         
-        # Insert message with timestamp
-        self.status_text.insert(tk.END, f"[{timestamp}] {prefix} {message}\n")
+        # Lines are written once per frame, whichever thread logged them
+        self.updates.post_batch('log', f"[{timestamp}] {prefix} {message}\n")
+    
+    def write_log(self, lines):
+        """Append a batch of log lines, scroll once and trim in bulk"""
+        self.status_text.insert(tk.END, ''.join(lines))
+        self.log_lines += sum(line.count('\n') for line in lines)
+        if self.log_lines > MAX_LOG_LINES + LOG_TRIM_SLACK:
+            excess = self.log_lines - MAX_LOG_LINES
+            self.status_text.delete('1.0', f'{excess + 1}.0')
+            self.log_lines -= excess
         self.status_text.see(tk.END)
-        
-        # Auto-scroll and limit text length
-        if int(self.status_text.index('end-1c').split('.')[0]) > 100:
-            self.status_text.delete(1.0, 50.0)
     
     def save_settings(self):
         """Save current settings"""
-        settings = {
+        self.core.save_settings({
             'interface': self.selected_interface.get(),
+            'apply_all': self.apply_all.get(),
             'download_limit': self.current_download_limit.get(),
-            'upload_limit': self.current_upload_limit.get()
-        }
-        
-        try:
-            with open('speed_limiter_settings.json', 'w') as f:
-                json.dump(settings, f)
-        except Exception:
-            pass
+            'upload_limit': self.current_upload_limit.get(),
+            'queue': QUEUE_CHOICES[self.queue_choice.get()],
+            'ingress_mode': INGRESS_CHOICES[self.ingress_choice.get()],
+            'metrics': self.metrics_address
+        })
     
     def load_settings(self):
         """Load saved settings"""
-        try:
-            if os.path.exists('speed_limiter_settings.json'):
-                with open('speed_limiter_settings.json', 'r') as f:
-                    settings = json.load(f)
-                    
-                if 'interface' in settings and settings['interface'] in self.interfaces:
-                    self.selected_interface.set(settings['interface'])
-                    
-        except Exception:
-            pass
+        settings = self.core.load_settings()
+        if 'interface' in settings and settings['interface'] in self.interfaces:
+            self.selected_interface.set(settings['interface'])
+        self.apply_all.set(bool(settings.get('apply_all')))
+        for label, queue in QUEUE_CHOICES.items():
+            if settings.get('queue') == queue:
+                self.queue_choice.set(label)
+        for label, mode in INGRESS_CHOICES.items():
+            if settings.get('ingress_mode') == mode:
+                self.ingress_choice.set(label)
+        self.metrics_address = settings.get('metrics')
     
     def on_closing(self):
         """Handle application closing"""
-        self.is_monitoring = False
         self.save_settings()
+        self.shaping.close()
+        self.updates.stop()
+        if self.tc_stats:
+            self.tc_stats.close()
+        self.core.close()
         self.root.destroy()
     
     def run(self):
@@ -0,0 +1,3 @@
+"""NetThrottle - network speed monitoring and bandwidth control"""
+
+__version__ = "1.0.0"
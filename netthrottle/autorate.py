@@ -0,0 +1,316 @@
+"""Closed-loop rate control: keep the link busy, but its queue short.
+
+A shaper only helps while its rate is just below the real capacity of the
+link; above it the queue builds up in the modem or the ISP instead. When that
+capacity varies (LTE, cable, shared Wi-Fi) a fixed limit is either too low
+most of the time or too high some of the time.
+
+``AutoRate`` closes the loop every tick: it reads the interface's throughput
+from the Sampler and the round-trip time to a few reflectors from a
+LatencyProbe. Queueing delay is the RTT above a slowly tracked baseline. For
+every limited direction:
+
+- delay over the target while the direction carries traffic means the rate
+  is above the capacity: cut to a fraction of what actually got through, and
+  hold the rate there for a few ticks
+- a loaded direction with a short queue is probed upwards, by up to 6% a
+  tick, less the closer the delay is to the target
+- an idle direction drifts back towards its base rate
+
+Rates only change through ThrottleCore.set_limits, which changes the HTB
+class (or the cake shaper's bandwidth) in place rather than rebuilding the tree.
+"""
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass
+
+DEFAULT_REFLECTORS = ('1.1.1.1', '8.8.8.8', '9.9.9.9')
+DEFAULT_TARGET_MS = 15.0
+DEFAULT_INTERVAL = 0.5
+
+# A direction counts as loaded above this fraction of its current rate
+LOADED = 0.75
+# Below this fraction of its rate a direction is idle and the delay is not its
+# doing; above it, a capacity that dropped under the rate is cut back to
+IDLE = 0.1
+# On delay: rate = achieved * CUT, but never below rate * MAX_CUT
+CUT = 0.9
+MAX_CUT = 0.5
+# Largest increase per tick while loaded, scaled down as the delay nears the target
+INCREASE = 0.06
+# Per tick while idle, as the fraction of the distance to the base rate
+DRIFT = 0.1
+# Ticks after a cut without further changes, while the queue drains
+HOLD_TICKS = 4
+# Changes smaller than this fraction of the rate are not applied
+TOLERANCE = 0.02
+# How fast the baseline RTT follows a rising RTT, per sample; it follows a
+# falling one at once, so it settles at the unloaded RTT of the path
+BASELINE_RISE = 0.002
+
+ICMP_ECHO = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct('!BBHHH')
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+
+def checksum(data):
+    """RFC 1071 internet checksum"""
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+@dataclass
+class RateBounds:
+    """Range an adaptive limit moves in, in kbit/s"""
+
+    minimum: int
+    base: int
+    maximum: int
+
+    def __post_init__(self):
+        if not 0 < self.minimum <= self.base <= self.maximum:
+            raise ValueError("Rates must satisfy 0 < minimum <= base <= maximum")
+
+    @classmethod
+    def for_capacity(cls, maximum):
+        """Bounds for a link of nominal capacity ``maximum`` kbit/s"""
+        return cls(max(1, maximum // 5), max(1, maximum * 3 // 5), maximum)
+
+
+class LatencyProbe:
+    """Round-trip time to a set of IPv4 reflectors with ICMP echo.
+
+    Uses an unprivileged ping socket where net.ipv4.ping_group_range allows
+    it, and a raw socket (root or CAP_NET_RAW) otherwise. With ``interface``
+    the probes are bound to it, so they take the shaped path.
+    """
+
+    def __init__(self, reflectors=DEFAULT_REFLECTORS, interface=None, timeout=0.4):
+        self.reflectors = [socket.gethostbyname(host) for host in reflectors]
+        self.timeout = timeout
+        self.ident = os.getpid() & 0xffff
+        self.sequence = 0
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        except OSError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        if interface:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, interface.encode())
+            except OSError:
+                pass
+        self.sock.setblocking(False)
+
+    def close(self):
+        self.sock.close()
+
+    def _send(self, address):
+        self.sequence = (self.sequence + 1) & 0xffff
+        payload = struct.pack('!Q', time.monotonic_ns())
+        header = ICMP_HEADER.pack(ICMP_ECHO, 0, 0, self.ident, self.sequence)
+        packet = ICMP_HEADER.pack(ICMP_ECHO, 0, checksum(header + payload),
+                                  self.ident, self.sequence) + payload
+        try:
+            self.sock.sendto(packet, (address, 0))
+        except OSError:
+            return None
+        return self.sequence
+
+    def _reply(self, data):
+        """Sequence number of an echo reply meant for us, or None"""
+        if self.raw:
+            data = data[(data[0] & 0x0f) * 4:]
+        if len(data) < ICMP_HEADER.size:
+            return None
+        kind, _, _, ident, sequence = ICMP_HEADER.unpack_from(data)
+        # Ping sockets rewrite the identifier and only deliver their own replies
+        if kind != ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+            return None
+        return sequence
+
+    def rtt(self):
+        """Lowest round-trip time of one echo to every reflector in ms, or None"""
+        sent = {}
+        for address in self.reflectors:
+            started = time.monotonic_ns()
+            sequence = self._send(address)
+            if sequence is not None:
+                sent[sequence] = started
+        best = None
+        deadline = time.monotonic() + self.timeout
+        while sent:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                break
+            try:
+                data = self.sock.recv(2048)
+            except OSError:
+                continue
+            started = sent.pop(self._reply(data), None)
+            if started is not None:
+                rtt = (time.monotonic_ns() - started) / 1e6
+                best = rtt if best is None else min(best, rtt)
+        return best
+
+
+class RateController:
+    """The adaptive rate of one direction"""
+
+    def __init__(self, bounds, target_ms=DEFAULT_TARGET_MS):
+        self.bounds = bounds
+        self.target_ms = target_ms
+        self.rate = bounds.base
+        self.hold = 0
+
+    def update(self, load_kbps, delay_ms):
+        """Next rate in kbit/s from this tick's load and queueing delay (None if unknown)"""
+        bounds = self.bounds
+        utilisation = load_kbps / self.rate
+        hold, self.hold = self.hold, max(0, self.hold - 1)
+        if delay_ms is not None and delay_ms > self.target_ms:
+            if utilisation >= IDLE and not hold:
+                cut = max(load_kbps * CUT, self.rate * MAX_CUT)
+                self.rate = max(bounds.minimum, min(self.rate * CUT, cut))
+                self.hold = HOLD_TICKS
+        elif utilisation >= LOADED:
+            if not hold:
+                headroom = 1 - (delay_ms or 0) / self.target_ms
+                self.rate = min(bounds.maximum, self.rate * (1 + INCREASE * headroom))
+        else:
+            self.rate += (bounds.base - self.rate) * DRIFT
+        return self.rate
+
+
+class AutoRate:
+    """Adjusts the limits of one interface from its throughput and latency.
+
+    ``download`` and ``upload`` are RateBounds, or None to leave that limit
+    alone; they are the limits of the same names in InterfacePolicy.
+    """
+
+    def __init__(self, core, interface, download=None, upload=None,
+                 reflectors=DEFAULT_REFLECTORS, target_ms=DEFAULT_TARGET_MS,
+                 interval=DEFAULT_INTERVAL, probe=None):
+        if download is None and upload is None:
+            raise ValueError("Autorate needs a download or an upload range")
+        self.core = core
+        self.interface = interface
+        self.interval = interval
+        self.controllers = {}
+        if download:
+            self.controllers['download'] = RateController(download, target_ms)
+        if upload:
+            self.controllers['upload'] = RateController(upload, target_ms)
+        self.probe = probe or LatencyProbe(reflectors, interface, timeout=interval * 0.8)
+        self.baseline = None
+        self.applied = {}
+        # Queue behind the limits, as of the last change
+        self.queue = None
+
+    def close(self):
+        self.probe.close()
+
+    def delay(self, rtt):
+        """Queueing delay of one RTT sample in ms, updating the baseline"""
+        if rtt is None:
+            return None
+        if self.baseline is None or rtt < self.baseline:
+            self.baseline = rtt
+        else:
+            self.baseline += (rtt - self.baseline) * BASELINE_RISE
+        return rtt - self.baseline
+
+    def own_delay(self):
+        """Time the probes spend in our own shaping queues, in ms.
+
+        With a FIFO behind the limits the probes wait behind the bulk traffic
+        they measure; fq_codel and cake give them a queue of their own.
+        """
+        from .policy import FIFO
+
+        if self.queue != FIFO:
+            return 0.0
+        try:
+            stats = self.core.queue_stats(self.interface)
+        except Exception:
+            return 0.0
+        delay = 0.0
+        for direction, rate in self.applied.items():
+            backlog = (stats.get(direction) or {}).get('backlog', 0)
+            delay += backlog * 8 / rate
+        return delay
+
+    def step(self, rates):
+        """One control tick; ``rates`` is the Sampler's (rx, tx) for the interface.
+
+        Returns a plain dict with the measurements and the rates in force.
+        """
+        rx, tx = rates
+        # The download limit shapes egress (tx), the upload limit ingress (rx)
+        load = {'download': tx * 8 / 1000, 'upload': rx * 8 / 1000}
+        queued = self.own_delay()
+        rtt = self.probe.rtt()
+        delay = self.delay(rtt)
+        if delay is not None:
+            delay = max(0.0, delay - queued)
+        targets = {direction: round(controller.update(load[direction], delay))
+                   for direction, controller in self.controllers.items()}
+        changed = {direction: rate for direction, rate in targets.items()
+                   if abs(rate - self.applied.get(direction, 0)) > rate * TOLERANCE}
+        error = None
+        if changed:
+            try:
+                # Not journaled: a restore brings back the limits set by hand
+                policy, _, _ = self.core.set_limits(self.interface,
+                                                 download_kbps=changed.get('download'),
+                                                 upload_kbps=changed.get('upload'), persist=False)
+                self.applied.update(changed)
+                self.queue = policy.queue
+            except Exception as e:
+                error = str(e)
+        return {
+            'interface': self.interface,
+            'time': time.time(),
+            'rtt_ms': rtt,
+            'baseline_ms': self.baseline,
+            'delay_ms': delay,
+            'own_queue_ms': queued,
+            'load_kbps': {direction: load[direction] for direction in self.controllers},
+            'rate_kbps': dict(self.applied),
+            'changed': [] if error else sorted(changed),
+            'error': error,
+        }
+
+    def run(self, stop, callback=None):
+        """Control the interface every interval until ``stop`` is set"""
+        from .sampler import Sampler, ticks
+
+        sampler = Sampler([self.interface], interval=self.interval)
+        try:
+            sampler.poll()
+            for _ in ticks(self.interval, stop):
+                rates = sampler.poll().get(self.interface)
+                if rates is None:
+                    continue
+                result = self.step(rates)
+                if callback:
+                    callback(result)
+        finally:
+            sampler.close()
+
+    def start(self, callback=None):
+        """Run on a daemon thread; returns the Event that stops it"""
+        stop = threading.Event()
+        threading.Thread(target=self.run, args=(stop, callback), daemon=True).start()
+        return stop
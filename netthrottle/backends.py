@@ -0,0 +1,961 @@
+"""Pluggable traffic-shaping backends.
+
+``NetlinkBackend`` talks rtnetlink over a persistent socket and is used
+whenever the process has CAP_NET_ADMIN. ``ShellBackend`` keeps the original
+``sudo tc`` / ``sudo ip`` behaviour as a fallback.
+"""
+import errno
+import json
+import os
+import platform
+import re
+import subprocess
+import threading
+
+from . import netlink as nl
+from . import tc
+
+CAP_NET_ADMIN = 12
+
+# Counters "tc -s -j" reports for a qdisc, including those of fq_codel
+QDISC_STATS = ('bytes', 'packets', 'qlen', 'backlog', 'drops', 'requeues', 'overlimits') + \
+    tc.FQ_CODEL_XSTATS_FIELDS
+PROTOCOLS = {'ip': tc.ETH_P_IP, 'all': tc.ETH_P_ALL, 'ipv6': 0x86DD}
+RATE_UNITS = {'bit': 1, 'kbit': 1000, 'mbit': 1000 ** 2, 'gbit': 1000 ** 3, 'tbit': 1000 ** 4}
+CLASS_LINE = re.compile(r'^class (\S+) (\S+) (?:root|parent (\S+))')
+# Statistics lines of "tc -s class show", mapped to the netlink counter names
+CLASS_STATS = (
+    (re.compile(r'Sent (\d+) bytes (\d+) pkt \(dropped (\d+), overlimits (\d+) requeues (\d+)'),
+     ('bytes', 'packets', 'drops', 'overlimits', 'requeues')),
+    (re.compile(r'backlog (\S+) (\d+)p'), ('backlog', 'qlen')),
+    (re.compile(r'lended: (\d+) borrowed: (\d+) giants: (\d+)'), ('lended', 'borrowed', 'giants')),
+    (re.compile(r'tokens: (-?\d+) ctokens: (-?\d+)'), ('tokens', 'ctokens')),
+)
+# tc prints queue sizes in powers of 1024
+SIZE_UNITS = {'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+
+
+class BackendError(Exception):
+    """A shaping operation failed"""
+
+
+class ShapingBackend:
+    """Primitive tc operations and state queries used by the reconciler.
+
+    Qdiscs, classes and filters are reported as plain dicts with handles in
+    tc notation ("1:10", "root", "ingress") and HTB rates in kbit. Qdiscs
+    and classes also carry their ``stats`` counters.
+    """
+
+    name = 'base'
+
+    def get_qdiscs(self, dev):
+        raise NotImplementedError
+
+    def get_classes(self, dev):
+        raise NotImplementedError
+
+    def get_filters(self, dev, parent):
+        raise NotImplementedError
+
+    def link_state(self, name):
+        """True/False for an existing link being up, None if it does not exist"""
+        raise NotImplementedError
+
+    def add_htb_qdisc(self, dev, handle='1:', parent='root', default=0x30):
+        raise NotImplementedError
+
+    def add_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        raise NotImplementedError
+
+    def change_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        """Update rate/ceil of an existing class in place"""
+        raise NotImplementedError
+
+    def delete_class(self, dev, classid):
+        raise NotImplementedError
+
+    def add_ingress_qdisc(self, dev):
+        raise NotImplementedError
+
+    def add_fq_codel_qdisc(self, dev, parent, target_us, interval_us, flows=None):
+        """Attach fq_codel below ``parent`` (an HTB class)"""
+        raise NotImplementedError
+
+    def change_fq_codel_qdisc(self, dev, parent, target_us, interval_us):
+        raise NotImplementedError
+
+    def add_cake_qdisc(self, dev, parent, handle=None, bandwidth_kbps=None, ingress=False):
+        """Attach cake shaping at ``bandwidth_kbps`` (None: unlimited)"""
+        raise NotImplementedError
+
+    def change_cake_qdisc(self, dev, parent, bandwidth_kbps=None):
+        raise NotImplementedError
+
+    def add_redirect_filter(self, dev, target, flowid='1:1'):
+        """Redirect everything arriving on ``dev``, whatever its protocol, to ``target``"""
+        raise NotImplementedError
+
+    def add_police_filter(self, dev, rate_kbps, burst_bytes):
+        """Drop whatever arrives on ``dev`` above ``rate_kbps`` (needs an ingress qdisc)"""
+        raise NotImplementedError
+
+    def change_police_filter(self, dev, prio, handle, rate_kbps, burst_bytes):
+        """Update the rate of the police filter ``handle`` in place"""
+        raise NotImplementedError
+
+    def delete_filter(self, dev, parent, prio):
+        """Delete every filter at ``prio``, ignoring the case where there is none"""
+        raise NotImplementedError
+
+    def get_u32_nodes(self, dev, parent, prio):
+        """u32 hash tables and nodes at ``prio`` as dicts.
+
+        Every entry has an integer ``handle``; tables carry ``divisor``, nodes
+        carry ``keys`` as (value, mask, offset) words plus ``classid`` or ``link``.
+        """
+        raise NotImplementedError
+
+    def add_u32_table(self, dev, parent, prio, htid, divisor):
+        raise NotImplementedError
+
+    def add_u32_node(self, dev, parent, prio, handle, keys, flowid=None, link=None,
+                     hashkey=(0, 0), eat=False):
+        """Add a u32 node that classifies to ``flowid`` or jumps to hash table ``link``"""
+        raise NotImplementedError
+
+    def delete_u32_node(self, dev, parent, prio, handle):
+        """Delete a u32 node, or a whole (empty, unlinked) hash table"""
+        raise NotImplementedError
+
+    def delete_qdisc(self, dev, parent='root'):
+        """Delete a qdisc, ignoring the case where none is installed"""
+        raise NotImplementedError
+
+    def create_ifb(self, name):
+        """Create (if needed) and bring up an IFB device"""
+        raise NotImplementedError
+
+    def delete_link(self, name):
+        """Delete a link, ignoring the case where it does not exist"""
+        raise NotImplementedError
+
+    def run(self, steps):
+        """Apply reconcile steps in order"""
+        for step in steps:
+            step.apply(self)
+
+    def close(self):
+        pass
+
+
+class NetlinkBackend(ShapingBackend):
+    """Applies tc changes directly over rtnetlink, without spawning processes"""
+
+    name = 'netlink'
+
+    def __init__(self):
+        self.sock = nl.NetlinkSocket()
+
+    def close(self):
+        self.sock.close()
+
+    def _request(self, msg_type, flags, payload):
+        try:
+            return self.sock.request(msg_type, payload, flags | nl.NLM_F_ACK)
+        except nl.NetlinkError as e:
+            raise BackendError(str(e)) from e
+
+    def _ifindex(self, dev):
+        try:
+            return nl.link_index(dev)
+        except nl.NetlinkError as e:
+            raise BackendError(str(e)) from e
+
+    def _dump(self, msg_type, payload):
+        try:
+            return self.sock.dump(msg_type, payload)
+        except nl.NetlinkError as e:
+            raise BackendError(str(e)) from e
+
+    def get_qdiscs(self, dev):
+        ifindex = self._ifindex(dev)
+        qdiscs = (tc.decode_qdisc(payload)
+                  for _, payload in self._dump(nl.RTM_GETQDISC, nl.tcmsg(0)))
+        return [q for q in qdiscs if q.pop('ifindex') == ifindex]
+
+    def get_classes(self, dev):
+        replies = self._dump(nl.RTM_GETTCLASS, nl.tcmsg(self._ifindex(dev)))
+        return [tc.decode_class(payload) for _, payload in replies]
+
+    def get_filters(self, dev, parent):
+        msg = nl.tcmsg(self._ifindex(dev), 0, tc.parse_handle(parent))
+        filters = [tc.decode_filter(payload) for _, payload in self._dump(nl.RTM_GETTFILTER, msg)]
+        # Skip the per-priority classifier heads and u32 hash table nodes
+        return [f for f in filters
+                if f['handle'] and (f['kind'] != 'u32' or f['handle'] & 0xFFF)]
+
+    def link_state(self, name):
+        try:
+            replies = self.sock.request(nl.RTM_GETLINK, nl.ifinfomsg(nl.link_index(name)), 0)
+        except nl.NetlinkError:
+            return None
+        for _, payload in replies:
+            return bool(nl.IFINFOMSG.unpack_from(payload)[3] & nl.IFF_UP)
+        return None
+
+    # Each _build_<method> returns the (type, flags, payload) request for <method>,
+    # so run() can send a sequence of them as one batch
+
+    def _build_add_htb_qdisc(self, dev, handle='1:', parent='root', default=0x30):
+        msg = nl.tcmsg(self._ifindex(dev), tc.parse_handle(handle), tc.parse_handle(parent))
+        msg += nl.attr_str(tc.TCA_KIND, 'htb') + tc.htb_qdisc_options(default)
+        return nl.RTM_NEWQDISC, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _build_add_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        msg = nl.tcmsg(self._ifindex(dev), tc.parse_handle(classid), tc.parse_handle(parent))
+        msg += nl.attr_str(tc.TCA_KIND, 'htb') + tc.htb_class_options(rate_kbps, ceil_kbps)
+        return nl.RTM_NEWTCLASS, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _build_change_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        msg = nl.tcmsg(self._ifindex(dev), tc.parse_handle(classid), tc.parse_handle(parent))
+        msg += nl.attr_str(tc.TCA_KIND, 'htb') + tc.htb_class_options(rate_kbps, ceil_kbps)
+        return nl.RTM_NEWTCLASS, 0, msg
+
+    def _build_delete_class(self, dev, classid):
+        return nl.RTM_DELTCLASS, 0, nl.tcmsg(self._ifindex(dev), tc.parse_handle(classid))
+
+    def _build_add_ingress_qdisc(self, dev):
+        msg = nl.tcmsg(self._ifindex(dev), tc.INGRESS_HANDLE, tc.TC_H_INGRESS)
+        msg += nl.attr_str(tc.TCA_KIND, 'ingress') + nl.nested(tc.TCA_OPTIONS)
+        return nl.RTM_NEWQDISC, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _qdisc_request(self, dev, parent, handle, kind, options, flags):
+        msg = nl.tcmsg(self._ifindex(dev), tc.parse_handle(handle or 0), tc.parse_handle(parent))
+        return nl.RTM_NEWQDISC, flags, msg + nl.attr_str(tc.TCA_KIND, kind) + options
+
+    def _build_add_fq_codel_qdisc(self, dev, parent, target_us, interval_us, flows=None):
+        return self._qdisc_request(dev, parent, None, 'fq_codel',
+                                   tc.fq_codel_options(target_us, interval_us, flows),
+                                   nl.NLM_F_CREATE | nl.NLM_F_EXCL)
+
+    def _build_change_fq_codel_qdisc(self, dev, parent, target_us, interval_us):
+        return self._qdisc_request(dev, parent, None, 'fq_codel',
+                                   tc.fq_codel_options(target_us, interval_us), 0)
+
+    def _build_add_cake_qdisc(self, dev, parent, handle=None, bandwidth_kbps=None, ingress=False):
+        return self._qdisc_request(dev, parent, handle, 'cake',
+                                   tc.cake_options(bandwidth_kbps, ingress),
+                                   nl.NLM_F_CREATE | nl.NLM_F_EXCL)
+
+    def _build_change_cake_qdisc(self, dev, parent, bandwidth_kbps=None):
+        return self._qdisc_request(dev, parent, None, 'cake', tc.cake_options(bandwidth_kbps), 0)
+
+    def _build_add_redirect_filter(self, dev, target, flowid='1:1'):
+        msg = nl.tcmsg(self._ifindex(dev), 0, tc.INGRESS_HANDLE,
+                       tc.filter_info(0, tc.ETH_P_ALL))
+        msg += nl.attr_str(tc.TCA_KIND, 'u32')
+        msg += tc.u32_redirect_options(self._ifindex(target), tc.parse_handle(flowid))
+        return nl.RTM_NEWTFILTER, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _build_add_police_filter(self, dev, rate_kbps, burst_bytes):
+        msg = nl.tcmsg(self._ifindex(dev), 0, tc.INGRESS_HANDLE,
+                       tc.filter_info(0, tc.ETH_P_ALL))
+        msg += nl.attr_str(tc.TCA_KIND, 'u32')
+        msg += tc.u32_match_all_options(tc.police_action(rate_kbps, burst_bytes))
+        return nl.RTM_NEWTFILTER, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _build_change_police_filter(self, dev, prio, handle, rate_kbps, burst_bytes):
+        msg = nl.tcmsg(self._ifindex(dev), handle, tc.INGRESS_HANDLE,
+                       tc.filter_info(prio, tc.ETH_P_ALL))
+        msg += nl.attr_str(tc.TCA_KIND, 'u32')
+        msg += tc.u32_match_all_options(tc.police_action(rate_kbps, burst_bytes))
+        return nl.RTM_NEWTFILTER, 0, msg
+
+    def _build_add_u32_table(self, dev, parent, prio, htid, divisor):
+        msg = nl.tcmsg(self._ifindex(dev), tc.u32_handle(htid), tc.parse_handle(parent),
+                       tc.filter_info(prio, tc.ETH_P_IP))
+        msg += nl.attr_str(tc.TCA_KIND, 'u32') + tc.u32_table_options(divisor)
+        return nl.RTM_NEWTFILTER, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _build_add_u32_node(self, dev, parent, prio, handle, keys, flowid=None, link=None,
+                            hashkey=(0, 0), eat=False):
+        msg = nl.tcmsg(self._ifindex(dev), handle, tc.parse_handle(parent),
+                       tc.filter_info(prio, tc.ETH_P_IP))
+        flowid = None if flowid is None else tc.parse_handle(flowid)
+        msg += nl.attr_str(tc.TCA_KIND, 'u32')
+        msg += tc.u32_node_options(handle, keys, flowid, link, hashkey, eat)
+        return nl.RTM_NEWTFILTER, nl.NLM_F_CREATE | nl.NLM_F_EXCL, msg
+
+    def _build_delete_u32_node(self, dev, parent, prio, handle):
+        msg = nl.tcmsg(self._ifindex(dev), handle, tc.parse_handle(parent),
+                       tc.filter_info(prio, tc.ETH_P_IP))
+        return nl.RTM_DELTFILTER, 0, msg + nl.attr_str(tc.TCA_KIND, 'u32')
+
+    def add_htb_qdisc(self, dev, handle='1:', parent='root', default=0x30):
+        self._request(*self._build_add_htb_qdisc(dev, handle, parent, default))
+
+    def add_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        self._request(*self._build_add_htb_class(dev, classid, parent, rate_kbps, ceil_kbps))
+
+    def change_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        self._request(*self._build_change_htb_class(dev, classid, parent, rate_kbps, ceil_kbps))
+
+    def delete_class(self, dev, classid):
+        self._request(*self._build_delete_class(dev, classid))
+
+    def add_ingress_qdisc(self, dev):
+        self._request(*self._build_add_ingress_qdisc(dev))
+
+    def add_redirect_filter(self, dev, target, flowid='1:1'):
+        self._request(*self._build_add_redirect_filter(dev, target, flowid))
+
+    def add_police_filter(self, dev, rate_kbps, burst_bytes):
+        self._request(*self._build_add_police_filter(dev, rate_kbps, burst_bytes))
+
+    def change_police_filter(self, dev, prio, handle, rate_kbps, burst_bytes):
+        self._request(*self._build_change_police_filter(dev, prio, handle, rate_kbps, burst_bytes))
+
+    def add_fq_codel_qdisc(self, dev, parent, target_us, interval_us, flows=None):
+        self._request(*self._build_add_fq_codel_qdisc(dev, parent, target_us, interval_us, flows))
+
+    def change_fq_codel_qdisc(self, dev, parent, target_us, interval_us):
+        self._request(*self._build_change_fq_codel_qdisc(dev, parent, target_us, interval_us))
+
+    def add_cake_qdisc(self, dev, parent, handle=None, bandwidth_kbps=None, ingress=False):
+        self._request(*self._build_add_cake_qdisc(dev, parent, handle, bandwidth_kbps, ingress))
+
+    def change_cake_qdisc(self, dev, parent, bandwidth_kbps=None):
+        self._request(*self._build_change_cake_qdisc(dev, parent, bandwidth_kbps))
+
+    def delete_filter(self, dev, parent, prio):
+        # Not batched: it must only run once the filter replacing it is in place
+        msg = nl.tcmsg(self._ifindex(dev), 0, tc.parse_handle(parent), tc.filter_info(prio, 0))
+        try:
+            self.sock.request(nl.RTM_DELTFILTER, msg)
+        except nl.NetlinkError as e:
+            if e.errno not in (errno.ENOENT, errno.ENODEV):
+                raise BackendError(str(e)) from e
+
+    def get_u32_nodes(self, dev, parent, prio):
+        msg = nl.tcmsg(self._ifindex(dev), 0, tc.parse_handle(parent),
+                       tc.filter_info(prio, tc.ETH_P_IP))
+        filters = (tc.decode_filter(payload) for _, payload in self._dump(nl.RTM_GETTFILTER, msg))
+        return [f for f in filters if f['kind'] == 'u32' and f['handle'] and f['prio'] == prio]
+
+    def add_u32_table(self, dev, parent, prio, htid, divisor):
+        self._request(*self._build_add_u32_table(dev, parent, prio, htid, divisor))
+
+    def add_u32_node(self, dev, parent, prio, handle, keys, flowid=None, link=None,
+                     hashkey=(0, 0), eat=False):
+        self._request(*self._build_add_u32_node(dev, parent, prio, handle, keys, flowid, link,
+                                                hashkey, eat))
+
+    def delete_u32_node(self, dev, parent, prio, handle):
+        self._request(*self._build_delete_u32_node(dev, parent, prio, handle))
+
+    def run(self, steps):
+        """Apply steps, sending runs of tc object changes as netlink batches"""
+        pending = []
+        for step in steps:
+            build = getattr(self, f'_build_{step.method}', None)
+            if build is None:
+                # Not batchable (e.g. it tolerates errors): flush to keep the order
+                self._send(pending)
+                pending = []
+                step.apply(self)
+            else:
+                pending.append(build(*step.args))
+        self._send(pending)
+
+    def _send(self, requests):
+        if not requests:
+            return
+        try:
+            self.sock.batch([(msg_type, flags | nl.NLM_F_ACK, payload)
+                             for msg_type, flags, payload in requests])
+        except nl.NetlinkError as e:
+            raise BackendError(str(e)) from e
+
+    def delete_qdisc(self, dev, parent='root'):
+        try:
+            ifindex = nl.link_index(dev)
+            self.sock.request(nl.RTM_DELQDISC, nl.tcmsg(ifindex, 0, tc.parse_handle(parent)))
+        except nl.NetlinkError as e:
+            if e.errno not in (errno.ENOENT, errno.EINVAL, errno.ENODEV):
+                raise BackendError(str(e)) from e
+
+    def create_ifb(self, name):
+        link_info = nl.nested(nl.IFLA_LINKINFO, nl.attr_str(nl.IFLA_INFO_KIND, 'ifb'))
+        msg = nl.ifinfomsg() + nl.attr_str(nl.IFLA_IFNAME, name) + link_info
+        try:
+            self.sock.request(nl.RTM_NEWLINK, msg, nl.NLM_F_ACK | nl.NLM_F_CREATE | nl.NLM_F_EXCL)
+        except nl.NetlinkError as e:
+            if e.errno != errno.EEXIST:
+                raise BackendError(f"Cannot create {name}: {e}") from e
+        msg = nl.ifinfomsg(self._ifindex(name), nl.IFF_UP, nl.IFF_UP)
+        self._request(nl.RTM_NEWLINK, 0, msg)
+
+    def delete_link(self, name):
+        try:
+            self.sock.request(nl.RTM_DELLINK, nl.ifinfomsg(nl.link_index(name)))
+        except nl.NetlinkError as e:
+            if e.errno != errno.ENODEV:
+                raise BackendError(str(e)) from e
+
+
+class ShellBackend(ShapingBackend):
+    """The original implementation: one tc/ip process per rule, via sudo when needed"""
+
+    name = 'shell'
+
+    def __init__(self):
+        self.prefix = [] if _has_net_admin() else ['sudo']
+        # tc commands queued by run() for one "tc -batch", kept per thread so
+        # several interfaces can be reconciled at once
+        self.local = threading.local()
+
+    @property
+    def batch(self):
+        return getattr(self.local, 'batch', None)
+
+    @batch.setter
+    def batch(self, lines):
+        self.local.batch = lines
+
+    def _run(self, *args, check=True, ignore=()):
+        if self.batch is not None and args[0] == 'tc' and check and not ignore:
+            self.batch.append(' '.join(args[1:]))
+            return None
+        self._flush()
+        cmd = self.prefix + list(args)
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        except OSError as e:
+            if check:
+                raise BackendError(f"Command failed: {' '.join(cmd)}\n{e}") from e
+            return None
+        if result.returncode != 0 and check:
+            stderr = result.stderr.strip()
+            if not any(text in stderr for text in ignore):
+                raise BackendError(f"Command failed: {' '.join(cmd)}\n{stderr}")
+        return result
+
+    def _flush(self):
+        if not self.batch:
+            return
+        lines, self.batch = self.batch, []
+        cmd = self.prefix + ['tc', '-batch', '-']
+        try:
+            result = subprocess.run(cmd, input='\n'.join(lines) + '\n', capture_output=True,
+                                    text=True)
+        except OSError as e:
+            raise BackendError(f"Command failed: {' '.join(cmd)}\n{e}") from e
+        if result.returncode != 0:
+            raise BackendError(f"Command failed: {' '.join(cmd)}\n{result.stderr.strip()}")
+
+    def run(self, steps):
+        """Apply steps, feeding runs of tc commands to a single "tc -batch" """
+        self.batch = []
+        try:
+            for step in steps:
+                step.apply(self)
+            self._flush()
+        finally:
+            self.batch = None
+
+    def _json(self, *args):
+        result = self._run(*args, check=False)
+        if result is None or result.returncode != 0 or not result.stdout.strip():
+            return []
+        return json.loads(result.stdout)
+
+    def get_qdiscs(self, dev):
+        qdiscs = []
+        for entry in self._json('tc', '-s', '-j', 'qdisc', 'show', 'dev', dev):
+            options = entry.get('options', {})
+            qdisc = {
+                'kind': entry['kind'],
+                'handle': entry['handle'],
+                'parent': 'root' if entry.get('root') else
+                          tc.format_handle(tc.parse_handle(entry.get('parent', 'root'))),
+                'stats': {key: entry[key] for key in QDISC_STATS if key in entry},
+            }
+            if entry['kind'] == 'htb':
+                qdisc['default'] = int(str(options.get('default', '0')), 16)
+            elif entry['kind'] == 'fq_codel':
+                qdisc['target'] = options.get('target')
+                qdisc['interval'] = options.get('interval')
+            elif entry['kind'] == 'cake':
+                # Reported in bytes per second, or "unlimited"
+                bandwidth = options.get('bandwidth')
+                qdisc['bandwidth'] = tc.rate_kbit(bandwidth) if isinstance(bandwidth, int) else None
+                qdisc['ingress'] = bool(options.get('ingress'))
+            qdiscs.append(qdisc)
+        return qdiscs
+
+    def get_classes(self, dev):
+        # Older iproute2 ignores -j for HTB classes, so parse the text output
+        result = self._run('tc', '-s', 'class', 'show', 'dev', dev, check=False)
+        classes = []
+        cls = None
+        for line in (result.stdout.splitlines() if result else []):
+            match = CLASS_LINE.match(line)
+            if not match:
+                if cls is not None:
+                    for pattern, keys in CLASS_STATS:
+                        found = pattern.search(line)
+                        if found:
+                            cls['stats'].update(zip(keys, map(parse_size, found.groups())))
+                continue
+            words = line.split()
+            classid = match.group(2)
+            cls = {'kind': match.group(1), 'classid': classid,
+                   'parent': match.group(3) or classid.split(':')[0] + ':', 'stats': {}}
+            for key in ('rate', 'ceil'):
+                if key in words:
+                    cls[key] = parse_rate(words[words.index(key) + 1])
+            classes.append(cls)
+        return classes
+
+    def get_filters(self, dev, parent):
+        filters = []
+        for entry in self._json('tc', '-j', 'filter', 'show', 'dev', dev, 'parent', parent):
+            options = entry.get('options', {})
+            if 'fh' not in options or options.get('ht_divisor'):
+                continue
+            handle = options['fh']
+            flt = {'kind': entry['kind'], 'parent': entry.get('parent', parent), 'prio': entry['pref'],
+                   'protocol': PROTOCOLS.get(entry['protocol'], 0),
+                   'handle': tc.parse_u32_handle(handle) if entry['kind'] == 'u32' else handle}
+            for action in options.get('actions', []):
+                if action.get('kind') == 'mirred':
+                    flt['redirect'] = action.get('to_dev')
+                elif action.get('kind') == 'police':
+                    # Bytes per second, or "5Mbit" from older iproute2
+                    rate = action.get('rate')
+                    flt['police'] = (tc.rate_kbit(rate) if isinstance(rate, int) else
+                                     parse_rate(rate) if rate else None)
+            filters.append(flt)
+        return filters
+
+    def link_state(self, name):
+        links = self._json('ip', '-j', 'link', 'show', 'dev', name)
+        if not links:
+            return None
+        return 'UP' in links[0].get('flags', [])
+
+    def add_htb_qdisc(self, dev, handle='1:', parent='root', default=0x30):
+        parent_args = ['root'] if parent == 'root' else ['parent', parent]
+        self._run('tc', 'qdisc', 'add', 'dev', dev, *parent_args, 'handle', handle,
+                  'htb', 'default', f"{default:x}")
+
+    def add_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        args = ['tc', 'class', 'add', 'dev', dev, 'parent', parent, 'classid', classid,
+                'htb', 'rate', f"{rate_kbps}kbit"]
+        if ceil_kbps:
+            args += ['ceil', f"{ceil_kbps}kbit"]
+        args += ['quantum', str(tc.htb_quantum(rate_kbps))]
+        self._run(*args)
+
+    def change_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        args = ['tc', 'class', 'change', 'dev', dev, 'parent', parent, 'classid', classid,
+                'htb', 'rate', f"{rate_kbps}kbit"]
+        if ceil_kbps:
+            args += ['ceil', f"{ceil_kbps}kbit"]
+        args += ['quantum', str(tc.htb_quantum(rate_kbps))]
+        self._run(*args)
+
+    def delete_class(self, dev, classid):
+        self._run('tc', 'class', 'del', 'dev', dev, 'classid', classid)
+
+    def add_ingress_qdisc(self, dev):
+        self._run('tc', 'qdisc', 'add', 'dev', dev, 'ingress')
+
+    def _qdisc_args(self, action, dev, parent, handle=None):
+        args = ['tc', 'qdisc', action, 'dev', dev]
+        args += ['root'] if parent == 'root' else ['parent', parent]
+        return args + (['handle', handle] if handle else [])
+
+    def add_fq_codel_qdisc(self, dev, parent, target_us, interval_us, flows=None):
+        args = self._qdisc_args('add', dev, parent)
+        args += ['fq_codel', 'target', f"{target_us}us", 'interval', f"{interval_us}us"]
+        self._run(*args, *(['flows', str(flows)] if flows else []))
+
+    def change_fq_codel_qdisc(self, dev, parent, target_us, interval_us):
+        self._run(*self._qdisc_args('change', dev, parent), 'fq_codel',
+                  'target', f"{target_us}us", 'interval', f"{interval_us}us")
+
+    def add_cake_qdisc(self, dev, parent, handle=None, bandwidth_kbps=None, ingress=False):
+        args = self._qdisc_args('add', dev, parent, handle) + ['cake']
+        args += ['bandwidth', f"{bandwidth_kbps}kbit"] if bandwidth_kbps else ['unlimited']
+        self._run(*args, 'ingress' if ingress else 'egress')
+
+    def change_cake_qdisc(self, dev, parent, bandwidth_kbps=None):
+        self._run(*self._qdisc_args('change', dev, parent), 'cake',
+                  *(['bandwidth', f"{bandwidth_kbps}kbit"] if bandwidth_kbps else ['unlimited']))
+
+    def add_redirect_filter(self, dev, target, flowid='1:1'):
+        self._run('tc', 'filter', 'add', 'dev', dev, 'parent', 'ffff:', 'protocol', 'all',
+                  'u32', 'match', 'u32', '0', '0', 'flowid', flowid,
+                  'action', 'mirred', 'egress', 'redirect', 'dev', target)
+
+    def _police_args(self, rate_kbps, burst_bytes):
+        return ['u32', 'match', 'u32', '0', '0', 'action', 'police',
+                'rate', f"{rate_kbps}kbit", 'burst', str(burst_bytes), 'drop']
+
+    def add_police_filter(self, dev, rate_kbps, burst_bytes):
+        self._run('tc', 'filter', 'add', 'dev', dev, 'parent', 'ffff:', 'protocol', 'all',
+                  *self._police_args(rate_kbps, burst_bytes))
+
+    def change_police_filter(self, dev, prio, handle, rate_kbps, burst_bytes):
+        self._run('tc', 'filter', 'change', 'dev', dev, 'parent', 'ffff:', 'prio', str(prio),
+                  'protocol', 'all', 'handle', tc.format_u32_handle(handle),
+                  *self._police_args(rate_kbps, burst_bytes))
+
+    def delete_filter(self, dev, parent, prio):
+        self._run('tc', 'filter', 'del', 'dev', dev, 'parent', parent, 'prio', str(prio),
+                  check=False)
+
+    def get_u32_nodes(self, dev, parent, prio):
+        # tc -j prints invalid JSON for u32 selectors, so parse the text output
+        result = self._run('tc', 'filter', 'show', 'dev', dev, 'parent', parent, 'prio', str(prio),
+                           'protocol', 'ip', check=False)
+        nodes = []
+        for line in (result.stdout.splitlines() if result else []):
+            words = line.split()
+            if words[:1] == ['filter'] and 'fh' in words:
+                node = {'handle': tc.parse_u32_handle(words[words.index('fh') + 1])}
+                if 'divisor' in words:
+                    node['divisor'] = int(words[words.index('divisor') + 1])
+                else:
+                    node['keys'] = []
+                for key in ('flowid', '*flowid', 'classid', '*classid'):
+                    if key in words:
+                        node['classid'] = words[words.index(key) + 1]
+                if 'link' in words:
+                    node['link'] = tc.parse_u32_handle(words[words.index('link') + 1]) >> 20
+                nodes.append(node)
+            elif words[:1] == ['match'] and nodes and 'keys' in nodes[-1]:
+                value, mask = words[1].split('/')
+                nodes[-1]['keys'].append((int(value, 16), int(mask, 16), int(words[3])))
+        return nodes
+
+    def _filter_args(self, action, dev, parent, prio, handle):
+        return ['tc', 'filter', action, 'dev', dev, 'parent', parent, 'prio', str(prio),
+                'protocol', 'ip', 'handle', tc.format_u32_handle(handle), 'u32']
+
+    def add_u32_table(self, dev, parent, prio, htid, divisor):
+        self._run(*self._filter_args('add', dev, parent, prio, tc.u32_handle(htid)),
+                  'divisor', str(divisor))
+
+    def add_u32_node(self, dev, parent, prio, handle, keys, flowid=None, link=None,
+                     hashkey=(0, 0), eat=False):
+        args = self._filter_args('add', dev, parent, prio, handle)
+        args += ['ht', tc.format_u32_handle(handle & 0xFFFFF000)]
+        for value, mask, offset in keys:
+            args += ['match', 'u32', f"0x{value:08x}", f"0x{mask:08x}", 'at', str(offset)]
+        if eat:
+            args += ['offset', 'at', '0', 'mask', '0f00', 'shift', '6', 'eat']
+        if hashkey[0]:
+            args += ['hashkey', 'mask', f"0x{hashkey[0]:08x}", 'at', str(hashkey[1])]
+        if link is not None:
+            args += ['link', f"{link:x}:"]
+        if flowid is not None:
+            args += ['flowid', flowid]
+        self._run(*args)
+
+    def delete_u32_node(self, dev, parent, prio, handle):
+        self._run(*self._filter_args('del', dev, parent, prio, handle))
+
+    def delete_qdisc(self, dev, parent='root'):
+        where = [parent] if parent in ('root', 'ingress') else ['parent', parent]
+        self._run('tc', 'qdisc', 'del', 'dev', dev, *where, check=False)
+
+    def create_ifb(self, name):
+        self._run('modprobe', 'ifb', check=False)
+        self._run('ip', 'link', 'add', name, 'type', 'ifb', ignore=('File exists',))
+        self._run('ip', 'link', 'set', 'dev', name, 'up')
+
+    def delete_link(self, name):
+        self._run('ip', 'link', 'del', name, check=False)
+
+
+class SimulatedBackend(ShapingBackend):
+    """Keeps tc state in memory instead of the kernel, for runs without privileges.
+
+    It models the objects and errors the reconciler relies on (a qdisc tree
+    per device, the ingress filter, u32 tables and nodes, IFB links), so a
+    plan applied here converges like one applied to a real interface. It
+    carries no traffic: every counter stays at zero. ``links`` are the
+    devices that exist, by default those of the host.
+    """
+
+    name = 'simulated'
+
+    def __init__(self, links=None):
+        if links is None:
+            try:
+                links = os.listdir('/sys/class/net')
+            except OSError:
+                links = []
+        self.links = dict.fromkeys(links, True)
+        self.qdiscs = {}
+        self.classes = {}
+        self.filters = {}
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def add_link(self, name, up=True):
+        self.links[name] = up
+
+    def _device(self, dev):
+        if dev not in self.links:
+            raise BackendError(f"Cannot find device \"{dev}\"")
+        return dev
+
+    def _stats(self):
+        return dict.fromkeys(('bytes', 'packets', 'qlen', 'backlog', 'drops', 'requeues',
+                              'overlimits'), 0)
+
+    def _add_qdisc(self, dev, qdisc):
+        qdiscs = self.qdiscs.setdefault(self._device(dev), {})
+        if qdisc['parent'] in qdiscs:
+            raise BackendError("Exclusivity flag on, cannot modify.")
+        if qdisc['parent'] not in ('root', 'ingress') and qdisc['parent'] not in self.classes.get(dev, {}):
+            raise BackendError("Invalid class ID")
+        if qdisc.get('handle') is None:
+            # Like the kernel, number unnamed qdiscs from 8001:
+            qdisc['handle'] = f"{0x8001 + len(qdiscs):x}:"
+        qdisc['stats'] = self._stats()
+        qdiscs[qdisc['parent']] = qdisc
+
+    def _qdisc(self, dev, parent):
+        qdisc = self.qdiscs.get(self._device(dev), {}).get(parent)
+        if qdisc is None:
+            raise BackendError("No such file or directory")
+        return qdisc
+
+    def get_qdiscs(self, dev):
+        with self.lock:
+            return [dict(q, stats=dict(q['stats']))
+                    for q in self.qdiscs.get(self._device(dev), {}).values()]
+
+    def get_classes(self, dev):
+        with self.lock:
+            self._device(dev)
+            return [dict(c, stats=dict(c['stats'])) for c in self.classes.get(dev, {}).values()]
+
+    def get_filters(self, dev, parent):
+        with self.lock:
+            self._device(dev)
+            return [dict(f) for f in self.filters.get(dev, [])] if parent == 'ffff:' else []
+
+    def link_state(self, name):
+        return self.links.get(name)
+
+    def add_htb_qdisc(self, dev, handle='1:', parent='root', default=0x30):
+        with self.lock:
+            self._add_qdisc(dev, {'kind': 'htb', 'handle': handle, 'parent': parent,
+                                  'default': default})
+
+    def add_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        with self.lock:
+            self._qdisc(dev, 'root')
+            classes = self.classes.setdefault(dev, {})
+            if classid in classes:
+                raise BackendError("File exists")
+            if parent != '1:' and parent not in classes:
+                raise BackendError("Invalid argument")
+            classes[classid] = {'kind': 'htb', 'classid': classid, 'parent': parent,
+                                'rate': rate_kbps, 'ceil': ceil_kbps or rate_kbps,
+                                'stats': dict(self._stats(), tokens=0, ctokens=0)}
+
+    def change_htb_class(self, dev, classid, parent, rate_kbps, ceil_kbps=None):
+        with self.lock:
+            cls = self.classes.get(self._device(dev), {}).get(classid)
+            if cls is None:
+                raise BackendError("No such file or directory")
+            cls['rate'], cls['ceil'] = rate_kbps, ceil_kbps or rate_kbps
+
+    def delete_class(self, dev, classid):
+        with self.lock:
+            classes = self.classes.get(self._device(dev), {})
+            if classid not in classes:
+                raise BackendError("No such file or directory")
+            if any(c['parent'] == classid for c in classes.values()):
+                raise BackendError("Device or resource busy")
+            del classes[classid]
+            self.qdiscs.get(dev, {}).pop(classid, None)
+
+    def add_ingress_qdisc(self, dev):
+        with self.lock:
+            self._add_qdisc(dev, {'kind': 'ingress', 'handle': 'ffff:', 'parent': 'ingress'})
+
+    def add_fq_codel_qdisc(self, dev, parent, target_us, interval_us, flows=None):
+        with self.lock:
+            self._add_qdisc(dev, {'kind': 'fq_codel', 'handle': None, 'parent': parent,
+                                  'target': target_us, 'interval': interval_us})
+
+    def change_fq_codel_qdisc(self, dev, parent, target_us, interval_us):
+        with self.lock:
+            self._qdisc(dev, parent).update(target=target_us, interval=interval_us)
+
+    def add_cake_qdisc(self, dev, parent, handle=None, bandwidth_kbps=None, ingress=False):
+        with self.lock:
+            self._add_qdisc(dev, {'kind': 'cake', 'handle': handle, 'parent': parent,
+                                  'bandwidth': bandwidth_kbps, 'ingress': ingress})
+
+    def change_cake_qdisc(self, dev, parent, bandwidth_kbps=None):
+        with self.lock:
+            self._qdisc(dev, parent)['bandwidth'] = bandwidth_kbps
+
+    def _add_filter(self, dev, **action):
+        self._qdisc(dev, 'ingress')
+        filters = self.filters.setdefault(dev, [])
+        # Like the kernel, number a new filter ahead of the first one
+        prio = min((flt['prio'] for flt in filters), default=49153) - 1
+        filters.append({'kind': 'u32', 'parent': 'ffff:', 'prio': prio,
+                        'protocol': tc.ETH_P_ALL, 'handle': tc.u32_handle(0x800, 0, 0x800), **action})
+
+    def add_redirect_filter(self, dev, target, flowid='1:1'):
+        with self.lock:
+            self._device(target)
+            self._add_filter(dev, redirect=target)
+
+    def add_police_filter(self, dev, rate_kbps, burst_bytes):
+        with self.lock:
+            self._add_filter(dev, police=rate_kbps)
+
+    def change_police_filter(self, dev, prio, handle, rate_kbps, burst_bytes):
+        with self.lock:
+            for flt in self.filters.get(self._device(dev), []):
+                if flt['prio'] == prio and flt['handle'] == handle and 'police' in flt:
+                    flt['police'] = rate_kbps
+                    return
+            raise BackendError("No such file or directory")
+
+    def delete_filter(self, dev, parent, prio):
+        with self.lock:
+            filters = self.filters.get(self._device(dev), [])
+            filters[:] = [flt for flt in filters if flt['prio'] != prio]
+
+    def get_u32_nodes(self, dev, parent, prio):
+        with self.lock:
+            self._device(dev)
+            return [dict(node) for node in self.nodes.get((dev, prio), {}).values()]
+
+    def _u32(self, dev, prio):
+        self._qdisc(dev, 'root')
+        # The kernel creates the root hash table with the first u32 filter at a priority
+        return self.nodes.setdefault((dev, prio), {tc.u32_handle(0x800): {
+            'handle': tc.u32_handle(0x800), 'divisor': 1}})
+
+    def add_u32_table(self, dev, parent, prio, htid, divisor):
+        with self.lock:
+            nodes = self._u32(dev, prio)
+            if tc.u32_handle(htid) in nodes:
+                raise BackendError("File exists")
+            nodes[tc.u32_handle(htid)] = {'handle': tc.u32_handle(htid), 'divisor': divisor}
+
+    def add_u32_node(self, dev, parent, prio, handle, keys, flowid=None, link=None,
+                     hashkey=(0, 0), eat=False):
+        with self.lock:
+            nodes = self._u32(dev, prio)
+            if handle in nodes:
+                raise BackendError("File exists")
+            table = handle & 0xFFF00000
+            if table not in nodes or (link is not None and tc.u32_handle(link) not in nodes):
+                raise BackendError("Invalid argument")
+            node = {'handle': handle, 'keys': [tuple(key) for key in keys]}
+            if link is not None:
+                node['link'] = link
+            else:
+                node['classid'] = flowid
+            nodes[handle] = node
+
+    def delete_u32_node(self, dev, parent, prio, handle):
+        with self.lock:
+            nodes = self.nodes.get((self._device(dev), prio), {})
+            if handle not in nodes:
+                raise BackendError("No such file or directory")
+            del nodes[handle]
+
+    def delete_qdisc(self, dev, parent='root'):
+        with self.lock:
+            qdiscs = self.qdiscs.get(dev, {})
+            if qdiscs.pop(parent, None) is None:
+                return
+            if parent == 'ingress':
+                self.filters.pop(dev, None)
+            elif parent == 'root':
+                # The whole tree goes with the root: classes, their queues and filters
+                self.qdiscs[dev] = {key: q for key, q in qdiscs.items() if key == 'ingress'}
+                self.classes.pop(dev, None)
+                for key in [key for key in self.nodes if key[0] == dev]:
+                    del self.nodes[key]
+
+    def create_ifb(self, name):
+        with self.lock:
+            self.links[name] = True
+
+    def delete_link(self, name):
+        with self.lock:
+            if self.links.pop(name, None) is None:
+                return
+            for state in (self.qdiscs, self.classes, self.filters):
+                state.pop(name, None)
+            for key in [key for key in self.nodes if key[0] == name]:
+                del self.nodes[key]
+            for dev, filters in self.filters.items():
+                # A redirect to a deleted device stays, pointing nowhere
+                for flt in filters:
+                    if flt.get('redirect') == name:
+                        flt['redirect'] = None
+
+
+def parse_rate(text):
+    """Convert a tc rate such as "5Mbit" to kbit"""
+    match = re.match(r'([\d.]+)([a-zA-Z]*)', text)
+    value, unit = float(match.group(1)), match.group(2).lower() or 'bit'
+    return int(value * RATE_UNITS.get(unit, 1) / 1000)
+
+
+def parse_size(text):
+    """Convert a tc size such as "12Kb" or a plain count to an int"""
+    match = re.match(r'(-?[\d.]+)([a-zA-Z]*)', text)
+    return int(float(match.group(1)) * SIZE_UNITS.get(match.group(2).lower() or 'b', 1))
+
+
+def _has_net_admin():
+    """True when the effective capability set includes CAP_NET_ADMIN"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('CapEff:'):
+                    return bool(int(line.split()[1], 16) & (1 << CAP_NET_ADMIN))
+    except (OSError, ValueError):
+        pass
+    return hasattr(os, 'geteuid') and os.geteuid() == 0
+
+
+def get_backend(name=None):
+    """Pick the shaping backend: netlink when privileged, shell otherwise.
+
+    ``name`` (or the NETTHROTTLE_BACKEND environment variable) forces a
+    specific backend. Returns None on platforms without tc support.
+    """
+    if platform.system().lower() != 'linux':
+        return None
+    name = name or os.environ.get('NETTHROTTLE_BACKEND')
+    if name == 'shell':
+        return ShellBackend()
+    if name == 'simulated':
+        return SimulatedBackend()
+    if name == 'netlink' or _has_net_admin():
+        try:
+            return NetlinkBackend()
+        except OSError:
+            if name == 'netlink':
+                raise
+    return ShellBackend()
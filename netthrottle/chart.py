@@ -0,0 +1,182 @@
+"""Live throughput chart drawn incrementally on a Tk canvas.
+
+Time runs right to left at one pixel column per ``column_seconds``. Samples
+arriving within a column are decimated to their maximum, so the canvas never
+holds more than one line segment per series per pixel. When a column closes
+the existing segments are shifted left with a single ``move`` and only the
+newest segment is created; a change of vertical scale is one ``scale`` call.
+A full redraw only happens when the canvas is resized.
+"""
+import math
+import tkinter as tk
+from collections import deque
+
+from .units import format_speed
+
+PAD_TOP = 20
+PAD_BOTTOM = 6
+# Columns of history kept for redrawing after a resize
+HISTORY_COLUMNS = 4096
+# Missed columns that are still bridged by a single segment
+MAX_BRIDGE = 10
+GRID_FRACTIONS = (0.5, 1.0)
+
+
+def nice_ceiling(value):
+    """Smallest 1, 2 or 5 times a power of ten that is >= value"""
+    if value <= 0:
+        return 1.0
+    magnitude = 10 ** math.floor(math.log10(value))
+    for step in (1, 2, 5, 10):
+        if step * magnitude >= value:
+            return step * magnitude
+
+
+class ThroughputChart:
+    """Scrolling multi-series line chart of KB/s values"""
+
+    def __init__(self, parent, column_seconds=0.1, height=180, bg='#f8fafc',
+                 grid_color='#e5e7eb', text_color='#6b7280'):
+        self.canvas = tk.Canvas(parent, height=height, bg=bg, highlightthickness=0, bd=0)
+        self.column_seconds = column_seconds
+        self.grid_color = grid_color
+        self.text_color = text_color
+        self.width = 1
+        self.height = height
+        self.scale = 1.0
+        self.column = None
+        self.series = {}
+        # (column, item) for every drawn segment, oldest first
+        self.segments = deque()
+        self.canvas.bind('<Configure>', self.on_resize)
+        self.draw_axes()
+
+    @property
+    def bottom(self):
+        return self.height - PAD_BOTTOM
+
+    def y(self, value):
+        return self.bottom - value / self.scale * (self.bottom - PAD_TOP)
+
+    def add_series(self, name, color, label=None):
+        self.series[name] = {
+            'color': color,
+            'label': label or name,
+            'pending': None,
+            'history': deque(maxlen=HISTORY_COLUMNS),
+        }
+        self.draw_legend()
+
+    def clear(self):
+        """Forget all samples (e.g. when the watched interface changes)"""
+        self.canvas.delete('data')
+        self.segments.clear()
+        self.column = None
+        for series in self.series.values():
+            series['pending'] = None
+            series['history'].clear()
+        self.scale = 1.0
+        self.draw_axes()
+
+    def add_sample(self, name, value, timestamp):
+        """Add a KB/s sample for series ``name`` taken at monotonic ``timestamp``"""
+        column = int(timestamp / self.column_seconds)
+        if self.column is None:
+            self.column = column
+        elif column > self.column:
+            self.close_columns(column)
+        series = self.series[name]
+        if series['pending'] is None or value > series['pending']:
+            series['pending'] = value
+
+    def close_columns(self, column):
+        """Draw the finished column and scroll everything left"""
+        gap = column - self.column
+        self.column = column
+        right = self.width - 1
+        peak = 0
+        self.canvas.move('data', -gap, 0)
+        for series in self.series.values():
+            value = series['pending']
+            series['pending'] = None
+            history = series['history']
+            previous = history[-1] if history else None
+            bridged = previous is not None and value is not None and gap <= MAX_BRIDGE
+            history.extend([value if bridged else None] * (gap - 1))
+            history.append(value)
+            if value is None:
+                continue
+            peak = max(peak, value)
+            if bridged:
+                item = self.canvas.create_line(right - gap, self.y(previous), right, self.y(value),
+                                               fill=series['color'], width=2, tags='data')
+                self.segments.append((column, item))
+
+        # Drop segments that scrolled off the left edge
+        oldest = column - self.width
+        while self.segments and self.segments[0][0] <= oldest:
+            self.canvas.delete(self.segments.popleft()[1])
+
+        if peak > self.scale:
+            self.rescale(nice_ceiling(peak))
+        elif column % self.width == 0:
+            # Shrink at most once per screen width, when the view is mostly empty
+            visible = [value for series in self.series.values()
+                       for value in list(series['history'])[-self.width:] if value is not None]
+            target = nice_ceiling(max(visible, default=0))
+            if target < self.scale / 2:
+                self.rescale(target)
+
+    def rescale(self, scale):
+        """Change the top of the y axis without redrawing the segments"""
+        self.canvas.scale('data', 0, self.bottom, 1, self.scale / scale)
+        self.scale = scale
+        self.draw_axes()
+
+    def draw_axes(self):
+        self.canvas.delete('axis')
+        for fraction in GRID_FRACTIONS:
+            y = self.y(self.scale * fraction)
+            self.canvas.create_line(0, y, self.width, y, fill=self.grid_color, tags='axis')
+            self.canvas.create_text(self.width - 4, y - 2, anchor=tk.SE, fill=self.text_color,
+                                    text=format_speed(self.scale * fraction),
+                                    font=('Inter', 8), tags='axis')
+        self.canvas.create_line(0, self.bottom, self.width, self.bottom,
+                                fill=self.grid_color, tags='axis')
+        self.canvas.tag_lower('axis')
+
+    def draw_legend(self):
+        self.canvas.delete('legend')
+        x = 6
+        for series in self.series.values():
+            item = self.canvas.create_text(x, 4, anchor=tk.NW, text=f"■ {series['label']}",
+                                           fill=series['color'], font=('Inter', 9, 'bold'),
+                                           tags='legend')
+            x = self.canvas.bbox(item)[2] + 12
+
+    def redraw(self):
+        """Rebuild every segment from the kept history"""
+        self.canvas.delete('data')
+        self.segments.clear()
+        if self.column is None:
+            return
+        right = self.width - 1
+        for series in self.series.values():
+            values = list(series['history'])[-(self.width + 1):]
+            offset = right - (len(values) - 1)
+            for i in range(1, len(values)):
+                if values[i - 1] is None or values[i] is None:
+                    continue
+                x = offset + i
+                item = self.canvas.create_line(x - 1, self.y(values[i - 1]), x, self.y(values[i]),
+                                               fill=series['color'], width=2, tags='data')
+                self.segments.append((self.column - (right - x), item))
+        self.segments = deque(sorted(self.segments))
+
+    def on_resize(self, event):
+        if (event.width, event.height) == (self.width, self.height):
+            return
+        self.width = max(1, event.width)
+        self.height = max(PAD_TOP + PAD_BOTTOM + 1, event.height)
+        self.draw_axes()
+        self.redraw()
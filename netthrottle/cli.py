@@ -0,0 +1,851 @@
+"""``netthrottle`` command line client.
+
+Commands are sent to a running daemon when one is listening, otherwise they
+run in-process. Only the standard library is imported on the fast path.
+"""
+import argparse
+import json
+import socket
+import sys
+
+from .paths import socket_path
+from .policy import INGRESS_MODES, POLICE, QUEUES
+from .units import (format_bytes, format_limit, format_queue, format_speed, format_tc_entry,
+                    parse_duration, parse_size, parse_speed)
+
+
+def speed_argument(text):
+    try:
+        return parse_speed(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def range_argument(text):
+    """"MAX" or "MIN:BASE:MAX" speeds into [min, base, max] kbit/s"""
+    from .autorate import RateBounds
+
+    try:
+        speeds = [parse_speed(part) for part in text.split(':')]
+        if len(speeds) == 1:
+            bounds = RateBounds.for_capacity(speeds[0])
+        elif len(speeds) == 3:
+            bounds = RateBounds(*speeds)
+        else:
+            raise ValueError(f"Expected MAX or MIN:BASE:MAX, got {text}")
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return [bounds.minimum, bounds.base, bounds.maximum]
+
+
+def size_argument(text):
+    try:
+        return parse_size(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def tier_argument(text):
+    """"PERCENT:DOWN:UP" into a quota.Tier dict, "-" leaving a limit alone"""
+    try:
+        percent, down, up = text.split(':')
+        return {'percent': float(percent.rstrip('%')),
+                'download_kbps': None if down == '-' else parse_speed(down),
+                'upload_kbps': None if up == '-' else parse_speed(up)}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected PERCENT:DOWN:UP, e.g. 80:10mbit:2mbit, got {text}")
+
+
+def forward_argument(text):
+    from .proxy import parse_forward
+
+    try:
+        return parse_forward(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def metrics_argument(text):
+    from .metrics import parse_address
+
+    try:
+        return parse_address(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def daemon_request(message, path):
+    """Yield reply messages from the daemon; raises OSError if it is not running"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        # One request per connection: let the daemon see EOF after replying
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('r') as replies:
+            for line in replies:
+                yield json.loads(line)
+    finally:
+        sock.close()
+
+
+def local_request(message):
+    """Run a request in-process when no daemon is available"""
+    from .daemon import autorate, dispatch, tc_stats, watch
+
+    if message['cmd'] == 'watch':
+        yield from watch(message['interface'], message['interval'], message['window'])
+        return
+
+    from .core import ThrottleCore
+
+    core = ThrottleCore()
+    try:
+        if message['cmd'] == 'autorate':
+            yield from autorate(core, message)
+        elif message['cmd'] == 'stats':
+            yield from tc_stats(core, message['interface'], message['interval'])
+        else:
+            yield dispatch(core, message)
+    finally:
+        core.close()
+
+
+def send(message, args):
+    if not args.local:
+        try:
+            replies = daemon_request(message, args.socket)
+            first = next(replies)
+        except (OSError, StopIteration):
+            pass
+        else:
+            yield first
+            yield from replies
+            return
+    yield from local_request(message)
+
+
+# Longer plans are summarised unless it is a dry run
+PLAN_PRINT_LIMIT = 50
+
+
+def print_result(reply, dry_run=True):
+    policy = reply['policy']
+    rules = f", {len(policy['rules'])} rules" if policy.get('rules') else ''
+    policed = ' (policed)' if policy.get('ingress_mode') == POLICE and policy['upload_kbps'] else ''
+    print(f"{policy['interface']}: download {format_limit(policy['download_kbps'])}, "
+          f"upload {format_limit(policy['upload_kbps'])}{policed}, queue {policy['queue']}{rules}")
+    if dry_run or len(reply['plan']) <= PLAN_PRINT_LIMIT:
+        for step in reply['plan']:
+            print(f"  {step}")
+    else:
+        print(f"  {len(reply['plan'])} changes applied")
+    if reply.get('warning'):
+        print(f"{policy['interface']}: Warning: {reply['warning']}", file=sys.stderr)
+
+
+def print_rules(reply):
+    for status in reply['interfaces']:
+        if status.get('error'):
+            print(f"{status['interface']}: {status['error']}", file=sys.stderr)
+            continue
+        print(f"{'MATCH':<20} {'DOWNLOAD':>14} {'UPLOAD':>14}")
+        for rule in status.get('rules', []):
+            print(f"{rule['match']:<20} {format_limit(rule['download_kbps']):>14} "
+                  f"{format_limit(rule['upload_kbps']):>14}")
+
+
+def load_rules(path):
+    """Rules from a file of "MATCH [DOWN [UP]]" lines; "-" leaves a direction unlimited"""
+    rules = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            try:
+                limits = [0 if word == '-' else parse_speed(word) for word in words[1:3]]
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {e}")
+            limits += [0] * (2 - len(limits))
+            rules.append({'match': words[0], 'down': limits[0], 'up': limits[1]})
+    return rules
+
+
+def load_interfaces(path):
+    """Interface settings from a file of "INTERFACE DOWN UP [queue=Q] [ingress=M]" lines.
+
+    "-" (or a missing limit) means no limit; "INTERFACE clear" removes everything.
+    """
+    entries = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            if words[1:] == ['clear']:
+                entries.append({'interface': words[0], 'clear': True})
+                continue
+            entry = {'interface': words[0]}
+            try:
+                limits = [word for word in words[1:] if '=' not in word]
+                if len(limits) > 2:
+                    raise ValueError(f"Unexpected {limits[2]!r}")
+                limits = [0 if word == '-' else parse_speed(word) for word in limits]
+                entry['down'], entry['up'] = limits + [0] * (2 - len(limits))
+                for option in (word for word in words[1:] if '=' in word):
+                    key, _, value = option.partition('=')
+                    choices = {'queue': QUEUES, 'ingress': INGRESS_MODES}.get(key)
+                    if choices is None or value not in choices:
+                        raise ValueError(f"Invalid option {option!r}")
+                    entry[key] = value
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {e}")
+            entries.append(entry)
+    return entries
+
+
+def print_sample(reply):
+    rx = reply['stats']['rx']
+    tx = reply['stats']['tx']
+    print(f"{reply['interface']}: ↓ {format_speed(reply['download_kbs'])} "
+          f"(avg {format_speed(rx['ewma'] / 1024)}, p95 {format_speed(rx['p95'] / 1024)}) | "
+          f"↑ {format_speed(reply['upload_kbs'])} "
+          f"(avg {format_speed(tx['ewma'] / 1024)}, p95 {format_speed(tx['p95'] / 1024)})",
+          flush=True)
+
+
+def print_autorate(reply):
+    if reply.get('error'):
+        print(f"{reply['interface']}: Error: {reply['error']}", file=sys.stderr, flush=True)
+        return
+    if reply['rtt_ms'] is None:
+        latency = "no reply"
+    else:
+        latency = f"rtt {reply['rtt_ms']:.1f} ms (+{reply['delay_ms']:.1f})"
+    line = f"{reply['interface']}: {latency}"
+    for direction, load in reply['load_kbps'].items():
+        rate = reply['rate_kbps'].get(direction, 0)
+        marker = '*' if direction in reply['changed'] else ''
+        line += f" | {direction} {load / 1000:.1f} of {rate / 1000:.1f} Mbit/s{marker}"
+    print(line, flush=True)
+
+
+def print_tc_stats(reply):
+    import time
+
+    print(f"{time.strftime('%H:%M:%S', time.localtime(reply['time']))} {reply['interface']}")
+    for direction in ('download', 'upload'):
+        tree = reply[direction]
+        if tree is None:
+            print(f"  {direction}: not shaped")
+            continue
+        link = tree['link']
+        print(f"  {direction} on {tree['device']}: rx {format_speed(link.get('rx', 0) / 1024)}, "
+              f"tx {format_speed(link.get('tx', 0) / 1024)}")
+        for qdisc in tree['qdiscs']:
+            print(f"    {format_tc_entry('qdisc', qdisc['handle'], qdisc)}")
+        for cls in tree['classes']:
+            print(f"    {format_tc_entry('class', cls['classid'], cls)}")
+    print(flush=True)
+
+
+def print_budgets(reply):
+    import time
+
+    if not reply['budgets']:
+        print("No budgets")
+    for budget in reply['budgets']:
+        resets = time.strftime('%Y-%m-%d', time.localtime(budget['period_end']))
+        print(f"{budget['interface']}: {format_bytes(budget['used_bytes'])} of "
+              f"{format_bytes(budget['limit_bytes'])} ({budget['percent']:.1f}%) "
+              f"{budget['period']}, resets {resets}")
+        for index, tier in enumerate(budget['tiers']):
+            active = "  <- active" if index == budget['tier'] else ""
+            limits = [f"{direction} {format_limit(tier[f'{direction}_kbps'])}"
+                      for direction in ('download', 'upload') if tier[f'{direction}_kbps']]
+            print(f"  at {tier['percent']:g}%: {', '.join(limits) or 'unchanged'}{active}")
+
+
+def print_status(reply):
+    for status in reply['interfaces']:
+        line = (f"{status['interface']}: download {format_limit(status.get('download_kbps'))}, "
+                f"upload {format_limit(status.get('upload_kbps'))}")
+        if status.get('ingress_mode') == POLICE and status.get('upload_kbps'):
+            line += " (policed)"
+        counters = status.get('counters')
+        if status.get('error'):
+            line = f"{status['interface']}: {status['error']}"
+        elif counters:
+            line += f", rx {counters['bytes_recv']:,} B, tx {counters['bytes_sent']:,} B"
+        if status.get('rules'):
+            line += f", {len(status['rules'])} rules"
+        print(line)
+        queues = status.get('queues') or {}
+        for direction in ('download', 'upload'):
+            if queues.get(direction):
+                policed = direction == 'upload' and status.get('ingress_mode') == POLICE
+                kind = POLICE if policed else status['queue']
+                print(f"  {direction} queue ({kind}): {format_queue(queues[direction])}")
+
+
+def run_top(args):
+    """Print the busiest links every interval (runs in-process, no daemon needed)"""
+    import threading
+
+    from .linkstats import LinkStats
+    from .sampler import ticks
+
+    stats = LinkStats()
+    try:
+        stats.poll()
+        for _ in ticks(args.interval, threading.Event()):
+            links = stats.poll()
+            if sys.stdout.isatty() and not args.once:
+                print("\033[H\033[J", end='')
+            print(f"{'INTERFACE':<16} {'DOWNLOAD':>14} {'UPLOAD':>14} {'TOTAL':>14}   "
+                  f"({links} links)")
+            for row in stats.top(args.count, args.sort):
+                rx = row['rx_bytes_per_sec'] / 1024
+                tx = row['tx_bytes_per_sec'] / 1024
+                print(f"{row['interface']:<16} {format_speed(rx):>14} {format_speed(tx):>14} "
+                      f"{format_speed(rx + tx):>14}")
+            sys.stdout.flush()
+            if args.once:
+                break
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        stats.close()
+    return 0
+
+
+def run_procs(args):
+    """Print the busiest processes (or cgroups) by TCP throughput every interval"""
+    import threading
+
+    from .procnet import ProcessTraffic, by_cgroup
+    from .sampler import ticks
+
+    traffic = ProcessTraffic()
+    try:
+        traffic.poll()
+        for _ in ticks(args.interval, threading.Event()):
+            rows = traffic.poll()
+            if sys.stdout.isatty() and not args.once:
+                print("\033[H\033[J", end='')
+            if args.cgroups:
+                print(f"{'CGROUP':<40} {'PROCS':>5} {'DOWNLOAD':>14} {'UPLOAD':>14}")
+                for row in by_cgroup(rows)[:args.count]:
+                    print(f"{row['cgroup'][-40:]:<40} {row['processes']:>5} "
+                          f"{format_speed(row['rx_bytes_per_sec'] / 1024):>14} "
+                          f"{format_speed(row['tx_bytes_per_sec'] / 1024):>14}")
+            else:
+                print(f"{'PID':>7} {'COMMAND':<16} {'SOCKS':>5} {'DOWNLOAD':>14} {'UPLOAD':>14}")
+                for row in rows[:args.count]:
+                    print(f"{row['pid'] or '-':>7} {row['name'][:16]:<16} {row['sockets']:>5} "
+                          f"{format_speed(row['rx_bytes_per_sec'] / 1024):>14} "
+                          f"{format_speed(row['tx_bytes_per_sec'] / 1024):>14}")
+            sys.stdout.flush()
+            if args.once:
+                break
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        traffic.close()
+    return 0
+
+
+def run_history(args):
+    """Print recorded traffic for an interface, or list recorded series"""
+    import time
+
+    from .tsdb import TIER_NAMES, TimeSeriesStore
+
+    store = TimeSeriesStore(args.directory)
+    try:
+        keys = store.keys()
+        if not args.interface:
+            for key in keys:
+                print(key)
+            return 0
+        if args.interface not in keys:
+            print(f"No history for {args.interface}", file=sys.stderr)
+            return 1
+        resolution = TIER_NAMES[args.tier]
+        start = time.time() - args.since if args.since else None
+        print(f"{'TIME':<20} {'DOWNLOAD':>14} {'UPLOAD':>14} {'RX PKTS':>10} {'TX PKTS':>10}")
+        for stamp, rx, tx, rx_packets, tx_packets in store.ring(args.interface, resolution).records(start):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)):<20} "
+                  f"{format_speed(rx / resolution / 1024):>14} {format_speed(tx / resolution / 1024):>14} "
+                  f"{rx_packets:>10} {tx_packets:>10}")
+    except BrokenPipeError:
+        pass
+    finally:
+        store.close()
+    return 0
+
+
+def print_verify(report):
+    def rtt(summary):
+        if not summary['samples']:
+            return f"no replies ({summary['lost']} probes lost)"
+        return (f"p50 {summary['p50']:.2f} ms, p95 {summary['p95']:.2f} ms, "
+                f"p99 {summary['p99']:.2f} ms, {summary['lost']} probes lost")
+
+    policy = report['policy']
+    print(f"Download {format_limit(policy['download_kbps'])}, upload "
+          f"{format_limit(policy['upload_kbps'])} (queue {policy['queue']}, ingress "
+          f"{policy['ingress_mode']}, {report['backend']} backend): {report['flows']} "
+          f"{report['protocol'].upper()} flows for {report['duration']:g}s after a "
+          f"{report['warmup']:g}s warm-up")
+    print(f"  idle RTT: {rtt(report['idle_rtt_ms'])}")
+    for direction, result in report['directions'].items():
+        print(f"  {direction}: {result['wire_kbps'] / 1000:.1f} of "
+              f"{format_limit(result['target_kbps'])} ({result['accuracy'] * 100:.1f}%) "
+              f"-> {result['verdict']}")
+        line = f"    goodput {result['goodput_kbps'] / 1000:.1f} Mbit/s"
+        if result.get('loss') is not None:
+            line += f", {result['loss'] * 100:.2f}% datagrams lost"
+        if result.get('baseline'):
+            line += f", unshaped {result['baseline']['wire_kbps'] / 1000:.1f} Mbit/s"
+        print(line)
+        added = result['added_latency_ms']
+        print(f"    RTT under load: {rtt(result['rtt_ms'])}"
+              + (f" ({added:+.2f} ms over idle)" if added is not None else ""))
+
+
+def run_restore(args):
+    """Re-apply the journaled limits of every interface in one batch (run at boot)"""
+    import time
+    from dataclasses import asdict
+
+    from .core import ThrottleCore
+    from .state import StateJournal
+
+    started = time.perf_counter()
+    core = ThrottleCore()
+    journals = [StateJournal(directory) for directory in args.state_dir] if args.state_dir else None
+    try:
+        results = core.restore_state(dry_run=args.dry_run, journals=journals)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        core.close()
+    elapsed = time.perf_counter() - started
+    replies = {}
+    for interface, result in sorted(results.items()):
+        if result is None:
+            replies[interface] = {'missing': True}
+        elif isinstance(result, Exception):
+            replies[interface] = {'error': str(result)}
+        else:
+            policy, steps = result
+            replies[interface] = {'policy': asdict(policy), 'plan': [str(step) for step in steps]}
+    if args.json:
+        print(json.dumps({'interfaces': replies, 'seconds': round(elapsed, 4)}, indent=2))
+    elif not replies:
+        print("Nothing to restore")
+    else:
+        for interface, reply in replies.items():
+            if reply.get('missing'):
+                print(f"{interface}: not present, skipped")
+            elif reply.get('error'):
+                print(f"{interface}: {reply['error']}", file=sys.stderr)
+            else:
+                print_result(reply, args.dry_run)
+        restored = sum(1 for reply in replies.values() if 'policy' in reply)
+        print(f"{'Planned' if args.dry_run else 'Restored'} {restored} of {len(replies)} "
+              f"interfaces in {elapsed * 1000:.0f} ms")
+    return 1 if any(reply.get('error') for reply in replies.values()) else 0
+
+
+def run_verify(args):
+    """Measure the limits in a throwaway namespace (runs in-process, needs root)"""
+    from .verify import VerifyError, verify
+
+    settings = {'download_kbps': args.down, 'upload_kbps': args.up, 'queue': args.queue,
+                'ingress_mode': args.ingress}
+    try:
+        if args.interface:
+            # Start from what the interface has; rules match the real network, so are left out
+            from .core import ThrottleCore
+
+            core = ThrottleCore()
+            try:
+                policy = core.get_policy(args.interface)
+            finally:
+                core.close()
+            for key, value in settings.items():
+                if value is None:
+                    settings[key] = getattr(policy, key)
+        report = verify(**settings, duration=args.duration, warmup=args.warmup,
+                        flows=args.flows, protocol='udp' if args.udp else 'tcp',
+                        baseline=not args.no_baseline, tolerance=args.tolerance / 100,
+                        backend=args.backend)
+    except (VerifyError, RuntimeError, OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_verify(report)
+    return 0 if all(result['verdict'] == 'ok' for result in report['directions'].values()) else 1
+
+
+def run_proxy(args):
+    """Serve the throttling proxy in the foreground until interrupted"""
+    import threading
+
+    from .proxy import SPLICE, ProxyLimits, ThrottleProxy
+    from .sampler import ticks
+
+    limits = ProxyLimits(download_kbps=args.down, upload_kbps=args.up,
+                         client_download_kbps=args.client_down, client_upload_kbps=args.client_up,
+                         destination_download_kbps=args.dest_down,
+                         destination_upload_kbps=args.dest_up)
+    address, port = args.listen
+    proxy = ThrottleProxy(limits, address, port, args.forwards, splice=SPLICE and not args.copy)
+    try:
+        proxy.start()
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    socks, *forwards = proxy.listening
+    print(f"SOCKS5 proxy on {socks[0]}:{socks[1]}: download {format_limit(args.down)}, "
+          f"upload {format_limit(args.up)}", flush=True)
+    for (host, port_), forward in zip(forwards, args.forwards):
+        print(f"Forwarding {host}:{port_} to {forward[2]}:{forward[3]}", flush=True)
+    try:
+        last = dict(proxy.bytes)
+        for _ in ticks(args.interval or 1.0, threading.Event()):
+            if not args.interval:
+                continue
+            current = dict(proxy.bytes)
+            rates = {direction: (current[direction] - last[direction]) / args.interval / 1024
+                     for direction in current}
+            last = current
+            print(f"↓ {format_speed(rates['download'])} | ↑ {format_speed(rates['upload'])} | "
+                  f"{proxy.active} connections", flush=True)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        proxy.stop()
+    return 0
+
+
+def duration_argument(text):
+    try:
+        return parse_duration(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='netthrottle',
+                                     description="Network speed monitoring and bandwidth control")
+    parser.add_argument('--socket', default=socket_path(),
+                        help="daemon socket path")
+    parser.add_argument('--local', action='store_true',
+                        help="run in-process even if a daemon is listening")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    daemon_cmd = commands.add_parser('daemon', help="run the long-lived daemon")
+    daemon_cmd.add_argument('--no-history', action='store_true',
+                            help="do not record traffic history")
+    daemon_cmd.add_argument('--record', action='append', metavar='INTERFACE',
+                            help="record the history of INTERFACE (repeatable; "
+                                 "default: the interfaces with limits)")
+    daemon_cmd.add_argument('--metrics', type=metrics_argument, metavar='[ADDRESS:]PORT',
+                            help="serve OpenMetrics on /metrics (address defaults to 127.0.0.1)")
+    daemon_cmd.add_argument('--no-hotplug', action='store_true',
+                            help="do not re-apply journaled limits when an interface (re)appears")
+
+    set_cmd = commands.add_parser('set', help="set download and/or upload limits")
+    set_cmd.add_argument('interfaces', nargs='+', metavar='interface',
+                         help="one or more interfaces, reconciled in parallel")
+    set_cmd.add_argument('--down', type=speed_argument, help="download limit, e.g. 50mbit (0 removes)")
+    set_cmd.add_argument('--up', type=speed_argument, help="upload limit, e.g. 10mbit (0 removes)")
+    set_cmd.add_argument('--queue', choices=QUEUES,
+                         help="queue behind the limits: fifo, fq_codel or cake per class, "
+                              "or cake as the shaper (no rules)")
+    set_cmd.add_argument('--ingress', choices=INGRESS_MODES,
+                         help="enforce the upload limit by shaping on an IFB device, or by "
+                              "policing (dropping) on the interface itself (cheaper, no rules)")
+    set_cmd.add_argument('--dry-run', action='store_true', help="print the plan without applying it")
+
+    clear_cmd = commands.add_parser('clear', help="remove all limits from interfaces")
+    clear_cmd.add_argument('interfaces', nargs='+', metavar='interface')
+    clear_cmd.add_argument('--dry-run', action='store_true', help="print the plan without applying it")
+
+    apply_cmd = commands.add_parser('apply', help="configure several interfaces from a file")
+    apply_cmd.add_argument('file', help='lines of "INTERFACE DOWN UP [queue=Q] [ingress=M]", '
+                                        '"-" for no limit, or "INTERFACE clear"')
+    apply_cmd.add_argument('--dry-run', action='store_true', help="print the plan without applying it")
+
+    restore_cmd = commands.add_parser(
+        'restore', help="re-apply the journaled limits of every interface (e.g. at boot)")
+    restore_cmd.add_argument('--dry-run', action='store_true', help="print the plan without applying it")
+    restore_cmd.add_argument('--json', action='store_true', help="print the results as JSON")
+    restore_cmd.add_argument('--state-dir', action='append', metavar='DIR',
+                             help="restore the journal in DIR (repeatable, later ones win; "
+                                  "default: the state directory)")
+
+    rule_cmd = commands.add_parser('rule', help="limit one host, subnet or port")
+    rule_cmd.add_argument('interface')
+    rule_cmd.add_argument('match', help="IPv4 address, subnet (10.0.0.0/24) or port:N")
+    rule_cmd.add_argument('--down', type=speed_argument, help="download limit (0 removes)")
+    rule_cmd.add_argument('--up', type=speed_argument, help="upload limit (0 removes)")
+    rule_cmd.add_argument('--dry-run', action='store_true', help="print the plan without applying it")
+
+    rules_cmd = commands.add_parser('rules', help="list rules, or load them from a file")
+    rules_cmd.add_argument('interface')
+    rules_cmd.add_argument('--file', help='lines of "MATCH [DOWN [UP]]", "-" for no limit')
+    rules_cmd.add_argument('--replace', action='store_true', help="drop rules not in the file")
+    rules_cmd.add_argument('--dry-run', action='store_true', help="print the plan without applying it")
+
+    status_cmd = commands.add_parser('status', help="show limits and counters")
+    status_cmd.add_argument('interface', nargs='?')
+    status_cmd.add_argument('--json', action='store_true', help="print the raw reply")
+
+    watch_cmd = commands.add_parser('watch', help="print live throughput")
+    watch_cmd.add_argument('interface')
+    watch_cmd.add_argument('--interval', type=float, default=1.0)
+    watch_cmd.add_argument('--window', type=float, default=10.0,
+                           help="seconds of history for the average and p95")
+
+    stats_cmd = commands.add_parser(
+        'stats', help="show rates, drops and backlog of every shaping queue and class")
+    stats_cmd.add_argument('interface')
+    stats_cmd.add_argument('--interval', type=float, default=1.0)
+    stats_cmd.add_argument('--once', action='store_true', help="print one sample and exit")
+    stats_cmd.add_argument('--json', action='store_true', help="print the raw replies")
+
+    quota_cmd = commands.add_parser('quota', help="show or set data-cap budgets")
+    quota_cmd.add_argument('interface', nargs='?', help="omit to show every budget")
+    quota_cmd.add_argument('--set', type=size_argument, metavar='SIZE', dest='budget',
+                           help="bytes allowed per period (received plus sent), e.g. 50GB")
+    quota_cmd.add_argument('--period', choices=('daily', 'monthly'), default='monthly')
+    quota_cmd.add_argument('--reset-day', type=int, default=1,
+                           help="day of the month a monthly period starts (1-28)")
+    quota_cmd.add_argument('--tier', type=tier_argument, action='append', dest='tiers', default=[],
+                           help="limits once PERCENT of the budget is used, as PERCENT:DOWN:UP "
+                                "(\"-\" keeps a limit); repeat for several")
+    quota_cmd.add_argument('--remove', action='store_true', help="drop the interface's budget")
+
+    autorate_cmd = commands.add_parser(
+        'autorate', help="adapt limits to the measured capacity until interrupted")
+    autorate_cmd.add_argument('interface')
+    autorate_cmd.add_argument('--down', type=range_argument,
+                              help="download range as MAX or MIN:BASE:MAX, e.g. 100mbit")
+    autorate_cmd.add_argument('--up', type=range_argument, help="upload range, as for --down")
+    autorate_cmd.add_argument('--target', type=float, default=15.0,
+                              help="queueing delay to stay under, in ms (default 15)")
+    autorate_cmd.add_argument('--reflector', action='append', dest='reflectors',
+                              help="host answering pings; repeat for several "
+                                   "(default 1.1.1.1, 8.8.8.8, 9.9.9.9)")
+    autorate_cmd.add_argument('--interval', type=float, default=0.5)
+
+    verify_cmd = commands.add_parser(
+        'verify', help="measure how well limits hold, and the latency they add, in a test namespace")
+    verify_cmd.add_argument('interface', nargs='?',
+                            help="verify this interface's limits, queue and ingress mode "
+                                 "(options override them)")
+    verify_cmd.add_argument('--down', type=speed_argument, help="download limit, e.g. 1gbit")
+    verify_cmd.add_argument('--up', type=speed_argument, help="upload limit, e.g. 1gbit")
+    verify_cmd.add_argument('--queue', choices=QUEUES)
+    verify_cmd.add_argument('--ingress', choices=INGRESS_MODES)
+    verify_cmd.add_argument('--duration', type=float, default=10.0,
+                            help="seconds measured per direction (default 10)")
+    verify_cmd.add_argument('--warmup', type=float, default=2.0,
+                            help="seconds of load before measuring (default 2)")
+    verify_cmd.add_argument('--flows', type=int, default=4, help="parallel flows (default 4)")
+    verify_cmd.add_argument('--udp', action='store_true',
+                            help="paced UDP at 120%% of the limit instead of TCP")
+    verify_cmd.add_argument('--tolerance', type=float, default=5.0,
+                            help="allowed deviation from the limit, in percent (default 5)")
+    verify_cmd.add_argument('--no-baseline', action='store_true',
+                            help="skip measuring the unshaped test bed first")
+    verify_cmd.add_argument('--backend', choices=('netlink', 'shell'))
+    verify_cmd.add_argument('--json', action='store_true', help="print the report as JSON")
+
+    proxy_cmd = commands.add_parser(
+        'proxy', help="limit applications through a local SOCKS5 proxy (no root or tc needed)")
+    proxy_cmd.add_argument('--listen', type=metrics_argument, default=('127.0.0.1', 1080),
+                           metavar='[ADDRESS:]PORT', help="SOCKS5 address (default 127.0.0.1:1080)")
+    proxy_cmd.add_argument('--down', type=speed_argument, help="total download limit, e.g. 50mbit")
+    proxy_cmd.add_argument('--up', type=speed_argument, help="total upload limit")
+    proxy_cmd.add_argument('--client-down', type=speed_argument,
+                           help="download limit of each client address")
+    proxy_cmd.add_argument('--client-up', type=speed_argument, help="upload limit of each client address")
+    proxy_cmd.add_argument('--dest-down', type=speed_argument,
+                           help="download limit of each destination host:port")
+    proxy_cmd.add_argument('--dest-up', type=speed_argument,
+                           help="upload limit of each destination host:port")
+    proxy_cmd.add_argument('--forward', type=forward_argument, action='append', dest='forwards',
+                           default=[], metavar='[ADDRESS:]PORT:HOST:HOSTPORT',
+                           help="also forward a local port to a fixed destination; repeat for several")
+    proxy_cmd.add_argument('--interval', type=float, default=0,
+                           help="print throughput every N seconds (default: quiet)")
+    proxy_cmd.add_argument('--copy', action='store_true',
+                           help="relay through Python buffers instead of splice()")
+
+    top_cmd = commands.add_parser('top', help="show the busiest interfaces")
+    top_cmd.add_argument('-n', '--count', type=int, default=10)
+    top_cmd.add_argument('--sort', choices=('total', 'rx', 'tx'), default='total')
+    top_cmd.add_argument('--interval', type=float, default=1.0)
+    top_cmd.add_argument('--once', action='store_true', help="print one sample and exit")
+
+    procs_cmd = commands.add_parser('procs', help="show TCP throughput per process")
+    procs_cmd.add_argument('-n', '--count', type=int, default=15)
+    procs_cmd.add_argument('--cgroups', action='store_true', help="group by cgroup")
+    procs_cmd.add_argument('--interval', type=float, default=1.0)
+    procs_cmd.add_argument('--once', action='store_true', help="print one sample and exit")
+
+    history_cmd = commands.add_parser('history', help="show recorded traffic history")
+    history_cmd.add_argument('interface', nargs='?',
+                             help="interface or class series such as eth0:1:30; omit to list")
+    history_cmd.add_argument('--tier', choices=('1s', '1m', '1h'), default='1m')
+    history_cmd.add_argument('--since', type=duration_argument, default=3600,
+                             help="how far back to show, e.g. 15m, 2h, 7d (default 1h)")
+    history_cmd.add_argument('--directory', help="history directory (default: state dir)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'daemon':
+        from .daemon import run
+        run(args.socket, history=not args.no_history, metrics=args.metrics,
+            hotplug=not args.no_hotplug, record=args.record)
+        return 0
+
+    if args.command == 'top':
+        return run_top(args)
+
+    if args.command == 'procs':
+        return run_procs(args)
+
+    if args.command == 'history':
+        return run_history(args)
+
+    if args.command == 'verify':
+        return run_verify(args)
+
+    if args.command == 'restore':
+        return run_restore(args)
+
+    if args.command == 'proxy':
+        return run_proxy(args)
+
+    if args.command == 'set':
+        if args.down is None and args.up is None and args.queue is None and args.ingress is None:
+            print("Nothing to set: pass --down, --up, --queue and/or --ingress", file=sys.stderr)
+            return 2
+        settings = {'down': args.down, 'up': args.up, 'queue': args.queue, 'ingress': args.ingress}
+        if len(args.interfaces) == 1:
+            message = {'cmd': 'set', 'interface': args.interfaces[0], 'dry_run': args.dry_run,
+                       **settings}
+        else:
+            message = {'cmd': 'apply', 'dry_run': args.dry_run,
+                       'interfaces': [{'interface': name, **settings} for name in args.interfaces]}
+    elif args.command == 'rule':
+        if args.down is None and args.up is None:
+            print("Nothing to set: pass --down and/or --up", file=sys.stderr)
+            return 2
+        message = {'cmd': 'rules', 'interface': args.interface, 'dry_run': args.dry_run,
+                   'rules': [{'match': args.match, 'down': args.down, 'up': args.up}]}
+    elif args.command == 'rules' and args.file:
+        try:
+            rules = load_rules(args.file)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        message = {'cmd': 'rules', 'interface': args.interface, 'rules': rules,
+                   'replace': args.replace, 'dry_run': args.dry_run}
+    elif args.command == 'rules':
+        message = {'cmd': 'status', 'interface': args.interface}
+    elif args.command == 'clear' and len(args.interfaces) == 1:
+        message = {'cmd': 'clear', 'interface': args.interfaces[0], 'dry_run': args.dry_run}
+    elif args.command == 'clear':
+        message = {'cmd': 'apply', 'dry_run': args.dry_run,
+                   'interfaces': [{'interface': name, 'clear': True} for name in args.interfaces]}
+    elif args.command == 'apply':
+        try:
+            interfaces = load_interfaces(args.file)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        message = {'cmd': 'apply', 'interfaces': interfaces, 'dry_run': args.dry_run}
+    elif args.command == 'status':
+        message = {'cmd': 'status', 'interface': args.interface}
+    elif args.command == 'quota':
+        message = {'cmd': 'quota', 'interface': args.interface}
+        if (args.budget or args.remove) and not args.interface:
+            print("--set and --remove need an interface", file=sys.stderr)
+            return 2
+        if args.budget:
+            message['budget'] = {'interface': args.interface, 'limit_bytes': args.budget,
+                                 'period': args.period, 'reset_day': args.reset_day,
+                                 'tiers': args.tiers}
+        message['remove'] = args.remove
+    elif args.command == 'stats':
+        message = {'cmd': 'stats', 'interface': args.interface, 'interval': args.interval}
+    elif args.command == 'autorate':
+        if args.down is None and args.up is None:
+            print("Nothing to adapt: pass --down and/or --up", file=sys.stderr)
+            return 2
+        message = {'cmd': 'autorate', 'interface': args.interface, 'down': args.down,
+                   'up': args.up, 'target_ms': args.target, 'reflectors': args.reflectors,
+                   'interval': args.interval}
+    else:
+        message = {'cmd': 'watch', 'interface': args.interface, 'interval': args.interval,
+                   'window': args.window}
+
+    try:
+        for reply in send(message, args):
+            if not reply.get('ok'):
+                print(f"Error: {reply.get('error')}", file=sys.stderr)
+                return 1
+            if args.command == 'watch':
+                print_sample(reply)
+            elif args.command == 'autorate':
+                print_autorate(reply)
+            elif args.command == 'stats':
+                if args.json:
+                    print(json.dumps(reply), flush=True)
+                else:
+                    print_tc_stats(reply)
+                if args.once:
+                    break
+            elif args.command == 'quota':
+                print_budgets(reply)
+            elif args.command == 'status' and args.json:
+                print(json.dumps(reply, indent=2))
+            elif args.command == 'status':
+                print_status(reply)
+            elif args.command == 'rules' and not args.file:
+                print_rules(reply)
+            elif 'results' in reply:
+                failed = False
+                for result in reply['results']:
+                    if result['ok']:
+                        print_result(result, args.dry_run)
+                    else:
+                        print(f"{result['interface']}: Error: {result['error']}", file=sys.stderr)
+                        failed = True
+                if failed:
+                    return 1
+            else:
+                print_result(reply, args.dry_run)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
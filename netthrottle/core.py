@@ -0,0 +1,774 @@
+"""GUI-independent shaping, monitoring and settings logic.
+
+``ThrottleCore`` is shared by the Tk window, the daemon and the command line
+client. It never imports tkinter; psutil and the shaping backend are only
+imported when first needed so the GUI can draw its window straight away.
+"""
+import json
+import os
+import platform
+import threading
+
+from .units import convert_to_kbps, format_limit, format_speed, parse_speed  # noqa: F401
+
+SETTINGS_FILE = 'speed_limiter_settings.json'
+# Interfaces reconciled at the same time by apply_many()
+MAX_PARALLEL_APPLY = 8
+# Recorder ticks between history flushes and interface rescans
+RECORD_FLUSH_TICKS = 60
+# Series the recorder creates at most (interfaces and tc classes), about 9.3MB each
+MAX_RECORDED_SERIES = 32
+
+class ThrottleCore:
+    """Shaping, monitoring and settings for one host"""
+
+    def __init__(self, backend=None, settings_file=None, journal=True):
+        self.os_type = platform.system().lower()
+        self.is_windows = self.os_type == 'windows'
+        self.is_linux = self.os_type == 'linux'
+
+        self._backend = backend
+        self._reconciler = None
+        self._backend_probed = backend is not None
+        self.settings_file = settings_file
+        # Every applied policy is journaled for restore_state() unless journal
+        # is False (test beds); True means a StateJournal in the state directory
+        self._journal = journal
+        # Serialise observe+apply per interface so concurrent clients cannot
+        # interleave plans; different interfaces are reconciled independently
+        self.lock = threading.Lock()
+        self.interface_locks = {}
+        self._backend_lock = threading.Lock()
+
+        self.is_monitoring = False
+        self.monitoring_thread = None
+        self.monitor_stop = threading.Event()
+        self.top_thread = None
+        self.queue_thread = None
+        self.recording_thread = None
+        self.sampler = None
+        # interface -> Event stopping its autorate thread
+        self.autorate_stops = {}
+        self._quota = None
+        self.quota_lock = threading.Lock()
+        self.quota_thread = None
+        self.metrics = None
+        self.proxy = None
+        self.link_watcher = None
+
+    @property
+    def backend(self):
+        """The shaping backend, chosen on first use (None without tc support)"""
+        if not self._backend_probed:
+            with self._backend_lock:
+                if not self._backend_probed:
+                    if self.is_linux:
+                        from .backends import get_backend
+                        self._backend = get_backend()
+                    self._backend_probed = True
+        return self._backend
+
+    @property
+    def reconciler(self):
+        if self._reconciler is None and self.backend is not None:
+            with self._backend_lock:
+                if self._reconciler is None:
+                    from .reconcile import Reconciler
+                    self._reconciler = Reconciler(self._backend)
+        return self._reconciler
+
+    @property
+    def journal(self):
+        if self._journal is True:
+            from .state import StateJournal
+            self._journal = StateJournal()
+        return self._journal or None
+
+    def close(self):
+        self.stop_metrics()
+        self.stop_proxy()
+        self.stop_link_watch()
+        self.stop_monitoring()
+        for interface in list(self.autorate_stops):
+            self.stop_autorate(interface)
+        for thread in (self.recording_thread, self.quota_thread):
+            if thread:
+                # Let the recorder and the quota journals write what they have
+                thread.join(timeout=2)
+        if self._backend:
+            self._backend.close()
+
+    # Interfaces and counters
+
+    def get_network_interfaces(self):
+        """Get available network interfaces (cross-platform)"""
+        try:
+            import psutil
+
+            interfaces = []
+            for interface, addrs in psutil.net_if_addrs().items():
+                # Skip loopback interfaces
+                if interface.lower() in ['lo', 'loopback']:
+                    continue
+
+                # Check if interface has an IP address
+                if any(addr.family == 2 for addr in addrs):  # AF_INET = 2
+                    interfaces.append(interface)
+
+            # Return found interfaces or platform-specific defaults
+            if interfaces:
+                return interfaces
+            elif self.is_windows:
+                return ['Wi-Fi', 'Ethernet', 'Local Area Connection']
+            else:
+                return self._device_names()
+
+        except Exception:
+            # Fallback defaults based on platform
+            if self.is_windows:
+                return ['Wi-Fi', 'Ethernet', 'Local Area Connection']
+            else:
+                return self._device_names()
+
+    def _device_names(self):
+        """Every device the kernel has, addressed or not (no made-up names)"""
+        import socket
+
+        try:
+            return [name for _, name in socket.if_nameindex() if name != 'lo']
+        except OSError:
+            return []
+
+    def interface_counters(self, interface):
+        """Byte/packet counters for one interface, or None if it is unknown"""
+        import psutil
+
+        stat = psutil.net_io_counters(pernic=True).get(interface)
+        if stat is None:
+            return None
+        return {
+            'bytes_sent': stat.bytes_sent,
+            'bytes_recv': stat.bytes_recv,
+            'packets_sent': stat.packets_sent,
+            'packets_recv': stat.packets_recv,
+        }
+
+    # Shaping
+
+    def _require_reconciler(self):
+        if self.reconciler is None:
+            from .backends import BackendError
+            raise BackendError("Bandwidth limiting requires Linux with Traffic Control (tc)")
+        return self.reconciler
+
+    def interface_lock(self, interface):
+        with self.lock:
+            return self.interface_locks.setdefault(interface, threading.Lock())
+
+    def get_policy(self, interface):
+        """The limits currently installed on ``interface``"""
+        return self._require_reconciler().observe(interface)
+
+    def set_limits(self, interface, download_kbps=None, upload_kbps=None, queue=None,
+                   ingress_mode=None, dry_run=False, persist=True):
+        """Set either or both limits; None keeps the current value, 0 removes it.
+
+        ``queue`` (one of policy.QUEUES) switches how shaped traffic is queued
+        and ``ingress_mode`` (one of policy.INGRESS_MODES) how the upload limit
+        is enforced; None keeps the current one. Returns (policy, steps,
+        warning) where steps is the applied (or planned) change list and
+        warning is None unless the change could not be journaled. Without
+        ``persist`` the change is not journaled, so a restore brings back the
+        previous limits.
+        """
+        from .policy import INGRESS_MODES, QUEUES
+
+        if queue is not None and queue not in QUEUES:
+            raise ValueError(f"Unknown queue {queue!r}, expected one of {', '.join(QUEUES)}")
+        if ingress_mode is not None and ingress_mode not in INGRESS_MODES:
+            raise ValueError(f"Unknown ingress mode {ingress_mode!r}, "
+                             f"expected one of {', '.join(INGRESS_MODES)}")
+        reconciler = self._require_reconciler()
+        with self.interface_lock(interface):
+            policy = reconciler.observe(interface)
+            if download_kbps is not None:
+                policy.download_kbps = download_kbps or None
+            if upload_kbps is not None:
+                policy.upload_kbps = upload_kbps or None
+            if queue is not None:
+                policy.queue = queue
+            if ingress_mode is not None:
+                policy.ingress_mode = ingress_mode
+            steps = reconciler.apply(policy, dry_run=dry_run)
+            warning = self._record(policy) if persist and not dry_run else None
+            return policy, steps, warning
+
+    def set_rules(self, interface, rules, replace=False, dry_run=False):
+        """Add or change per-host/subnet/port Rules on ``interface``.
+
+        As with set_limits, a None limit keeps the current value and 0 removes
+        it; a rule left without limits is dropped. ``replace`` drops every rule
+        not listed. Returns (policy, steps, warning) like set_limits.
+        """
+        from .policy import Rule
+        from .rules import format_match, parse_match
+
+        reconciler = self._require_reconciler()
+        with self.interface_lock(interface):
+            policy = reconciler.observe(interface)
+            current = {} if replace else {parse_match(rule.match): rule for rule in policy.rules}
+            for rule in rules:
+                key = parse_match(rule.match)
+                merged = current.get(key) or Rule(format_match(key))
+                if rule.download_kbps is not None:
+                    merged.download_kbps = rule.download_kbps or None
+                if rule.upload_kbps is not None:
+                    merged.upload_kbps = rule.upload_kbps or None
+                current[key] = merged
+            policy.rules = [rule for rule in current.values() if rule.download_kbps or rule.upload_kbps]
+            steps = reconciler.apply(policy, dry_run=dry_run)
+            return policy, steps, None if dry_run else self._record(policy)
+
+    def clear_limits(self, interface, dry_run=False):
+        """Remove all limits from ``interface``, and its IFB device; returns (policy, steps, warning)"""
+        from .policy import InterfacePolicy
+
+        reconciler = self._require_reconciler()
+        with self.interface_lock(interface):
+            policy = InterfacePolicy(interface, ifb=reconciler.observe(interface).ifb)
+            steps = reconciler.apply(policy, dry_run=dry_run)
+            return policy, steps, None if dry_run else self._record(policy)
+
+    def apply_many(self, changes, dry_run=False):
+        """Reconcile several interfaces in parallel, each with its own IFB.
+
+        ``changes`` maps interface names to set_limits() keyword arguments,
+        or to None to clear the interface. Returns {interface: (policy, steps,
+        warning)}, or the exception for an interface that failed; the others
+        still apply.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def apply(interface):
+            try:
+                if changes[interface] is None:
+                    return self.clear_limits(interface, dry_run=dry_run)
+                return self.set_limits(interface, **changes[interface], dry_run=dry_run)
+            except Exception as e:
+                return e
+
+        self._require_reconciler()
+        with ThreadPoolExecutor(max_workers=min(len(changes), MAX_PARALLEL_APPLY) or 1) as pool:
+            return dict(zip(changes, pool.map(apply, changes)))
+
+    def _record(self, *policies):
+        """Journal applied policies; returns a warning instead of raising, as the change succeeded"""
+        try:
+            if self.journal:
+                self.journal.record(policies)
+        except Exception as e:
+            return f"Limits applied but not saved, a restore will not bring them back: {e}"
+        return None
+
+    def restore_state(self, dry_run=False, journals=None):
+        """Re-apply every journaled policy in one batch, e.g. at boot.
+
+        ``journals`` are the state.StateJournal objects to restore, later
+        ones winning for an interface in several; by default this core's.
+        Returns {interface: (policy, steps)}, or the exception for an
+        interface that failed. Interfaces that do not exist (yet) map to None
+        and stay in the journal for the next restore.
+        """
+        from contextlib import ExitStack
+
+        reconciler = self._require_reconciler()
+        policies = {}
+        for journal in ([self.journal] if journals is None else journals):
+            if journal:
+                policies.update(journal.load())
+        results = {}
+        present = []
+        for interface, policy in policies.items():
+            if self.backend.link_state(interface) is None:
+                results[interface] = None
+            else:
+                present.append(policy)
+        with ExitStack() as stack:
+            for policy in sorted(present, key=lambda policy: policy.interface):
+                stack.enter_context(self.interface_lock(policy.interface))
+            plans = reconciler.apply_batch(present, dry_run=dry_run)
+        for policy in present:
+            plan = plans[policy.interface]
+            results[policy.interface] = plan if isinstance(plan, Exception) else (policy, plan)
+        return results
+
+    def reapply_journaled(self, interface):
+        """Bring back the journaled policy of ``interface`` if it is not in place.
+
+        Returns the steps applied (empty when nothing was missing), or None
+        when nothing is journaled for it.
+        """
+        policy = (self.journal.load() if self.journal else {}).get(interface)
+        if policy is None or self.reconciler is None:
+            return None
+        with self.interface_lock(interface):
+            return self.reconciler.apply(policy)
+
+    def queue_stats(self, interface):
+        """Backlog and drop counters of the shaping queues: {'download': ..., 'upload': ...}"""
+        return self._require_reconciler().queue_stats(interface)
+
+    def tc_snapshot(self, interface):
+        """Every qdisc and class of the shaping with its counters (see tcstats.TcStats)"""
+        return self._require_reconciler().tc_snapshot(interface)
+
+    def status(self, interface):
+        """Installed limits, queue and interface counters for ``interface`` as a plain dict"""
+        from dataclasses import asdict
+
+        status = {'interface': interface}
+        try:
+            if self.reconciler:
+                status.update(asdict(self.reconciler.observe(interface)))
+                status['queues'] = self.reconciler.queue_stats(interface)
+            status['counters'] = self.interface_counters(interface)
+        except Exception as e:
+            status.setdefault('counters', None)
+            status['error'] = str(e)
+        return status
+
+    def start_autorate(self, interface, download=None, upload=None, callback=None, **options):
+        """Adapt the limits of ``interface`` to its measured throughput and latency.
+
+        ``download`` and ``upload`` are autorate.RateBounds (None leaves that
+        limit alone); ``options`` go to autorate.AutoRate. ``callback(step)``
+        receives every tick's measurements. Replaces a running controller.
+        """
+        from .autorate import AutoRate
+
+        self._require_reconciler()
+        controller = AutoRate(self, interface, download, upload, **options)
+        self.stop_autorate(interface)
+
+        def run(stop):
+            try:
+                controller.run(stop, callback)
+            finally:
+                controller.close()
+
+        stop = self.autorate_stops[interface] = threading.Event()
+        threading.Thread(target=run, args=(stop,), daemon=True).start()
+
+    def stop_autorate(self, interface):
+        """Stop adapting ``interface``; the last rates stay in force"""
+        stop = self.autorate_stops.pop(interface, None)
+        if stop:
+            stop.set()
+        return stop is not None
+
+    # Data caps
+
+    @property
+    def quota(self):
+        """The QuotaEngine keeping budgets and usage, created on first use"""
+        with self.quota_lock:
+            if self._quota is None:
+                from .quota import QuotaEngine
+
+                def limits(interface):
+                    policy = self.get_policy(interface)
+                    return policy.download_kbps, policy.upload_kbps
+
+                # Tier rates are not journaled: a restore brings back the user's limits
+                # and the engine re-applies the tier in force when it starts
+                self._quota = QuotaEngine(
+                    lambda interface, down, up: self.set_limits(interface, down, up, persist=False),
+                    limits)
+            return self._quota
+
+    def set_budget(self, budget):
+        """Add or replace the quota.Budget of its interface"""
+        engine = self.quota
+        with self.quota_lock:
+            engine.set_budget(budget)
+
+    def remove_budget(self, interface):
+        """Drop the budget of ``interface``; returns False if it had none"""
+        engine = self.quota
+        with self.quota_lock:
+            return engine.remove_budget(interface)
+
+    def quota_status(self):
+        """Usage of every budget in the current period"""
+        engine = self.quota
+        with self.quota_lock:
+            return engine.status()
+
+    def start_quota(self, callback=None, interval=1.0):
+        """Count usage against the budgets every interval, stepping through their tiers.
+
+        ``callback(change)`` is told about every tier change. Linux only;
+        returns False elsewhere. Stops with stop_monitoring.
+        """
+        if not self.is_linux or self.quota_thread:
+            return False
+        self.monitor_stop.clear()
+        self.quota_thread = threading.Thread(
+            target=self.account_quota, args=(callback, interval), daemon=True)
+        self.quota_thread.start()
+        return True
+
+    def account_quota(self, callback, interval):
+        """Account data usage.
+
+        A failing tick (no state directory, an unreadable budgets file, a
+        journal that cannot be written) is reported to ``callback`` as a
+        change with an ``error``, once until it clears, and retried on the
+        next tick.
+        """
+        from .sampler import open_counters, ticks
+
+        counters = {}
+        engine = None
+        reported = set()
+        failed = set()
+
+        def notify(change):
+            if not callback:
+                return
+            try:
+                callback(change)
+            except Exception as e:
+                # A failing listener must not stop the accounting
+                print(f"Data cap handler failed: {e}")
+
+        def report(interface, error):
+            failed.add((interface, error))
+            if (interface, error) not in reported:
+                reported.add((interface, error))
+                notify({'interface': interface, 'error': error})
+
+        try:
+            for _ in ticks(interval, self.monitor_stop):
+                failed.clear()
+                try:
+                    if engine is None:
+                        engine = self.quota
+                    with self.quota_lock:
+                        try:
+                            engine.reload()
+                        except Exception as e:
+                            report(None, f"Could not reload the data caps: {e}")
+                        for name in set(counters) - set(engine.budgets):
+                            counters.pop(name).close()
+                        for name in engine.budgets:
+                            try:
+                                if name not in counters:
+                                    counters[name] = open_counters(name)
+                                rx, tx = counters[name].read()
+                            except OSError:
+                                counter = counters.pop(name, None)
+                                if counter:
+                                    counter.close()
+                                continue
+                            try:
+                                change = engine.update(name, rx, tx)
+                            except Exception as e:
+                                report(name, f"Could not count data usage: {e}")
+                                continue
+                            if change:
+                                notify(change)
+                except Exception as e:
+                    report(None, f"Data cap accounting failed: {e}")
+                # Report an error again if it comes back after clearing
+                reported &= failed
+        finally:
+            for counter in counters.values():
+                counter.close()
+            if self._quota:
+                with self.quota_lock:
+                    self._quota.close()
+            self.quota_thread = None
+
+    # Monitoring
+
+    def start_monitoring(self, get_interface, callback, interval=1.0):
+        """Call ``callback(upload_kbs, download_kbs)`` for the current interface every interval"""
+        if not self.is_monitoring:
+            self.is_monitoring = True
+            self.monitor_stop.clear()
+            self.monitoring_thread = threading.Thread(
+                target=self.monitor_network, args=(get_interface, callback, interval), daemon=True)
+            self.monitoring_thread.start()
+
+    def stop_monitoring(self):
+        self.is_monitoring = False
+        self.monitor_stop.set()
+
+    def monitor_network(self, get_interface, callback, interval=1.0):
+        """Monitor network activity"""
+        from .sampler import Sampler, ticks
+
+        self.sampler = sampler = Sampler(interval=interval)
+        try:
+            for _ in ticks(interval, self.monitor_stop):
+                try:
+                    interface = get_interface()
+                    sampler.set_interfaces([interface] if interface else [])
+                    rates = sampler.poll()
+                    if interface in rates:
+                        rx, tx = rates[interface]
+                        # Convert to KB/s
+                        callback(tx / 1024, rx / 1024)
+                except Exception:
+                    pass
+        finally:
+            sampler.close()
+
+    def start_top_monitoring(self, callback, get_sort=lambda: 'total', count=10, interval=1.0):
+        """Call ``callback(rows)`` with the ``count`` busiest links every interval.
+
+        Uses one netlink stats dump per tick for all links, so it is Linux
+        only; returns False where it is unavailable. Stops with stop_monitoring.
+        """
+        if not self.is_linux or self.top_thread:
+            return False
+        self.top_thread = threading.Thread(
+            target=self.monitor_top, args=(callback, get_sort, count, interval), daemon=True)
+        self.top_thread.start()
+        return True
+
+    def monitor_top(self, callback, get_sort, count, interval):
+        """Monitor the busiest links"""
+        from .linkstats import LinkStats
+        from .sampler import ticks
+
+        try:
+            stats = LinkStats()
+        except OSError:
+            return
+        try:
+            stats.poll()
+            for _ in ticks(interval, self.monitor_stop):
+                try:
+                    stats.poll()
+                    callback(stats.top(count, get_sort()))
+                except Exception:
+                    pass
+        finally:
+            stats.close()
+            self.top_thread = None
+
+    def start_queue_monitoring(self, get_interface, callback, interval=1.0):
+        """Call ``callback(interface, stats)`` with queue_stats() of the current interface
+        every interval.
+
+        Linux only; returns False elsewhere. Stops with stop_monitoring.
+        """
+        if not self.is_linux or self.queue_thread:
+            return False
+        self.queue_thread = threading.Thread(
+            target=self.monitor_queues, args=(get_interface, callback, interval), daemon=True)
+        self.queue_thread.start()
+        return True
+
+    def monitor_queues(self, get_interface, callback, interval):
+        """Monitor the backlog and drops of the shaping queues"""
+        from .sampler import ticks
+
+        try:
+            # Probes the backend on this thread rather than the caller's
+            if self.reconciler is None:
+                return
+            for _ in ticks(interval, self.monitor_stop):
+                try:
+                    interface = get_interface()
+                    if interface:
+                        callback(interface, self.queue_stats(interface))
+                except Exception:
+                    pass
+        finally:
+            self.queue_thread = None
+
+    def start_recording(self, interfaces=None, interval=1.0, directory=None):
+        """Append counters to the traffic history every interval.
+
+        Records ``interfaces`` and the tc classes shaping them, or the
+        interfaces with journaled limits when None. Stops with stop_monitoring.
+        """
+        if not self.recording_thread:
+            self.monitor_stop.clear()
+            self.recording_thread = threading.Thread(
+                target=self.record_history, args=(interfaces, interval, directory), daemon=True)
+            self.recording_thread.start()
+
+    def shaped_interfaces(self):
+        """Interfaces with journaled limits"""
+        try:
+            return sorted(self.journal.load()) if self.journal else []
+        except ValueError:
+            return []
+
+    def record_history(self, interfaces, interval, directory):
+        """Record traffic history"""
+        from .sampler import open_counters, ticks
+        from .tsdb import FIELDS, TimeSeriesStore
+
+        store = TimeSeriesStore(directory)
+        counters = {}
+        names = interfaces or self.shaped_interfaces()
+        refused = set()
+
+        def add(key, reading):
+            if key in store.series or len(store.series) < MAX_RECORDED_SERIES:
+                store.add(key, reading)
+            elif key not in refused:
+                refused.add(key)
+                print(f"Not recording {key}: {MAX_RECORDED_SERIES} series already recorded")
+
+        try:
+            for tick, _ in enumerate(ticks(interval, self.monitor_stop), 1):
+                for name in names:
+                    try:
+                        if name not in counters:
+                            counters[name] = open_counters(name, FIELDS[1:])
+                        add(name, counters[name].read())
+                    except OSError:
+                        counter = counters.pop(name, None)
+                        if counter:
+                            counter.close()
+                    self._record_classes(name, add)
+                if tick % RECORD_FLUSH_TICKS == 0:
+                    store.flush()
+                    if not interfaces:
+                        names = self.shaped_interfaces()
+        finally:
+            for counter in counters.values():
+                counter.close()
+            store.close()
+            self.recording_thread = None
+
+    def _record_classes(self, interface, add):
+        """Pass the counters of every tc class shaping ``interface`` to ``add``.
+
+        Series are keyed by device and class (``eth0:1:30``, ``ifb-eth0:1:30``
+        for upload); a class counts what it sent, in the tx fields.
+        """
+        try:
+            snapshot = self.reconciler.tc_snapshot(interface) if self.reconciler else {}
+        except Exception:
+            return
+        for tree in snapshot.values():
+            for cls in (tree or {}).get('classes', ()):
+                stats = cls.get('stats', {})
+                add(f"{tree['device']}:{cls['classid']}",
+                    (0, stats.get('bytes', 0), 0, stats.get('packets', 0)))
+
+    def start_metrics(self, address=None, port=None, interval=None, interfaces=None):
+        """Serve OpenMetrics on http://address:port/metrics (see metrics.MetricsExporter).
+
+        Raises OSError when the port cannot be bound.
+        """
+        from .metrics import DEFAULT_ADDRESS, DEFAULT_INTERVAL, DEFAULT_PORT, MetricsExporter
+
+        self.stop_metrics()
+        self.metrics = MetricsExporter(self, address or DEFAULT_ADDRESS, port or DEFAULT_PORT,
+                                       interval or DEFAULT_INTERVAL, interfaces)
+        self.metrics.start()
+        return self.metrics
+
+    def stop_metrics(self):
+        if self.metrics:
+            self.metrics.stop()
+            self.metrics = None
+
+    def start_link_watch(self, callback=None, reapply=True):
+        """Follow interfaces appearing, disappearing and bouncing (Linux only).
+
+        ``callback(event)`` gets every linkwatch.LinkWatcher event from its
+        thread. With ``reapply``, an interface that appears or comes back up
+        gets its journaled policy again; the event then carries ``restored``
+        (the steps applied) or ``error``. Returns the watcher, whose
+        interfaces() lists the current devices.
+        """
+        from .linkwatch import LinkWatcher
+
+        def on_event(event):
+            if reapply and event['event'] in ('added', 'renamed', 'up'):
+                try:
+                    steps = self.reapply_journaled(event['interface'])
+                    if steps is not None:
+                        event['restored'] = [str(step) for step in steps]
+                except Exception as e:
+                    event['error'] = str(e)
+            if callback:
+                callback(event)
+
+        self.stop_link_watch()
+        self.link_watcher = LinkWatcher(on_event)
+        self.link_watcher.start()
+        return self.link_watcher
+
+    def stop_link_watch(self):
+        if self.link_watcher:
+            self.link_watcher.stop()
+            self.link_watcher = None
+
+    def start_proxy(self, limits=None, address=None, port=None, forwards=()):
+        """Run the throttling SOCKS5 proxy on a thread (see proxy.ThrottleProxy).
+
+        Raises OSError when a port cannot be bound.
+        """
+        from .proxy import DEFAULT_ADDRESS, DEFAULT_PORT, ThrottleProxy
+
+        self.stop_proxy()
+        self.proxy = ThrottleProxy(limits, address or DEFAULT_ADDRESS, port or DEFAULT_PORT, forwards)
+        self.proxy.start()
+        return self.proxy
+
+    def set_proxy_limits(self, **limits):
+        """Change ProxyLimits fields, starting the proxy on its default port if needed"""
+        if self.proxy is None:
+            from .proxy import ProxyLimits
+            return self.start_proxy(ProxyLimits(**limits))
+        self.proxy.set_limits(**limits)
+        return self.proxy
+
+    def stop_proxy(self):
+        if self.proxy:
+            self.proxy.stop()
+            self.proxy = None
+
+    def speed_stats(self, interface, window=None):
+        """Smoothed rate, min/max and percentiles from the monitor, in bytes/sec"""
+        return self.sampler.stats(interface, window) if self.sampler else None
+
+    # Settings
+
+    @property
+    def settings_path(self):
+        if self.settings_file:
+            return self.settings_file
+        from .paths import state_dir
+        return os.path.join(state_dir(), SETTINGS_FILE)
+
+    def save_settings(self, settings):
+        """Save current settings, replacing the file atomically"""
+        try:
+            from .fsutil import write_atomic
+
+            os.makedirs(os.path.dirname(self.settings_path) or '.', exist_ok=True)
+            write_atomic(self.settings_path, json.dumps(settings).encode())
+        except Exception:
+            pass
+
+    def load_settings(self):
+        """Load saved settings, or those older versions kept in the working directory"""
+        for path in (self.settings_path, SETTINGS_FILE):
+            try:
+                if os.path.exists(path):
+                    with open(path, 'r') as f:
+                        return json.load(f)
+            except Exception:
+                pass
+        return {}
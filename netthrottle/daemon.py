@@ -0,0 +1,263 @@
+"""Long-lived NetThrottle daemon serving requests over a Unix socket.
+
+Requests and replies are single lines of JSON. Keeping the process (and its
+netlink socket) alive means a ``netthrottle set`` only costs one round trip.
+"""
+import json
+import os
+import signal
+import socketserver
+import threading
+from dataclasses import asdict
+
+from .paths import socket_path
+
+
+def applied_reply(result):
+    """Reply for a (policy, steps, warning) result of the core"""
+    policy, steps, warning = result
+    reply = {'ok': True, 'policy': asdict(policy), 'plan': [str(s) for s in steps]}
+    if warning:
+        reply['warning'] = warning
+    return reply
+
+
+def dispatch(core, request):
+    """Execute one request against ``core`` and return the JSON-able reply"""
+    try:
+        cmd = request.get('cmd')
+        interface = request.get('interface')
+        if cmd == 'set':
+            return applied_reply(core.set_limits(interface, request.get('down'), request.get('up'),
+                                                 request.get('queue'), request.get('ingress'),
+                                                 dry_run=request.get('dry_run', False)))
+        if cmd == 'rules':
+            from .policy import Rule
+
+            rules = [Rule(rule['match'], rule.get('down'), rule.get('up'))
+                     for rule in request.get('rules', [])]
+            return applied_reply(core.set_rules(interface, rules, request.get('replace', False),
+                                                dry_run=request.get('dry_run', False)))
+        if cmd == 'clear':
+            return applied_reply(core.clear_limits(interface, dry_run=request.get('dry_run', False)))
+        if cmd == 'apply':
+            changes = {}
+            for entry in request.get('interfaces', []):
+                changes[entry['interface']] = None if entry.get('clear') else {
+                    'download_kbps': entry.get('down'), 'upload_kbps': entry.get('up'),
+                    'queue': entry.get('queue'), 'ingress_mode': entry.get('ingress')}
+            results = []
+            for name, result in core.apply_many(changes, request.get('dry_run', False)).items():
+                if isinstance(result, Exception):
+                    results.append({'ok': False, 'interface': name, 'error': str(result)})
+                else:
+                    results.append(applied_reply(result))
+            return {'ok': True, 'results': results}
+        if cmd == 'quota':
+            from .quota import Budget
+
+            if request.get('budget'):
+                core.set_budget(Budget(**request['budget']))
+            elif request.get('remove') and not core.remove_budget(interface):
+                return {'ok': False, 'error': f"{interface} has no budget"}
+            budgets = [budget for budget in core.quota_status()
+                       if not interface or budget['interface'] == interface]
+            return {'ok': True, 'budgets': budgets}
+        if cmd == 'status':
+            interfaces = [interface] if interface else core.get_network_interfaces()
+            return {'ok': True, 'interfaces': [core.status(name) for name in interfaces]}
+        return {'ok': False, 'error': f"Unknown command: {cmd}"}
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}
+
+
+def watch(interface, interval, window=10.0):
+    """Yield one rate sample per ``interval`` seconds for ``interface``.
+
+    Each sample carries the sampler statistics over the last ``window`` seconds.
+    """
+    from .sampler import Sampler, ticks
+
+    sampler = Sampler([interface], interval)
+    try:
+        sampler.poll()
+        for _ in ticks(interval, threading.Event()):
+            if sampler.counters[interface] is None:
+                break
+            rates = sampler.poll()
+            if interface in rates:
+                rx, tx = rates[interface]
+                yield {'ok': True, 'interface': interface,
+                       'download_kbs': rx / 1024, 'upload_kbs': tx / 1024,
+                       'stats': sampler.stats(interface, window)}
+        yield {'ok': False, 'error': f"Interface {interface} not found in statistics"}
+    finally:
+        sampler.close()
+
+
+def tc_stats(core, interface, interval):
+    """Yield the qdisc and class counters of ``interface`` as rates every ``interval`` seconds"""
+    from .sampler import ticks
+    from .tcstats import TcStats
+
+    stats = TcStats(core)
+    try:
+        stats.poll(interface)
+        for _ in ticks(interval, threading.Event()):
+            yield {'ok': True, **stats.poll(interface)}
+    except Exception as e:
+        yield {'ok': False, 'error': str(e)}
+    finally:
+        stats.close()
+
+
+def autorate(core, request):
+    """Adapt the limits of one interface, yielding every control tick.
+
+    ``down`` and ``up`` are [minimum, base, maximum] in kbit/s. The
+    controller runs until the generator is closed (the client went away);
+    the last rates stay in force.
+    """
+    import queue
+
+    from .autorate import DEFAULT_INTERVAL, DEFAULT_REFLECTORS, DEFAULT_TARGET_MS, RateBounds
+
+    interface = request.get('interface')
+    steps = queue.Queue()
+    try:
+        bounds = [RateBounds(*request[key]) if request.get(key) else None for key in ('down', 'up')]
+        core.start_autorate(interface, *bounds, callback=steps.put,
+                            reflectors=request.get('reflectors') or DEFAULT_REFLECTORS,
+                            target_ms=float(request.get('target_ms', DEFAULT_TARGET_MS)),
+                            interval=float(request.get('interval', DEFAULT_INTERVAL)))
+    except Exception as e:
+        yield {'ok': False, 'error': str(e)}
+        return
+    try:
+        while True:
+            yield {'ok': True, **steps.get()}
+    finally:
+        core.stop_autorate(interface)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self._serve()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, e.g. Ctrl+C on "netthrottle watch"
+            pass
+
+    def _serve(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self._reply({'ok': False, 'error': "Malformed request"})
+                continue
+            if request.get('cmd') == 'watch':
+                stream = watch(request.get('interface'), float(request.get('interval', 1.0)),
+                               float(request.get('window', 10.0)))
+            elif request.get('cmd') == 'autorate':
+                stream = autorate(self.server.core, request)
+            elif request.get('cmd') == 'stats':
+                stream = tc_stats(self.server.core, request.get('interface'),
+                                  float(request.get('interval', 1.0)))
+            else:
+                self._reply(dispatch(self.server.core, request))
+                continue
+            try:
+                for message in stream:
+                    self._reply(message)
+            finally:
+                stream.close()
+            return
+
+    def _reply(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+
+def log_link_event(event):
+    """Report interfaces coming and going, and limits brought back with them"""
+    if event['event'] == 'failed':
+        print(f"Interface watch failed, retrying in {event['retry']:g}s: {event['error']}",
+              flush=True)
+        return
+    if event['event'] in ('added', 'removed', 'renamed'):
+        print(f"Interface {event['interface']} {event['event']}", flush=True)
+    if event.get('restored'):
+        print(f"Restored the limits of {event['interface']} ({len(event['restored'])} changes)",
+              flush=True)
+    elif event.get('error'):
+        print(f"Could not restore the limits of {event['interface']}: {event['error']}", flush=True)
+
+
+def log_quota_change(change):
+    """Report data cap tier changes and accounting failures"""
+    if change.get('error') and change['interface'] is None:
+        print(change['error'], flush=True)
+    elif change.get('error'):
+        print(f"Data cap error on {change['interface']}: {change['error']}", flush=True)
+    elif change['to'] < 0:
+        print(f"Data cap period restarted on {change['interface']}, limits restored", flush=True)
+    else:
+        print(f"Data cap tier {change['to'] + 1} in force on {change['interface']}", flush=True)
+
+
+class ThrottleDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server exposing a ThrottleCore"""
+
+    daemon_threads = True
+
+    def __init__(self, path=None, core=None, history=True, metrics=None, hotplug=True,
+                 record=None):
+        self.path = path or socket_path()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if core is None:
+            from .core import ThrottleCore
+            core = ThrottleCore()
+        self.core = core
+        super().__init__(self.path, RequestHandler)
+        os.chmod(self.path, 0o660)
+        if history:
+            self.core.start_recording(record)
+        self.core.start_quota(log_quota_change)
+        if metrics:
+            self.core.start_metrics(*metrics)
+        if hotplug and self.core.is_linux:
+            try:
+                self.core.start_link_watch(log_link_event)
+            except Exception as e:
+                print(f"Not following interface changes: {e}")
+
+    def server_close(self):
+        super().server_close()
+        self.core.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def run(path=None, history=True, metrics=None, hotplug=True, record=None):
+    """Serve until interrupted; ``metrics`` is an (address, port) to export metrics on.
+
+    ``record`` lists the interfaces whose history is recorded, the shaped ones when None.
+    """
+    server = ThrottleDaemon(path, history=history, metrics=metrics, hotplug=hotplug,
+                            record=record)
+    # Stop cleanly (flushing history) on SIGTERM from a service manager too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"NetThrottle daemon listening on {server.path}")
+    if server.core.metrics:
+        address, port = server.core.metrics.address[:2]
+        host = f"[{address}]" if ':' in address else address
+        print(f"Metrics on http://{host}:{port}/metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
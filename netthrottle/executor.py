@@ -0,0 +1,174 @@
+"""Shaping operations run off the caller's thread, one interface at a time.
+
+The GUI hands limit changes to a ``ShapingExecutor`` instead of calling
+ThrottleCore on the Tk thread, so a slow sudo prompt or a hung tc never
+freezes the window:
+
+* operations on one interface run one after another, in submission order;
+  different interfaces run in parallel, up to ``max_workers`` at a time;
+* changes still waiting for an interface are coalesced. set_limits()
+  settings merge into the pending change (newer values win), a clear
+  replaces every pending change, and a repeated call of the same function
+  replaces the waiting one. However fast a rate is changed, only the
+  latest one is applied;
+* every operation reports ``callback(event)`` from the worker thread as it
+  is queued, coalesced, started and finished (see ``Operation.event``).
+
+Workers are daemon threads, so an operation that never returns cannot keep
+the process from exiting.
+"""
+import itertools
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+
+from .core import MAX_PARALLEL_APPLY
+
+
+@dataclass
+class Operation:
+    """One queued change: kind is 'set', 'clear' or 'call'"""
+
+    id: int
+    interface: str
+    kind: str
+    settings: dict = field(default_factory=dict)
+    function: object = None
+    args: tuple = ()
+
+    def event(self, state, pending, **extra):
+        """The dict passed to the callback.
+
+        ``state`` is 'queued', 'coalesced' (with ``into``, the id of the
+        operation that absorbed this one), 'running', 'done' (with
+        ``result``: (policy, steps, warning) for set/clear, the return value
+        for a call) or 'failed' (with ``error``). ``pending`` counts the
+        operations queued or running on every interface, this one included
+        until it has finished.
+        """
+        event = {'id': self.id, 'interface': self.interface, 'kind': self.kind,
+                 'settings': dict(self.settings), 'state': state, 'pending': pending}
+        event.update(extra)
+        return event
+
+
+class ShapingExecutor:
+    """Background, per-interface serialised and coalescing shaping queue"""
+
+    def __init__(self, core, callback=None, max_workers=MAX_PARALLEL_APPLY):
+        self.core = core
+        self.callback = callback
+        self.lock = threading.Lock()
+        # interface -> deque of Operations not started yet
+        self.queues = {}
+        # Interfaces with a worker draining their queue
+        self.active = set()
+        self.slots = threading.Semaphore(max_workers)
+        self.ids = itertools.count(1)
+        self.running = 0
+        self.closed = False
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values()) + self.running
+
+    def set_limits(self, interface, **settings):
+        """Queue core.set_limits(interface, **settings); returns the operation id"""
+        return self._submit(interface, 'set', settings=settings)
+
+    def clear_limits(self, interface):
+        return self._submit(interface, 'clear')
+
+    def call(self, interface, function, *args):
+        """Queue ``function(*args)`` behind the changes to ``interface``"""
+        return self._submit(interface, 'call', function=function, args=args)
+
+    def close(self):
+        """Drop everything not started yet; running operations finish on their own"""
+        with self.lock:
+            self.closed = True
+            self.queues.clear()
+
+    def _submit(self, interface, kind, **options):
+        events = []
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Shaping executor is closed")
+            operation = Operation(next(self.ids), interface, kind, **options)
+            queue = self.queues.setdefault(interface, deque())
+            for old in self._coalesce(queue, operation):
+                events.append(old.event('coalesced', None, into=operation.id))
+            queue.append(operation)
+            pending = self.pending
+            for event in events:
+                event['pending'] = pending
+            events.append(operation.event('queued', pending))
+            start = interface not in self.active
+            if start:
+                self.active.add(interface)
+        for event in events:
+            self._emit(event)
+        if start:
+            threading.Thread(target=self._drain, args=(interface,), daemon=True,
+                             name=f"shaping-{interface}").start()
+        return operation.id
+
+    @staticmethod
+    def _coalesce(queue, operation):
+        """Remove the operations ``operation`` supersedes from ``queue``; returns them"""
+        if operation.kind == 'clear':
+            # Clearing undoes every change still waiting; reads keep their place
+            superseded = [old for old in queue if old.kind != 'call']
+        elif operation.kind == 'call':
+            superseded = [old for old in queue
+                          if old.kind == 'call' and old.function == operation.function]
+        else:
+            changes = [old for old in queue if old.kind != 'call']
+            # A set after a clear must still run after it, so only merge set into set
+            superseded = changes[-1:] if changes and changes[-1].kind == 'set' else []
+            for old in superseded:
+                operation.settings = {**old.settings, **operation.settings}
+        for old in superseded:
+            queue.remove(old)
+        return superseded
+
+    def _drain(self, interface):
+        """Worker: run the queue of ``interface`` until it is empty"""
+        while True:
+            with self.lock:
+                queue = self.queues.get(interface)
+                if not queue:
+                    self.queues.pop(interface, None)
+                    self.active.discard(interface)
+                    return
+                operation = queue.popleft()
+                self.running += 1
+                pending = self.pending
+            with self.slots:
+                self._emit(operation.event('running', pending))
+                try:
+                    result = self._run(operation)
+                    outcome = {'result': result}
+                except Exception as e:
+                    outcome = {'error': e}
+            with self.lock:
+                self.running -= 1
+                pending = self.pending
+            self._emit(operation.event('failed' if 'error' in outcome else 'done', pending,
+                                       **outcome))
+
+    def _run(self, operation):
+        if operation.kind == 'set':
+            return self.core.set_limits(operation.interface, **operation.settings)
+        if operation.kind == 'clear':
+            return self.core.clear_limits(operation.interface)
+        return operation.function(*operation.args)
+
+    def _emit(self, event):
+        if self.callback is None:
+            return
+        try:
+            self.callback(event)
+        except Exception as e:
+            # A failing listener must not take the worker down
+            print(f"Shaping event handler failed: {e}")
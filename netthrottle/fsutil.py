@@ -0,0 +1,24 @@
+"""Crash-safe file replacement, usable on every platform"""
+import os
+
+
+def sync_directory(path):
+    """Make a rename in ``path`` durable; directories cannot be opened on Windows"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path or '.', os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, data):
+    """Replace ``path`` with ``data`` so readers see the old or the new file, never a mix"""
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    sync_directory(os.path.dirname(path))
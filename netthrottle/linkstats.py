@@ -0,0 +1,197 @@
+"""Throughput of every link on the host from one netlink dump per tick.
+
+``RTM_GETSTATS`` filtered to ``IFLA_STATS_LINK_64`` returns one fixed-size
+message per link carrying its 64-bit counters, so the whole dump can be
+decoded as a strided record array. Counters and rates live in arrays indexed
+by ifindex and every rate is computed in one vectorized step. NumPy is
+optional; without it the same work is done with plain Python.
+"""
+import heapq
+import socket
+import struct
+import time
+
+from . import netlink as nl
+
+# Offsets into one reply: nlmsghdr, if_stats_msg, rtattr, rtnl_link_stats64
+RECORD = struct.Struct('=4xH14xI8xQQQQ')
+STATS_REQUEST = nl.if_stats_msg(filter_mask=1 << (nl.IFLA_STATS_LINK_64 - 1))
+SORT_KEYS = ('total', 'rx', 'tx')
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def record_dtype(record_size):
+    """NumPy view of one reply message"""
+    return np.dtype({
+        'names': ['type', 'ifindex', 'rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes'],
+        'formats': ['u2', 'u4', 'u8', 'u8', 'u8', 'u8'],
+        'offsets': [4, 20, 32, 40, 48, 56],
+        'itemsize': record_size,
+    })
+
+
+class NumpyRates:
+    """Counters and rates in arrays indexed by ifindex"""
+
+    ARRAYS = ('rx_bytes', 'tx_bytes', 'rx_rate', 'tx_rate', 'present')
+
+    def __init__(self, capacity=1024):
+        self.rx_bytes = np.zeros(capacity, np.uint64)
+        self.tx_bytes = np.zeros(capacity, np.uint64)
+        self.rx_rate = np.zeros(capacity)
+        self.tx_rate = np.zeros(capacity)
+        self.present = np.zeros(capacity, bool)
+
+    def _grow(self, capacity):
+        for name in self.ARRAYS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def decode(self, data, record_size):
+        """(ifindex, rx_bytes, tx_bytes) arrays from the raw dump"""
+        records = np.frombuffer(data, record_dtype(record_size), len(data) // record_size)
+        records = records[records['type'] == nl.RTM_NEWSTATS]
+        return records['ifindex'], records['rx_bytes'], records['tx_bytes']
+
+    def update(self, ifindex, rx, tx, elapsed):
+        if len(ifindex) and ifindex.max() >= len(self.present):
+            # ifindexes only grow on a busy host; leave room for the next ones
+            self._grow(int(ifindex.max()) * 2)
+        prev_rx = self.rx_bytes[ifindex]
+        prev_tx = self.tx_bytes[ifindex]
+        # New links, and counters that went backwards (device reset), get no rate yet
+        valid = self.present[ifindex] & (rx >= prev_rx) & (tx >= prev_tx)
+        self.rx_rate.fill(0)
+        self.tx_rate.fill(0)
+        if elapsed > 0:
+            self.rx_rate[ifindex] = np.where(valid, (rx - prev_rx) / elapsed, 0)
+            self.tx_rate[ifindex] = np.where(valid, (tx - prev_tx) / elapsed, 0)
+        self.present.fill(False)
+        self.present[ifindex] = True
+        self.rx_bytes[ifindex] = rx
+        self.tx_bytes[ifindex] = tx
+
+    def rate(self, ifindex):
+        if ifindex < len(self.present) and self.present[ifindex]:
+            return float(self.rx_rate[ifindex]), float(self.tx_rate[ifindex])
+        return None
+
+    def top(self, n, key):
+        """[(ifindex, rx_rate, tx_rate)] for the ``n`` busiest links"""
+        candidates = np.flatnonzero(self.present)
+        values = {'rx': self.rx_rate, 'tx': self.tx_rate}.get(key)
+        values = (self.rx_rate + self.tx_rate if values is None else values)[candidates]
+        if n < len(candidates):
+            keep = np.argpartition(-values, n)[:n]
+            candidates = candidates[keep]
+            values = values[keep]
+        order = candidates[np.argsort(-values, kind='stable')]
+        return list(zip(order.tolist(), self.rx_rate[order].tolist(),
+                        self.tx_rate[order].tolist()))
+
+
+class PythonRates:
+    """Fallback for hosts without NumPy"""
+
+    def __init__(self):
+        self.counters = {}
+        self.rates = {}
+
+    def decode(self, data, record_size):
+        ifindex = []
+        rx = []
+        tx = []
+        for offset in range(0, len(data) - record_size + 1, record_size):
+            msg_type, index, _, _, rx_bytes, tx_bytes = RECORD.unpack_from(data, offset)
+            if msg_type == nl.RTM_NEWSTATS:
+                ifindex.append(index)
+                rx.append(rx_bytes)
+                tx.append(tx_bytes)
+        return ifindex, rx, tx
+
+    def update(self, ifindex, rx, tx, elapsed):
+        counters = dict(zip(ifindex, zip(rx, tx)))
+        rates = {}
+        for index, (rx_bytes, tx_bytes) in counters.items():
+            prev = self.counters.get(index)
+            if prev and elapsed > 0 and rx_bytes >= prev[0] and tx_bytes >= prev[1]:
+                rates[index] = ((rx_bytes - prev[0]) / elapsed, (tx_bytes - prev[1]) / elapsed)
+            else:
+                rates[index] = (0.0, 0.0)
+        self.counters = counters
+        self.rates = rates
+
+    def rate(self, ifindex):
+        return self.rates.get(ifindex)
+
+    def top(self, n, key):
+        if key == 'rx':
+            sort_key = lambda item: item[1][0]
+        elif key == 'tx':
+            sort_key = lambda item: item[1][1]
+        else:
+            sort_key = lambda item: item[1][0] + item[1][1]
+        return [(index, rx, tx) for index, (rx, tx)
+                in heapq.nlargest(n, self.rates.items(), key=sort_key)]
+
+
+class LinkStats:
+    """Rates for all links, refreshed by ``poll()``"""
+
+    def __init__(self, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = np is not None
+        self.sock = nl.NetlinkSocket()
+        self.rates = NumpyRates() if use_numpy else PythonRates()
+        self.record_size = None
+        self.last_poll = None
+        self.names = {}
+
+    def close(self):
+        self.sock.close()
+
+    def _dump(self):
+        data = self.sock.dump_datagrams(nl.RTM_GETSTATS, STATS_REQUEST, self.record_size)
+        if self.record_size is None and len(data) >= nl.NLMSGHDR.size:
+            # Every reply has the same length; learn it from the first one
+            self.record_size = nl.NLMSGHDR.unpack_from(data)[0]
+        return data
+
+    def poll(self):
+        """Read every link's counters once; returns the number of links"""
+        data = self._dump()
+        now = time.monotonic_ns()
+        if not self.record_size:
+            return 0
+        ifindex, rx, tx = self.rates.decode(data, self.record_size)
+        elapsed = (now - self.last_poll) / 1e9 if self.last_poll else 0
+        self.rates.update(ifindex, rx, tx, elapsed)
+        self.last_poll = now
+        return len(ifindex)
+
+    def name(self, ifindex):
+        if ifindex not in self.names:
+            # One call refreshes every name, so a burst of new links costs one lookup
+            self.names = {index: name for index, name in socket.if_nameindex()}
+        return self.names.get(ifindex, str(ifindex))
+
+    def rate(self, interface):
+        """(rx_bytes_per_sec, tx_bytes_per_sec) for one link, or None"""
+        try:
+            return self.rates.rate(socket.if_nametoindex(interface))
+        except OSError:
+            return None
+
+    def top(self, n=10, key='total'):
+        """The ``n`` busiest links as dicts, sorted by ``key`` (total, rx or tx)"""
+        if key not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {key}")
+        return [{'interface': self.name(index), 'ifindex': index,
+                 'rx_bytes_per_sec': rx, 'tx_bytes_per_sec': tx}
+                for index, rx, tx in self.rates.top(n, key)]
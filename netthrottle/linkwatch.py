@@ -0,0 +1,268 @@
+"""Interface discovery driven by rtnetlink notifications instead of polling.
+
+``LinkWatcher`` dumps the links and addresses once, then follows the
+kernel's link and address multicast groups, so interfaces that appear later
+(USB tethering, a VPN's tun device, container veths) are seen as soon as the
+kernel creates them, and bounces as soon as they happen. Its thread sleeps
+in select() between notifications.
+
+The subscription is opened before the dump, so nothing that happens in
+between is missed; notifications that repeat the dump change nothing. If
+the kernel drops notifications because the socket buffer overflowed
+(ENOBUFS), the watcher dumps again and reports the differences. Any other
+failure of the socket or the dump is reported as a 'failed' event, and the
+watcher subscribes and dumps again after a growing back-off.
+
+Reading links needs no privileges. Linux only.
+"""
+import errno
+import os
+import select
+import socket
+import threading
+from dataclasses import dataclass, field
+
+from . import netlink as nl
+
+GROUPS = nl.RTMGRP_LINK | nl.RTMGRP_IPV4_IFADDR | nl.RTMGRP_IPV6_IFADDR
+# Room for the notifications of a burst of containers starting at once
+RECEIVE_BUFFER = 1 << 20
+# Back-off before subscribing again after an error, doubled up to the maximum
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 60.0
+
+
+@dataclass
+class Link:
+    """What the watcher knows about one network device"""
+
+    index: int
+    name: str
+    kind: str = ''
+    flags: int = 0
+    addresses: set = field(default_factory=set)
+
+    @property
+    def up(self):
+        """Administratively up with a carrier"""
+        return bool(self.flags & nl.IFF_UP and self.flags & nl.IFF_LOWER_UP)
+
+    @property
+    def listed(self):
+        """Offered for shaping: not loopback, and not an IFB carrying upload shaping"""
+        return not self.flags & nl.IFF_LOOPBACK and self.kind != 'ifb'
+
+
+def parse_link(payload):
+    """A Link from an RTM_NEWLINK/RTM_DELLINK payload"""
+    _, _, index, flags, _ = nl.IFINFOMSG.unpack_from(payload)
+    attrs = nl.parse_attrs(payload, nl.IFINFOMSG.size)
+    kind = ''
+    if nl.IFLA_LINKINFO in attrs:
+        info = nl.parse_attrs(attrs[nl.IFLA_LINKINFO])
+        if nl.IFLA_INFO_KIND in info:
+            kind = nl.attr_string(info[nl.IFLA_INFO_KIND])
+    name = nl.attr_string(attrs[nl.IFLA_IFNAME]) if nl.IFLA_IFNAME in attrs else ''
+    return Link(index, name, kind, flags)
+
+
+def parse_address(payload):
+    """(ifindex, address text) from an RTM_NEWADDR/RTM_DELADDR payload"""
+    family, _, _, _, index = nl.IFADDRMSG.unpack_from(payload)
+    attrs = nl.parse_attrs(payload, nl.IFADDRMSG.size)
+    # IFA_LOCAL is the interface's own address on point-to-point links
+    raw = attrs.get(nl.IFA_LOCAL, attrs.get(nl.IFA_ADDRESS))
+    address = socket.inet_ntop(family, bytes(raw)) if raw is not None else None
+    return index, address
+
+
+class LinkWatcher:
+    """Keeps a live view of the network devices and reports every change.
+
+    ``callback(event)`` is called from the watcher thread with a dict:
+    ``event`` is 'added', 'removed', 'renamed' (with ``previous``), 'up',
+    'down' or 'address'; ``interface``, ``index``, ``up`` and ``addresses``
+    describe the device, and ``interfaces`` lists every listed device now.
+    'failed' events (``interface`` None) carry the ``error`` and the
+    seconds until the next attempt in ``retry``.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.links = {}
+        self.lock = threading.Lock()
+        self.events = None
+        self.thread = None
+        self.wakeup = None
+
+    def interfaces(self):
+        """Names of the devices offered for shaping, those with an address first"""
+        with self.lock:
+            listed = [link for link in self.links.values() if link.listed]
+        return [link.name for link in sorted(listed, key=lambda link: (not link.addresses, link.name))]
+
+    def start(self):
+        """Read the current devices, then follow changes on a thread"""
+        self.events = self._subscribe()
+        try:
+            self.resync(report=False)
+        except Exception:
+            self.events.close()
+            raise
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='linkwatch')
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            os.write(self.wakeup[1], b'x')
+            self.thread.join(timeout=2)
+            self.thread = None
+        for fd in self.wakeup or ():
+            os.close(fd)
+        self.wakeup = None
+        if self.events:
+            self.events.close()
+            self.events = None
+
+    def resync(self, report=True):
+        """Dump every link and address, reporting what changed since the last view"""
+        sock = nl.NetlinkSocket()
+        try:
+            links = {}
+            for _, payload in sock.dump(nl.RTM_GETLINK, nl.ifinfomsg()):
+                link = parse_link(payload)
+                links[link.index] = link
+            for _, payload in sock.dump(nl.RTM_GETADDR, nl.ifaddrmsg()):
+                index, address = parse_address(payload)
+                if index in links and address:
+                    links[index].addresses.add(address)
+        finally:
+            sock.close()
+        for index in [index for index in self.links if index not in links]:
+            self._removed(index, report)
+        for link in links.values():
+            self._update(link, report, dumped=True)
+
+    def _subscribe(self):
+        events = nl.NetlinkSocket(groups=GROUPS)
+        try:
+            events.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except Exception:
+            events.close()
+            raise
+        return events
+
+    def recover(self):
+        """Subscribe on a new socket and dump again, after an error"""
+        events = self._subscribe()
+        old, self.events = self.events, events
+        old.close()
+        self.resync()
+
+    def run(self):
+        buffer = bytearray(nl.RECV_SIZE)
+        view = memoryview(buffer)
+        retry = None
+        while True:
+            if retry is not None:
+                # Wait out the back-off unless stopped meanwhile
+                if select.select([self.wakeup[0]], [], [], retry)[0]:
+                    return
+                try:
+                    self.recover()
+                    retry = None
+                except Exception as e:
+                    retry = min(retry * 2, MAX_RETRY_SECONDS)
+                    self._failed(e, retry)
+                continue
+            try:
+                readable, _, _ = select.select([self.events, self.wakeup[0]], [], [])
+                if self.wakeup[0] in readable:
+                    return
+                received = self.events.sock.recv_into(buffer)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # Notifications were lost: start again from a fresh dump
+                    try:
+                        self.resync()
+                        continue
+                    except Exception as resync_error:
+                        e = resync_error
+                retry = RETRY_SECONDS
+                self._failed(e, retry)
+                continue
+            for msg_type, _, _, payload in nl.iter_messages(view[:received]):
+                try:
+                    self.handle(msg_type, payload)
+                except Exception as e:
+                    print(f"Link notification failed: {e}")
+
+    def handle(self, msg_type, payload):
+        """Apply one notification"""
+        if msg_type == nl.RTM_NEWLINK:
+            self._update(parse_link(payload))
+        elif msg_type == nl.RTM_DELLINK:
+            self._removed(parse_link(payload).index)
+        elif msg_type in (nl.RTM_NEWADDR, nl.RTM_DELADDR):
+            index, address = parse_address(payload)
+            with self.lock:
+                link = self.links.get(index)
+                if link is None or not address:
+                    return
+                before = set(link.addresses)
+                if msg_type == nl.RTM_NEWADDR:
+                    link.addresses.add(address)
+                else:
+                    link.addresses.discard(address)
+                changed = link.addresses != before
+            if changed:
+                self._emit('address', link)
+
+    def _update(self, link, report=True, dumped=False):
+        """Store ``link``; a notification's carries no addresses, a dump's all of them"""
+        with self.lock:
+            old = self.links.get(link.index)
+            if old is not None:
+                if not dumped:
+                    link.addresses = old.addresses
+                # Notifications about a link often omit its kind
+                link.kind = link.kind or old.kind
+                link.name = link.name or old.name
+            self.links[link.index] = link
+        if not report:
+            return
+        if old is None:
+            self._emit('added', link)
+        elif old.name != link.name:
+            self._emit('renamed', link, previous=old.name)
+        elif old.up != link.up:
+            self._emit('up' if link.up else 'down', link)
+
+    def _removed(self, index, report=True):
+        with self.lock:
+            link = self.links.pop(index, None)
+        if link is not None and report:
+            self._emit('removed', link)
+
+    def _failed(self, error, retry):
+        if self.callback is None:
+            return
+        self._notify({'event': 'failed', 'interface': None, 'index': None, 'up': None,
+                      'addresses': [], 'interfaces': self.interfaces(), 'error': str(error),
+                      'retry': retry})
+
+    def _emit(self, event, link, **extra):
+        if self.callback is None or not link.listed:
+            return
+        message = {'event': event, 'interface': link.name, 'index': link.index, 'up': link.up,
+                   'addresses': sorted(link.addresses), 'interfaces': self.interfaces()}
+        message.update(extra)
+        self._notify(message)
+
+    def _notify(self, message):
+        try:
+            self.callback(message)
+        except Exception as e:
+            # A failing listener must not stop the watcher
+            print(f"Link event handler failed: {e}")
@@ -0,0 +1,286 @@
+"""OpenMetrics / Prometheus exporter for counters, shaping statistics and limits.
+
+``MetricsExporter`` serves ``/metrics`` from a stdlib HTTP server, on
+localhost unless told otherwise. A collector thread reads everything once per
+interval and renders the exposition into a cache:
+
+- byte, packet and drop counters of every interface, and their current rates
+- the limits installed on each interface
+- the counters of every qdisc and class shaping it (see Reconciler.tc_snapshot)
+- the health of the exporter's own sampling
+
+A scrape only copies the cached text, so a slow or frequent scraper never
+delays sampling, and sampling never makes a scrape wait for netlink or tc.
+"""
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 9877
+DEFAULT_INTERVAL = 5.0
+# Collector ticks between interface rescans
+RESCAN_TICKS = 12
+
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# sysfs counter -> metric name, all counters
+INTERFACE_COUNTERS = {
+    'rx_bytes': ('netthrottle_interface_receive_bytes', "Bytes received"),
+    'tx_bytes': ('netthrottle_interface_transmit_bytes', "Bytes sent"),
+    'rx_packets': ('netthrottle_interface_receive_packets', "Packets received"),
+    'tx_packets': ('netthrottle_interface_transmit_packets', "Packets sent"),
+    'rx_dropped': ('netthrottle_interface_receive_drops', "Received packets dropped by the interface"),
+    'tx_dropped': ('netthrottle_interface_transmit_drops', "Outgoing packets dropped by the interface"),
+}
+# tc counter -> (metric suffix, help, type)
+TC_METRICS = {
+    'bytes': ('bytes', "Bytes sent", 'counter'),
+    'packets': ('packets', "Packets sent", 'counter'),
+    'drops': ('drops', "Packets dropped", 'counter'),
+    'overlimits': ('overlimits', "Packets held back over the rate", 'counter'),
+    'requeues': ('requeues', "Packets requeued", 'counter'),
+    'backlog': ('backlog_bytes', "Bytes queued", 'gauge'),
+    'qlen': ('queue_length', "Packets queued", 'gauge'),
+    'tokens': ('tokens', "HTB tokens at the rate; negative while over it", 'gauge'),
+    'ctokens': ('ctokens', "HTB tokens at the ceiling; negative while over it", 'gauge'),
+}
+
+SAMPLER_UP = "Whether the interface's counters could be read"
+
+
+def parse_address(text):
+    """Parse "9877", "0.0.0.0:9877" or "[::1]:9877" into (address, port)"""
+    address, _, port = str(text).rpartition(':')
+    address = address.strip('[]') or DEFAULT_ADDRESS
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid metrics address: {text}")
+    return address, int(port)
+
+
+def escape(value):
+    """Label value or help text with backslashes, quotes and newlines escaped"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Family:
+    """One metric family and its samples"""
+
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.samples = []
+
+    def add(self, labels, value):
+        self.samples.append((labels, value))
+
+    def render(self, openmetrics):
+        # OpenMetrics names the counter family without its _total suffix
+        name = self.name if openmetrics or self.kind != 'counter' else f'{self.name}_total'
+        lines = [f"# TYPE {name} {self.kind}", f"# HELP {name} {escape(self.help)}"]
+        suffix = '_total' if self.kind == 'counter' else ''
+        for labels, value in self.samples:
+            label_text = ','.join(f'{key}="{escape(text)}"' for key, text in labels.items())
+            lines.append(f"{self.name}{suffix}{{{label_text}}} {value}" if label_text
+                         else f"{self.name}{suffix} {value}")
+        return lines
+
+
+class Registry:
+    """Metric families of one collection, in the order they were first used"""
+
+    def __init__(self):
+        self.families = {}
+
+    def family(self, name, kind, help):
+        if name not in self.families:
+            self.families[name] = Family(name, kind, help)
+        return self.families[name]
+
+    def add(self, name, kind, help, labels, value):
+        self.family(name, kind, help).add(labels, value)
+
+    def render(self, openmetrics=True):
+        lines = []
+        for family in self.families.values():
+            if family.samples:
+                lines += family.render(openmetrics)
+        if openmetrics:
+            lines.append('# EOF')
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class MetricsExporter:
+    """Collects metrics every ``interval`` seconds and serves the latest on /metrics.
+
+    ``interfaces`` are exported, or every detected interface when None.
+    """
+
+    def __init__(self, core, address=DEFAULT_ADDRESS, port=DEFAULT_PORT,
+                 interval=DEFAULT_INTERVAL, interfaces=None):
+        self.core = core
+        self.interval = interval
+        self.interfaces = interfaces
+        self.stop_event = threading.Event()
+        self.counters = {}
+        self.errors = 0
+        self.collections = 0
+        self.cache = (Registry().render(True), Registry().render(False))
+        server_class = type('Server', (ThreadingHTTPServer,), {
+            'daemon_threads': True,
+            'address_family': socket.AF_INET6 if ':' in address else socket.AF_INET})
+        self.server = server_class((address, port), self._handler())
+        self.address = self.server.server_address
+
+    def _handler(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+                body = exporter.cache[0 if openmetrics else 1]
+                self.send_response(200)
+                self.send_header('Content-Type', OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Serve and collect on daemon threads"""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run(self):
+        """Collect every interval until stopped"""
+        from .sampler import Sampler, ticks
+
+        sampler = Sampler(interval=self.interval)
+        names = self.interfaces or self.core.get_network_interfaces()
+        try:
+            sampler.set_interfaces(names)
+            self.refresh(names, sampler.poll())
+            for tick, _ in enumerate(ticks(self.interval, self.stop_event), 1):
+                if not self.interfaces and tick % RESCAN_TICKS == 0:
+                    names = self.core.get_network_interfaces()
+                    sampler.set_interfaces(names)
+                self.refresh(names, sampler.poll())
+        finally:
+            sampler.close()
+            for counters in self.counters.values():
+                counters.close()
+
+    def refresh(self, names, rates):
+        """Collect once and replace the cached exposition"""
+        started = time.monotonic()
+        registry = Registry()
+        try:
+            self.collect(registry, names, rates)
+        except Exception:
+            self.errors += 1
+        self.collections += 1
+        self._health(registry, time.monotonic() - started)
+        self.cache = (registry.render(True), registry.render(False))
+
+    def collect(self, registry, names, rates):
+        """Add every interface's counters, rates, limits and tc statistics to ``registry``"""
+        for name in names:
+            if not self._interface(registry, name, rates.get(name)) or self.core.reconciler is None:
+                continue
+            try:
+                self._shaping(registry, name)
+            except Exception:
+                self.errors += 1
+
+    def _interface(self, registry, name, rates):
+        """Add the counters and rates of ``name``; False if it cannot be read"""
+        from .sampler import open_counters
+
+        try:
+            if name not in self.counters:
+                self.counters[name] = open_counters(name, tuple(INTERFACE_COUNTERS))
+            values = self.counters[name].read()
+        except Exception:
+            counters = self.counters.pop(name, None)
+            if counters:
+                counters.close()
+            registry.add('netthrottle_sampler_up', 'gauge', SAMPLER_UP, {'interface': name}, 0)
+            return False
+        registry.add('netthrottle_sampler_up', 'gauge', SAMPLER_UP, {'interface': name}, 1)
+        for field, value in zip(INTERFACE_COUNTERS, values):
+            metric, help = INTERFACE_COUNTERS[field]
+            registry.add(metric, 'counter', help, {'interface': name}, value)
+        if rates:
+            for direction, verb, rate in zip(('receive', 'transmit'), ('received', 'sent'), rates):
+                registry.add(f'netthrottle_interface_{direction}_rate_bytes_per_second', 'gauge',
+                             f"Bytes {verb} per second over the last interval",
+                             {'interface': name}, round(rate, 1))
+        return True
+
+    def _shaping(self, registry, name):
+        policy = self.core.reconciler.observe(name)
+        for direction in ('download', 'upload'):
+            kbps = getattr(policy, f'{direction}_kbps')
+            if kbps:
+                registry.add('netthrottle_limit_bits_per_second', 'gauge',
+                             "Limit installed on the interface",
+                             {'interface': name, 'direction': direction}, kbps * 1000)
+        for rule in policy.rules:
+            for direction in ('download', 'upload'):
+                kbps = getattr(rule, f'{direction}_kbps')
+                if kbps:
+                    registry.add('netthrottle_rule_limit_bits_per_second', 'gauge',
+                                 "Limit of one host, subnet or port rule",
+                                 {'interface': name, 'direction': direction, 'match': rule.match},
+                                 kbps * 1000)
+        if not (policy.download_kbps or policy.upload_kbps or policy.rules):
+            return
+        registry.add('netthrottle_shaping_info', 'gauge', "Queue and upload mode of the shaping",
+                     {'interface': name, 'queue': policy.queue, 'ingress_mode': policy.ingress_mode}, 1)
+        for direction, tree in self.core.tc_snapshot(name).items():
+            if tree is None:
+                continue
+            base = {'interface': name, 'direction': direction, 'device': tree['device']}
+            for qdisc in tree['qdiscs']:
+                labels = dict(base, handle=qdisc['handle'], kind=qdisc['kind'])
+                self._tc(registry, 'qdisc', labels, qdisc.get('stats', {}))
+            for cls in tree['classes']:
+                labels = dict(base, classid=cls['classid'], parent=cls['parent'], kind=cls['kind'])
+                self._tc(registry, 'class', labels, cls.get('stats', {}))
+                for key in ('rate', 'ceil'):
+                    if cls.get(key):
+                        registry.add(f'netthrottle_class_{key}_bits_per_second', 'gauge',
+                                     f"HTB class {key}", labels, cls[key] * 1000)
+
+    def _tc(self, registry, kind, labels, stats):
+        for key, (suffix, help, metric_type) in TC_METRICS.items():
+            if key in stats:
+                registry.add(f'netthrottle_{kind}_{suffix}', metric_type, f"{help} ({kind})",
+                             labels, stats[key])
+
+    def _health(self, registry, duration):
+        registry.add('netthrottle_sampler_interval_seconds', 'gauge',
+                     "Seconds between samples", {}, self.interval)
+        registry.add('netthrottle_sampler_last_sample_timestamp_seconds', 'gauge',
+                     "When the metrics were last collected", {}, round(time.time(), 3))
+        registry.add('netthrottle_sampler_collect_duration_seconds', 'gauge',
+                     "How long the last collection took", {}, round(duration, 6))
+        registry.add('netthrottle_sampler_collections', 'counter',
+                     "Collections since the exporter started", {}, self.collections)
+        registry.add('netthrottle_sampler_errors', 'counter',
+                     "Collections of an interface that failed", {}, self.errors)
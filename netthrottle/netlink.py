@@ -0,0 +1,347 @@
+"""Minimal rtnetlink client used by the native traffic-control backend"""
+import errno
+import os
+import socket
+import struct
+import threading
+
+NETLINK_ROUTE = 0
+SOL_NETLINK = 270
+NETLINK_CAP_ACK = 10
+NETLINK_EXT_ACK = 11
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_CAPPED = 0x100
+NLM_F_ACK_TLVS = 0x200
+
+NLMSGERR_ATTR_MSG = 1
+NLA_TYPE_MASK = 0x3fff
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWQDISC = 36
+RTM_DELQDISC = 37
+RTM_GETQDISC = 38
+RTM_NEWTCLASS = 40
+RTM_DELTCLASS = 41
+RTM_GETTCLASS = 42
+RTM_NEWTFILTER = 44
+RTM_DELTFILTER = 45
+RTM_GETTFILTER = 46
+RTM_NEWSTATS = 92
+RTM_GETSTATS = 94
+
+# Multicast groups for link and address notifications
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+# Link attributes
+IFLA_IFNAME = 3
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_LOWER_UP = 0x10000
+
+# Address attributes
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+# RTM_GETSTATS
+IFLA_STATS_LINK_64 = 1
+
+NLMSGHDR = struct.Struct('=IHHII')
+RTATTR = struct.Struct('=HH')
+TCMSG = struct.Struct('=BxxxiIII')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+IF_STATS_MSG = struct.Struct('=BxxxiI')
+_ERRNO = struct.Struct('=i')
+
+# Keep each write well below the default socket buffers so acks never overflow
+BATCH_BYTES = 32768
+BATCH_MESSAGES = 256
+RECV_SIZE = 65536
+TIMEOUT = 5.0
+
+
+class NetlinkError(OSError):
+    """A netlink request was rejected by the kernel"""
+
+
+def align(length):
+    """Round a length up to the 4-byte netlink alignment"""
+    return (length + 3) & ~3
+
+
+def attr(attr_type, payload=b''):
+    """Encode a single rtattr"""
+    length = RTATTR.size + len(payload)
+    return RTATTR.pack(length, attr_type) + payload + b'\0' * (align(length) - length)
+
+
+def attr_u8(attr_type, value):
+    return attr(attr_type, struct.pack('=B', value))
+
+
+def attr_u16(attr_type, value):
+    return attr(attr_type, struct.pack('=H', value))
+
+
+def attr_u32(attr_type, value):
+    return attr(attr_type, struct.pack('=I', value))
+
+
+def attr_u64(attr_type, value):
+    return attr(attr_type, struct.pack('=Q', value))
+
+
+def attr_str(attr_type, value):
+    return attr(attr_type, value.encode() + b'\0')
+
+
+def nested(attr_type, *attrs):
+    """Encode a nested attribute from already encoded children"""
+    return attr(attr_type, b''.join(attrs))
+
+
+def parse_attrs(data, offset=0):
+    """Decode a run of rtattrs into a {type: payload} dict"""
+    attrs = {}
+    end = len(data)
+    while offset + RTATTR.size <= end:
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type & NLA_TYPE_MASK] = data[offset + RTATTR.size:offset + length]
+        offset += align(length)
+    return attrs
+
+
+def attr_string(payload):
+    """Decode a NUL terminated string attribute"""
+    return bytes(payload).split(b'\0', 1)[0].decode(errors='replace')
+
+
+def iter_messages(data):
+    """Yield (type, flags, seq, payload) for every message in a receive buffer"""
+    offset = 0
+    end = len(data)
+    while offset + NLMSGHDR.size <= end:
+        length, msg_type, flags, seq, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield msg_type, flags, seq, data[offset + NLMSGHDR.size:offset + length]
+        offset += align(length)
+
+
+def tcmsg(ifindex, handle=0, parent=0, info=0, family=socket.AF_UNSPEC):
+    """Pack a struct tcmsg header"""
+    return TCMSG.pack(family, ifindex, handle, parent, info)
+
+
+def ifinfomsg(ifindex=0, flags=0, change=0, family=socket.AF_UNSPEC, link_type=0):
+    """Pack a struct ifinfomsg header"""
+    return IFINFOMSG.pack(family, link_type, ifindex, flags, change)
+
+
+def ifaddrmsg(family=socket.AF_UNSPEC, ifindex=0):
+    """Pack a struct ifaddrmsg header"""
+    return IFADDRMSG.pack(family, 0, 0, 0, ifindex)
+
+
+def if_stats_msg(ifindex=0, filter_mask=0, family=socket.AF_UNSPEC):
+    """Pack a struct if_stats_msg header"""
+    return IF_STATS_MSG.pack(family, ifindex, filter_mask)
+
+
+def link_index(name):
+    """Resolve an interface name to its ifindex"""
+    try:
+        return socket.if_nametoindex(name)
+    except OSError:
+        raise NetlinkError(errno.ENODEV, f"Cannot find device \"{name}\"")
+
+
+def _error_from_ack(flags, payload):
+    """Build a NetlinkError from an NLMSG_ERROR payload, or None for an ack"""
+    code = _ERRNO.unpack_from(payload)[0]
+    if code == 0:
+        return None
+    message = os.strerror(-code)
+    if flags & NLM_F_ACK_TLVS:
+        if flags & NLM_F_CAPPED:
+            offset = _ERRNO.size + NLMSGHDR.size
+        else:
+            offset = _ERRNO.size + NLMSGHDR.unpack_from(payload, _ERRNO.size)[0]
+        ext = parse_attrs(payload, offset)
+        if NLMSGERR_ATTR_MSG in ext:
+            message = f"{message}: {attr_string(ext[NLMSGERR_ATTR_MSG])}"
+    return NetlinkError(-code, message)
+
+
+class NetlinkSocket:
+    """Persistent netlink socket with request/ack bookkeeping"""
+
+    def __init__(self, protocol=NETLINK_ROUTE, groups=0):
+        self.sock = socket.socket(socket.AF_NETLINK,
+                                  socket.SOCK_RAW | socket.SOCK_CLOEXEC, protocol)
+        for option in (NETLINK_CAP_ACK, NETLINK_EXT_ACK):
+            try:
+                self.sock.setsockopt(SOL_NETLINK, option, 1)
+            except OSError:
+                pass
+        self.sock.settimeout(TIMEOUT)
+        self.sock.bind((0, groups))
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.buffer = bytearray(RECV_SIZE)
+        self.bulk_buffer = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, msg_type, payload, flags=NLM_F_ACK):
+        """Send one request and return its replies (dump messages, if any)"""
+        return self.batch([(msg_type, flags, payload)])[0]
+
+    def dump(self, msg_type, payload):
+        """Run a dump request and return the list of (type, payload) replies"""
+        return self.request(msg_type, payload, NLM_F_DUMP)
+
+    def dump_datagrams(self, msg_type, payload, record_size=None):
+        """Run a dump and return the raw bytes of its reply messages.
+
+        For callers that decode many replies in bulk: datagrams are received
+        back to back into one growing buffer, and the returned memoryview
+        stays valid until the next bulk dump. ``record_size`` is a hint for
+        dumps whose replies all have the same length; the end of the dump is
+        then found without walking every message header.
+        """
+        with self.lock:
+            self.seq = (self.seq + 1) & 0xffffffff
+            seq = self.seq
+            self.sock.sendto(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+                                           NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload, (0, 0))
+            if self.bulk_buffer is None:
+                self.bulk_buffer = bytearray(RECV_SIZE * 4)
+            size = 0
+            while True:
+                if len(self.bulk_buffer) - size < RECV_SIZE:
+                    # Earlier views may still be exported, so grow by copying
+                    grown = bytearray(len(self.bulk_buffer) * 2)
+                    grown[:size] = self.bulk_buffer[:size]
+                    self.bulk_buffer = grown
+                view = memoryview(self.bulk_buffer)
+                try:
+                    received = self.sock.recv_into(view[size:])
+                except socket.timeout:
+                    raise NetlinkError(errno.ETIMEDOUT, "Timed out waiting for the kernel")
+                end = self._dump_end(view[size:], received, seq, record_size)
+                if end is None:
+                    size += received
+                    continue
+                _, msg_type, flags, _, _ = NLMSGHDR.unpack_from(view, size + end)
+                if msg_type == NLMSG_ERROR:
+                    error = _error_from_ack(flags, view[size + end + NLMSGHDR.size:size + received])
+                    if error is not None:
+                        raise error
+                return view[:size + end]
+
+    def _dump_end(self, view, received, seq, record_size):
+        """Offset of the NLMSG_DONE/ERROR message ending dump ``seq``, if present"""
+        if record_size:
+            end = received - received % record_size
+            if end == received:
+                return None
+            length, msg_type, _, msg_seq, _ = NLMSGHDR.unpack_from(view, end)
+            if msg_seq == seq and msg_type in (NLMSG_DONE, NLMSG_ERROR):
+                return end
+        offset = 0
+        while offset + NLMSGHDR.size <= received:
+            length, msg_type, _, msg_seq, _ = NLMSGHDR.unpack_from(view, offset)
+            if length < NLMSGHDR.size:
+                break
+            if msg_seq == seq and msg_type in (NLMSG_DONE, NLMSG_ERROR):
+                return offset
+            offset += align(length)
+        return None
+
+    def batch(self, requests, check=True):
+        """Send (type, flags, payload) requests in as few writes as possible.
+
+        Returns one entry per request: its list of replies, or the
+        NetlinkError it failed with when ``check`` is false.
+        """
+        results = []
+        with self.lock:
+            window = []
+            size = 0
+            for request in requests:
+                window.append(request)
+                size += NLMSGHDR.size + len(request[2])
+                if size >= BATCH_BYTES or len(window) >= BATCH_MESSAGES:
+                    results.extend(self._transact(window))
+                    window = []
+                    size = 0
+            if window:
+                results.extend(self._transact(window))
+        if check:
+            for result in results:
+                if isinstance(result, NetlinkError):
+                    raise result
+        return results
+
+    def _transact(self, requests):
+        seqs = []
+        chunks = []
+        for msg_type, flags, payload in requests:
+            self.seq = (self.seq + 1) & 0xffffffff
+            seqs.append(self.seq)
+            chunks.append(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+                                        flags | NLM_F_REQUEST, self.seq, 0))
+            chunks.append(payload)
+        self.sock.sendto(b''.join(chunks), (0, 0))
+
+        replies = {seq: [] for seq in seqs}
+        pending = set(seqs)
+        view = memoryview(self.buffer)
+        while pending:
+            try:
+                received = self.sock.recv_into(self.buffer)
+            except socket.timeout:
+                raise NetlinkError(errno.ETIMEDOUT, "Timed out waiting for the kernel")
+            for msg_type, flags, seq, payload in iter_messages(view[:received]):
+                if seq not in pending:
+                    continue
+                if msg_type == NLMSG_ERROR:
+                    error = _error_from_ack(flags, payload)
+                    if error is not None:
+                        replies[seq] = error
+                    pending.discard(seq)
+                elif msg_type == NLMSG_DONE:
+                    pending.discard(seq)
+                else:
+                    replies[seq].append((msg_type, bytes(payload)))
+                    if not flags & NLM_F_MULTI:
+                        pending.discard(seq)
+        return [replies[seq] for seq in seqs]
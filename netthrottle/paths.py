@@ -0,0 +1,25 @@
+"""Well-known filesystem locations"""
+import os
+
+
+def socket_path():
+    """Where the daemon listens unless NETTHROTTLE_SOCKET says otherwise"""
+    if os.environ.get('NETTHROTTLE_SOCKET'):
+        return os.environ['NETTHROTTLE_SOCKET']
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        return '/run/netthrottle.sock'
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'netthrottle.sock')
+    return f"/tmp/netthrottle-{os.getuid()}.sock"
+
+
+def state_dir():
+    """Directory for persistent state such as traffic history"""
+    if os.environ.get('NETTHROTTLE_STATE_DIR'):
+        return os.environ['NETTHROTTLE_STATE_DIR']
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        return '/var/lib/netthrottle'
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(state_home, 'netthrottle')
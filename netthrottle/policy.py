@@ -0,0 +1,57 @@
+"""Desired shaping state for a network interface"""
+import zlib
+from dataclasses import dataclass, field
+
+# Every interface gets its own IFB device, named after it
+IFB_PREFIX = 'ifb-'
+IFNAMSIZ = 15
+
+# How shaped traffic is queued: the kernel's FIFO, fq_codel or cake below every
+# HTB leaf class, or cake as the shaper itself (no HTB, so no per-rule limits)
+FIFO = 'fifo'
+CAKE_SHAPER = 'cake-shaper'
+QUEUES = (FIFO, 'fq_codel', 'cake', CAKE_SHAPER)
+
+# How the upload limit is enforced on ingress: redirected to an IFB device and
+# shaped there like egress, or policed on the ingress qdisc itself - cheaper,
+# but excess packets are dropped instead of queued and rules are not possible
+IFB = 'ifb'
+POLICE = 'police'
+INGRESS_MODES = (IFB, POLICE)
+
+
+def ifb_name(interface):
+    """Name of the IFB device carrying ``interface``'s ingress traffic"""
+    name = IFB_PREFIX + interface
+    if len(name) > IFNAMSIZ:
+        name = f"{IFB_PREFIX}{zlib.crc32(interface.encode()):08x}"
+    return name
+
+
+@dataclass
+class Rule:
+    """Limits for traffic to or from one host, subnet or port (see rules.parse_match)"""
+
+    match: str
+    download_kbps: int | None = None
+    upload_kbps: int | None = None
+
+
+@dataclass
+class InterfacePolicy:
+    """Limits NetThrottle should enforce on one interface (None means no limit).
+
+    ``ifb`` defaults to the interface's own device (see ifb_name).
+    """
+
+    interface: str
+    download_kbps: int | None = None
+    upload_kbps: int | None = None
+    ifb: str = ''
+    queue: str = FIFO
+    ingress_mode: str = IFB
+    rules: list[Rule] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.ifb:
+            self.ifb = ifb_name(self.interface)
@@ -0,0 +1,266 @@
+"""Per-process and per-cgroup TCP throughput.
+
+Byte counters come from one sock_diag (``INET_DIAG``) dump per address
+family per tick: ``tcp_info.bytes_acked`` (sent) and ``bytes_received`` of
+every TCP socket, keyed by socket inode. Inodes are attributed to processes
+through the ``socket:[inode]`` links in ``/proc/<pid>/fd``.
+
+That index is maintained incrementally: ``/proc`` is only consulted when the
+dump shows inodes with no known owner, and then only new processes and
+processes whose open-file count changed are rescanned. A process that closed
+one socket and opened another keeps its count, so inodes still unowned after
+that trigger a full scan, at most once per ``FULL_RESCAN_SECONDS``.
+"""
+import os
+import socket
+import struct
+import time
+
+from . import netlink as nl
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+INET_DIAG_INFO = 2
+# Every TCP state except LISTEN (10); TIME_WAIT sockets carry no tcp_info anyway
+TCP_STATES = 0xfff & ~(1 << 10)
+
+# inet_diag_req_v2 with an all-zero inet_diag_sockid
+INET_DIAG_REQ = struct.Struct('=BBBxI48x')
+# Offsets inside one reply (after the nlmsghdr): inode in inet_diag_msg,
+# then the attributes; bytes_acked/bytes_received inside struct tcp_info
+DIAG_MSG_SIZE = 72
+INODE = struct.Struct('=I')
+INODE_OFFSET = 68
+TCP_BYTES = struct.Struct('=QQ')
+TCP_BYTES_OFFSET = 120
+MSG_HEADER = struct.Struct('=IH')
+
+PROC = '/proc'
+# Inodes the fd counts do not explain (a reused fd, or no counts from the
+# kernel) trigger at most one full scan per interval
+FULL_RESCAN_SECONDS = 10.0
+
+
+def diag_request(family):
+    return INET_DIAG_REQ.pack(family, socket.IPPROTO_TCP, 1 << (INET_DIAG_INFO - 1), TCP_STATES)
+
+
+def parse_sockets(data, counters, hint=None):
+    """Add {inode: (bytes_sent, bytes_received)} for every socket in a raw dump.
+
+    Replies of one dump carry the same attributes in the same order, so the
+    offset of tcp_info is guessed from the previous reply (``hint``) and the
+    attributes are only walked when the guess misses. Returns the last offset.
+    """
+    offset = 0
+    end = len(data)
+    header = nl.NLMSGHDR.size
+    attrs = header + DIAG_MSG_SIZE
+    unpack_header = MSG_HEADER.unpack_from
+    unpack_attr = nl.RTATTR.unpack_from
+    unpack_inode = INODE.unpack_from
+    unpack_bytes = TCP_BYTES.unpack_from
+    needed = 4 + TCP_BYTES_OFFSET + TCP_BYTES.size
+    while offset + header <= end:
+        length, msg_type = unpack_header(data, offset)
+        if length < header:
+            break
+        if msg_type == SOCK_DIAG_BY_FAMILY:
+            info = None
+            if hint is not None and hint + 4 <= length:
+                attr_length, attr_type = unpack_attr(data, offset + hint)
+                if attr_type == INET_DIAG_INFO:
+                    info = hint
+            if info is None:
+                attr = attrs
+                while attr + 4 <= length:
+                    attr_length, attr_type = unpack_attr(data, offset + attr)
+                    if attr_length < 4:
+                        break
+                    if attr_type == INET_DIAG_INFO:
+                        info = hint = attr
+                        break
+                    attr += nl.align(attr_length)
+            if info is not None and attr_length >= needed and info + needed <= length:
+                inode = unpack_inode(data, offset + header + INODE_OFFSET)[0]
+                if inode:
+                    counters[inode] = unpack_bytes(data, offset + info + 4 + TCP_BYTES_OFFSET)
+        offset += nl.align(length)
+    return hint
+
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class SocketOwners:
+    """Incrementally maintained socket inode -> PID index"""
+
+    def __init__(self, proc=PROC):
+        self.proc = proc
+        self.owner = {}
+        # pid -> (fd count, inodes, name, cgroup)
+        self.processes = {}
+        self.last_full_scan = 0
+        self.scans = 0
+
+    def _fd_count(self, pid):
+        # st_size of /proc/<pid>/fd is the number of open fds (Linux 6.2+), else 0
+        try:
+            return os.stat(f'{self.proc}/{pid}/fd').st_size
+        except OSError:
+            return None
+
+    def _scan(self, pid, fd_count):
+        """Re-read one process's socket inodes"""
+        self.scans += 1
+        old = self.processes.get(pid)
+        inodes = set()
+        fd_dir = f'{self.proc}/{pid}/fd'
+        try:
+            for fd in os.listdir(fd_dir):
+                try:
+                    target = os.readlink(f'{fd_dir}/{fd}')
+                except OSError:
+                    continue
+                if target.startswith('socket:['):
+                    inodes.add(int(target[8:-1]))
+        except OSError:
+            self._forget(pid)
+            return
+        if old:
+            name, cgroup = old[2], old[3]
+            for inode in old[1] - inodes:
+                if self.owner.get(inode) == pid:
+                    del self.owner[inode]
+        else:
+            name = (read_text(f'{self.proc}/{pid}/comm') or '?').strip()
+            cgroup = self._cgroup(pid)
+        for inode in inodes:
+            self.owner.setdefault(inode, pid)
+        self.processes[pid] = (fd_count, inodes, name, cgroup)
+
+    def _cgroup(self, pid):
+        text = read_text(f'{self.proc}/{pid}/cgroup') or ''
+        for line in text.splitlines():
+            # cgroup v2 line is "0::/path"; fall back to the first v1 hierarchy
+            if line.startswith('0::'):
+                return line[3:] or '/'
+        return text.split(':', 2)[2].strip() if text.count(':') >= 2 else '/'
+
+    def _forget(self, pid):
+        old = self.processes.pop(pid, None)
+        if old:
+            for inode in old[1]:
+                if self.owner.get(inode) == pid:
+                    del self.owner[inode]
+
+    def resolve(self, inodes):
+        """Make sure owners of ``inodes`` are indexed, rescanning as little as possible"""
+        if all(inode in self.owner for inode in inodes):
+            return
+        pids = {int(name) for name in os.listdir(self.proc) if name.isdigit()}
+        for pid in set(self.processes) - pids:
+            self._forget(pid)
+        counts = {}
+        for pid in pids:
+            fd_count = self._fd_count(pid)
+            if fd_count is None:
+                continue
+            counts[pid] = fd_count
+            known = self.processes.get(pid)
+            if known is None or known[0] != fd_count:
+                self._scan(pid, fd_count)
+
+        now = time.monotonic()
+        if (now - self.last_full_scan >= FULL_RESCAN_SECONDS
+                and not all(inode in self.owner for inode in inodes)):
+            # A socket replaced by another under the same fd count, or no counts
+            # from the kernel at all: fall back to a throttled full scan
+            self.last_full_scan = now
+            for pid, fd_count in counts.items():
+                self._scan(pid, fd_count)
+
+    def process(self, pid):
+        """(name, cgroup) of an indexed process"""
+        known = self.processes.get(pid)
+        return (known[2], known[3]) if known else ('?', '/')
+
+
+class ProcessTraffic:
+    """TCP throughput per process, refreshed by ``poll()``"""
+
+    def __init__(self):
+        self.sock = nl.NetlinkSocket(NETLINK_SOCK_DIAG)
+        self.owners = SocketOwners()
+        self.requests = {family: diag_request(family) for family in (socket.AF_INET, socket.AF_INET6)}
+        self.hints = {}
+        self.counters = {}
+        self.last_poll = None
+
+    def close(self):
+        self.sock.close()
+
+    def read(self):
+        """{inode: (bytes_sent, bytes_received)} for every TCP socket"""
+        counters = {}
+        for family in (socket.AF_INET, socket.AF_INET6):
+            data = self.sock.dump_datagrams(SOCK_DIAG_BY_FAMILY, self.requests[family])
+            self.hints[family] = parse_sockets(data, counters, self.hints.get(family))
+        return counters
+
+    def poll(self):
+        """Per-process rates since the previous poll, busiest first.
+
+        Returns a list of dicts with pid, name, cgroup, sockets and
+        rx/tx bytes per second. The first poll only records a baseline.
+        """
+        counters = self.read()
+        now = time.monotonic()
+        previous, self.counters = self.counters, counters
+        last_poll, self.last_poll = self.last_poll, now
+        if last_poll is None:
+            return []
+        elapsed = now - last_poll
+
+        self.owners.resolve(counters.keys())
+        owner = self.owners.owner
+        usage = {}
+        for inode, (sent, received) in counters.items():
+            # Sockets opened since the last poll moved all their bytes in this interval
+            prev_sent, prev_received = previous.get(inode, (0, 0))
+            pid = owner.get(inode)
+            entry = usage.get(pid)
+            if entry is None:
+                entry = usage[pid] = [0, 0, 0]
+            entry[0] += received - prev_received
+            entry[1] += sent - prev_sent
+            entry[2] += 1
+
+        rows = []
+        for pid, (received, sent, sockets) in usage.items():
+            name, cgroup = self.owners.process(pid) if pid else ('(unknown)', '/')
+            rows.append({'pid': pid, 'name': name, 'cgroup': cgroup, 'sockets': sockets,
+                         'rx_bytes_per_sec': received / elapsed,
+                         'tx_bytes_per_sec': sent / elapsed})
+        rows.sort(key=lambda row: row['rx_bytes_per_sec'] + row['tx_bytes_per_sec'], reverse=True)
+        return rows
+
+
+def by_cgroup(rows):
+    """Sum per-process rows into per-cgroup rows, busiest first"""
+    groups = {}
+    for row in rows:
+        group = groups.setdefault(row['cgroup'], {'cgroup': row['cgroup'], 'processes': 0,
+                                                  'sockets': 0, 'rx_bytes_per_sec': 0.0,
+                                                  'tx_bytes_per_sec': 0.0})
+        group['processes'] += 1
+        group['sockets'] += row['sockets']
+        group['rx_bytes_per_sec'] += row['rx_bytes_per_sec']
+        group['tx_bytes_per_sec'] += row['tx_bytes_per_sec']
+    return sorted(groups.values(), key=lambda g: g['rx_bytes_per_sec'] + g['tx_bytes_per_sec'],
+                  reverse=True)
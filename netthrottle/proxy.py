@@ -0,0 +1,481 @@
+"""Userspace throttling: a local SOCKS5 and TCP forwarding proxy with token buckets.
+
+Shaping with tc needs Linux and root. Elsewhere (Windows, macOS, containers
+without CAP_NET_ADMIN) applications can be pointed at ``ThrottleProxy``
+instead. It speaks SOCKS5 (CONNECT, no authentication) and can forward fixed
+ports to fixed destinations.
+
+Bytes are charged to a hierarchy of token buckets in each direction: the
+global one, the client's (by source address) and the destination's
+(``host:port``). A transfer waits for the most limited of them, so one
+client or one destination can be held below the global rate while the
+others share it. Rates count TCP payload; the wire carries a few percent
+more in headers.
+
+On Linux the payload never enters Python. Each direction is spliced socket
+-> pipe -> socket with ``os.splice``, and Python only decides how many bytes
+may move next. Elsewhere it falls back to ``recv_into``/``sendall`` through
+one reusable buffer per direction. ``sendfile`` cannot help here: it needs a
+file as its source, not a socket.
+"""
+import asyncio
+import errno
+import os
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass, fields
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 1080
+
+# Buckets save up this much time at their rate, and never less than MIN_BURST,
+# so the loop's timer slack does not lose tokens
+BURST_SECONDS = 0.01
+MIN_BURST = 64 * 1024
+# Smallest grant worth a wake-up, and the most moved per splice
+MIN_GRANT = 16 * 1024
+MAX_GRANT = 1024 * 1024
+COPY_BUFFER = 256 * 1024
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+SPLICE = hasattr(os, 'splice') and fcntl is not None
+
+SOCKS_VERSION = 5
+SOCKS_CONNECT = 1
+SOCKS_IPV4, SOCKS_DOMAIN, SOCKS_IPV6 = 1, 3, 4
+# SOCKS5 reply codes
+SUCCEEDED = 0
+GENERAL_FAILURE = 1
+NETWORK_UNREACHABLE = 3
+HOST_UNREACHABLE = 4
+CONNECTION_REFUSED = 5
+COMMAND_NOT_SUPPORTED = 7
+ADDRESS_NOT_SUPPORTED = 8
+
+DIRECTIONS = ('download', 'upload')
+# Bucket levels, in the order a grant is checked
+LEVELS = ('', 'client_', 'destination_')
+
+
+class ProxyError(Exception):
+    pass
+
+
+@dataclass
+class ProxyLimits:
+    """Proxy rates in kbit/s, None for unlimited. Upload is client -> destination."""
+
+    download_kbps: int | None = None
+    upload_kbps: int | None = None
+    client_download_kbps: int | None = None
+    client_upload_kbps: int | None = None
+    destination_download_kbps: int | None = None
+    destination_upload_kbps: int | None = None
+
+
+def parse_forward(text):
+    """Parse "[ADDRESS:]PORT:HOST:HOSTPORT" into (address, port, host, hostport)"""
+    parts = str(text).rsplit(':', 3)
+    if len(parts) == 3:
+        parts.insert(0, DEFAULT_ADDRESS)
+    try:
+        address, port, host, host_port = parts
+        return address.strip('[]') or DEFAULT_ADDRESS, int(port), host.strip('[]'), int(host_port)
+    except ValueError:
+        raise ValueError(f"Invalid forward {text!r}, expected [ADDRESS:]PORT:HOST:HOSTPORT")
+
+
+class TokenBucket:
+    """Bytes allowed at ``rate`` bytes/s, saving up to a burst"""
+
+    def __init__(self, rate=None):
+        self.rate = None
+        self.burst = MIN_BURST
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.refill(time.monotonic())
+        self.rate = rate or None
+        if self.rate:
+            self.burst = max(self.rate * BURST_SECONDS, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+
+async def acquire(buckets, want):
+    """Take up to ``want`` bytes from every limited bucket, waiting for at least a grant"""
+    while True:
+        # Looked up on every pass: a rate may change while waiting
+        limited = [bucket for bucket in buckets if bucket.rate]
+        if not limited:
+            return want
+        now = time.monotonic()
+        available = want
+        for bucket in limited:
+            bucket.refill(now)
+            available = min(available, bucket.tokens)
+        needed = min(want, MIN_GRANT, *(bucket.burst for bucket in limited))
+        if available >= needed:
+            grant = int(available)
+            for bucket in limited:
+                bucket.tokens -= grant
+            return grant
+        await asyncio.sleep(max((needed - bucket.tokens) / bucket.rate for bucket in limited))
+
+
+def refund(buckets, count):
+    """Give back tokens granted but not used"""
+    if count > 0:
+        for bucket in buckets:
+            if bucket.rate:
+                bucket.tokens += count
+
+
+class Level:
+    """Buckets of one level and direction, by key, alive while a connection uses them"""
+
+    def __init__(self, rate_kbps=None):
+        self.rate = rate_kbps * 1000 / 8 if rate_kbps else None
+        self.buckets = {}
+        self.users = {}
+
+    def get(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.rate)
+            self.users[key] = 0
+        self.users[key] += 1
+        return self.buckets[key]
+
+    def release(self, key):
+        self.users[key] -= 1
+        if not self.users[key]:
+            del self.users[key], self.buckets[key]
+
+    def set_rate(self, rate_kbps):
+        self.rate = rate_kbps * 1000 / 8 if rate_kbps else None
+        for bucket in self.buckets.values():
+            bucket.set_rate(self.rate)
+
+
+def socks_reply(code, address=('0.0.0.0', 0)):
+    host, port = address[:2]
+    if ':' in host:
+        return bytes([SOCKS_VERSION, code, 0, SOCKS_IPV6]) + socket.inet_pton(
+            socket.AF_INET6, host) + struct.pack('!H', port)
+    return bytes([SOCKS_VERSION, code, 0, SOCKS_IPV4]) + socket.inet_aton(host) + struct.pack('!H', port)
+
+
+def socks_error(error):
+    """SOCKS5 reply code for a failed connect"""
+    if isinstance(error, socket.gaierror):
+        return HOST_UNREACHABLE
+    if isinstance(error, ConnectionRefusedError):
+        return CONNECTION_REFUSED
+    if getattr(error, 'errno', None) == errno.ENETUNREACH:
+        return NETWORK_UNREACHABLE
+    if isinstance(error, TimeoutError) or getattr(error, 'errno', None) == errno.EHOSTUNREACH:
+        return HOST_UNREACHABLE
+    return GENERAL_FAILURE
+
+
+async def receive_exactly(sock, count):
+    loop = asyncio.get_running_loop()
+    data = b''
+    while len(data) < count:
+        chunk = await loop.sock_recv(sock, count - len(data))
+        if not chunk:
+            raise ProxyError("Client closed the connection during the handshake")
+        data += chunk
+    return data
+
+
+async def wait_fd(fd, writable=False):
+    """Wait until ``fd`` is readable (or writable)"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    add, remove = (loop.add_writer, loop.remove_writer) if writable else \
+        (loop.add_reader, loop.remove_reader)
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+class ThrottleProxy:
+    """SOCKS5 proxy on ``address``:``port`` plus fixed ``forwards``, rate limited by ``limits``.
+
+    ``forwards`` are (address, port, host, hostport) tuples (see parse_forward).
+    Run it with ``serve()`` inside an event loop, or ``start()`` on a thread.
+    """
+
+    def __init__(self, limits=None, address=DEFAULT_ADDRESS, port=DEFAULT_PORT, forwards=(),
+                 splice=SPLICE):
+        self.limits = limits or ProxyLimits()
+        self.address = address
+        self.port = port
+        self.forwards = list(forwards)
+        self.splice = splice
+        self.levels = {(level, direction): Level(getattr(self.limits, f'{level}{direction}_kbps'))
+                       for level in LEVELS for direction in DIRECTIONS}
+        self.bytes = dict.fromkeys(DIRECTIONS, 0)
+        self.active = 0
+        self.connections = 0
+        self.listening = []
+        self.loop = None
+        self.stopping = None
+        self.thread = None
+
+    def stats(self):
+        return {'listening': list(self.listening), 'active': self.active,
+                'connections': self.connections, 'bytes': dict(self.bytes),
+                'limits': {f.name: getattr(self.limits, f.name) for f in fields(self.limits)}}
+
+    def set_limits(self, **changes):
+        """Change ProxyLimits fields; connections in progress follow at once"""
+        for name in changes:
+            if not hasattr(self.limits, name):
+                raise ValueError(f"Unknown proxy limit {name!r}")
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._apply_limits, changes)
+        else:
+            self._apply_limits(changes)
+
+    def _apply_limits(self, changes):
+        for name, value in changes.items():
+            setattr(self.limits, name, value or None)
+        for (level, direction), buckets in self.levels.items():
+            buckets.set_rate(getattr(self.limits, f'{level}{direction}_kbps'))
+
+    # Running
+
+    def start(self):
+        """Serve on a daemon thread; raises OSError if a port cannot be bound"""
+        ready = threading.Event()
+        failure = []
+
+        def run():
+            try:
+                asyncio.run(self.serve(ready))
+            except Exception as e:
+                failure.append(e)
+                ready.set()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+        if failure:
+            raise failure[0]
+
+    def stop(self):
+        if self.loop and self.stopping:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        if self.thread:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    async def serve(self, ready=None):
+        """Accept connections until stop()"""
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        listeners = []
+        try:
+            for address, port, target in [(self.address, self.port, None)] + [
+                    (address, port, (host, host_port))
+                    for address, port, host, host_port in self.forwards]:
+                listener = socket.create_server((address, port), backlog=128,
+                                                family=socket.AF_INET6 if ':' in address
+                                                else socket.AF_INET)
+                listener.setblocking(False)
+                listeners.append((listener, target))
+                self.listening.append(listener.getsockname()[:2])
+            if ready:
+                ready.set()
+            tasks = [asyncio.create_task(self._accept(listener, target))
+                     for listener, target in listeners]
+            await self.stopping.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for listener, _ in listeners:
+                listener.close()
+            self.listening = []
+
+    async def _accept(self, listener, target):
+        connections = set()
+        try:
+            while True:
+                client, address = await self.loop.sock_accept(listener)
+                task = asyncio.create_task(self._client(client, address, target))
+                connections.add(task)
+                task.add_done_callback(connections.discard)
+        finally:
+            for task in list(connections):
+                task.cancel()
+
+    async def _client(self, client, address, target):
+        upstream = None
+        self.active += 1
+        self.connections += 1
+        try:
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            host, port = target or await self._socks_request(client)
+            try:
+                upstream = await self._connect(host, port)
+            except OSError as e:
+                if target is None:
+                    await self.loop.sock_sendall(client, socks_reply(socks_error(e)))
+                return
+            if target is None:
+                await self.loop.sock_sendall(client, socks_reply(SUCCEEDED, upstream.getsockname()))
+            await self._relay(client, upstream, address[0], f'{host}:{port}')
+        except (OSError, ProxyError):
+            pass
+        finally:
+            self.active -= 1
+            client.close()
+            if upstream:
+                upstream.close()
+
+    async def _socks_request(self, client):
+        """Negotiate SOCKS5 with ``client`` and return the (host, port) it asks for"""
+        version, count = await receive_exactly(client, 2)
+        methods = await receive_exactly(client, count)
+        if version != SOCKS_VERSION:
+            raise ProxyError(f"Not a SOCKS5 client (version {version})")
+        if 0 not in methods:
+            await self.loop.sock_sendall(client, bytes([SOCKS_VERSION, 0xff]))
+            raise ProxyError("Client wants authentication")
+        await self.loop.sock_sendall(client, bytes([SOCKS_VERSION, 0]))
+
+        _, command, _, kind = await receive_exactly(client, 4)
+        if kind == SOCKS_IPV4:
+            host = socket.inet_ntoa(await receive_exactly(client, 4))
+        elif kind == SOCKS_IPV6:
+            host = socket.inet_ntop(socket.AF_INET6, await receive_exactly(client, 16))
+        elif kind == SOCKS_DOMAIN:
+            length, = await receive_exactly(client, 1)
+            host = (await receive_exactly(client, length)).decode('idna')
+        else:
+            await self.loop.sock_sendall(client, socks_reply(ADDRESS_NOT_SUPPORTED))
+            raise ProxyError(f"Unknown address type {kind}")
+        port, = struct.unpack('!H', await receive_exactly(client, 2))
+        if command != SOCKS_CONNECT:
+            await self.loop.sock_sendall(client, socks_reply(COMMAND_NOT_SUPPORTED))
+            raise ProxyError(f"Unsupported SOCKS command {command}")
+        return host, port
+
+    async def _connect(self, host, port):
+        error = OSError(f"No address for {host}")
+        for family, kind, proto, _, address in await self.loop.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM):
+            sock = socket.socket(family, kind, proto)
+            sock.setblocking(False)
+            try:
+                await self.loop.sock_connect(sock, address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        raise error
+
+    async def _relay(self, client, upstream, client_key, destination):
+        """Forward both directions until both are closed"""
+        keys = {'': '', 'client_': client_key, 'destination_': destination}
+        chains = {direction: [self.levels[(level, direction)].get(keys[level]) for level in LEVELS]
+                  for direction in DIRECTIONS}
+        pump = self._splice if self.splice else self._copy
+        tasks = [asyncio.create_task(pump(client, upstream, chains['upload'], 'upload')),
+                 asyncio.create_task(pump(upstream, client, chains['download'], 'download'))]
+        try:
+            # A direction that ends cleanly half-closes and lets the other finish;
+            # one that fails (reset, broken pipe) ends both
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for level in LEVELS:
+                for direction in DIRECTIONS:
+                    self.levels[(level, direction)].release(keys[level])
+
+    def _half_close(self, sock):
+        """Pass an EOF on, so the peer can finish the other direction"""
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    async def _splice(self, source, destination, buckets, direction):
+        """Move bytes from ``source`` to ``destination`` through a pipe, never into Python"""
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        read_end, write_end = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            size = fcntl.fcntl(write_end, F_SETPIPE_SZ, MAX_GRANT)
+        except OSError:
+            # Above /proc/sys/fs/pipe-max-size: keep the default 64 KiB
+            size = 64 * 1024
+        src, dst = source.fileno(), destination.fileno()
+        try:
+            while True:
+                grant = await acquire(buckets, size)
+                moved = 0
+                try:
+                    while True:
+                        try:
+                            moved = os.splice(src, write_end, grant, flags=flags)
+                            break
+                        except BlockingIOError:
+                            await wait_fd(src)
+                finally:
+                    refund(buckets, grant - moved)
+                if not moved:
+                    self._half_close(destination)
+                    return
+                pending = moved
+                while pending:
+                    try:
+                        pending -= os.splice(read_end, dst, pending,
+                                             flags=flags | os.SPLICE_F_MORE)
+                    except BlockingIOError:
+                        await wait_fd(dst, writable=True)
+                self.bytes[direction] += moved
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+
+    async def _copy(self, source, destination, buckets, direction):
+        """Portable fallback: through a buffer, with the same token accounting"""
+        view = memoryview(bytearray(COPY_BUFFER))
+        while True:
+            grant = await acquire(buckets, COPY_BUFFER)
+            moved = 0
+            try:
+                moved = await self.loop.sock_recv_into(source, view[:grant])
+            finally:
+                refund(buckets, grant - moved)
+            if not moved:
+                self._half_close(destination)
+                return
+            await self.loop.sock_sendall(destination, view[:moved])
+            self.bytes[direction] += moved
@@ -0,0 +1,431 @@
+"""Data-cap budgets for metered links, with automatic throttle tiers.
+
+A Budget gives an interface a byte allowance per day or per month, counted
+from the same rx/tx counters the monitor reads. As usage crosses each Tier's
+percentage the interface's limits step down to that tier's rates; when the
+period rolls over the limits in force before the first tier come back.
+
+Usage is kept in one append-only journal per interface. Every sample appends
+a fixed-width record with a CRC, which costs one write() and survives a
+crashed process; the journal is fsynced every few seconds and whenever the
+tier changes, so a power cut loses at most those seconds. Loading takes the
+last record whose CRC matches, so a torn tail is ignored, and the journal is
+compacted to its last record once it grows. Each record keeps the raw
+counters and the boot id, so counters that reset (reboot, interface
+recreated) are detected and counted from zero instead of going backwards.
+
+Journals are locked while in use: a second NetThrottle process (the GUI next
+to the daemon) leaves an interface that is already being accounted alone.
+"""
+import calendar
+import json
+import os
+import struct
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from urllib.parse import quote
+
+from .fsutil import sync_directory, write_atomic
+from .paths import state_dir
+
+try:
+    import fcntl
+except ImportError:
+    # Journals are not locked where flock() does not exist (Windows)
+    fcntl = None
+
+DAILY = 'daily'
+MONTHLY = 'monthly'
+PERIODS = (DAILY, MONTHLY)
+# Later days do not exist in every month
+MAX_RESET_DAY = 28
+
+MAGIC = b'NTQJ'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+# Period start (unix seconds), bytes used, raw rx/tx counters, boot id, index
+# of the active tier (-1 for none), limits in force before the first tier
+# (kbit/s, 0 for none), then the CRC32 of everything before it
+RECORD = struct.Struct('<qQQQ16siII')
+CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + CRC.size
+# Records kept before the journal is rewritten as its last one (about 256KB)
+COMPACT_RECORDS = 4096
+SYNC_SECONDS = 10.0
+BUDGETS_FILE = 'budgets.json'
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+
+
+@dataclass
+class Tier:
+    """Limits applied once ``percent`` of the budget is used (None leaves a limit alone)"""
+
+    percent: float
+    download_kbps: int | None = None
+    upload_kbps: int | None = None
+
+
+@dataclass
+class Budget:
+    """Bytes ``interface`` may transfer (received plus sent) per period"""
+
+    interface: str
+    limit_bytes: int
+    period: str = MONTHLY
+    reset_day: int = 1
+    tiers: list[Tier] = field(default_factory=list)
+
+    def __post_init__(self):
+        if self.period not in PERIODS:
+            raise ValueError(f"Unknown period {self.period!r}, expected one of {', '.join(PERIODS)}")
+        if not 1 <= self.reset_day <= MAX_RESET_DAY:
+            raise ValueError(f"The reset day must be between 1 and {MAX_RESET_DAY}")
+        if self.limit_bytes <= 0:
+            raise ValueError("The budget must be positive")
+        self.tiers = sorted((Tier(**tier) if isinstance(tier, dict) else tier for tier in self.tiers),
+                            key=lambda tier: tier.percent)
+
+    def tier_index(self, used):
+        """Index of the tier ``used`` bytes fall in, or -1 below the first"""
+        percent = used * 100 / self.limit_bytes
+        index = -1
+        for i, tier in enumerate(self.tiers):
+            if percent >= tier.percent:
+                index = i
+        return index
+
+
+@dataclass
+class Usage:
+    """One journal record"""
+
+    period_start: int
+    used: int = 0
+    rx: int = 0
+    tx: int = 0
+    boot: bytes = bytes(16)
+    tier: int = -1
+    saved_download_kbps: int = 0
+    saved_upload_kbps: int = 0
+
+    def pack(self):
+        data = RECORD.pack(self.period_start, self.used, self.rx, self.tx, self.boot, self.tier,
+                           self.saved_download_kbps, self.saved_upload_kbps)
+        return data + CRC.pack(zlib.crc32(data))
+
+
+def period_start(period, reset_day, now=None):
+    """Unix time at which the period containing ``now`` began (local midnight)"""
+    t = time.localtime(now)
+    year, month, day = t.tm_year, t.tm_mon, t.tm_mday
+    if period == MONTHLY:
+        if day < reset_day:
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+        day = reset_day
+    return int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+
+
+def period_end(period, reset_day, now=None):
+    """Unix time at which the period containing ``now`` ends"""
+    start = time.localtime(period_start(period, reset_day, now))
+    if period == DAILY:
+        year, month, day = start.tm_year, start.tm_mon, start.tm_mday + 1
+        if day > calendar.monthrange(year, month)[1]:
+            year, month, day = (year + 1, 1, 1) if month == 12 else (year, month + 1, 1)
+    else:
+        year, month = (start.tm_year + 1, 1) if start.tm_mon == 12 else (start.tm_year, start.tm_mon + 1)
+        day = reset_day
+    return int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+
+
+def read_records(data):
+    """(newest intact Usage or None, end offset of the intact records, their count)"""
+    last, end, count = None, HEADER.size, 0
+    if data[:HEADER.size] != HEADER.pack(MAGIC, VERSION):
+        return None, 0, 0
+    for offset in range(HEADER.size, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        body = data[offset:offset + RECORD.size]
+        if zlib.crc32(body) != CRC.unpack_from(data, offset + RECORD.size)[0]:
+            break
+        last, end, count = Usage(*RECORD.unpack(body)), offset + RECORD_SIZE, count + 1
+    return last, end, count
+
+
+def boot_id():
+    try:
+        with open(BOOT_ID) as f:
+            return bytes.fromhex(f.read().strip().replace('-', ''))
+    except (OSError, ValueError):
+        return bytes(16)
+
+
+class Journal:
+    """Append-only usage records of one interface, locked while open"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.records = 0
+        self.synced = time.monotonic()
+
+    def load(self):
+        """The newest intact record, or None; a damaged tail is cut off"""
+        data = os.pread(self.fd, os.fstat(self.fd).st_size, 0)
+        last, end, self.records = read_records(data)
+        if last is None:
+            os.ftruncate(self.fd, 0)
+            os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION), 0)
+        elif end != len(data):
+            os.ftruncate(self.fd, end)
+        os.lseek(self.fd, 0, os.SEEK_END)
+        return last
+
+    def append(self, usage, sync=False):
+        if self.records >= COMPACT_RECORDS:
+            self.compact(usage)
+            return
+        os.write(self.fd, usage.pack())
+        self.records += 1
+        if sync or time.monotonic() - self.synced >= SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.fd)
+        self.synced = time.monotonic()
+
+    def compact(self, usage):
+        """Replace the journal by one holding just ``usage``"""
+        temporary = f'{self.path}.tmp'
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            os.write(fd, HEADER.pack(MAGIC, VERSION) + usage.pack())
+            os.fsync(fd)
+            # Lock the new file before it becomes visible under the journal's name
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.rename(temporary, self.path)
+        except BaseException:
+            os.close(fd)
+            raise
+        sync_directory(os.path.dirname(self.path))
+        os.close(self.fd)
+        self.fd = fd
+        self.records = 1
+        self.synced = time.monotonic()
+
+    def close(self):
+        try:
+            self.sync()
+        finally:
+            os.close(self.fd)
+
+
+class QuotaEngine:
+    """Counts usage against every Budget and reports when a tier changes.
+
+    ``apply(interface, download_kbps, upload_kbps)`` changes limits with the
+    semantics of ThrottleCore.set_limits; ``limits(interface)`` returns the
+    (download_kbps, upload_kbps) in force, None meaning no limit.
+    """
+
+    def __init__(self, apply, limits, directory=None):
+        self.apply = apply
+        self.limits = limits
+        self.directory = directory or os.path.join(state_dir(), 'quota')
+        os.makedirs(self.directory, exist_ok=True)
+        self.budgets = {}
+        self.budgets_mtime = None
+        self.journals = {}
+        self.usage = {}
+        self.errors = {}
+        self.boot = boot_id()
+        self.reload()
+
+    # Budgets
+
+    @property
+    def budgets_path(self):
+        return os.path.join(self.directory, BUDGETS_FILE)
+
+    def reload(self):
+        """Re-read the budgets if another process changed them"""
+        try:
+            mtime = os.stat(self.budgets_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.budgets_mtime:
+            return
+        self.budgets_mtime = mtime
+        budgets = {}
+        if mtime is not None:
+            with open(self.budgets_path) as f:
+                for entry in json.load(f):
+                    budgets[entry['interface']] = Budget(**entry)
+        for interface in set(self.journals) - set(budgets):
+            self._close(interface)
+        self.budgets = budgets
+
+    def _save(self):
+        write_atomic(self.budgets_path, json.dumps(
+            [asdict(budget) for budget in self.budgets.values()], indent=2).encode())
+        self.budgets_mtime = os.stat(self.budgets_path).st_mtime_ns
+
+    def set_budget(self, budget):
+        self.reload()
+        self.budgets[budget.interface] = budget
+        self._save()
+
+    def remove_budget(self, interface):
+        """Drop the budget and its usage; limits set by a tier stay in force"""
+        self.reload()
+        if self.budgets.pop(interface, None) is None:
+            return False
+        self._save()
+        self._close(interface)
+        try:
+            os.unlink(self._journal_path(interface))
+        except OSError:
+            pass
+        return True
+
+    # Accounting
+
+    def _journal_path(self, interface):
+        return os.path.join(self.directory, quote(interface, safe='') + '.journal')
+
+    def _open(self, interface, rx, tx, now):
+        """Open the journal and carry its usage over to the current counters.
+
+        Returns None when another process holds it.
+        """
+        try:
+            journal = Journal(self._journal_path(interface))
+        except BlockingIOError:
+            return None
+        last = journal.load()
+        budget = self.budgets[interface]
+        start = period_start(budget.period, budget.reset_day, now)
+        if last is None:
+            usage = Usage(start)
+        else:
+            usage = last
+            # Traffic while nothing was counting: since the last record, or
+            # since the counters started after a reboot or reset
+            if last.boot == self.boot and rx >= last.rx and tx >= last.tx:
+                usage.used += (rx - last.rx) + (tx - last.tx)
+            else:
+                usage.used += rx + tx
+        usage.rx, usage.tx, usage.boot = rx, tx, self.boot
+        self.journals[interface] = journal
+        self.usage[interface] = usage
+        return usage
+
+    def _close(self, interface):
+        journal = self.journals.pop(interface, None)
+        self.usage.pop(interface, None)
+        if journal:
+            journal.close()
+
+    def update(self, interface, rx, tx, now=None):
+        """Count raw counters of ``interface``.
+
+        Returns a dict describing a tier change, or the first of a run of
+        identical errors applying one; None otherwise.
+        """
+        budget = self.budgets.get(interface)
+        if budget is None:
+            return None
+        now = time.time() if now is None else now
+        usage = self.usage.get(interface)
+        opened = usage is None
+        if opened:
+            usage = self._open(interface, rx, tx, now)
+            if usage is None:
+                return None
+        else:
+            # A counter going backwards was reset: it counted up from zero since
+            usage.used += (rx - usage.rx if rx >= usage.rx else rx) + \
+                          (tx - usage.tx if tx >= usage.tx else tx)
+            usage.rx, usage.tx = rx, tx
+        start = period_start(budget.period, budget.reset_day, now)
+        if start != usage.period_start:
+            usage.period_start, usage.used = start, 0
+        # The limits of a tier recorded before a restart may be gone (after a
+        # reboot there are none), so they are applied again
+        try:
+            change = self._step(interface, budget, usage,
+                                force=opened or interface in self.errors)
+            self.errors.pop(interface, None)
+        except Exception as e:
+            # Usage is still counted; the tier is retried on the next update
+            change = None
+            if self.errors.get(interface) != str(e):
+                self.errors[interface] = str(e)
+                change = {'interface': interface, 'error': str(e)}
+        self.journals[interface].append(usage, sync=change is not None)
+        return change
+
+    def _step(self, interface, budget, usage, force=False):
+        """Apply the tier ``usage`` falls in, if it is not the one in force"""
+        tier = budget.tier_index(usage.used)
+        if tier == usage.tier and not (force and tier >= 0):
+            return None
+        if tier >= 0:
+            download, upload = budget.tiers[tier].download_kbps, budget.tiers[tier].upload_kbps
+            if usage.tier < 0:
+                saved = self.limits(interface)
+                usage.saved_download_kbps, usage.saved_upload_kbps = (kbps or 0 for kbps in saved)
+        else:
+            # Back under every threshold (a new period): restore the old limits,
+            # where 0 removes a limit
+            download, upload = usage.saved_download_kbps, usage.saved_upload_kbps
+        self.apply(interface, download, upload)
+        change = {'interface': interface, 'from': usage.tier, 'to': tier,
+                  'used_bytes': usage.used, 'limit_bytes': budget.limit_bytes,
+                  'download_kbps': download, 'upload_kbps': upload}
+        usage.tier = tier
+        return change
+
+    def flush(self):
+        for journal in self.journals.values():
+            journal.sync()
+
+    def close(self):
+        for interface in list(self.journals):
+            self._close(interface)
+
+    def status(self, now=None):
+        """Usage of every budget as plain dicts"""
+        now = time.time() if now is None else now
+        self.reload()
+        report = []
+        for interface, budget in self.budgets.items():
+            usage = self.usage.get(interface)
+            if usage is None:
+                usage = self._peek(interface)
+            start = period_start(budget.period, budget.reset_day, now)
+            used = usage.used if usage and usage.period_start == start else 0
+            # The recorded tier indexes the tiers of the time; the accounting
+            # thread moves to this one on its next update
+            report.append({**asdict(budget), 'used_bytes': used,
+                           'percent': used * 100 / budget.limit_bytes,
+                           'tier': budget.tier_index(used),
+                           'period_start': start,
+                           'period_end': period_end(budget.period, budget.reset_day, now)})
+        return report
+
+    def _peek(self, interface):
+        """The newest journal record without taking the lock (another process may write it)"""
+        try:
+            with open(self._journal_path(interface), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        return read_records(data)[0]
@@ -0,0 +1,609 @@
+"""Bring live tc state in line with an InterfacePolicy using the fewest changes.
+
+Instead of deleting the root qdisc and rebuilding the tree on every change,
+the reconciler reads what is installed, diffs it against the desired layout
+and only issues the missing pieces - typically a single in-place
+``tc class change`` when a rate is adjusted.
+
+Each HTB leaf class can get fq_codel or cake as its queue instead of the
+kernel's FIFO, so a full class drops or marks early rather than building up
+hundreds of milliseconds of delay; their parameters follow the class ceiling.
+
+Upload is limited on the ingress qdisc by one filter matching every protocol
+(so IPv6 is limited too): either a redirect to an IFB device carrying the
+same HTB tree as egress, or a police action that drops excess packets there
+without the extra device hop.
+"""
+from . import rules as rl
+from .policy import CAKE_SHAPER, FIFO, IFB, POLICE, InterfacePolicy, Rule, ifb_name
+from .tc import ETH_P_ALL, codel_params, format_u32_handle, police_burst, u32_handle
+
+ROOT_HANDLE = '1:'
+ROOT_CLASS = '1:1'
+DEFAULT_CLASS = 0x30
+DEFAULT_LEAF = '1:30'
+INGRESS_HANDLE = 'ffff:'
+# Minor numbers of per-rule classes start here
+RULE_CLASS_BASE = 0x100
+# Root class rate when only rules are set; anything at or above reads as "no limit"
+UNLIMITED_KBPS = 10_000_000
+MIN_RATE_KBPS = 8
+# tc prints rates rounded for display, so allow a little slack when comparing
+RATE_TOLERANCE = 0.01
+# Queues the reconciler attaches below HTB leaf classes
+LEAF_QUEUES = ('fq_codel', 'cake')
+# fq_codel allocates its flow table up front; rule classes carry few flows
+RULE_QUEUE_FLOWS = 64
+
+
+class RestoreError(Exception):
+    """A plan failed and the limits in force before could not be put back.
+
+    The failure of the plan is the ``__cause__``; ``failures`` maps each
+    interface left without its previous limits to the error restoring them.
+    """
+
+    def __init__(self, message, failures):
+        super().__init__(message)
+        self.failures = failures
+
+
+class Step:
+    """One change in a reconcile plan, described in tc command syntax"""
+
+    def __init__(self, description, method, *args):
+        self.description = description
+        self.method = method
+        self.args = args
+
+    def __str__(self):
+        return self.description
+
+    def __repr__(self):
+        return f"Step({self.description!r})"
+
+    def apply(self, backend):
+        getattr(backend, self.method)(*self.args)
+
+
+def guaranteed_share(total_kbps, rule_count):
+    """Rate each leaf class is guaranteed when ``rule_count`` rules share the link"""
+    if not rule_count:
+        return total_kbps
+    share = total_kbps // (rule_count + 1)
+    # Rounded down to a power of two so adding a rule rarely changes every class
+    return min(total_kbps, max(MIN_RATE_KBPS, 1 << (share.bit_length() - 1) if share else 0))
+
+
+def htb_classes(rate_kbps, rule_rates=None):
+    """Class layout: {classid: (parent, rate, ceil)}.
+
+    Unclassified traffic goes to the default class 1:30. Rule classes and the
+    default class share the interface limit (or the link, without one): each
+    is guaranteed an equal share and borrows up to its own ceiling.
+    """
+    rule_rates = rule_rates or {}
+    total = rate_kbps or UNLIMITED_KBPS
+    share = guaranteed_share(total, len(rule_rates))
+    classes = {
+        ROOT_CLASS: (ROOT_HANDLE, total, total),
+        DEFAULT_LEAF: (ROOT_CLASS, share, total),
+    }
+    for classid, limit in rule_rates.items():
+        ceil = min(limit, total)
+        classes[classid] = (ROOT_CLASS, min(share, ceil), ceil)
+    return classes
+
+
+def _same_rate(live, wanted):
+    return live is not None and abs(live - wanted) <= wanted * RATE_TOLERANCE
+
+
+def _add_class_step(dev, classid, parent, rate, ceil):
+    return Step(f"tc class add dev {dev} parent {parent} classid {classid} "
+                f"htb rate {rate}kbit ceil {ceil}kbit",
+                'add_htb_class', dev, classid, parent, rate, ceil)
+
+
+def _delete_qdisc_step(dev, parent):
+    return Step(f"tc qdisc del dev {dev} {parent}", 'delete_qdisc', dev, parent)
+
+
+def _filter_prefix(action, dev, handle):
+    return (f"tc filter {action} dev {dev} parent {ROOT_HANDLE} prio {rl.RULE_PRIO} protocol ip "
+            f"handle {format_u32_handle(handle)} u32")
+
+
+def _add_table_step(dev, htid, divisor):
+    return Step(f"{_filter_prefix('add', dev, u32_handle(htid))} divisor {divisor}",
+                'add_u32_table', dev, ROOT_HANDLE, rl.RULE_PRIO, htid, divisor)
+
+
+def _add_node_step(dev, handle, keys, flowid=None, link=None, hashkey=(0, 0), eat=False):
+    words = [_filter_prefix('add', dev, handle), f"ht {format_u32_handle(handle & 0xFFFFF000)}"]
+    words += [f"match u32 0x{value:08x} 0x{mask:08x} at {offset}" for value, mask, offset in keys]
+    if eat:
+        words.append("offset at 0 mask 0f00 shift 6 eat")
+    if hashkey[0]:
+        words.append(f"hashkey mask 0x{hashkey[0]:08x} at {hashkey[1]}")
+    words.append(f"link {link:x}:" if link is not None else f"flowid {flowid}")
+    return Step(' '.join(words), 'add_u32_node', dev, ROOT_HANDLE, rl.RULE_PRIO, handle,
+                list(keys), flowid, link, hashkey, eat)
+
+
+def _delete_node_step(dev, handle):
+    return Step(_filter_prefix('del', dev, handle),
+                'delete_u32_node', dev, ROOT_HANDLE, rl.RULE_PRIO, handle)
+
+
+def redirect_target(filters):
+    """The device the ingress ``filters`` redirect to, if any"""
+    return next((flt['redirect'] for flt in filters if flt.get('redirect')), None)
+
+
+def police_filter(filters):
+    """The ingress filter policing every protocol, if any"""
+    return next((flt for flt in filters if 'police' in flt and flt['protocol'] == ETH_P_ALL), None)
+
+
+def root_qdisc(qdiscs):
+    return next((q for q in qdiscs if q['parent'] == 'root'), None)
+
+
+def leaf_qdiscs(qdiscs):
+    """{classid: qdisc} for the fq_codel/cake queues below HTB classes"""
+    return {q['parent']: q for q in qdiscs
+            if q['kind'] in LEAF_QUEUES and q['parent'] not in ('root', 'ingress')}
+
+
+def is_cake_shaper(qdisc):
+    return qdisc is not None and qdisc['kind'] == 'cake' and qdisc['handle'] == ROOT_HANDLE
+
+
+def installed_rules(nodes):
+    """{rule key: [(handle, classid)]} for the terminal u32 nodes installed"""
+    leaves = {}
+    for node in nodes:
+        if 'classid' in node:
+            key = rl.leaf_key(node['handle'], node.get('keys'))
+            if key is not None:
+                leaves.setdefault(key, []).append((node['handle'], node['classid']))
+    return leaves
+
+
+def tears_down(steps):
+    """Whether ``steps`` delete a root or ingress qdisc, leaving the link unshaped meanwhile"""
+    return any(step.method == 'delete_qdisc' and step.args[1] in ('root', 'ingress')
+               for step in steps)
+
+
+def format_plan(steps):
+    """Render a plan for dry-run output"""
+    if not steps:
+        return "Nothing to do - live state already matches the policy"
+    return '\n'.join(str(step) for step in steps)
+
+
+class Reconciler:
+    """Diffs and applies InterfacePolicy objects through a shaping backend"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def observe(self, interface):
+        """Build the policy that describes what is currently installed.
+
+        An interface already redirected to an IFB (such as the shared ``ifb0``
+        of older versions) keeps that device.
+        """
+        policy = InterfacePolicy(interface)
+        qdiscs = self.backend.get_qdiscs(interface)
+        policy.download_kbps, download, policy.queue = self._installed(interface, qdiscs)
+        upload = {}
+        filters = self._ingress_filters(interface, qdiscs)
+        target = redirect_target(filters)
+        if target:
+            policy.ifb = target
+            policy.upload_kbps, upload, queue = self._installed(target)
+            if policy.download_kbps is None and not download:
+                policy.queue = queue
+        elif police_filter(filters):
+            policy.ingress_mode = POLICE
+            policy.upload_kbps = police_filter(filters).get('police')
+        policy.rules = [Rule(rl.format_match(key), download.get(key), upload.get(key))
+                        for key in sorted(set(download) | set(upload))]
+        return policy
+
+    def plan(self, policy):
+        """Return the list of Steps needed to reach ``policy``"""
+        download, upload = rl.rule_limits(policy.rules)
+        if policy.queue == CAKE_SHAPER and policy.rules:
+            raise ValueError("Rules need HTB classes: use the fq_codel or cake queue instead")
+        if policy.ingress_mode == POLICE and upload:
+            raise ValueError("Upload rules need the IFB: use the ifb ingress mode instead")
+        return (self.plan_egress(policy.interface, policy.download_kbps, rules=download,
+                                 queue=policy.queue) +
+                self.plan_ingress(policy.interface, policy.upload_kbps, policy.ifb, rules=upload,
+                                  queue=policy.queue, mode=policy.ingress_mode))
+
+    def apply(self, policy, dry_run=False):
+        """Plan and (unless ``dry_run``) execute the changes; returns the plan.
+
+        If a plan that removes the root or ingress qdisc fails part way, the
+        shaping observed beforehand is put back before the error is raised,
+        so a failed switch never leaves the interface unlimited. If putting
+        it back fails too, RestoreError is raised instead, carrying both.
+        """
+        steps = self.plan(policy)
+        if not dry_run:
+            self._run(steps, self._restore_points({policy.interface: steps}))
+        return steps
+
+    def apply_batch(self, policies, dry_run=False):
+        """Plan every policy, then execute all the plans in one backend run.
+
+        With the netlink backend that is one batch of messages, with the
+        shell backend one "tc -batch", instead of one per interface. Returns
+        {interface: plan}, or the exception for an interface that failed. If
+        the combined run fails, each interface is re-planned and applied on
+        its own, so a failure only affects its own interface.
+        """
+        plans = {}
+        for policy in policies:
+            try:
+                plans[policy.interface] = self.plan(policy)
+            except Exception as e:
+                plans[policy.interface] = e
+        if dry_run:
+            return plans
+        previous = self._restore_points(plans)
+        try:
+            self.backend.run([step for plan in plans.values() if not isinstance(plan, Exception)
+                              for step in plan])
+        except Exception:
+            # Part of the batch may be in place; planning again picks up from there
+            for policy in policies:
+                if isinstance(plans[policy.interface], Exception):
+                    continue
+                restore = {name: old for name, old in previous.items() if name == policy.interface}
+                try:
+                    self._run(self.plan(policy), restore)
+                except Exception as e:
+                    plans[policy.interface] = e
+        return plans
+
+    def plan_egress(self, dev, rate_kbps, exists=True, rules=None, offset=rl.DST_OFFSET,
+                    queue=FIFO, ingress=False):
+        """Steps for the HTB tree and rule classifier on the root of ``dev``.
+
+        ``rules`` maps rule keys to their limit in this direction. ``ingress``
+        marks the IFB of an interface, where cake should account for drops.
+        """
+        rules = rules or {}
+        qdiscs = self.backend.get_qdiscs(dev) if exists else []
+        root = root_qdisc(qdiscs)
+        installed = root is not None and root['handle'] != '0:'
+        if rate_kbps is None and not rules:
+            return [_delete_qdisc_step(dev, 'root')] if installed else []
+
+        if queue == CAKE_SHAPER:
+            if is_cake_shaper(root):
+                if _same_rate(root.get('bandwidth'), rate_kbps):
+                    return []
+                return [Step(f"tc qdisc change dev {dev} root cake bandwidth {rate_kbps}kbit",
+                             'change_cake_qdisc', dev, 'root', rate_kbps)]
+            steps = [_delete_qdisc_step(dev, 'root')] if installed else []
+            return steps + [Step(f"tc qdisc add dev {dev} root handle {ROOT_HANDLE} cake "
+                                 f"bandwidth {rate_kbps}kbit {'ingress' if ingress else 'egress'}",
+                                 'add_cake_qdisc', dev, 'root', ROOT_HANDLE, rate_kbps, ingress)]
+
+        if not self._is_ours(root):
+            steps = [_delete_qdisc_step(dev, 'root')] if installed else []
+            return steps + self._build_tree(dev, rate_kbps, rules, offset, queue, ingress)
+
+        live = {cls['classid']: cls for cls in self.backend.get_classes(dev)}
+        nodes = self.backend.get_u32_nodes(dev, ROOT_HANDLE, rl.RULE_PRIO)
+        classids = self._assign_classes(rules, installed_rules(nodes), live)
+        desired = htb_classes(rate_kbps, {classids[key]: rate for key, rate in rules.items()})
+        steps = []
+        for classid, (parent, rate, ceil) in desired.items():
+            cls = live.get(classid)
+            if cls is None:
+                steps.append(_add_class_step(dev, classid, parent, rate, ceil))
+            elif cls['parent'] != parent:
+                steps = [_delete_qdisc_step(dev, 'root')]
+                return steps + self._build_tree(dev, rate_kbps, rules, offset, queue, ingress)
+            elif not (_same_rate(cls.get('rate'), rate) and _same_rate(cls.get('ceil'), ceil)):
+                steps.append(Step(f"tc class change dev {dev} parent {parent} classid {classid} "
+                                  f"htb rate {rate}kbit ceil {ceil}kbit",
+                                  'change_htb_class', dev, classid, parent, rate, ceil))
+        steps += self._plan_queues(dev, queue, desired, leaf_qdiscs(qdiscs), ingress)
+        steps += self._plan_filters(dev, offset, classids, nodes)
+        # Remove leftovers once no filter points at them, deepest-first so parents are empty
+        for classid in sorted(set(live) - set(desired), key=lambda c: live[c]['parent'] == ROOT_HANDLE):
+            steps.append(Step(f"tc class del dev {dev} classid {classid}",
+                              'delete_class', dev, classid))
+        return steps
+
+    def plan_ingress(self, dev, rate_kbps, ifb=None, rules=None, queue=FIFO, mode=IFB):
+        """Steps for the ingress filter on ``dev`` and, in IFB mode, the HTB tree on its IFB.
+
+        Anything but a single filter of the wanted kind for every protocol
+        (such as the IPv4-only redirect of older versions) is replaced.
+        """
+        ifb = ifb or ifb_name(dev)
+        qdiscs = self.backend.get_qdiscs(dev)
+        has_ingress = any(q['parent'] == 'ingress' for q in qdiscs)
+        filters = self._ingress_filters(dev, qdiscs)
+        ifb_state = self.backend.link_state(ifb)
+        # Removed last, so the redirect to it is gone first
+        unused_ifb = [Step(f"ip link del {ifb}", 'delete_link', ifb)] if ifb_state is not None else []
+
+        if rate_kbps is None and not rules:
+            return ([_delete_qdisc_step(dev, 'ingress')] if has_ingress else []) + unused_ifb
+
+        if mode == POLICE:
+            burst = police_burst(rate_kbps)
+            police = f"u32 match u32 0 0 action police rate {rate_kbps}kbit burst {burst} drop"
+            live = police_filter(filters)
+            if live is None or len(filters) != 1:
+                return self._replace_ingress(dev, has_ingress, filters, Step(
+                    f"tc filter add dev {dev} parent {INGRESS_HANDLE} protocol all {police}",
+                    'add_police_filter', dev, rate_kbps, burst)) + unused_ifb
+            if _same_rate(live['police'], rate_kbps):
+                return unused_ifb
+            return [Step(f"tc filter change dev {dev} parent {INGRESS_HANDLE} prio {live['prio']} "
+                         f"protocol all handle {format_u32_handle(live['handle'])} {police}",
+                         'change_police_filter', dev, live['prio'], live['handle'], rate_kbps,
+                         burst)] + unused_ifb
+
+        steps = []
+        if not ifb_state:
+            steps.append(Step(f"ip link add {ifb} type ifb; ip link set dev {ifb} up",
+                              'create_ifb', ifb))
+        # The IFB is shaped before traffic is redirected to it
+        steps += self.plan_egress(ifb, rate_kbps, exists=ifb_state is not None, rules=rules,
+                                  offset=rl.SRC_OFFSET, queue=queue, ingress=True)
+        if not (len(filters) == 1 and redirect_target(filters) == ifb and
+                filters[0]['protocol'] == ETH_P_ALL):
+            steps += self._replace_ingress(dev, has_ingress, filters, Step(
+                f"tc filter add dev {dev} parent {INGRESS_HANDLE} protocol all "
+                f"u32 match u32 0 0 flowid 1:1 action mirred egress redirect dev {ifb}",
+                'add_redirect_filter', dev, ifb))
+        return steps
+
+    def queue_stats(self, interface):
+        """Queue counters of the shaping on ``interface``: {'download': ..., 'upload': ...}.
+
+        Each is the ``stats`` of the root qdisc (its backlog and drops include
+        those of every leaf queue), or None when that direction is not shaped.
+        When upload is policed its drops are counted by the ingress qdisc.
+        """
+        qdiscs = self.backend.get_qdiscs(interface)
+        filters = self._ingress_filters(interface, qdiscs)
+        target = redirect_target(filters)
+        if target:
+            upload = self._root_stats(self.backend.get_qdiscs(target))
+        elif police_filter(filters):
+            upload = next(q for q in qdiscs if q['parent'] == 'ingress').get('stats')
+        else:
+            upload = None
+        return {'download': self._root_stats(qdiscs), 'upload': upload}
+
+    def tc_snapshot(self, interface):
+        """Every qdisc and class shaping ``interface``, with their counters.
+
+        {'download': ..., 'upload': ...}, each {'device', 'qdiscs', 'classes'}.
+        Upload is the tree of the IFB device, the ingress qdisc when policed,
+        or None when it is not shaped.
+        """
+        qdiscs = self.backend.get_qdiscs(interface)
+        filters = self._ingress_filters(interface, qdiscs)
+        target = redirect_target(filters)
+        if target:
+            upload = {'device': target, 'qdiscs': self.backend.get_qdiscs(target),
+                      'classes': self.backend.get_classes(target)}
+        elif police_filter(filters):
+            upload = {'device': interface, 'classes': [],
+                      'qdiscs': [q for q in qdiscs if q['parent'] == 'ingress']}
+        else:
+            upload = None
+        download = {'device': interface, 'classes': self.backend.get_classes(interface),
+                    'qdiscs': [q for q in qdiscs if q['parent'] != 'ingress']}
+        return {'download': download, 'upload': upload}
+
+    def _build_tree(self, dev, rate_kbps, rules=None, offset=rl.DST_OFFSET, queue=FIFO, ingress=False):
+        rules = rules or {}
+        steps = [Step(f"tc qdisc add dev {dev} root handle {ROOT_HANDLE} htb default {DEFAULT_CLASS:x}",
+                      'add_htb_qdisc', dev, ROOT_HANDLE, 'root', DEFAULT_CLASS)]
+        classids = self._assign_classes(rules, {}, {})
+        classes = htb_classes(rate_kbps, {classids[key]: rate for key, rate in rules.items()})
+        for classid, (parent, rate, ceil) in classes.items():
+            steps.append(_add_class_step(dev, classid, parent, rate, ceil))
+        steps += self._plan_queues(dev, queue, classes, {}, ingress)
+        return steps + self._plan_filters(dev, offset, classids, [])
+
+    def _plan_queues(self, dev, queue, classes, live, ingress):
+        """Steps giving every leaf class the ``queue`` discipline, tuned to its ceiling.
+
+        ``live`` holds the leaf qdiscs installed now (see leaf_qdiscs).
+        """
+        wanted = queue if queue in LEAF_QUEUES else None
+        steps = []
+        for classid, (_, _, ceil) in classes.items():
+            if classid == ROOT_CLASS:
+                continue
+            qdisc = live.get(classid)
+            if qdisc is not None and qdisc['kind'] != wanted:
+                steps.append(Step(f"tc qdisc del dev {dev} parent {classid}",
+                                  'delete_qdisc', dev, classid))
+                qdisc = None
+            where = f"dev {dev} parent {classid} {wanted}"
+            if wanted == 'fq_codel':
+                target, interval = codel_params(ceil)
+                timing = f"target {target}us interval {interval}us"
+                if qdisc is None:
+                    flows = None if classid == DEFAULT_LEAF else RULE_QUEUE_FLOWS
+                    if flows:
+                        timing += f" flows {flows}"
+                    steps.append(Step(f"tc qdisc add {where} {timing}",
+                                      'add_fq_codel_qdisc', dev, classid, target, interval, flows))
+                elif not (_same_rate(qdisc.get('target'), target) and
+                          _same_rate(qdisc.get('interval'), interval)):
+                    steps.append(Step(f"tc qdisc change {where} {timing}",
+                                      'change_fq_codel_qdisc', dev, classid, target, interval))
+            elif wanted == 'cake':
+                # cake derives its target and interval from the bandwidth
+                if qdisc is None:
+                    steps.append(Step(f"tc qdisc add {where} bandwidth {ceil}kbit "
+                                      f"{'ingress' if ingress else 'egress'}",
+                                      'add_cake_qdisc', dev, classid, None, ceil, ingress))
+                elif not _same_rate(qdisc.get('bandwidth'), ceil):
+                    steps.append(Step(f"tc qdisc change {where} bandwidth {ceil}kbit",
+                                      'change_cake_qdisc', dev, classid, ceil))
+        return steps
+
+    def _assign_classes(self, rules, leaves, live_classes):
+        """{rule key: classid}, keeping the class of every rule already installed"""
+        classids = {}
+        for key in rules:
+            installed = {classid for _, classid in leaves.get(key, ())}
+            if len(installed) == 1:
+                classids[key] = installed.pop()
+        used = set(live_classes) | set(classids.values())
+        minor = RULE_CLASS_BASE
+        for key in rules:
+            if key in classids:
+                continue
+            while f"1:{minor:x}" in used:
+                minor += 1
+            if minor > 0xFFFF:
+                raise ValueError("Too many rules for one interface")
+            classids[key] = f"1:{minor:x}"
+            used.add(classids[key])
+        return classids
+
+    def _plan_filters(self, dev, offset, classids, nodes):
+        """Steps adding the u32 tables and nodes that classify ``classids``, then
+        removing everything else installed at the rule priority"""
+        tables = {}
+        links = {}
+        wanted = {}
+        for key, classid in classids.items():
+            key_tables, key_links, leaves = rl.layout(key, offset)
+            tables.update(key_tables)
+            links.update(key_links)
+            for htid, bucket, keys in leaves:
+                wanted[(htid, bucket, keys)] = classid
+
+        live_tables = {node['handle'] >> 20: node['divisor'] for node in nodes if 'divisor' in node}
+        live_links = {node['handle']: node['link'] for node in nodes if 'link' in node}
+        adds = []
+        deletes = []
+        for htid, divisor in sorted(tables.items()):
+            if htid not in live_tables:
+                adds.append(_add_table_step(dev, htid, divisor))
+        for handle, (link, keys, hashkey, eat) in sorted(links.items()):
+            if live_links.get(handle) != link:
+                if handle in live_links:
+                    adds.append(_delete_node_step(dev, handle))
+                adds.append(_add_node_step(dev, handle, keys, link=link, hashkey=hashkey, eat=eat))
+
+        # Terminal nodes: keep matching ones, remove the rest, add what is missing
+        used = {}
+        for node in nodes:
+            if 'classid' not in node:
+                continue
+            handle = node['handle']
+            used.setdefault(handle >> 12, set()).add(handle & 0xFFF)
+            location = (handle >> 20, (handle >> 12) & 0xFF, tuple(node.get('keys', ())))
+            if wanted.get(location) == node['classid']:
+                del wanted[location]
+            else:
+                deletes.append(_delete_node_step(dev, handle))
+        for (htid, bucket, keys), classid in wanted.items():
+            ids = used.setdefault((htid << 8) | bucket, set())
+            node = max(ids, default=0) + 1
+            if node > 0xFFF:
+                node = min(set(range(1, 0x1000)) - ids)
+            ids.add(node)
+            adds.append(_add_node_step(dev, u32_handle(htid, bucket, node), keys, flowid=classid))
+
+        for handle in sorted(set(live_links) - set(links)):
+            deletes.append(_delete_node_step(dev, handle))
+        # The kernel drops a link's hold on its table asynchronously, so only tables
+        # that were already unlinked go now; the rest are collected by the next apply
+        linked = set(live_links.values())
+        for htid in sorted(set(live_tables) - set(tables) - linked - {rl.ROOT_TABLE}):
+            deletes.append(_delete_node_step(dev, u32_handle(htid)))
+        return adds + deletes
+
+    def _is_ours(self, qdisc):
+        return (qdisc is not None and qdisc['kind'] == 'htb' and
+                qdisc['handle'] == ROOT_HANDLE and qdisc.get('default') == DEFAULT_CLASS)
+
+    def _installed(self, dev, qdiscs=None):
+        """(interface limit, {rule key: limit}, queue) installed on the root of ``dev``"""
+        qdiscs = self.backend.get_qdiscs(dev) if qdiscs is None else qdiscs
+        root = root_qdisc(qdiscs)
+        if is_cake_shaper(root):
+            return root.get('bandwidth'), {}, CAKE_SHAPER
+        if not self._is_ours(root):
+            return None, {}, FIFO
+        ceilings = {cls['classid']: cls.get('ceil') for cls in self.backend.get_classes(dev)}
+        limit = ceilings.get(ROOT_CLASS)
+        if limit is not None and limit >= UNLIMITED_KBPS * (1 - RATE_TOLERANCE):
+            limit = None
+        rules = {}
+        for key, leaves in installed_rules(self.backend.get_u32_nodes(
+                dev, ROOT_HANDLE, rl.RULE_PRIO)).items():
+            rules[key] = ceilings.get(leaves[0][1])
+        leaf = leaf_qdiscs(qdiscs).get(DEFAULT_LEAF)
+        return limit, rules, leaf['kind'] if leaf else FIFO
+
+    def _root_stats(self, qdiscs):
+        root = root_qdisc(qdiscs)
+        return root.get('stats') if self._is_ours(root) or is_cake_shaper(root) else None
+
+    def _restore_points(self, plans):
+        """{interface: observed policy} for the ``plans`` that tear a qdisc down"""
+        return {interface: self.observe(interface) for interface, steps in plans.items()
+                if not isinstance(steps, Exception) and tears_down(steps)}
+
+    def _run(self, steps, previous):
+        """Execute ``steps``; on failure, reconcile back to the ``previous`` policies"""
+        try:
+            self.backend.run(steps)
+        except Exception as error:
+            failures = {}
+            for policy in previous.values():
+                try:
+                    self.backend.run(self.plan(policy))
+                except Exception as e:
+                    failures[policy.interface] = e
+            if not failures:
+                raise
+            details = '; '.join(f"could not restore the previous limits of {interface}: {e}"
+                                for interface, e in failures.items())
+            raise RestoreError(f"{error}; {details}", failures) from error
+
+    def _ingress_filters(self, dev, qdiscs):
+        if not any(q['parent'] == 'ingress' for q in qdiscs):
+            return []
+        return self.backend.get_filters(dev, INGRESS_HANDLE)
+
+    def _replace_ingress(self, dev, has_ingress, filters, filter_step):
+        """Steps swapping the ingress ``filters`` of ``dev`` for ``filter_step``.
+
+        The kernel gives a new filter a priority ahead of those installed, so
+        it takes over as soon as it is added; the old filters are deleted only
+        after that, and a failed add leaves the previous upload limit working.
+        """
+        steps = [] if has_ingress else [Step(f"tc qdisc add dev {dev} ingress",
+                                             'add_ingress_qdisc', dev)]
+        steps.append(filter_step)
+        for prio in sorted({flt['prio'] for flt in filters}):
+            steps.append(Step(f"tc filter del dev {dev} parent {INGRESS_HANDLE} prio {prio}",
+                              'delete_filter', dev, INGRESS_HANDLE, prio))
+        return steps
+
@@ -0,0 +1,141 @@
+"""Per-host, per-subnet and per-port limits classified through hashed u32 tables.
+
+Every rule gets its own HTB class under 1:1. Packets find that class through
+u32 hash tables instead of a linear filter chain, so classification takes a
+few lookups however many rules are installed:
+
+* hosts (/32): the root table jumps to a table hashed on the third octet of
+  the address, whose buckets jump to tables hashed on the fourth octet;
+* subnets: one table per prefix length, hashed on the last whole octet of
+  the prefix, tried longest prefix first;
+* ports: TCP and UDP packets (not later fragments) skip the IP header and are
+  looked up by the low byte of the destination port, then of the source port.
+
+On an interface's own root qdisc rules match the destination address (the
+host on the far side of the link); on its IFB they match the source. Only
+IPv4 is classified. This module only computes the layout; the reconciler
+turns it into tc changes.
+"""
+import ipaddress
+
+from .tc import u32_handle
+
+RULE_PRIO = 10
+ROOT_TABLE = 0x800
+HOST_TABLE = 0x1
+PORT_TABLE = 0x2
+DPORT_TABLE = 0x3
+SPORT_TABLE = 0x4
+# + prefix length (0-31)
+SUBNET_TABLES = 0x20
+# + third octet
+HOST_TABLES = 0x100
+
+# Node ids in the root table; lower ids are tried first
+HOST_LINK_NODE = 0x1
+SUBNET_LINK_NODE = 0x100
+PORT_LINK_NODE = 0x200
+
+DST_OFFSET = 16
+SRC_OFFSET = 12
+MATCH_ALL = (0, 0, 0)
+# Fragment offset zero: only first fragments carry ports
+FIRST_FRAGMENT = (0, 0x1FFF, 4)
+PROTOCOLS = (6, 17)
+
+
+def parse_match(text):
+    """Key of a rule match: ('net', address, prefixlen) or ('port', number).
+
+    Accepts an IPv4 address, a CIDR subnet or "port:N".
+    """
+    text = text.strip()
+    if text.lower().startswith('port'):
+        port = int(text[4:].lstrip(' :='))
+        if not 0 < port < 65536:
+            raise ValueError(f"Invalid port: {port}")
+        return ('port', port)
+    network = ipaddress.IPv4Network(text, strict=False)
+    return ('net', int(network.network_address), network.prefixlen)
+
+
+def format_match(key):
+    if key[0] == 'port':
+        return f"port:{key[1]}"
+    _, address, prefix = key
+    if prefix == 32:
+        return str(ipaddress.IPv4Address(address))
+    return str(ipaddress.IPv4Network((address, prefix)))
+
+
+def rule_limits(rules):
+    """({key: download_kbps}, {key: upload_kbps}) for a list of Rules"""
+    download = {}
+    upload = {}
+    for rule in rules:
+        key = parse_match(rule.match)
+        if rule.download_kbps:
+            download[key] = rule.download_kbps
+        if rule.upload_kbps:
+            upload[key] = rule.upload_kbps
+    return download, upload
+
+
+def layout(key, offset=DST_OFFSET):
+    """u32 objects that classify ``key`` with addresses at ``offset``.
+
+    Returns (tables, links, leaves): {htid: divisor},
+    {node handle: (linked htid, keys, hashkey, eat)} and
+    [(htid, bucket, keys)] for the terminal nodes.
+    """
+    if key[0] == 'port':
+        port = key[1]
+        tables = {PORT_TABLE: 1, DPORT_TABLE: 256, SPORT_TABLE: 256}
+        links = {
+            u32_handle(PORT_TABLE, 0, 1): (DPORT_TABLE, (MATCH_ALL,), (0x000000FF, 0), False),
+            u32_handle(PORT_TABLE, 0, 2): (SPORT_TABLE, (MATCH_ALL,), (0x00FF0000, 0), False),
+        }
+        for node, protocol in enumerate(PROTOCOLS, PORT_LINK_NODE):
+            keys = ((protocol << 16, 0x00FF0000, 8), FIRST_FRAGMENT)
+            links[u32_handle(ROOT_TABLE, 0, node)] = (PORT_TABLE, keys, (0, 0), True)
+        leaves = [(DPORT_TABLE, port & 0xFF, ((port, 0xFFFF, 0),)),
+                  (SPORT_TABLE, port & 0xFF, ((port << 16, 0xFFFF0000, 0),))]
+        return tables, links, leaves
+
+    _, address, prefix = key
+    if prefix == 32:
+        third = (address >> 8) & 0xFF
+        tables = {HOST_TABLE: 256, HOST_TABLES + third: 256}
+        links = {
+            u32_handle(ROOT_TABLE, 0, HOST_LINK_NODE): (HOST_TABLE, (MATCH_ALL,), (0xFF00, offset), False),
+            u32_handle(HOST_TABLE, third, 1): (HOST_TABLES + third, (MATCH_ALL,), (0xFF, offset), False),
+        }
+        return tables, links, [(HOST_TABLES + third, address & 0xFF, ((address, 0xFFFFFFFF, offset),))]
+
+    htid = SUBNET_TABLES + prefix
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    if prefix >= 8:
+        # Hash on the last octet that lies wholly inside the prefix
+        shift = 8 * (4 - prefix // 8)
+        hashkey, bucket, divisor = (0xFF << shift, offset), (address >> shift) & 0xFF, 256
+    else:
+        hashkey, bucket, divisor = (0, offset), 0, 1
+    links = {u32_handle(ROOT_TABLE, 0, SUBNET_LINK_NODE + 32 - prefix): (htid, (MATCH_ALL,), hashkey, False)}
+    return {htid: divisor}, links, [(htid, bucket, ((address & mask, mask, offset),))]
+
+
+def leaf_key(handle, keys):
+    """The rule key a terminal node installed by ``layout`` classifies, or None"""
+    if not keys:
+        return None
+    htid = handle >> 20
+    value = keys[0][0]
+    if HOST_TABLES <= htid < HOST_TABLES + 256:
+        return ('net', value, 32)
+    if SUBNET_TABLES <= htid < SUBNET_TABLES + 32:
+        return ('net', value, htid - SUBNET_TABLES)
+    if htid == DPORT_TABLE:
+        return ('port', value & 0xFFFF)
+    if htid == SPORT_TABLE:
+        return ('port', value >> 16)
+    return None
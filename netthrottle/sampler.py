@@ -0,0 +1,283 @@
+"""Low-overhead interface throughput sampling.
+
+On Linux the per-interface ``statistics/rx_bytes`` and ``tx_bytes`` sysfs
+files are opened once and re-read with ``preadv`` into preallocated buffers,
+so a sample costs two syscalls per interface instead of parsing all of
+``/proc/net/dev``. Other platforms fall back to psutil.
+
+Every reading is timestamped with ``time.monotonic_ns()`` and rates are
+computed from the real elapsed time, so a late wakeup under load changes the
+sample spacing but not the accuracy of the rate.
+"""
+import math
+import os
+import threading
+import time
+from array import array
+
+SYSFS_NET = '/sys/class/net'
+FIELDS = ('rx_bytes', 'tx_bytes')
+# A u64 counter is at most 20 digits plus the newline
+BUFFER_SIZE = 32
+# Ten minutes of history at the default 100ms interval
+RING_CAPACITY = 6000
+EWMA_HALFLIFE = 2.0
+PERCENTILES = (50, 95, 99)
+
+
+def ticks(interval, stop):
+    """Yield once per ``interval`` seconds until ``stop`` is set.
+
+    Deadlines are absolute on the monotonic clock, so time spent by the
+    caller does not accumulate as drift. Deadlines that were missed entirely
+    are skipped rather than delivered in a burst.
+    """
+    step = max(1, int(interval * 1e9))
+    deadline = time.monotonic_ns()
+    while True:
+        deadline += step
+        now = time.monotonic_ns()
+        if deadline <= now:
+            deadline += ((now - deadline) // step + 1) * step
+        if stop.wait((deadline - now) / 1e9):
+            return
+        yield
+
+
+def percentile(ordered, p):
+    """Linearly interpolated percentile of an already sorted sequence"""
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values):
+    """min/max/percentiles of a list of rates"""
+    if not values:
+        return {'samples': 0, 'min': None, 'max': None,
+                **{f'p{p}': None for p in PERCENTILES}}
+    values.sort()
+    summary = {'samples': len(values), 'min': values[0], 'max': values[-1]}
+    for p in PERCENTILES:
+        summary[f'p{p}'] = percentile(values, p)
+    return summary
+
+
+class RateRing:
+    """Fixed-size ring of (timestamp_ns, rx_rate, tx_rate) samples with EWMAs"""
+
+    def __init__(self, capacity=RING_CAPACITY, halflife=EWMA_HALFLIFE):
+        self.capacity = capacity
+        self.halflife = halflife
+        self.times = array('q', bytes(8 * capacity))
+        self.rx = array('d', bytes(8 * capacity))
+        self.tx = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+        self.rx_ewma = None
+        self.tx_ewma = None
+
+    def append(self, timestamp_ns, rx, tx):
+        if self.count:
+            # Time-aware smoothing: a sample's weight depends on how long it covers
+            last = self.times[self.head - 1]
+            elapsed = (timestamp_ns - last) / 1e9
+            alpha = 1 - math.exp(-math.log(2) * elapsed / self.halflife) if self.halflife else 1
+            self.rx_ewma += alpha * (rx - self.rx_ewma)
+            self.tx_ewma += alpha * (tx - self.tx_ewma)
+        else:
+            self.rx_ewma = rx
+            self.tx_ewma = tx
+        self.times[self.head] = timestamp_ns
+        self.rx[self.head] = rx
+        self.tx[self.head] = tx
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def latest(self):
+        """The newest (timestamp_ns, rx, tx), or None when empty"""
+        if not self.count:
+            return None
+        i = self.head - 1
+        return self.times[i], self.rx[i], self.tx[i]
+
+    def window(self, seconds=None):
+        """(rx_rates, tx_rates) for the last ``seconds`` (everything if None)"""
+        rx = []
+        tx = []
+        if not self.count:
+            return rx, tx
+        newest = self.times[self.head - 1]
+        since = newest - int(seconds * 1e9) if seconds is not None else None
+        for n in range(1, self.count + 1):
+            i = self.head - n
+            if since is not None and self.times[i] < since:
+                break
+            rx.append(self.rx[i])
+            tx.append(self.tx[i])
+        return rx, tx
+
+    def stats(self, seconds=None):
+        """Current rate, EWMA, min/max and percentiles per direction in bytes/sec"""
+        latest = self.latest()
+        rx, tx = self.window(seconds)
+        rx_stats = summarize(rx)
+        tx_stats = summarize(tx)
+        rx_stats['rate'] = latest[1] if latest else None
+        tx_stats['rate'] = latest[2] if latest else None
+        rx_stats['ewma'] = self.rx_ewma
+        tx_stats['ewma'] = self.tx_ewma
+        return {'rx': rx_stats, 'tx': tx_stats}
+
+
+class SysfsCounters:
+    """One interface's counters, kept open for repeated reads"""
+
+    def __init__(self, interface, fields=FIELDS):
+        self.interface = interface
+        self.fds = []
+        try:
+            for field in fields:
+                path = os.path.join(SYSFS_NET, interface, 'statistics', field)
+                self.fds.append(os.open(path, os.O_RDONLY | os.O_CLOEXEC))
+        except OSError:
+            self.close()
+            raise
+        self.buffers = [bytearray(BUFFER_SIZE) for _ in fields]
+        self.vectors = [[buffer] for buffer in self.buffers]
+        self.reads = list(zip(self.fds, self.buffers, self.vectors))
+
+    def read(self):
+        """Return the counters in ``fields`` order; raises OSError if the interface went away"""
+        # sysfs regenerates the value on every read at offset 0
+        return [int(buffer[:os.preadv(fd, vector, 0)]) for fd, buffer, vector in self.reads]
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+class PsutilCounters:
+    """Fallback for platforms without sysfs"""
+
+    NAMES = {'rx_bytes': 'bytes_recv', 'tx_bytes': 'bytes_sent',
+             'rx_packets': 'packets_recv', 'tx_packets': 'packets_sent'}
+
+    def __init__(self, interface, fields=FIELDS):
+        import psutil
+
+        self.interface = interface
+        self.psutil = psutil
+        self.names = [self.NAMES[field] for field in fields]
+        self.read()
+
+    def read(self):
+        stat = self.psutil.net_io_counters(pernic=True).get(self.interface)
+        if stat is None:
+            raise OSError(f"Interface {self.interface} not found in statistics")
+        return [getattr(stat, name) for name in self.names]
+
+    def close(self):
+        pass
+
+
+def open_counters(interface, fields=FIELDS):
+    """Open the cheapest available counter source for ``interface``"""
+    if os.path.isdir(SYSFS_NET):
+        return SysfsCounters(interface, fields)
+    return PsutilCounters(interface, fields)
+
+
+class Sampler:
+    """Turns counter readings for a set of interfaces into byte rates"""
+
+    def __init__(self, interfaces=(), interval=0.1, capacity=RING_CAPACITY,
+                 halflife=EWMA_HALFLIFE):
+        self.interval = interval
+        self.capacity = capacity
+        self.halflife = halflife
+        self.counters = {}
+        self.last = {}
+        self.rings = {}
+        self.lock = threading.Lock()
+        self.set_interfaces(interfaces)
+
+    def set_interfaces(self, interfaces):
+        """Sample exactly ``interfaces`` from now on"""
+        interfaces = list(interfaces)
+        for name in list(self.counters):
+            if name not in interfaces:
+                self._drop(name)
+        for name in interfaces:
+            self.counters.setdefault(name, None)
+            if name not in self.rings:
+                self.rings[name] = RateRing(self.capacity, self.halflife)
+
+    def _drop(self, name):
+        counters = self.counters.pop(name, None)
+        if counters:
+            counters.close()
+        self.last.pop(name, None)
+        self.rings.pop(name, None)
+
+    def close(self):
+        for name in list(self.counters):
+            self._drop(name)
+
+    def poll(self):
+        """Read every interface once.
+
+        Returns {interface: (rx_bytes_per_sec, tx_bytes_per_sec)} for the
+        interfaces that have a previous reading. Interfaces that cannot be
+        read are reopened on the next poll.
+        """
+        rates = {}
+        for name, counters in self.counters.items():
+            try:
+                if counters is None:
+                    counters = self.counters[name] = open_counters(name)
+                rx, tx = counters.read()
+            except OSError:
+                if counters is not None:
+                    counters.close()
+                    self.counters[name] = None
+                self.last.pop(name, None)
+                continue
+            now = time.monotonic_ns()
+            last = self.last.get(name)
+            self.last[name] = (now, rx, tx)
+            if last is None:
+                continue
+            elapsed = (now - last[0]) / 1e9
+            rx_delta = rx - last[1]
+            tx_delta = tx - last[2]
+            # A counter going backwards means the device was reset
+            if elapsed > 0 and rx_delta >= 0 and tx_delta >= 0:
+                rates[name] = (rx_delta / elapsed, tx_delta / elapsed)
+                with self.lock:
+                    self.rings[name].append(now, *rates[name])
+        return rates
+
+    def stats(self, interface, window=None):
+        """RateRing.stats for ``interface`` over the last ``window`` seconds"""
+        with self.lock:
+            ring = self.rings.get(interface)
+            return ring.stats(window) if ring else None
+
+    def run(self, callback, stop):
+        """Call ``callback(rates)`` every interval until ``stop`` is set"""
+        self.poll()
+        for _ in ticks(self.interval, stop):
+            rates = self.poll()
+            if rates:
+                callback(rates)
+
+    def start(self, callback):
+        """Run on a daemon thread; returns the Event that stops it"""
+        stop = threading.Event()
+        threading.Thread(target=self.run, args=(callback, stop), daemon=True).start()
+        return stop
@@ -0,0 +1,107 @@
+"""Crash-safe journal of the shaping policies in force, restored at boot.
+
+Every change made through ThrottleCore is recorded in ``policies.json`` in
+the state directory (see paths.state_dir). The file is replaced atomically:
+written to a temporary file, fsynced, renamed over the old one and the
+directory fsynced. After a crash or a power cut it holds the old or the new
+policies, never a torn mix. A lock file serialises the read-modify-write of
+processes sharing the directory (the GUI, the daemon and the command line).
+
+``netthrottle restore`` re-applies every journaled interface in one batch,
+see ThrottleCore.restore_state.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict
+
+from .fsutil import write_atomic
+from .paths import state_dir
+from .policy import InterfacePolicy, Rule
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STATE_FILE = 'policies.json'
+LOCK_FILE = 'policies.lock'
+VERSION = 1
+
+
+def is_unshaped(policy):
+    return not (policy.download_kbps or policy.upload_kbps or policy.rules)
+
+
+def policy_from_dict(entry):
+    entry = dict(entry)
+    entry['rules'] = [Rule(**rule) for rule in entry.get('rules', ())]
+    return InterfacePolicy(**entry)
+
+
+class StateJournal:
+    """The last policy applied to every shaped interface, kept on disk"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or state_dir()
+        self.path = os.path.join(self.directory, STATE_FILE)
+        self.lock = threading.Lock()
+
+    def load(self):
+        """{interface: InterfacePolicy}; empty when nothing has been journaled.
+
+        Raises ValueError when the file is not a journal.
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            raise ValueError(f"{self.path}: {e}")
+        try:
+            return {entry['interface']: policy_from_dict(entry) for entry in data['policies']}
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"{self.path} is not a policy journal: {e}")
+
+    def record(self, policies):
+        """Journal the policies now in force; an interface left unshaped is dropped.
+
+        Returns whether the file changed. An unreadable journal is replaced.
+        """
+        with self.lock, self._locked():
+            try:
+                current = {name: asdict(policy) for name, policy in self.load().items()}
+            except ValueError:
+                current = {}
+            updated = dict(current)
+            for policy in policies:
+                if is_unshaped(policy):
+                    updated.pop(policy.interface, None)
+                else:
+                    updated[policy.interface] = asdict(policy)
+            if updated == current:
+                return False
+            write_atomic(self.path, json.dumps({
+                'version': VERSION,
+                'saved': time.time(),
+                'policies': [updated[name] for name in sorted(updated)],
+            }, indent=2).encode())
+            return True
+
+    @contextmanager
+    def _locked(self):
+        """Hold the journal's lock file, excluding other processes"""
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+                     0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
@@ -0,0 +1,458 @@
+"""Encoders and decoders for the traffic-control objects NetThrottle manages"""
+import socket
+import struct
+
+from .netlink import TCMSG, attr, attr_str, attr_string, attr_u32, attr_u64, nested, parse_attrs
+
+TC_H_ROOT = 0xFFFFFFFF
+TC_H_INGRESS = 0xFFFFFFF1
+INGRESS_HANDLE = 0xFFFF0000
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_STATS2 = 7
+TCA_STATS_BASIC = 1
+TCA_STATS_QUEUE = 3
+TCA_STATS_APP = 4
+
+# HTB
+TCA_HTB_PARMS = 1
+TCA_HTB_INIT = 2
+TCA_HTB_RATE64 = 6
+TCA_HTB_CEIL64 = 7
+HTB_VERSION = 3
+HTB_RATE2QUANTUM = 10
+# The kernel clamps rate/r2q to this range (logging a warning per class)
+HTB_MIN_QUANTUM = 1000
+HTB_MAX_QUANTUM = 200000
+TC_LINKLAYER_ETHERNET = 1
+
+# fq_codel
+TCA_FQ_CODEL_TARGET = 1
+TCA_FQ_CODEL_INTERVAL = 3
+TCA_FQ_CODEL_FLOWS = 5
+# CoDel's defaults, and the packet size whose serialization time bounds the target
+CODEL_TARGET_US = 5000
+CODEL_INTERVAL_US = 100000
+CODEL_MTU = 1514
+
+# cake
+TCA_CAKE_BASE_RATE64 = 2
+TCA_CAKE_INGRESS = 15
+
+# u32 classifier
+TCA_U32_CLASSID = 1
+TCA_U32_HASH = 2
+TCA_U32_LINK = 3
+TCA_U32_DIVISOR = 4
+TCA_U32_SEL = 5
+TCA_U32_ACT = 7
+TC_U32_TERMINAL = 1
+TC_U32_VAROFFSET = 4
+TC_U32_EAT = 8
+U32_ROOT_TABLE = 0x800
+
+# Actions
+TCA_ACT_KIND = 1
+TCA_ACT_OPTIONS = 2
+TCA_MIRRED_PARMS = 2
+TCA_EGRESS_REDIR = 1
+TC_ACT_SHOT = 2
+TC_ACT_STOLEN = 4
+TCA_POLICE_TBF = 1
+TCA_POLICE_RATE = 2
+TCA_POLICE_RATE64 = 8
+# tc's default MTU for police rate tables; it sets their cell size
+POLICE_MTU = 2047
+RTAB_CELLS = 256
+# Police bucket: this long at the policed rate, but never less than a few packets
+POLICE_BURST_US = 20000
+POLICE_MIN_BURST = 10 * 1514
+
+MTU = 1600
+TIME_UNITS_PER_SEC = 1000000
+
+RATESPEC = struct.Struct('=BBHhHI')
+HTB_GLOB = struct.Struct('=IIIII')
+HTB_OPT = struct.Struct('=12s12sIIIII')
+U32_SEL = struct.Struct('=BBBxHHhhI')
+MIRRED = struct.Struct('=IIiiiiI')
+POLICE = struct.Struct('=IiIII12s12siiI')
+STATS_BASIC = struct.Struct('=QI')
+STATS_QUEUE = struct.Struct('=IIIII')
+# Discipline-specific counters (TCA_STATS_APP), named as in "tc -s" output
+HTB_XSTATS = struct.Struct('=IIIii')
+HTB_XSTATS_FIELDS = ('lended', 'borrowed', 'giants', 'tokens', 'ctokens')
+FQ_CODEL_XSTATS = struct.Struct('=IIIIIII')
+FQ_CODEL_XSTATS_FIELDS = ('maxpacket', 'drop_overlimit', 'ecn_mark', 'new_flow_count',
+                          'new_flows_len', 'old_flows_len')
+TCA_FQ_CODEL_XSTATS_QDISC = 0
+
+
+def _read_psched():
+    """Return (tick_in_usec, hz) the same way iproute2 derives them"""
+    try:
+        with open('/proc/net/psched') as f:
+            t2us, us2t, clock_res, hz = (int(field, 16) for field in f.read().split()[:4])
+    except (OSError, ValueError):
+        return 15.625, 1000
+    if clock_res == 1000000000:
+        t2us = us2t
+    tick_in_usec = t2us / us2t * (clock_res / TIME_UNITS_PER_SEC)
+    return tick_in_usec, (hz if clock_res == 1000000 else 1000)
+
+
+TICK_IN_USEC, HZ = _read_psched()
+
+
+def parse_handle(value):
+    """Convert a tc handle such as "1:10", "ffff:" or "root" to its integer form"""
+    if isinstance(value, int):
+        return value
+    if value == 'root':
+        return TC_H_ROOT
+    if value == 'ingress':
+        return TC_H_INGRESS
+    major, _, minor = value.partition(':')
+    return (int(major or '0', 16) << 16) | int(minor or '0', 16)
+
+
+def format_handle(value):
+    """Convert an integer handle back to tc's "major:minor" notation"""
+    if value == TC_H_ROOT:
+        return 'root'
+    if value == TC_H_INGRESS:
+        return 'ingress'
+    major, minor = value >> 16, value & 0xFFFF
+    return f"{major:x}:{minor:x}" if minor else f"{major:x}:"
+
+
+def kbit_to_bytes(rate_kbps):
+    """tc's "kbit" is 1000 bits per second"""
+    return int(rate_kbps) * 1000 // 8
+
+
+def xmit_ticks(rate_bytes, size):
+    """Time needed to send ``size`` bytes at ``rate_bytes``, in psched ticks"""
+    return int(TIME_UNITS_PER_SEC * size / rate_bytes * TICK_IN_USEC)
+
+
+def ratespec(rate_bytes, cell_log=0):
+    """Pack a struct tc_ratespec, clamping to the 32-bit field"""
+    return RATESPEC.pack(cell_log, TC_LINKLAYER_ETHERNET, 0, -1, 0, min(rate_bytes, 0xFFFFFFFF))
+
+
+def rate_table(rate_bytes, mtu=POLICE_MTU):
+    """(cell_log, table) of transmit times per packet size, as tc_calc_rtable builds it"""
+    cell_log = 0
+    while (mtu >> cell_log) >= RTAB_CELLS:
+        cell_log += 1
+    times = (min(xmit_ticks(rate_bytes, (cell + 1) << cell_log), 0xFFFFFFFF)
+             for cell in range(RTAB_CELLS))
+    return cell_log, struct.pack(f'={RTAB_CELLS}I', *times)
+
+
+def htb_qdisc_options(default_class):
+    """TCA_OPTIONS for an HTB root qdisc"""
+    glob = HTB_GLOB.pack(HTB_VERSION, HTB_RATE2QUANTUM, default_class, 0, 0)
+    return nested(TCA_OPTIONS, attr(TCA_HTB_INIT, glob))
+
+
+def htb_quantum(rate_kbps):
+    """Bytes a class may send per round, as the kernel would derive it but without the warning"""
+    return min(max(kbit_to_bytes(rate_kbps) // HTB_RATE2QUANTUM, HTB_MIN_QUANTUM), HTB_MAX_QUANTUM)
+
+
+def htb_class_options(rate_kbps, ceil_kbps=None):
+    """TCA_OPTIONS for an HTB class, with tc's default burst sizing"""
+    rate = kbit_to_bytes(rate_kbps)
+    ceil = kbit_to_bytes(ceil_kbps or rate_kbps)
+    buffer = xmit_ticks(rate, rate // HZ + MTU)
+    cbuffer = xmit_ticks(ceil, ceil // HZ + MTU)
+    opt = HTB_OPT.pack(ratespec(rate), ratespec(ceil), buffer, cbuffer, htb_quantum(rate_kbps), 0, 0)
+    attrs = [attr(TCA_HTB_PARMS, opt)]
+    if rate > 0xFFFFFFFF:
+        attrs.append(attr_u64(TCA_HTB_RATE64, rate))
+    if ceil > 0xFFFFFFFF:
+        attrs.append(attr_u64(TCA_HTB_CEIL64, ceil))
+    return nested(TCA_OPTIONS, *attrs)
+
+
+def codel_params(rate_kbps):
+    """(target, interval) in microseconds for a CoDel queue drained at ``rate_kbps``.
+
+    Below a few Mbit/s one full-size packet takes longer than the default 5ms
+    target to send, so the target is raised to 1.5 packet times and the
+    interval grows by the same amount.
+    """
+    target = max(CODEL_TARGET_US, -(-CODEL_MTU * 8 * 1500 // max(int(rate_kbps), 1)))
+    return target, CODEL_INTERVAL_US + target - CODEL_TARGET_US
+
+
+def fq_codel_options(target_us, interval_us, flows=None):
+    """TCA_OPTIONS for fq_codel; ``flows`` can only be set when the qdisc is created"""
+    attrs = [attr_u32(TCA_FQ_CODEL_TARGET, target_us), attr_u32(TCA_FQ_CODEL_INTERVAL, interval_us)]
+    if flows:
+        attrs.append(attr_u32(TCA_FQ_CODEL_FLOWS, flows))
+    return nested(TCA_OPTIONS, *attrs)
+
+
+def cake_options(bandwidth_kbps=None, ingress=None):
+    """TCA_OPTIONS for cake shaping at ``bandwidth_kbps`` (None: unlimited)"""
+    attrs = [attr_u64(TCA_CAKE_BASE_RATE64, kbit_to_bytes(bandwidth_kbps or 0))]
+    if ingress is not None:
+        attrs.append(attr_u32(TCA_CAKE_INGRESS, int(ingress)))
+    return nested(TCA_OPTIONS, *attrs)
+
+
+def police_burst(rate_kbps):
+    """Bucket size in bytes for policing at ``rate_kbps``"""
+    return max(POLICE_MIN_BURST, kbit_to_bytes(rate_kbps) * POLICE_BURST_US // TIME_UNITS_PER_SEC)
+
+
+def filter_info(prio, protocol):
+    """tcm_info for a filter: priority in the high half, protocol (network order) in the low"""
+    return (prio << 16) | socket.htons(protocol)
+
+
+def u32_key(mask, value, offset):
+    """Pack a struct tc_u32_key"""
+    return struct.pack('!II', mask, value) + struct.pack('=ii', offset, 0)
+
+
+def u32_handle(htid, bucket=0, node=0):
+    """Pack a u32 filter handle (hash table, bucket, node)"""
+    return (htid << 20) | (bucket << 12) | node
+
+
+def split_u32_handle(handle):
+    return handle >> 20, (handle >> 12) & 0xFF, handle & 0xFFF
+
+
+def format_u32_handle(handle):
+    """tc's "ht:bucket:node" notation for a u32 handle"""
+    htid, bucket, node = split_u32_handle(handle)
+    return f"{htid:x}:{bucket:x}:{node:x}" if node else f"{htid:x}:{bucket:x}:"
+
+
+def parse_u32_handle(text):
+    """Inverse of format_u32_handle ("3:bb:1", "800::", "2:")"""
+    htid, bucket, node = (text.split(':') + ['', ''])[:3]
+    return u32_handle(int(htid or '0', 16), int(bucket or '0', 16), int(node or '0', 16))
+
+
+def u32_selector(keys, flags=0, hashkey=(0, 0), eat=False):
+    """Pack a struct tc_u32_sel from (value, mask, offset) words.
+
+    ``hashkey`` is (mask, offset) of the word that picks the bucket in the
+    linked table; ``eat`` skips the IPv4 header (IHL * 4 bytes) so keys in
+    the linked table are relative to the transport header.
+    """
+    offshift, offmask = (6, 0x0F00) if eat else (0, 0)
+    if eat:
+        flags |= TC_U32_VAROFFSET | TC_U32_EAT
+    hmask, hoff = hashkey
+    # offmask and hmask are big-endian, the other fields host order
+    header = (struct.pack('=BBBx', flags, offshift, len(keys)) + struct.pack('!H', offmask) +
+              struct.pack('=Hhh', 0, 0, hoff) + struct.pack('!I', hmask))
+    return header + b''.join(u32_key(mask, value, offset) for value, mask, offset in keys)
+
+
+def u32_table_options(divisor):
+    """TCA_OPTIONS creating a u32 hash table with ``divisor`` buckets"""
+    return nested(TCA_OPTIONS, attr_u32(TCA_U32_DIVISOR, divisor))
+
+
+def u32_node_options(handle, keys, flowid=None, link=None, hashkey=(0, 0), eat=False):
+    """TCA_OPTIONS for a u32 node that either classifies (flowid) or jumps to table ``link``"""
+    attrs = [attr_u32(TCA_U32_HASH, handle & 0xFFFFF000)]
+    flags = 0
+    if flowid is not None:
+        attrs.append(attr_u32(TCA_U32_CLASSID, flowid))
+        flags = TC_U32_TERMINAL
+    if link is not None:
+        attrs.append(attr_u32(TCA_U32_LINK, u32_handle(link)))
+    attrs.append(attr(TCA_U32_SEL, u32_selector(keys, flags, hashkey, eat)))
+    return nested(TCA_OPTIONS, *attrs)
+
+
+def decode_u32_keys(sel):
+    """(value, mask, offset) words of a packed tc_u32_sel"""
+    nkeys = sel[2]
+    keys = []
+    for i in range(nkeys):
+        offset = U32_SEL.size + i * 16
+        mask, value = struct.unpack_from('!II', sel, offset)
+        keys.append((value, mask, struct.unpack_from('=i', sel, offset + 8)[0]))
+    return keys
+
+
+def mirred_redirect(target_ifindex):
+    """A single "mirred egress redirect" action table"""
+    parms = MIRRED.pack(0, 0, TC_ACT_STOLEN, 0, 0, TCA_EGRESS_REDIR, target_ifindex)
+    return nested(1, attr_str(TCA_ACT_KIND, 'mirred'),
+                  nested(TCA_ACT_OPTIONS, attr(TCA_MIRRED_PARMS, parms)))
+
+
+def police_action(rate_kbps, burst_bytes):
+    """A single "police rate R burst B drop" action table"""
+    rate = kbit_to_bytes(rate_kbps)
+    cell_log, table = rate_table(rate)
+    burst = min(xmit_ticks(rate, burst_bytes), 0xFFFFFFFF)
+    parms = POLICE.pack(0, TC_ACT_SHOT, 0, burst, 0, ratespec(rate, cell_log), bytes(12), 0, 0, 0)
+    options = [attr(TCA_POLICE_TBF, parms), attr(TCA_POLICE_RATE, table)]
+    if rate > 0xFFFFFFFF:
+        options.append(attr_u64(TCA_POLICE_RATE64, rate))
+    return nested(1, attr_str(TCA_ACT_KIND, 'police'), nested(TCA_ACT_OPTIONS, *options))
+
+
+def u32_match_all_options(actions, flowid=None):
+    """TCA_OPTIONS for "u32 match u32 0 0 [flowid X]" running the ``actions`` table"""
+    sel = U32_SEL.pack(TC_U32_TERMINAL, 0, 1, 0, 0, 0, 0, 0) + u32_key(0, 0, 0)
+    attrs = [] if flowid is None else [attr_u32(TCA_U32_CLASSID, flowid)]
+    return nested(TCA_OPTIONS, *attrs, attr(TCA_U32_SEL, sel), nested(TCA_U32_ACT, actions))
+
+
+def u32_redirect_options(target_ifindex, flowid):
+    """TCA_OPTIONS for "u32 match u32 0 0 flowid X action mirred egress redirect dev Y" """
+    return u32_match_all_options(mirred_redirect(target_ifindex), flowid)
+
+
+def rate_kbit(rate_bytes):
+    """Bytes per second to tc kbit"""
+    return rate_bytes * 8 // 1000
+
+
+def _ratespec_rate(packed):
+    return RATESPEC.unpack_from(packed)[5]
+
+
+def decode_header(payload):
+    """Split an RTM_*QDISC/TCLASS/TFILTER payload into (ifindex, handle, parent, info, attrs)"""
+    _, ifindex, handle, parent, info = TCMSG.unpack_from(payload)
+    return ifindex, handle, parent, info, parse_attrs(payload, TCMSG.size)
+
+
+def decode_qdisc(payload):
+    """Decode a qdisc message into the dict shape used by the reconciler"""
+    ifindex, handle, parent, _, attrs = decode_header(payload)
+    qdisc = {
+        'kind': attr_string(attrs.get(TCA_KIND, b'')),
+        'handle': format_handle(handle),
+        'parent': format_handle(parent),
+        'ifindex': ifindex,
+    }
+    options = parse_attrs(attrs.get(TCA_OPTIONS, b''))
+    if qdisc['kind'] == 'htb' and TCA_HTB_INIT in options:
+        qdisc['default'] = HTB_GLOB.unpack_from(options[TCA_HTB_INIT])[2]
+    elif qdisc['kind'] == 'fq_codel':
+        qdisc['target'] = _u32(options.get(TCA_FQ_CODEL_TARGET, b'\0' * 4))
+        qdisc['interval'] = _u32(options.get(TCA_FQ_CODEL_INTERVAL, b'\0' * 4))
+    elif qdisc['kind'] == 'cake':
+        qdisc['bandwidth'] = rate_kbit(_u64(options.get(TCA_CAKE_BASE_RATE64))) or None
+        qdisc['ingress'] = bool(_u32(options.get(TCA_CAKE_INGRESS, b'\0' * 4)))
+    if TCA_STATS2 in attrs:
+        xstats = fq_codel_xstats if qdisc['kind'] == 'fq_codel' else None
+        qdisc['stats'] = decode_stats(attrs[TCA_STATS2], xstats)
+    return qdisc
+
+
+def decode_stats(payload, xstats=None):
+    """Counters of a TCA_STATS2 attribute, named as in "tc -s -j" output.
+
+    ``xstats`` decodes the discipline's own counters, if it has any.
+    """
+    stats = parse_attrs(payload)
+    counters = {}
+    if TCA_STATS_BASIC in stats:
+        counters['bytes'], counters['packets'] = STATS_BASIC.unpack_from(stats[TCA_STATS_BASIC])
+    if TCA_STATS_QUEUE in stats:
+        (counters['qlen'], counters['backlog'], counters['drops'], counters['requeues'],
+         counters['overlimits']) = STATS_QUEUE.unpack_from(stats[TCA_STATS_QUEUE])
+    if xstats and TCA_STATS_APP in stats:
+        counters.update(xstats(stats[TCA_STATS_APP]))
+    return counters
+
+
+def htb_xstats(payload):
+    """Borrowing and token counters of an HTB class; negative tokens mean it is over its rate"""
+    if len(payload) < HTB_XSTATS.size:
+        return {}
+    return dict(zip(HTB_XSTATS_FIELDS, HTB_XSTATS.unpack_from(payload)))
+
+
+def fq_codel_xstats(payload):
+    if len(payload) < FQ_CODEL_XSTATS.size or _u32(payload[:4]) != TCA_FQ_CODEL_XSTATS_QDISC:
+        return {}
+    return dict(zip(FQ_CODEL_XSTATS_FIELDS, FQ_CODEL_XSTATS.unpack_from(payload)[1:]))
+
+
+def decode_class(payload):
+    """Decode a class message; HTB rates are reported in kbit"""
+    _, handle, parent, _, attrs = decode_header(payload)
+    if parent == TC_H_ROOT:
+        # Top-level classes are reported against the root; name their qdisc instead
+        parent = handle & 0xFFFF0000
+    cls = {
+        'kind': attr_string(attrs.get(TCA_KIND, b'')),
+        'classid': format_handle(handle),
+        'parent': format_handle(parent),
+    }
+    options = parse_attrs(attrs.get(TCA_OPTIONS, b''))
+    if cls['kind'] == 'htb' and TCA_HTB_PARMS in options:
+        rate, ceil = HTB_OPT.unpack_from(options[TCA_HTB_PARMS])[:2]
+        rate = _u64(options.get(TCA_HTB_RATE64)) or _ratespec_rate(rate)
+        ceil = _u64(options.get(TCA_HTB_CEIL64)) or _ratespec_rate(ceil)
+        cls['rate'] = rate_kbit(rate)
+        cls['ceil'] = rate_kbit(ceil)
+    if TCA_STATS2 in attrs:
+        cls['stats'] = decode_stats(attrs[TCA_STATS2], htb_xstats if cls['kind'] == 'htb' else None)
+    return cls
+
+
+def decode_filter(payload):
+    """Decode a filter message, resolving a mirred redirect target or police rate if present"""
+    _, handle, parent, info, attrs = decode_header(payload)
+    flt = {
+        'kind': attr_string(attrs.get(TCA_KIND, b'')),
+        'parent': format_handle(parent),
+        'prio': info >> 16,
+        'protocol': socket.ntohs(info & 0xFFFF),
+        'handle': handle,
+    }
+    options = parse_attrs(attrs.get(TCA_OPTIONS, b''))
+    if flt['kind'] == 'u32':
+        if TCA_U32_DIVISOR in options:
+            flt['divisor'] = _u32(options[TCA_U32_DIVISOR])
+        if TCA_U32_CLASSID in options:
+            flt['classid'] = format_handle(_u32(options[TCA_U32_CLASSID]))
+        if TCA_U32_LINK in options:
+            flt['link'] = _u32(options[TCA_U32_LINK]) >> 20
+        if TCA_U32_SEL in options:
+            flt['keys'] = decode_u32_keys(options[TCA_U32_SEL])
+    if flt['kind'] == 'u32' and TCA_U32_ACT in options:
+        for action in parse_attrs(options[TCA_U32_ACT]).values():
+            action = parse_attrs(action)
+            kind = attr_string(action.get(TCA_ACT_KIND, b''))
+            options = parse_attrs(action.get(TCA_ACT_OPTIONS, b''))
+            if kind == 'mirred' and TCA_MIRRED_PARMS in options:
+                try:
+                    flt['redirect'] = socket.if_indextoname(
+                        MIRRED.unpack_from(options[TCA_MIRRED_PARMS])[6])
+                except OSError:
+                    flt['redirect'] = None
+            elif kind == 'police' and TCA_POLICE_TBF in options:
+                rate = POLICE.unpack_from(options[TCA_POLICE_TBF])[5]
+                flt['police'] = rate_kbit(_u64(options.get(TCA_POLICE_RATE64)) or _ratespec_rate(rate))
+    return flt
+
+
+def _u32(payload):
+    return struct.unpack('=I', payload)[0]
+
+
+def _u64(payload):
+    return struct.unpack('=Q', payload)[0] if payload else 0
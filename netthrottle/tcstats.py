@@ -0,0 +1,97 @@
+"""Per-qdisc and per-class counters of the shaping, as rates.
+
+ThrottleCore.queue_stats only reports the root qdisc of each direction.
+``TcStats`` reads every qdisc and class on an interface and on the IFB
+device carrying its upload (as structured data from the backend: "tc -s -j"
+or netlink) and turns two readings into per-second rates, next to the rx/tx
+rates of the devices themselves.
+
+A class sending at its ceiling with overlimits going up and negative tokens
+is where a limit is being hit; the drops show which queue discards packets.
+"""
+import time
+
+# Counters that only go up, reported per second
+COUNTERS = ('bytes', 'packets', 'drops', 'overlimits', 'requeues')
+
+
+def _rates(stats, previous, elapsed, keys=COUNTERS):
+    """Per-second rates of ``stats`` since ``previous``; None where a counter went back"""
+    rates = {}
+    for key in keys:
+        if key in stats and key in previous and elapsed > 0:
+            delta = stats[key] - previous[key]
+            rates[key] = delta / elapsed if delta >= 0 else None
+    return rates
+
+
+class TcStats:
+    """Rates of the tc counters of shaped interfaces between successive polls"""
+
+    def __init__(self, core):
+        self.core = core
+        self.previous = {}
+        self.counters = {}
+
+    def close(self):
+        for counters in self.counters.values():
+            counters.close()
+        self.counters.clear()
+
+    def _link(self, device):
+        """(rx, tx) byte counters of ``device``, or None"""
+        from .sampler import open_counters
+
+        try:
+            if device not in self.counters:
+                self.counters[device] = open_counters(device)
+            return self.counters[device].read()
+        except Exception:
+            counters = self.counters.pop(device, None)
+            if counters:
+                counters.close()
+            return None
+
+    def poll(self, interface):
+        """Counters and rates of every qdisc and class shaping ``interface``.
+
+        Returns {'interface', 'time', 'elapsed', 'download', 'upload'}; each
+        direction is None when it is not shaped, or
+        {'device', 'link', 'qdiscs', 'classes'}. ``link`` has the rx/tx rates
+        of the device in bytes/s; every qdisc and class keeps its ``stats``
+        and gains ``rates``, and classes with a ceiling their ``utilisation``.
+        Rates are empty on the first poll of an interface.
+        """
+        snapshot = self.core.tc_snapshot(interface)
+        now = time.monotonic()
+        last_time, last = self.previous.get(interface, (None, {}))
+        elapsed = now - last_time if last_time is not None else 0.0
+        current = {}
+        result = {'interface': interface, 'time': time.time(),
+                  'elapsed': elapsed or None}
+        for direction, tree in snapshot.items():
+            if tree is None:
+                result[direction] = None
+                continue
+            device = tree['device']
+            link = self._link(device)
+            link = current[(device, 'link')] = dict(zip(('rx', 'tx'), link)) if link else {}
+            result[direction] = {
+                'device': device,
+                'link': _rates(link, last.get((device, 'link'), {}), elapsed, ('rx', 'tx')),
+                'qdiscs': [self._entry(current, last, elapsed, device, 'qdisc', 'handle', qdisc)
+                           for qdisc in tree['qdiscs']],
+                'classes': [self._entry(current, last, elapsed, device, 'class', 'classid', cls)
+                            for cls in tree['classes']],
+            }
+        self.previous[interface] = (now, current)
+        return result
+
+    def _entry(self, current, last, elapsed, device, kind, handle_key, entry):
+        stats = entry.get('stats', {})
+        key = (device, kind, entry[handle_key], entry['kind'])
+        current[key] = stats
+        entry = dict(entry, rates=_rates(stats, last.get(key, {}), elapsed))
+        if entry['rates'].get('bytes') is not None and entry.get('ceil'):
+            entry['utilisation'] = entry['rates']['bytes'] * 8 / 1000 / entry['ceil']
+        return entry
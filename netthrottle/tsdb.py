@@ -0,0 +1,241 @@
+"""Persistent traffic history in memory-mapped ring files.
+
+Each series (an interface, or a device and tc class such as ``eth0:1:30``)
+has one file per resolution tier. A file is a small header
+followed by a ring of fixed-width records, each holding the bytes and packets
+counted during one bucket. Disk and memory use are fixed when the file is
+created; the oldest buckets are overwritten once the ring is full.
+
+Writes only need the standard library. Queries return NumPy structured arrays
+that are views of the mapped file.
+"""
+import mmap
+import os
+import struct
+import time
+from urllib.parse import quote
+
+from .paths import state_dir
+
+MAGIC = b'NTTS'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQQQ')
+HEADER_SIZE = 64
+# Bucket start (unix seconds) and the counts seen during the bucket
+RECORD = struct.Struct('<qQQQQ')
+FIELDS = ('time', 'rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets')
+
+# (resolution in seconds, records): two days of seconds, 30 days of
+# minutes and two years of hours, 233,520 records or about 9.3MB per series
+TIERS = ((1, 2 * 86400), (60, 30 * 1440), (3600, 2 * 8760))
+TIER_NAMES = {'1s': 1, '1m': 60, '1h': 3600}
+
+
+def record_dtype():
+    import numpy as np
+
+    return np.dtype([(field, '<i8' if field == 'time' else '<u8') for field in FIELDS])
+
+
+class Ring:
+    """One memory-mapped ring of fixed-width records"""
+
+    def __init__(self, path, resolution, capacity):
+        self.path = path
+        self.resolution = resolution
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, record_size, stored_resolution, stored_capacity, head, count = \
+            HEADER.unpack_from(self.map)
+        self.head = head
+        self.count = count
+        if fresh or (magic, version, record_size, stored_resolution, stored_capacity) != (
+                MAGIC, VERSION, RECORD.size, resolution, capacity):
+            # Unknown or differently shaped file: start over rather than misread it
+            self.head = self.count = 0
+            self.map[:HEADER_SIZE] = bytes(HEADER_SIZE)
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.resolution,
+                         self.capacity, self.head, self.count)
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * RECORD.size
+
+    def last(self):
+        """The newest record as a tuple, or None"""
+        if not self.count:
+            return None
+        return RECORD.unpack_from(self.map, self._offset((self.head - 1) % self.capacity))
+
+    def append(self, record):
+        """Append a record; a record for the newest bucket is merged into it"""
+        last = self.last()
+        if last is not None and record[0] <= last[0]:
+            # Same bucket (or the clock stepped back): add to the newest record
+            merged = (last[0],) + tuple(a + b for a, b in zip(last[1:], record[1:]))
+            RECORD.pack_into(self.map, self._offset((self.head - 1) % self.capacity), *merged)
+            return
+        # The record is written before the header points at it
+        RECORD.pack_into(self.map, self._offset(self.head), *record)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._write_header()
+
+    def _segments(self):
+        """(first index, length) of the filled part of the ring, oldest first"""
+        # Re-read the header so readers see records appended by another process
+        self.head, self.count = HEADER.unpack_from(self.map)[5:]
+        if self.count < self.capacity:
+            return [(0, self.count)]
+        return [(self.head, self.capacity - self.head), (0, self.head)]
+
+    def records(self, start=None, end=None):
+        """Yield record tuples with start <= time < end, oldest first (no NumPy needed)"""
+        for first, length in self._segments():
+            for index in range(first, first + length):
+                record = RECORD.unpack_from(self.map, self._offset(index))
+                if start is not None and record[0] < start:
+                    continue
+                if end is not None and record[0] >= end:
+                    return
+                yield record
+
+    def segments(self, start=None, end=None):
+        """Structured-array views of the records with start <= time < end.
+
+        Returns at most two views (the ring may wrap inside the range), oldest
+        first. They share memory with the file: no records are copied.
+        """
+        import numpy as np
+
+        everything = np.frombuffer(self.map, record_dtype(), self.capacity, HEADER_SIZE)
+        views = []
+        for first, length in self._segments():
+            view = everything[first:first + length]
+            times = view['time']
+            lo = 0 if start is None else np.searchsorted(times, start, 'left')
+            hi = length if end is None else np.searchsorted(times, end, 'left')
+            if hi > lo:
+                views.append(view[lo:hi])
+        return views
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # Query views still reference the mapping; it is unmapped once they are gone
+            pass
+
+
+class Series:
+    """Rolls cumulative counter readings of one series up into every tier"""
+
+    def __init__(self, directory, key, tiers=TIERS):
+        name = quote(key, safe='')
+        self.rings = {resolution: Ring(os.path.join(directory, f'{name}.{resolution}s.ring'),
+                                       resolution, capacity)
+                      for resolution, capacity in tiers}
+        self.last = None
+        # Per tier: [bucket start, rx_bytes, tx_bytes, rx_packets, tx_packets]
+        self.pending = {resolution: None for resolution in self.rings}
+
+    def add(self, timestamp, counters):
+        """Add a cumulative (rx_bytes, tx_bytes, rx_packets, tx_packets) reading"""
+        last, self.last = self.last, counters
+        if last is None:
+            return
+        # A counter that went backwards was reset; count from zero
+        deltas = [value - previous if value >= previous else value
+                  for value, previous in zip(counters, last)]
+        for resolution, ring in self.rings.items():
+            bucket = int(timestamp) // resolution * resolution
+            pending = self.pending[resolution]
+            if pending is not None and bucket > pending[0]:
+                ring.append(pending)
+                pending = None
+            if pending is None:
+                pending = self.pending[resolution] = [bucket, 0, 0, 0, 0]
+            for i, delta in enumerate(deltas, 1):
+                pending[i] += delta
+
+    def flush(self):
+        """Write partially filled buckets; later readings merge into them"""
+        for resolution, pending in self.pending.items():
+            if pending is not None and any(pending[1:]):
+                self.rings[resolution].append(pending)
+                self.pending[resolution] = [pending[0], 0, 0, 0, 0]
+            self.rings[resolution].flush()
+
+    def close(self):
+        self.flush()
+        for ring in self.rings.values():
+            ring.close()
+
+
+class TimeSeriesStore:
+    """Per-series traffic history under ``directory``"""
+
+    def __init__(self, directory=None, tiers=TIERS):
+        self.directory = directory or os.path.join(state_dir(), 'history')
+        os.makedirs(self.directory, exist_ok=True)
+        self.tiers = tiers
+        self.series = {}
+
+    def _series(self, key):
+        if key not in self.series:
+            self.series[key] = Series(self.directory, key, self.tiers)
+        return self.series[key]
+
+    def add(self, key, counters, timestamp=None):
+        """Record cumulative (rx_bytes, tx_bytes, rx_packets, tx_packets) for ``key``"""
+        self._series(key).add(time.time() if timestamp is None else timestamp, counters)
+
+    def ring(self, key, resolution):
+        return self._series(key).rings[resolution]
+
+    def keys(self):
+        """Every series with history on disk"""
+        from urllib.parse import unquote
+
+        suffix = f'.{self.tiers[0][0]}s.ring'
+        return sorted(unquote(name[:-len(suffix)]) for name in os.listdir(self.directory)
+                      if name.endswith(suffix))
+
+    def query(self, key, resolution=1, start=None, end=None):
+        """Records of ``key`` at ``resolution`` with start <= time < end as a NumPy array.
+
+        The result is a view of the mapped file unless the range spans the
+        ring's wrap point, in which case the two halves are joined.
+        """
+        import numpy as np
+
+        views = self.ring(key, resolution).segments(start, end)
+        if len(views) == 1:
+            return views[0]
+        if not views:
+            return np.empty(0, record_dtype())
+        return np.concatenate(views)
+
+    def flush(self):
+        for series in self.series.values():
+            series.flush()
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+        self.series = {}
@@ -0,0 +1,97 @@
+"""Hand-off of updates from worker threads to the Tk main loop.
+
+Workers never touch Tk directly and never schedule their own ``after``
+callbacks. They post into this queue, which the Tk thread drains once per
+frame within a time budget:
+
+* ``post_latest`` coalesces by key, so only the newest value of a stat is
+  ever applied however often it is produced;
+* ``post_batch`` collects items per key and hands the whole batch to one
+  handler call (e.g. one Text insert for many log lines);
+* ``post`` runs one-off callbacks in order.
+
+Posting only appends to a deque or replaces a dict entry, both atomic under
+the GIL, so producers never take a lock or block. Every buffer is bounded;
+when a consumer falls behind the oldest entries are dropped.
+"""
+import time
+from collections import deque
+
+FRAME_MS = 50
+BUDGET_MS = 10
+MAX_EVENTS = 1000
+MAX_BATCH = 1000
+
+
+class UpdateQueue:
+    """Bounded, coalescing queue drained on the Tk thread every frame"""
+
+    def __init__(self, root, frame_ms=FRAME_MS, budget_ms=BUDGET_MS):
+        self.root = root
+        self.frame_ms = frame_ms
+        self.budget = budget_ms / 1000
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.latest = {}
+        self.batches = {}
+        self.handlers = {}
+        self.dropped = 0
+        self.job = None
+
+    def post(self, callback, *args):
+        """Run ``callback(*args)`` on the Tk thread, in posting order"""
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append((callback, args))
+
+    def post_latest(self, key, callback, *args):
+        """Run ``callback(*args)`` on the next frame, replacing anything pending for ``key``"""
+        self.latest[key] = (callback, args)
+
+    def register_batch(self, key, handler, maxlen=MAX_BATCH):
+        """Route items posted under ``key`` to ``handler(items)``, once per frame"""
+        self.handlers[key] = handler
+        self.batches[key] = deque(maxlen=maxlen)
+
+    def post_batch(self, key, item):
+        self.batches[key].append(item)
+
+    def start(self):
+        if self.job is None:
+            self.job = self.root.after(self.frame_ms, self.drain)
+
+    def stop(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+
+    def drain(self):
+        """Apply pending updates, stopping early once the frame budget is spent"""
+        deadline = time.perf_counter() + self.budget
+        try:
+            # popitem() is atomic, so a producer replacing an entry meanwhile is
+            # never lost; bounded so constant posting cannot hold the frame
+            for _ in range(len(self.latest)):
+                try:
+                    _, (callback, args) = self.latest.popitem()
+                except KeyError:
+                    break
+                self._run(callback, args)
+
+            for key, batch in self.batches.items():
+                # Only what is queued now; items posted meanwhile wait a frame
+                items = [batch.popleft() for _ in range(len(batch))]
+                if items:
+                    self._run(self.handlers[key], (items,))
+
+            while self.events and time.perf_counter() < deadline:
+                callback, args = self.events.popleft()
+                self._run(callback, args)
+        finally:
+            self.job = self.root.after(self.frame_ms, self.drain)
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            # One bad update must not stop the pipeline
+            print(f"UI update failed: {e}")
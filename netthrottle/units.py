@@ -0,0 +1,111 @@
+"""Speed parsing and formatting shared by the GUI, daemon and CLI"""
+import re
+
+# Speed units accepted on the command line, as multiples of kbit/s
+SPEED_UNITS = {
+    '': 1, 'k': 1, 'kbit': 1, 'kbps': 1,
+    'm': 1000, 'mbit': 1000, 'mbps': 1000,
+    'g': 1000000, 'gbit': 1000000, 'gbps': 1000000,
+}
+
+
+def convert_to_kbps(value, unit):
+    """Convert speed value to kbps"""
+    try:
+        value = float(value)
+        if unit == "mbps":
+            return int(value * 1000)
+        return int(value)
+    except ValueError:
+        return None
+
+
+# Duration suffixes accepted on the command line, in seconds
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_duration(text):
+    """Parse "90", "15m", "2h" or "7d" into seconds"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]?)\s*', str(text))
+    if not match or match.group(2).lower() not in DURATION_UNITS:
+        raise ValueError(f"Invalid duration: {text}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2).lower()]
+
+
+# Data sizes accepted on the command line, in bytes; carriers count in powers of 1000
+SIZE_UNITS = {
+    '': 1, 'b': 1,
+    'k': 10**3, 'kb': 10**3, 'kib': 2**10,
+    'm': 10**6, 'mb': 10**6, 'mib': 2**20,
+    'g': 10**9, 'gb': 10**9, 'gib': 2**30,
+    't': 10**12, 'tb': 10**12, 'tib': 2**40,
+}
+
+
+def parse_size(text):
+    """Parse "50GB", "500MiB" or a bare number of bytes into bytes"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', str(text))
+    if not match or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def format_bytes(count):
+    """Human readable byte count in powers of 1000, as carriers bill"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1000:
+            return f"{count:.0f} {unit}" if unit == 'B' else f"{count:.1f} {unit}"
+        count /= 1000
+    return f"{count:.1f} TB"
+
+
+def parse_speed(text):
+    """Parse "50mbit", "500kbit" or a bare number of kbit into kbit/s"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', str(text))
+    if not match or match.group(2).lower() not in SPEED_UNITS:
+        raise ValueError(f"Invalid speed: {text}")
+    return int(float(match.group(1)) * SPEED_UNITS[match.group(2).lower()])
+
+
+def format_speed(speed_kbs):
+    """Format a KB/s value the way the UI shows it"""
+    if speed_kbs > 1024:
+        return f"{speed_kbs/1024:.1f} MB/s"
+    else:
+        return f"{speed_kbs:.1f} KB/s"
+
+
+def format_limit(kbps):
+    """Human readable form of a policy limit"""
+    if not kbps:
+        return "No limit"
+    if kbps % 1000 == 0:
+        return f"{kbps // 1000} mbps"
+    return f"{kbps} kbps"
+
+
+def format_queue(stats):
+    """Backlog and drops of a shaping queue (see ThrottleCore.queue_stats)"""
+    if not stats:
+        return "Not shaped"
+    return (f"backlog {stats.get('backlog', 0) / 1024:.1f} KB ({stats.get('qlen', 0)} pkts), "
+            f"{stats.get('drops', 0):,} drops")
+
+
+def format_tc_entry(kind, handle, entry):
+    """One line of rates and gauges of a qdisc or class from TcStats"""
+    stats, rates = entry.get('stats', {}), entry['rates']
+    line = f"{kind} {entry['kind']} {handle}:"
+    if rates.get('bytes') is not None:
+        line += f" {rates['bytes'] * 8 / 1000:.0f} kbit/s, {rates.get('packets') or 0:.0f} pkt/s"
+    if entry.get('ceil'):
+        line += f" of {format_limit(entry['ceil'])}"
+        if 'utilisation' in entry:
+            line += f" ({entry['utilisation'] * 100:.0f}%)"
+    for key in ('drops', 'overlimits'):
+        if rates.get(key):
+            line += f", {rates[key]:.0f} {key}/s"
+    line += f", {format_queue(stats)}"
+    if 'tokens' in stats:
+        line += f", tokens {stats['tokens']}"
+    return line
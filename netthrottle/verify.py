@@ -0,0 +1,474 @@
+"""Check that a policy holds its rate, and measure the latency it adds under load.
+
+``verify`` builds a throwaway test bed: two network namespaces joined by a
+veth pair, the shaped end ``ntv0`` and its peer ``ntv1``. It installs the
+limits on ``ntv0`` through ThrottleCore exactly as ``set`` would, then for
+every limited direction:
+
+- saturates it with parallel TCP flows (or paced UDP at 120% of the limit)
+  from an asyncio loop, without the limit first when ``baseline`` is set, so
+  a rig too slow to reach the target is reported as such rather than passed
+- probes the round-trip time every 10 ms over UDP, idle and under load
+
+Goodput is the payload delivered to the receiving sockets over the
+measurement window, after a warm-up. The achieved rate adds the headers of
+every frame that carried it (Ethernet, IP, and TCP with its options or UDP),
+which is how tc counts a limit. The veth's own byte counters would not do:
+they see one header per TSO super-packet, where the shaper charges one per
+segment, and would report a shaper exactly on its rate as 4% under.
+
+Download is what leaves the interface and upload what arrives on it, as in
+the rest of NetThrottle. Needs root and Linux; nothing outside the two
+namespaces is touched, and both are deleted afterwards.
+"""
+import asyncio
+import os
+import socket
+import struct
+import subprocess
+import time
+
+SHAPED = 'ntv0'
+PEER = 'ntv1'
+SHAPED_ADDRESS = '198.18.0.1'
+PEER_ADDRESS = '198.18.0.2'
+TCP_PORT = 5201
+UDP_PORT = 5202
+ECHO_PORT = 5203
+
+DEFAULT_DURATION = 10.0
+DEFAULT_WARMUP = 2.0
+DEFAULT_FLOWS = 4
+DEFAULT_TOLERANCE = 0.05
+PROBE_INTERVAL = 0.01
+# Replies to probes sent in the window are waited for this long at most;
+# a bloated queue can hold them for over a second
+PROBE_GRACE = 3.0
+# Size of the file the TCP senders sendfile() from, again and again
+SEND_FILE_SIZE = 4 * 1024 * 1024
+# UDP payload filling a 1500-byte frame, and the Ethernet, IPv4 and UDP headers around it
+DATAGRAM = 1472
+ETHERNET_HEADER = 14
+FRAME_OVERHEAD = ETHERNET_HEADER + 28
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+# Received data is discarded in the kernel, so this only bounds one read
+DRAIN_SIZE = 1024 * 1024
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+# UDP sends at this multiple of the limit, so the shaper always has a backlog
+UDP_OVERLOAD = 1.2
+UDP_TICK = 0.001
+PROBE = struct.Struct('!Qq')
+
+
+class VerifyError(Exception):
+    pass
+
+
+class Namespace:
+    """Switches the calling thread into a network namespace, and back on exit.
+
+    Sockets keep the namespace they were created in, so one event loop can
+    drive sockets of both ends once they exist.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+        with open(f'/run/netns/{self.name}') as f:
+            os.setns(f.fileno(), os.CLONE_NEWNET)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            os.setns(self.previous, os.CLONE_NEWNET)
+        finally:
+            os.close(self.previous)
+
+
+def sh(*args):
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise VerifyError(f"{' '.join(args)}: {result.stderr.strip()}")
+    return result.stdout
+
+
+def create_testbed(name):
+    """Namespaces ``name`` (shaped end) and ``name``-peer joined by SHAPED/PEER"""
+    peer = f'{name}-peer'
+    sh('ip', 'netns', 'add', name)
+    sh('ip', 'netns', 'add', peer)
+    sh('ip', '-n', name, 'link', 'add', SHAPED, 'type', 'veth', 'peer', 'name', PEER,
+       'netns', peer)
+    for namespace, device, address in ((name, SHAPED, SHAPED_ADDRESS), (peer, PEER, PEER_ADDRESS)):
+        sh('ip', '-n', namespace, 'addr', 'add', f'{address}/30', 'dev', device)
+        sh('ip', '-n', namespace, 'link', 'set', 'lo', 'up')
+        sh('ip', '-n', namespace, 'link', 'set', device, 'up')
+    return peer
+
+
+def delete_testbed(name):
+    for namespace in (name, f'{name}-peer'):
+        subprocess.run(['ip', 'netns', 'del', namespace], capture_output=True)
+
+
+class Counter:
+    """Bytes and packets read from the sockets of one direction"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.packets = 0
+        self.sent_packets = 0
+        # Payload per full TCP segment and the header bytes framing it
+        self.mss = None
+        self.overhead = FRAME_OVERHEAD
+
+    def frame_bytes(self, payload, packets):
+        """Bytes of the frames that carried ``payload`` (in ``packets`` datagrams for UDP)"""
+        if self.mss:
+            packets = -(-payload // self.mss)
+        return payload + packets * self.overhead
+
+
+def drain(sock, counter, buffer=bytearray(DRAIN_SIZE)):
+    """Read everything queued on ``sock`` without copying it; False on EOF"""
+    while True:
+        try:
+            # MSG_TRUNC discards the data in the kernel and returns its length
+            size = sock.recv_into(buffer, DRAIN_SIZE, socket.MSG_TRUNC | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        if size == 0 and sock.type == socket.SOCK_STREAM:
+            return False
+        counter.bytes += size
+        counter.packets += 1
+
+
+def watch(loop, sock, counter):
+    def readable():
+        if not drain(sock, counter):
+            loop.remove_reader(sock.fileno())
+
+    loop.add_reader(sock.fileno(), readable)
+
+
+class Prober(asyncio.DatagramProtocol):
+    """Sends timestamped probes to the echo port and records their round trips"""
+
+    def __init__(self):
+        self.transport = None
+        self.sent = {}
+        self.rtts = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        sequence, sent = PROBE.unpack_from(data)
+        if sequence in self.sent:
+            self.rtts[sequence] = (time.monotonic_ns() - sent) / 1e6
+
+    async def run(self, stop):
+        sequence = 0
+        while not stop.is_set():
+            self.sent[sequence] = time.monotonic()
+            self.transport.sendto(PROBE.pack(sequence, time.monotonic_ns()))
+            sequence += 1
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    async def settle(self, start, end):
+        """Wait up to PROBE_GRACE for replies to the probes sent in the window"""
+        deadline = time.monotonic() + PROBE_GRACE
+        while time.monotonic() < deadline and any(
+                start <= at < end and sequence not in self.rtts
+                for sequence, at in self.sent.items()):
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    def window(self, start, end):
+        """RTT summary (ms) of the probes sent between ``start`` and ``end``"""
+        from .sampler import summarize
+
+        sent = [sequence for sequence, at in self.sent.items() if start <= at < end]
+        rtts = [self.rtts[sequence] for sequence in sent if sequence in self.rtts]
+        summary = summarize(rtts)
+        summary['lost'] = len(sent) - len(rtts)
+        return {key: round(value, 3) if isinstance(value, float) else value
+                for key, value in summary.items()}
+
+
+class Echo(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.transport.sendto(data, address)
+
+
+class Testbed:
+    """Sockets of both ends, created in their namespaces, and the flows between them"""
+
+    def __init__(self, name, peer, flows, protocol):
+        self.name = name
+        self.peer = peer
+        self.flows = flows
+        self.protocol = protocol
+        self.send_file = None
+
+    def sockets(self, namespace, kind, count):
+        with Namespace(namespace):
+            sockets = [socket.socket(socket.AF_INET, kind) for _ in range(count)]
+        for sock in sockets:
+            sock.setblocking(False)
+        return sockets
+
+    def open_send_file(self):
+        fd = os.memfd_create('netthrottle-verify')
+        os.ftruncate(fd, SEND_FILE_SIZE)
+        self.send_file = os.fdopen(fd, 'rb')
+
+    def close(self):
+        if self.send_file:
+            self.send_file.close()
+
+    def ends(self, direction):
+        """(sending namespace, receiving namespace, receiving address) of ``direction``"""
+        if direction == 'download':
+            return self.name, self.peer, PEER_ADDRESS
+        return self.peer, self.name, SHAPED_ADDRESS
+
+    async def tcp(self, direction, counter, stop):
+        """Saturate ``direction`` with TCP flows until ``stop`` is set"""
+        loop = asyncio.get_running_loop()
+        sender, receiver, address = self.ends(direction)
+        listener, = self.sockets(receiver, socket.SOCK_STREAM, 1)
+        clients = self.sockets(sender, socket.SOCK_STREAM, self.flows)
+        accepted = []
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((address, TCP_PORT))
+            listener.listen(self.flows)
+            for client in clients:
+                await loop.sock_connect(client, (address, TCP_PORT))
+                conn, _ = await loop.sock_accept(listener)
+                conn.setblocking(False)
+                accepted.append(conn)
+                if counter.mss is None:
+                    counter.mss = conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG)
+                    mtu = conn.getsockopt(socket.IPPROTO_IP, IP_MTU)
+                    counter.overhead = mtu - counter.mss + ETHERNET_HEADER
+                watch(loop, conn, counter)
+            senders = [asyncio.create_task(self.send_tcp(client)) for client in clients]
+            await stop.wait()
+            for task in senders:
+                task.cancel()
+            await asyncio.gather(*senders, return_exceptions=True)
+        finally:
+            for sock in accepted:
+                loop.remove_reader(sock.fileno())
+            for sock in [listener, *clients, *accepted]:
+                sock.close()
+
+    async def send_tcp(self, sock):
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.sock_sendfile(sock, self.send_file, 0, SEND_FILE_SIZE)
+
+    async def udp(self, direction, counter, stop, rate_kbps):
+        """Send datagrams over ``direction`` at UDP_OVERLOAD x ``rate_kbps``, or flat out"""
+        loop = asyncio.get_running_loop()
+        sender, receiver, address = self.ends(direction)
+        sink, = self.sockets(receiver, socket.SOCK_DGRAM, 1)
+        clients = self.sockets(sender, socket.SOCK_DGRAM, self.flows)
+        payload = bytes(DATAGRAM)
+        try:
+            sink.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, 4 * 1024 * 1024)
+            sink.bind((address, UDP_PORT))
+            watch(loop, sink, counter)
+            for client in clients:
+                client.connect((address, UDP_PORT))
+            # Packets per second; what is owed accrues with the time actually
+            # slept, carrying fractions over, so the average rate is exact
+            per_second = rate_kbps * 1000 * UDP_OVERLOAD / 8 / (DATAGRAM + FRAME_OVERHEAD) \
+                if rate_kbps else None
+            credit, last = 0.0, time.monotonic()
+            while not stop.is_set():
+                if per_second is None:
+                    burst = 64 * len(clients)
+                else:
+                    now = time.monotonic()
+                    credit += per_second * (now - last)
+                    last = now
+                    burst, credit = int(credit), credit - int(credit)
+                for index in range(burst):
+                    try:
+                        clients[index % len(clients)].send(payload)
+                        counter.sent_packets += 1
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        # ENOBUFS from a full qdisc: the packet is lost
+                        counter.sent_packets += 1
+                await asyncio.sleep(UDP_TICK if per_second is not None else 0)
+            # Let the last datagrams in flight arrive
+            await asyncio.sleep(0.2)
+        finally:
+            loop.remove_reader(sink.fileno())
+            for sock in [sink, *clients]:
+                sock.close()
+
+
+async def measure(bed, prober, direction, rate_kbps, warmup, duration):
+    """Load ``direction`` and measure rate and RTT over ``duration`` after ``warmup``"""
+    counter = Counter()
+    stop = asyncio.Event()
+    if bed.protocol == 'udp':
+        load = asyncio.create_task(bed.udp(direction, counter, stop, rate_kbps))
+    else:
+        load = asyncio.create_task(bed.tcp(direction, counter, stop))
+    try:
+        await asyncio.sleep(warmup)
+        started, received, packets = time.monotonic(), counter.bytes, counter.packets
+        await asyncio.sleep(duration)
+        ended, received, packets = (time.monotonic(), counter.bytes - received,
+                                    counter.packets - packets)
+    finally:
+        stop.set()
+        await load
+    await prober.settle(started, ended)
+    elapsed = ended - started
+    result = {
+        'goodput_kbps': round(received * 8 / 1000 / elapsed),
+        'wire_kbps': round(counter.frame_bytes(received, packets) * 8 / 1000 / elapsed),
+        'rtt_ms': prober.window(started, ended),
+    }
+    if bed.protocol == 'udp':
+        lost = counter.sent_packets - counter.packets
+        result['loss'] = round(lost / counter.sent_packets, 4) if counter.sent_packets else None
+    return result
+
+
+def verdict(result, target_kbps, tolerance):
+    """'ok', 'under', 'over', or 'rig-limited' when even the unshaped rig was slower"""
+    baseline = result.get('baseline')
+    if baseline and baseline['wire_kbps'] < target_kbps * (1 + tolerance):
+        return 'rig-limited'
+    accuracy = result['accuracy']
+    if accuracy < 1 - tolerance:
+        return 'under'
+    if accuracy > 1 + tolerance:
+        return 'over'
+    return 'ok'
+
+
+async def run_checks(core, bed, policy, duration, warmup, baseline, tolerance):
+    loop = asyncio.get_running_loop()
+    directions = [(direction, getattr(policy, f'{direction}_kbps'))
+                  for direction in ('download', 'upload') if getattr(policy, f'{direction}_kbps')]
+    echo_sock, = bed.sockets(bed.peer, socket.SOCK_DGRAM, 1)
+    echo_sock.bind((PEER_ADDRESS, ECHO_PORT))
+    echo, _ = await loop.create_datagram_endpoint(Echo, sock=echo_sock)
+    probe_sock, = bed.sockets(bed.name, socket.SOCK_DGRAM, 1)
+    probe_sock.connect((PEER_ADDRESS, ECHO_PORT))
+    _, prober = await loop.create_datagram_endpoint(Prober, sock=probe_sock)
+    stop_probing = asyncio.Event()
+    probing = asyncio.create_task(prober.run(stop_probing))
+    report = {'directions': {}}
+    try:
+        results = {direction: {'target_kbps': rate} for direction, rate in directions}
+        if baseline:
+            for direction, _ in directions:
+                results[direction]['baseline'] = await measure(
+                    bed, prober, direction, None, warmup, max(duration / 2, 1.0))
+
+        # Let the RTT settle, then take the idle baseline
+        await asyncio.sleep(0.5)
+        started = time.monotonic()
+        await asyncio.sleep(min(duration, 3.0))
+        ended = time.monotonic()
+        await prober.settle(started, ended)
+        report['idle_rtt_ms'] = prober.window(started, ended)
+
+        try:
+            core.set_limits(SHAPED, policy.download_kbps or 0, policy.upload_kbps or 0,
+                            queue=policy.queue, ingress_mode=policy.ingress_mode)
+        except Exception as e:
+            raise VerifyError(f"Could not apply the policy: {e}") from e
+        for direction, rate in directions:
+            result = results[direction]
+            result.update(await measure(bed, prober, direction, rate, warmup, duration))
+            result['accuracy'] = round(result['wire_kbps'] / rate, 4)
+            idle = report['idle_rtt_ms'].get('p50')
+            loaded = result['rtt_ms'].get('p50')
+            result['added_latency_ms'] = round(loaded - idle, 3) if idle is not None and \
+                loaded is not None else None
+            result['verdict'] = verdict(result, rate, tolerance)
+            report['directions'][direction] = result
+    finally:
+        stop_probing.set()
+        await probing
+        prober.transport.close()
+        echo.close()
+    return report
+
+
+def verify(download_kbps=None, upload_kbps=None, queue=None, ingress_mode=None, duration=DEFAULT_DURATION,
+           warmup=DEFAULT_WARMUP, flows=DEFAULT_FLOWS, protocol='tcp', baseline=True,
+           tolerance=DEFAULT_TOLERANCE, backend=None):
+    """Apply the limits in a test bed and measure them; returns the report as a dict.
+
+    Every direction in the report has its ``target_kbps``, the achieved
+    ``wire_kbps`` and ``goodput_kbps``, ``accuracy`` (achieved / target),
+    ``rtt_ms`` under load, ``added_latency_ms`` over the idle RTT, the
+    unshaped ``baseline`` when measured, and a ``verdict``.
+    """
+    from .backends import get_backend
+    from .core import ThrottleCore
+    from .policy import FIFO, IFB, InterfacePolicy
+
+    if not hasattr(os, 'setns') or not os.path.isdir('/proc/thread-self/ns'):
+        raise VerifyError("Verification needs Linux network namespaces")
+    if os.geteuid() != 0:
+        raise VerifyError("Verification needs root: it creates network namespaces")
+    if not download_kbps and not upload_kbps:
+        raise VerifyError("Nothing to verify: no download or upload limit")
+    if protocol not in ('tcp', 'udp'):
+        raise VerifyError(f"Unknown protocol {protocol!r}, expected tcp or udp")
+
+    policy = InterfacePolicy(SHAPED, download_kbps=download_kbps or None,
+                             upload_kbps=upload_kbps or None, queue=queue or FIFO,
+                             ingress_mode=ingress_mode or IFB)
+    name = f'ntverify-{os.getpid()}'
+    peer = create_testbed(name)
+    bed = Testbed(name, peer, flows, protocol)
+    core = None
+    try:
+        bed.open_send_file()
+        with Namespace(name):
+            # The backend talks to the kernel of the namespace it was created in
+            core = ThrottleCore(backend=get_backend(backend), journal=False)
+            if core.backend is None or core.backend.name == 'simulated':
+                raise VerifyError("Verification needs a backend that shapes in the kernel")
+            started = time.time()
+            report = asyncio.run(run_checks(core, bed, policy, duration, warmup, baseline,
+                                            tolerance))
+        report.update({
+            'policy': {'download_kbps': policy.download_kbps, 'upload_kbps': policy.upload_kbps,
+                       'queue': policy.queue, 'ingress_mode': policy.ingress_mode},
+            'backend': core.backend.name,
+            'protocol': protocol,
+            'flows': flows,
+            'duration': duration,
+            'warmup': warmup,
+            'tolerance': tolerance,
+            'started': started,
+        })
+        return report
+    finally:
+        if core:
+            core.close()
+        bed.close()
+        delete_testbed(name)
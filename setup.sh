@@ -39,6 +39,27 @@ if ! grep -q "ifb" /etc/modules 2>/dev/null; then
     echo "ifb" | sudo tee -a /etc/modules
 fi
 
+# Re-apply the limits in force before a reboot
+if command -v systemctl &> /dev/null && [ -d /etc/systemd/system ]; then
+    echo "Installing the boot-time restore service..."
+    UNIT=/etc/systemd/system/netthrottle-restore.service
+    sudo cp netthrottle-restore.service "$UNIT"
+    if ! command -v netthrottle &> /dev/null; then
+        # Not installed as a package: run the module from this directory
+        sudo sed -i "s|^ExecStart=.*|WorkingDirectory=$PWD\nExecStart=$(command -v python3) -m netthrottle restore|" "$UNIT"
+    else
+        sudo sed -i "s|^ExecStart=.*|ExecStart=$(command -v netthrottle) restore|" "$UNIT"
+    fi
+    if [ "$(id -u)" -ne 0 ]; then
+        # The GUI run as this user (tc through sudo) journals here; restore it too
+        USER_STATE="${NETTHROTTLE_STATE_DIR:-${XDG_STATE_HOME:-$HOME/.local/state}/netthrottle}"
+        sudo sed -i -e "s#^\(ExecStart=.*\) restore\$#\1 restore --state-dir /var/lib/netthrottle --state-dir $USER_STATE#" \
+                    -e "s#^ConditionPathExists=.*#&\nConditionPathExists=|$USER_STATE/policies.json\nRequiresMountsFor=$USER_STATE#" "$UNIT"
+    fi
+    sudo systemctl daemon-reload
+    sudo systemctl enable netthrottle-restore.service
+fi
+
 echo "Setup complete!"
 echo ""
 echo "Usage:"
@@ -0,0 +1,46 @@
+import os
+
+from netthrottle import procnet
+from netthrottle.procnet import SocketOwners
+
+
+def make_process(proc, pid, sockets):
+    fd_dir = proc / str(pid) / 'fd'
+    fd_dir.mkdir(parents=True)
+    (proc / str(pid) / 'comm').write_text('server\n')
+    (proc / str(pid) / 'cgroup').write_text('0::/system.slice/server.service\n')
+    for fd, inode in sockets.items():
+        os.symlink(f'socket:[{inode}]', fd_dir / str(fd))
+    return fd_dir
+
+
+def test_socket_reusing_a_closed_fd_is_resolved(tmp_path):
+    fd_dir = make_process(tmp_path, 100, {3: 1001, 4: 1002})
+    owners = SocketOwners(str(tmp_path))
+    owners.resolve({1001, 1002})
+    assert owners.owner == {1001: 100, 1002: 100}
+
+    # Close one connection and accept another on the same fd: the fd count is unchanged
+    count = os.stat(fd_dir).st_size
+    os.unlink(fd_dir / '4')
+    os.symlink('socket:[1003]', fd_dir / '4')
+    assert os.stat(fd_dir).st_size == count
+
+    owners.resolve({1001, 1003})
+    assert owners.owner == {1001: 100, 1003: 100}
+    assert owners.process(100) == ('server', '/system.slice/server.service')
+
+
+def test_full_scans_are_throttled(tmp_path, monkeypatch):
+    make_process(tmp_path, 100, {3: 1001})
+    owners = SocketOwners(str(tmp_path))
+    owners.resolve({1001, 9999})
+    scans = owners.scans
+
+    # An inode no process owns must not rescan /proc on every tick
+    owners.resolve({1001, 9999})
+    assert owners.scans == scans
+
+    monkeypatch.setattr(procnet, 'FULL_RESCAN_SECONDS', 0.0)
+    owners.resolve({1001, 9999})
+    assert owners.scans == scans + 1